@@ -0,0 +1,289 @@
+# aggregation.py
+import argparse
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import case, delete, event, func, inspect, insert, literal, select
+from sqlalchemy.orm import Session
+
+from database import (
+    SessionLocal, Activity, AggregatedAttendance, Attendance, AttendanceEvent, AttendanceRollup, CalendarEvent, Group,
+    activity_group_association, upsert_rows,
+)
+from cache import attendance_event_cache
+
+PERSON = "person"
+ACTIVITY = "activity"
+GROUP = "group"
+PERIOD = "period"
+
+ALL_TIME = ""
+PERIOD_ALL = "all" # scope_id för periodsummor över samtliga närvaroposter
+
+# Närvarohändelser som räknas som närvaro; övriga räknas som frånvaro
+PRESENT_EVENT_NAMES = ("Närvarande", "Sen ankomst")
+
+TRACKED_ATTRIBUTES = ("person_id", "activity_id", "attendance_event_id", "calendar_event_id", "created")
+
+# (tecken, person_id, activity_id, attendance_event_id, calendar_event_id, created)
+AttendanceDelta = Tuple[int, Optional[str], Optional[str], Optional[str], Optional[str], Optional[datetime]]
+
+
+def period_of(when: Optional[datetime]) -> str:
+    return (when or datetime.utcnow()).strftime("%Y-%m")
+
+def lesson_starts(conn, calendar_event_ids: Iterable[str]) -> Dict[str, datetime]:
+    """Lektionstillfällenas starttider. Genererade förekomster finns inte i tabellen och saknas i svaret."""
+    ids = {id for id in calendar_event_ids if id}
+    if not ids:
+        return {}
+    table = CalendarEvent.__table__
+    return dict(conn.execute(select(table.c.id, table.c.start_time).where(table.c.id.in_(ids))).all())
+
+def attendance_percentage(present_count: int, total_count: int) -> Optional[float]:
+    if not total_count:
+        return None
+    return round(100.0 * present_count / total_count, 1)
+
+def is_present(db: Session, attendance_event_id: Optional[str]) -> bool:
+    if attendance_event_id is None:
+        return False
+    attendance_event = attendance_event_cache.get(db, attendance_event_id)
+    return attendance_event is not None and attendance_event.name in PRESENT_EVENT_NAMES
+
+def _scope_keys(person_id, activity_id, group_ids, period):
+    keys = [(PERIOD, PERIOD_ALL, period)]
+    scopes = [(PERSON, person_id), (ACTIVITY, activity_id)] + [(GROUP, group_id) for group_id in group_ids]
+    for scope_type, scope_id in scopes:
+        if scope_id is not None:
+            keys.append((scope_type, scope_id, ALL_TIME))
+            keys.append((scope_type, scope_id, period))
+    return keys
+
+def refresh_aggregated_attendance(conn, person_ids: Optional[Iterable[str]] = None) -> int:
+    """
+    Räknar om aggregatedAttendance från personernas totalsummor, eller för alla om person_ids är None.
+    Personer utan närvaroposter tas bort ur tabellen.
+    """
+    rollups = AttendanceRollup.__table__
+    aggregated = AggregatedAttendance.__table__
+
+    query = select(rollups.c.scope_id, rollups.c.present_count, rollups.c.total_count).where(
+        rollups.c.scope_type == PERSON, rollups.c.period == ALL_TIME,
+    )
+    if person_ids is not None:
+        person_ids = set(person_ids)
+        if not person_ids:
+            return 0
+        query = query.where(rollups.c.scope_id.in_(person_ids))
+
+    now = datetime.utcnow()
+    rows = [
+        {"id": str(uuid.uuid4()), "person_id": row.scope_id, "created": now, "modified": now,
+         "attendance_percentage": attendance_percentage(row.present_count, row.total_count)}
+        for row in conn.execute(query) if row.total_count > 0
+    ]
+    upsert_rows(conn, aggregated, rows, ("person_id",), update=("attendance_percentage", "modified"))
+
+    remaining = select(rollups.c.scope_id).where(
+        rollups.c.scope_type == PERSON, rollups.c.period == ALL_TIME, rollups.c.total_count > 0,
+    )
+    stale = delete(aggregated).where(aggregated.c.person_id.not_in(remaining))
+    if person_ids is not None:
+        stale = stale.where(aggregated.c.person_id.in_(person_ids))
+    conn.execute(stale)
+    return len(rows)
+
+def apply_attendance_deltas(db: Session, deltas: List[AttendanceDelta]) -> int:
+    """
+    Uppdaterar summorna med ändringarna i deltas, i sessionens transaktion. Varje post bidrar
+    till personens, aktivitetens och aktivitetens gruppers summor, både totalt och för månaden.
+    """
+    if not deltas:
+        return 0
+    conn = db.connection()
+
+    activity_ids = {activity_id for _, _, activity_id, _, _, _ in deltas if activity_id}
+    groups = defaultdict(list)
+    if activity_ids:
+        for activity_id, group_id in conn.execute(
+            select(activity_group_association.c.activity_id, activity_group_association.c.group_id)
+            .where(activity_group_association.c.activity_id.in_(activity_ids))
+        ):
+            groups[activity_id].append(group_id)
+
+    # Månaden är lektionens, eller registreringens när posten saknar lektionstillfälle
+    starts = lesson_starts(conn, (calendar_event_id for _, _, _, _, calendar_event_id, _ in deltas))
+    counts = defaultdict(lambda: [0, 0])
+    for sign, person_id, activity_id, attendance_event_id, calendar_event_id, created in deltas:
+        present = sign if is_present(db, attendance_event_id) else 0
+        period = period_of(starts.get(calendar_event_id) or created)
+        for key in _scope_keys(person_id, activity_id, groups.get(activity_id, ()), period):
+            counts[key][0] += present
+            counts[key][1] += sign
+
+    now = datetime.utcnow()
+    rows = [
+        {"scope_type": scope_type, "scope_id": scope_id, "period": period,
+         "present_count": present, "total_count": total, "modified": now}
+        for (scope_type, scope_id, period), (present, total) in counts.items()
+        if present or total
+    ]
+    upsert_rows(conn, AttendanceRollup.__table__, rows, ("scope_type", "scope_id", "period"),
+                increment=("present_count", "total_count"), update=("modified",))
+    if any(delta[0] < 0 for delta in deltas):
+        # Summor som blivit tomma tas bort så att resultatet motsvarar en fullständig ombyggnad
+        rollups = AttendanceRollup.__table__
+        conn.execute(delete(rollups).where(
+            rollups.c.total_count <= 0, rollups.c.scope_id.in_({scope_id for _, scope_id, _ in counts}),
+        ))
+    refresh_aggregated_attendance(conn, {delta[1] for delta in deltas if delta[1]})
+    return len(rows)
+
+def _collect_deltas(session: Session) -> List[AttendanceDelta]:
+    """Samlar ihop de närvaroposter som lagts till, tagits bort eller ändrats i den aktuella flushen."""
+    deltas = []
+    for obj in session.new:
+        if isinstance(obj, Attendance):
+            deltas.append((1,) + tuple(getattr(obj, name) for name in TRACKED_ATTRIBUTES))
+    for obj in session.deleted:
+        if isinstance(obj, Attendance):
+            deltas.append((-1,) + tuple(getattr(obj, name) for name in TRACKED_ATTRIBUTES))
+    for obj in session.dirty:
+        if not isinstance(obj, Attendance):
+            continue
+        attrs = inspect(obj).attrs
+        if not any(attrs[name].history.has_changes() for name in TRACKED_ATTRIBUTES):
+            continue
+        old = tuple(attrs[name].history.deleted[0] if attrs[name].history.deleted else getattr(obj, name) for name in TRACKED_ATTRIBUTES)
+        deltas.append((-1,) + old)
+        deltas.append((1,) + tuple(getattr(obj, name) for name in TRACKED_ATTRIBUTES))
+    return deltas
+
+def _changed_groups(session: Session) -> Set[str]:
+    """Grupper vars koppling till en aktivitet lagts till eller tagits bort i den aktuella flushen."""
+    group_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Activity):
+            history = inspect(obj).attrs.groups.history
+            groups = history.sum() if obj in session.deleted else history.added + history.deleted
+            group_ids.update(group.id for group in groups)
+        elif isinstance(obj, Group) and (obj in session.deleted or inspect(obj).attrs.activities.history.has_changes()):
+            group_ids.add(obj.id)
+    return group_ids
+
+@event.listens_for(SessionLocal, "after_flush")
+def _maintain_rollups(session, flush_context):
+    apply_attendance_deltas(session, _collect_deltas(session))
+    group_ids = _changed_groups(session)
+    if group_ids:
+        rebuild_group_rollups(session.connection(), group_ids)
+
+def _month_expression(dialect_name: str, column):
+    if dialect_name == "mysql":
+        return func.date_format(column, "%Y-%m")
+    if dialect_name == "sqlite":
+        return func.strftime("%Y-%m", column)
+    return func.to_char(column, "YYYY-MM")
+
+class _RollupQueries:
+    """Grupperade SELECT-satser som ger summorna direkt från närvaroposterna."""
+
+    def __init__(self, dialect_name: str):
+        self.rollups = AttendanceRollup.__table__
+        self.columns = [self.rollups.c.scope_type, self.rollups.c.scope_id, self.rollups.c.period,
+                        self.rollups.c.present_count, self.rollups.c.total_count, self.rollups.c.modified]
+        # Lektionens månad, eller registreringens när posten saknar lektionstillfälle, som i apply_attendance_deltas
+        self.month = _month_expression(dialect_name, func.coalesce(CalendarEvent.start_time, Attendance.created))
+        self.present = func.coalesce(func.sum(case((AttendanceEvent.name.in_(PRESENT_EVENT_NAMES), 1), else_=0)), 0)
+        self.attendance = (
+            Attendance.__table__
+            .outerjoin(AttendanceEvent.__table__, AttendanceEvent.id == Attendance.attendance_event_id)
+            .outerjoin(CalendarEvent.__table__, CalendarEvent.id == Attendance.calendar_event_id)
+        )
+        self.with_groups = self.attendance.join(
+            activity_group_association, activity_group_association.c.activity_id == Attendance.activity_id)
+        self.now = datetime.utcnow()
+
+    def grouped(self, scope_type, scope_id, source, by_month):
+        period = self.month if by_month else literal(ALL_TIME)
+        group_by = [scope_id, self.month] if by_month else [scope_id]
+        return select(literal(scope_type), scope_id, period, self.present, func.count(), literal(self.now)).select_from(
+            source
+        ).where(scope_id.is_not(None)).group_by(*group_by)
+
+    def groups(self, by_month, group_ids=None):
+        query = self.grouped(GROUP, activity_group_association.c.group_id, self.with_groups, by_month)
+        if group_ids is not None:
+            query = query.where(activity_group_association.c.group_id.in_(group_ids))
+        return query
+
+    def insert(self, conn, query):
+        conn.execute(insert(self.rollups).from_select(self.columns, query))
+
+def rebuild_rollups(conn) -> int:
+    """
+    Bygger om alla summor från grunden med grupperade INSERT ... SELECT och räknar sedan om
+    aggregatedAttendance. Körs i anroparens transaktion.
+    """
+    queries = _RollupQueries(conn.dialect.name)
+    attendance, month = queries.attendance, queries.month
+    selects = [
+        queries.grouped(PERSON, Attendance.person_id, attendance, False),
+        queries.grouped(PERSON, Attendance.person_id, attendance, True),
+        queries.grouped(ACTIVITY, Attendance.activity_id, attendance, False),
+        queries.grouped(ACTIVITY, Attendance.activity_id, attendance, True),
+        queries.groups(False),
+        queries.groups(True),
+        select(literal(PERIOD), literal(PERIOD_ALL), month, queries.present, func.count(), literal(queries.now))
+        .select_from(attendance).group_by(month),
+    ]
+
+    conn.execute(delete(queries.rollups))
+    for query in selects:
+        queries.insert(conn, query)
+    refresh_aggregated_attendance(conn)
+    return conn.execute(select(func.count()).select_from(queries.rollups)).scalar()
+
+def rebuild_group_rollups(conn, group_ids: Optional[Iterable[str]] = None) -> None:
+    """
+    Bygger om summorna för de angivna grupperna, eller för alla om group_ids är None, t.ex. när en
+    aktivitet fått eller förlorat en grupp. Övriga summor påverkas inte av vilka grupper en
+    aktivitet har. Körs i anroparens transaktion.
+    """
+    rollups = AttendanceRollup.__table__
+    clear = delete(rollups).where(rollups.c.scope_type == GROUP)
+    if group_ids is not None:
+        group_ids = set(group_ids)
+        if not group_ids:
+            return
+        clear = clear.where(rollups.c.scope_id.in_(group_ids))
+    queries = _RollupQueries(conn.dialect.name)
+    conn.execute(clear)
+    queries.insert(conn, queries.groups(False, group_ids))
+    queries.insert(conn, queries.groups(True, group_ids))
+
+def ensure_rollups(bind) -> int:
+    """Bygger summorna om tabellen är tom men närvaroposter finns, t.ex. efter att database.sql lästs in."""
+    with bind.begin() as conn:
+        if conn.execute(select(func.count()).select_from(AttendanceRollup.__table__)).scalar():
+            return 0
+        if not conn.execute(select(func.count()).select_from(Attendance.__table__)).scalar():
+            return 0
+        return rebuild_rollups(conn)
+
+
+if __name__ == "__main__":
+    from database import init_engine
+
+    parser = argparse.ArgumentParser(description="Underhåll av förberäknade närvarosummor.")
+    parser.add_argument("--rebuild", action="store_true", help="Bygg om alla summor och aggregatedAttendance från närvaroposterna.")
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.error("Ange --rebuild")
+    with init_engine().begin() as conn:
+        count = rebuild_rollups(conn)
+    print(f"Byggde om {count} summor")
@@ -0,0 +1,350 @@
+# analytics.py
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import case, func, or_, select
+from sqlalchemy.orm import Session, joinedload
+
+from database import Attendance, AttendanceEvent, CalendarEvent, GroupMembership, activity_group_association
+from aggregation import PRESENT_EVENT_NAMES
+
+ANALYTICS_CHUNK_ROWS = int(os.environ.get("ANALYTICS_CHUNK_ROWS", "50000"))
+ANALYTICS_SNAPSHOT_TTL = int(os.environ.get("ANALYTICS_SNAPSHOT_TTL", "300"))
+# Antal tidsfönster vars ögonblicksbilder hålls i minnet samtidigt; det minst nyligen använda får lämna plats
+ANALYTICS_SNAPSHOT_CACHE_SIZE = int(os.environ.get("ANALYTICS_SNAPSHOT_CACHE_SIZE", "8"))
+
+# Vanlig definition av kronisk frånvaro: minst 10 % av lektionerna
+CHRONIC_ABSENCE_THRESHOLD = 0.10
+CHRONIC_ABSENCE_MIN_LESSONS = 10
+
+WEEKDAY_NAMES = ("Måndag", "Tisdag", "Onsdag", "Torsdag", "Fredag", "Lördag", "Söndag")
+
+
+def _rate(absences, lessons):
+    """Frånvarograd per element; 0 där det saknas lektioner."""
+    return np.divide(absences, lessons, out=np.zeros(np.shape(lessons), dtype=float), where=np.asarray(lessons) > 0)
+
+def _lesson_time():
+    # Lektionens starttid, eller registreringens tidpunkt när posten saknar lektionstillfälle
+    return func.coalesce(CalendarEvent.start_time, Attendance.created)
+
+def _attendance_query(start: Optional[datetime], end: Optional[datetime]):
+    when = _lesson_time()
+    query = select(
+        Attendance.person_id,
+        when.label("start_time"),
+        case((AttendanceEvent.name.in_(PRESENT_EVENT_NAMES), 1), else_=0).label("present"),
+        # Lektionens aktivitet, eller registreringens när posten saknar lektionstillfälle
+        func.coalesce(CalendarEvent.activity_id, Attendance.activity_id).label("activity_id"),
+    ).select_from(
+        Attendance.__table__
+        .outerjoin(CalendarEvent.__table__, CalendarEvent.id == Attendance.calendar_event_id)
+        .outerjoin(AttendanceEvent.__table__, AttendanceEvent.id == Attendance.attendance_event_id)
+    ).where(Attendance.person_id.is_not(None))
+    if start:
+        query = query.where(when >= start)
+    if end:
+        query = query.where(when <= end)
+    return query
+
+
+class AttendanceSnapshot:
+    """
+    Kolumnvis ögonblicksbild av närvaroposterna inom ett tidsfönster. Person-, grupp- och
+    aktivitets-ID:n kodas som heltal; person_ids[kod] m.fl. ger tillbaka ID:t. activity är -1
+    för poster utan aktivitet. Gruppmedlemskapen och aktiviteternas grupper är par av koder.
+    """
+
+    def __init__(self, person_ids, person, present, start, group_ids, member_group, member_person,
+                 activity_ids, activity, activity_group_activity, activity_group_group):
+        self.person_ids = person_ids
+        self.person = person
+        self.present = present
+        self.start = start
+        self.group_ids = group_ids
+        self.member_group = member_group
+        self.member_person = member_person
+        self.activity_ids = activity_ids
+        self.activity = activity
+        self.activity_group_activity = activity_group_activity
+        self.activity_group_group = activity_group_group
+
+    def __len__(self):
+        return len(self.person)
+
+    @property
+    def weekday(self):
+        # 1970-01-01 var en torsdag; måndag blir 0
+        return ((self.start.astype("datetime64[D]").astype(np.int64) + 3) % 7).astype(np.int8)
+
+    @property
+    def slot(self):
+        """Lektionens starttid i minuter efter midnatt."""
+        return (self.start - self.start.astype("datetime64[D]")).astype("timedelta64[m]").astype(np.int16)
+
+    @classmethod
+    def load(cls, conn, start: Optional[datetime] = None, end: Optional[datetime] = None,
+             chunk_rows: int = ANALYTICS_CHUNK_ROWS) -> "AttendanceSnapshot":
+        """Läser närvaroposterna i block om chunk_rows rader och bygger kolumnerna blockvis."""
+        codes: Dict[str, int] = {}
+        activity_codes: Dict[str, int] = {}
+        persons, presents, starts, activities = [], [], [], []
+        result = conn.execution_options(stream_results=True, yield_per=chunk_rows).execute(_attendance_query(start, end))
+        for chunk in result.partitions(chunk_rows):
+            persons.append(np.fromiter((codes.setdefault(row[0], len(codes)) for row in chunk), dtype=np.int32, count=len(chunk)))
+            starts.append(np.array([row[1] for row in chunk], dtype="datetime64[m]"))
+            presents.append(np.fromiter((row[2] for row in chunk), dtype=bool, count=len(chunk)))
+            activities.append(np.fromiter((-1 if row[3] is None else activity_codes.setdefault(row[3], len(activity_codes)) for row in chunk),
+                                          dtype=np.int32, count=len(chunk)))
+
+        person = np.concatenate(persons) if persons else np.zeros(0, dtype=np.int32)
+        present = np.concatenate(presents) if presents else np.zeros(0, dtype=bool)
+        start_times = np.concatenate(starts) if starts else np.zeros(0, dtype="datetime64[m]")
+        activity = np.concatenate(activities) if activities else np.zeros(0, dtype=np.int32)
+        known = ~np.isnat(start_times)
+        person, present, start_times, activity = person[known], present[known], start_times[known], activity[known]
+
+        # Gruppmedlemskap som överlappar fönstret, för personer som har närvaroposter
+        memberships = select(GroupMembership.group_id, GroupMembership.person_id).where(
+            GroupMembership.group_id.is_not(None), GroupMembership.person_id.is_not(None),
+        )
+        if end:
+            memberships = memberships.where(or_(GroupMembership.start_date.is_(None), GroupMembership.start_date <= end.date()))
+        if start:
+            memberships = memberships.where(or_(GroupMembership.end_date.is_(None), GroupMembership.end_date >= start.date()))
+        group_codes: Dict[str, int] = {}
+        pairs = [(group_codes.setdefault(g, len(group_codes)), codes[p]) for g, p in conn.execute(memberships) if p in codes]
+        member = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+
+        # Aktiviteternas grupper; en grupp utan medlemmar med närvaroposter kan aldrig räknas
+        activity_groups = select(activity_group_association.c.activity_id, activity_group_association.c.group_id)
+        taught = np.array([(activity_codes[a], group_codes[g]) for a, g in conn.execute(activity_groups)
+                           if a in activity_codes and g in group_codes], dtype=np.int32).reshape(-1, 2)
+
+        person_ids = np.empty(len(codes), dtype=object)
+        person_ids[list(codes.values())] = list(codes.keys())
+        group_ids = np.empty(len(group_codes), dtype=object)
+        group_ids[list(group_codes.values())] = list(group_codes.keys())
+        activity_ids = np.empty(len(activity_codes), dtype=object)
+        activity_ids[list(activity_codes.values())] = list(activity_codes.keys())
+        return cls(person_ids, person, present, start_times, group_ids, member[:, 0], member[:, 1],
+                   activity_ids, activity, taught[:, 0], taught[:, 1])
+
+
+def student_totals(snapshot: AttendanceSnapshot) -> Tuple[np.ndarray, np.ndarray]:
+    """(lektioner, frånvarotillfällen) per personkod."""
+    n = len(snapshot.person_ids)
+    lessons = np.bincount(snapshot.person, minlength=n)
+    absences = np.bincount(snapshot.person, weights=~snapshot.present, minlength=n).astype(np.int64)
+    return lessons, absences
+
+def absence_streaks(snapshot: AttendanceSnapshot) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (längsta, pågående) följd av frånvarotillfällen i rad per personkod, i lektionsordning.
+    Posterna sorteras per person och tid och delas upp i sammanhängande följder av samma utfall.
+    """
+    n = len(snapshot.person_ids)
+    longest = np.zeros(n, dtype=np.int64)
+    current = np.zeros(n, dtype=np.int64)
+    if not len(snapshot):
+        return longest, current
+
+    order = np.lexsort((snapshot.start, snapshot.person))
+    person = snapshot.person[order]
+    absent = ~snapshot.present[order]
+
+    run_start = np.ones(len(person), dtype=bool)
+    run_start[1:] = (person[1:] != person[:-1]) | (absent[1:] != absent[:-1])
+    run_length = np.bincount(np.cumsum(run_start) - 1)
+    run_person = person[run_start]
+    run_absent = absent[run_start]
+
+    np.maximum.at(longest, run_person[run_absent], run_length[run_absent])
+    last_run = np.ones(len(run_person), dtype=bool)
+    last_run[:-1] = run_person[1:] != run_person[:-1]
+    ongoing = last_run & run_absent
+    current[run_person[ongoing]] = run_length[ongoing]
+    return longest, current
+
+def student_report(snapshot: AttendanceSnapshot, threshold: float = CHRONIC_ABSENCE_THRESHOLD,
+                   min_lessons: int = CHRONIC_ABSENCE_MIN_LESSONS) -> List[dict]:
+    lessons, absences = student_totals(snapshot)
+    rates = _rate(absences, lessons)
+    longest, current = absence_streaks(snapshot)
+    chronic = (rates >= threshold) & (lessons >= min_lessons)
+    order = np.lexsort((snapshot.person_ids.astype(str), -rates))
+    return [
+        {"person_id": snapshot.person_ids[i], "lessons": int(lessons[i]), "absences": int(absences[i]),
+         "absence_rate": round(float(rates[i]), 4), "longest_absence_streak": int(longest[i]),
+         "current_absence_streak": int(current[i]), "chronic_absence": bool(chronic[i])}
+        for i in order
+    ]
+
+def group_rows(snapshot: AttendanceSnapshot) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (post, grupp) för varje närvaropost och grupp den räknas för: grupper som läser lektionens
+    aktivitet och där personen är medlem. Posterna upprepas en gång per sådan grupp.
+    """
+    groups_per_activity = np.bincount(snapshot.activity_group_activity, minlength=len(snapshot.activity_ids))
+    order = np.argsort(snapshot.activity_group_activity, kind="stable")
+    taught_group = snapshot.activity_group_group[order]
+    first = np.cumsum(groups_per_activity) - groups_per_activity
+
+    has_activity = snapshot.activity >= 0
+    per_row = np.zeros(len(snapshot), dtype=np.int64)
+    per_row[has_activity] = groups_per_activity[snapshot.activity[has_activity]]
+    rows = np.repeat(np.arange(len(snapshot)), per_row)
+    nth = np.arange(len(rows)) - np.repeat(np.cumsum(per_row) - per_row, per_row)
+    group = taught_group[first[snapshot.activity[rows]] + nth]
+
+    member = np.isin(group.astype(np.int64) * len(snapshot.person_ids) + snapshot.person[rows], _membership_keys(snapshot))
+    return rows[member], group[member]
+
+def _membership_keys(snapshot: AttendanceSnapshot) -> np.ndarray:
+    """Unika (grupp, person) som grupp * antal personer + person."""
+    return np.unique(snapshot.member_group.astype(np.int64) * len(snapshot.person_ids) + snapshot.member_person)
+
+def group_report(snapshot: AttendanceSnapshot) -> List[dict]:
+    """
+    Frånvarograd per grupp, totalt och per veckodag. En lektion räknas bara för de grupper som
+    läser lektionens aktivitet och som eleven är medlem i.
+    """
+    groups = len(snapshot.group_ids)
+    rows, group = group_rows(snapshot)
+    keys = group.astype(np.int64) * 7 + snapshot.weekday[rows]
+    lessons = np.bincount(keys, minlength=groups * 7).reshape(groups, 7)
+    absences = np.bincount(keys, weights=~snapshot.present[rows], minlength=groups * 7).reshape(groups, 7)
+    total_lessons = lessons.sum(axis=1)
+    total_absences = absences.sum(axis=1)
+    total_rates = _rate(total_absences, total_lessons)
+    weekday_rates = _rate(absences, lessons)
+    members = np.bincount(_membership_keys(snapshot) // max(len(snapshot.person_ids), 1), minlength=groups)
+
+    return [
+        {"group_id": snapshot.group_ids[g], "members": int(members[g]), "lessons": int(total_lessons[g]),
+         "absences": int(total_absences[g]), "absence_rate": round(float(total_rates[g]), 4),
+         "by_weekday": {WEEKDAY_NAMES[d]: round(float(weekday_rates[g, d]), 4) for d in range(7) if lessons[g, d]}}
+        for g in np.argsort(snapshot.group_ids.astype(str))
+    ]
+
+def slot_report(snapshot: AttendanceSnapshot) -> List[dict]:
+    """Frånvarograd per veckodag och lektionens starttid."""
+    keys = snapshot.weekday.astype(np.int32) * 1440 + snapshot.slot
+    slots, inverse = np.unique(keys, return_inverse=True)
+    lessons = np.bincount(inverse, minlength=len(slots))
+    absences = np.bincount(inverse, weights=~snapshot.present, minlength=len(slots)).astype(np.int64)
+    rates = _rate(absences, lessons)
+    return [
+        {"weekday": WEEKDAY_NAMES[slot // 1440], "start": f"{slot % 1440 // 60:02d}:{slot % 60:02d}",
+         "lessons": int(lessons[i]), "absences": int(absences[i]), "absence_rate": round(float(rates[i]), 4)}
+        for i, slot in enumerate(slots.tolist())
+    ]
+
+
+_snapshots: "OrderedDict[tuple, Tuple[float, AttendanceSnapshot]]" = OrderedDict()
+_snapshots_lock = threading.Lock()
+
+def get_snapshot(conn, start: Optional[datetime] = None, end: Optional[datetime] = None) -> AttendanceSnapshot:
+    """
+    Återanvänder en ögonblicksbild för samma fönster i ANALYTICS_SNAPSHOT_TTL sekunder.
+    Högst ANALYTICS_SNAPSHOT_CACHE_SIZE fönster sparas, eftersom varje start och slut ger en egen nyckel.
+    """
+    key = (start, end)
+    with _snapshots_lock:
+        cached = _snapshots.get(key)
+        if cached:
+            _snapshots.move_to_end(key)
+    if cached and time.monotonic() - cached[0] < ANALYTICS_SNAPSHOT_TTL:
+        return cached[1]
+    snapshot = AttendanceSnapshot.load(conn, start, end)
+    with _snapshots_lock:
+        for stale in [k for k, (loaded_at, _) in _snapshots.items() if time.monotonic() - loaded_at >= ANALYTICS_SNAPSHOT_TTL]:
+            del _snapshots[stale]
+        _snapshots[key] = (time.monotonic(), snapshot)
+        while len(_snapshots) > ANALYTICS_SNAPSHOT_CACHE_SIZE:
+            _snapshots.popitem(last=False)
+    return snapshot
+
+
+def sql_student_totals(conn, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Dict[str, Tuple[int, int]]:
+    """Samma summor per person som student_totals, men som en grupperad SQL-fråga."""
+    rows = _attendance_query(start, end).subquery()
+    query = select(rows.c.person_id, func.count(), func.sum(1 - rows.c.present)).group_by(rows.c.person_id)
+    return {person_id: (lessons, int(absences or 0)) for person_id, lessons, absences in conn.execute(query)}
+
+def orm_student_totals(db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Dict[str, Tuple[int, int]]:
+    """Rad-för-rad via ORM-objekten, så som rapporterna beräknades tidigare."""
+    totals: Dict[str, List[int]] = {}
+    query = db.query(Attendance).options(joinedload(Attendance.attendance_event), joinedload(Attendance.calendar_event))
+    for record in query.yield_per(ANALYTICS_CHUNK_ROWS):
+        if record.person_id is None:
+            continue
+        when = record.calendar_event.start_time if record.calendar_event else record.created
+        if when is None or (start and when < start) or (end and when > end):
+            continue
+        present = record.attendance_event is not None and record.attendance_event.name in PRESENT_EVENT_NAMES
+        entry = totals.setdefault(record.person_id, [0, 0])
+        entry[0] += 1
+        entry[1] += 0 if present else 1
+    return {person_id: tuple(entry) for person_id, entry in totals.items()}
+
+def benchmark(db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None) -> dict:
+    """Jämför ORM-vägen, den grupperade SQL-frågan och den vektoriserade vägen och kontrollerar att summorna stämmer."""
+    conn = db.connection()
+    timings = {}
+
+    started = time.perf_counter()
+    orm = orm_student_totals(db, start, end)
+    timings["orm_ms"] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    sql = sql_student_totals(conn, start, end)
+    timings["sql_ms"] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    snapshot = AttendanceSnapshot.load(conn, start, end)
+    timings["snapshot_load_ms"] = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    lessons, absences = student_totals(snapshot)
+    student_report(snapshot)
+    group_report(snapshot)
+    slot_report(snapshot)
+    timings["vectorized_reports_ms"] = (time.perf_counter() - started) * 1000
+
+    vectorized = {snapshot.person_ids[i]: (int(lessons[i]), int(absences[i])) for i in range(len(lessons))}
+    return {"rows": len(snapshot), "persons": len(vectorized), "matches_sql": vectorized == sql, "matches_orm": vectorized == orm, **timings}
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, init_engine
+
+    parser = argparse.ArgumentParser(description="Närvaroanalys över en kolumnvis ögonblicksbild.")
+    parser.add_argument("report", choices=["students", "groups", "slots", "benchmark"])
+    parser.add_argument("--start", type=datetime.fromisoformat, help="Fönstrets början, t.ex. 2024-08-19")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="Fönstrets slut, t.ex. 2025-06-13")
+    parser.add_argument("--threshold", type=float, default=CHRONIC_ABSENCE_THRESHOLD, help="Gräns för kronisk frånvaro.")
+    args = parser.parse_args()
+
+    init_engine()
+    db = SessionLocal()
+    try:
+        if args.report == "benchmark":
+            result = benchmark(db, args.start, args.end)
+        else:
+            snapshot = AttendanceSnapshot.load(db.connection(), args.start, args.end)
+            if args.report == "students":
+                result = student_report(snapshot, args.threshold)
+            elif args.report == "groups":
+                result = group_report(snapshot)
+            else:
+                result = slot_report(snapshot)
+    finally:
+        db.close()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
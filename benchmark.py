@@ -0,0 +1,529 @@
+# benchmark.py
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+from enum import Enum
+from typing import Dict, List, NamedTuple, Optional, Tuple, get_args
+from urllib.parse import urlencode
+
+try:
+    import resource
+except ImportError:
+    # Saknas på Windows; toppminnet rapporteras då inte
+    resource = None
+
+BENCHMARK_REQUESTS = int(os.environ.get("BENCHMARK_REQUESTS", "50"))
+BENCHMARK_WARMUP = int(os.environ.get("BENCHMARK_WARMUP", "3"))
+BENCHMARK_CONCURRENCY = int(os.environ.get("BENCHMARK_CONCURRENCY", "8"))
+BENCHMARK_THRESHOLD = float(os.environ.get("BENCHMARK_THRESHOLD", "0.15"))
+# Latensökningar under så här många millisekunder räknas som brus vid jämförelsen
+BENCHMARK_MIN_DELTA_MS = float(os.environ.get("BENCHMARK_MIN_DELTA_MS", "1"))
+# Samma nyckel som appen; utan den är /admin/* avstängda och mäts inte
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Rutter som inte går att mäta som vanliga anrop
+UNMEASURABLE_ROUTES = {
+    "/changes/stream": "oändligt flöde",
+    "/changes/ws": "websocket",
+    "/import/jobs/{id}": "kräver ett pågående importjobb",
+}
+
+# Frågeparametrar som pekar ut en rad, och vilken fixtur som används för dem
+REFERENCE_PARAMS = {
+    "organisation": "school", "parent": "school", "owner": "school", "relationship.organisation": "school",
+    "member": "student", "student": "student", "person": "student", "child": "student",
+    "teacher": "teacher", "group": "group", "activity": "activity",
+}
+# Tidsfilter som tillsammans avgränsar en skolvecka
+WINDOW_PARAMS = {
+    "startTime.onOrAfter": "window_start", "startTime.onOrBefore": "window_end",
+    "endTime.onOrBefore": "window_end",
+    "startDate.onOrBefore": "window_end", "endDate.onOrAfter": "window_start",
+    "relationship.startDate.onOrBefore": "window_end", "relationship.endDate.onOrAfter": "window_start",
+}
+REQUIRED_VALUES = {"scopeType": "activity"}
+LOOKUP_IDS = 50
+LARGE_PAGE = 1000
+
+# SQL-satser räknas per anrop; bakgrundstrådarna har inget värde och räknas inte
+_statements: ContextVar[Optional[List[int]]] = ContextVar("benchmark_statements", default=None)
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    path: str
+    query: List[Tuple[str, str]]
+    body: Optional[dict]
+
+
+# --- ASGI utan nätverk ---
+async def asgi_request(app, method: str, path: str, query: List[Tuple[str, str]] = (), body: Optional[dict] = None) -> Tuple[int, int, int]:
+    """Skickar ett anrop direkt till ASGI-appen. Returnerar status, svarets storlek och antal SQL-satser."""
+    payload = json.dumps(body).encode() if body is not None else b""
+    headers = [(b"host", b"benchmark")]
+    if ADMIN_TOKEN and path.startswith("/admin/"):
+        headers.append((b"x-admin-token", ADMIN_TOKEN.encode()))
+    if body is not None:
+        headers.append((b"content-type", b"application/json"))
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": urlencode(query).encode(),
+        "headers": headers, "client": ("127.0.0.1", 50000), "server": ("benchmark", 80),
+    }
+    messages = [{"type": "http.request", "body": payload, "more_body": False}]
+    response = {"status": 500, "size": 0}
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # Klienten kopplar aldrig ner; vänta tills svaret är klart
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["size"] += len(message.get("body", b""))
+
+    counter = [0]
+    token = _statements.set(counter)
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        # Ohanterade fel har redan besvarats med 500 innan de kastas vidare
+        pass
+    finally:
+        _statements.reset(token)
+    return response["status"], response["size"], counter[0]
+
+@asynccontextmanager
+async def running(app):
+    """Kör appens lifespan runt blocket, som uvicorn gör vid start och nedstängning."""
+    inbox: asyncio.Queue = asyncio.Queue()
+    outbox: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(app({"type": "lifespan", "asgi": {"version": "3.0"}}, inbox.get, outbox.put))
+    await inbox.put({"type": "lifespan.startup"})
+    message = await outbox.get()
+    if message["type"] != "lifespan.startup.complete":
+        await asyncio.gather(task, return_exceptions=True)
+        raise RuntimeError(message.get("message") or "Applikationen kunde inte starta")
+    try:
+        yield
+    finally:
+        await inbox.put({"type": "lifespan.shutdown"})
+        await outbox.get()
+        await task
+
+async def wait_until_ready(app, timeout: float = 300):
+    deadline = time.monotonic() + timeout
+    while (await asgi_request(app, "GET", "/health/ready"))[0] != 200:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Applikationen blev aldrig redo")
+        await asyncio.sleep(0.1)
+
+
+# --- Dataset och fixturer ---
+def prepare_database(database_url: Optional[str], preset: str, seed: int, regenerate: bool) -> str:
+    """
+    Returnerar databas-URL:en att mäta mot. Utan URL används en SQLite-fil per preset och seed
+    som genereras med datagen första gången, eller när schemaversionen inte längre stämmer.
+    En angiven databas genereras bara om med regenerate, eftersom alla tabeller tas bort.
+    """
+    if database_url is None:
+        path = os.path.join(tempfile.gettempdir(), f"ss12000-benchmark-{preset}-{seed}.db")
+        database_url = f"sqlite:///{path}"
+        regenerate = regenerate or not os.path.exists(path)
+    os.environ["DATABASE_URL"] = database_url
+
+    from database import check_schema_version, dispose_engine, init_engine
+    if not regenerate:
+        try:
+            check_schema_version(init_engine(database_url))
+        except RuntimeError:
+            regenerate = True
+        finally:
+            dispose_engine()
+
+    if regenerate:
+        # Genereras i en egen process så att toppminnet bara gäller själva mätningen
+        print(f"Genererar dataset {preset} med seed {seed}", file=sys.stderr)
+        subprocess.run([
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "datagen.py"),
+            "--preset", preset, "--seed", str(seed), "--database-url", database_url, "--reset",
+        ], check=True, stdout=sys.stderr)
+    return database_url
+
+def _table_key(name: str) -> str:
+    return name.replace("_", "").lower()
+
+def load_fixtures(db) -> dict:
+    """ID:n att peka ut i sökvägar och filter, valda deterministiskt ur databasen."""
+    from sqlalchemy import func, select
+    from database import Base, CalendarEvent, Duty, GroupMembership, Organisation
+
+    fixtures = {"tables": {}}
+    for table in Base.metadata.sorted_tables:
+        key = list(table.primary_key.columns)
+        if len(key) == 1:
+            fixtures["tables"][_table_key(table.name)] = list(db.execute(select(key[0]).order_by(key[0]).limit(LOOKUP_IDS)).scalars())
+
+    fixtures["school"] = db.execute(select(Organisation.id).where(Organisation.type == "Skola").order_by(Organisation.id).limit(1)).scalar()
+    fixtures["student"] = db.execute(select(GroupMembership.person_id).order_by(GroupMembership.person_id).limit(1)).scalar()
+    fixtures["teacher"] = db.execute(select(Duty.person_id).order_by(Duty.person_id).limit(1)).scalar()
+    fixtures["group"] = (fixtures["tables"].get("groups") or [None])[0]
+    fixtures["activity"] = (fixtures["tables"].get("activities") or [None])[0]
+    # En skolvecka från den första lektionen
+    first = db.execute(select(func.min(CalendarEvent.start_time))).scalar() or datetime.utcnow()
+    fixtures["window_start"] = datetime.combine(first.date() - timedelta(days=first.weekday()), datetime.min.time())
+    fixtures["window_end"] = fixtures["window_start"] + timedelta(days=7)
+    return fixtures
+
+def _path_ids(path: str, fixtures: dict) -> List[str]:
+    key = _table_key(path.strip("/").split("/")[0])
+    if key == "persons" and fixtures["student"]:
+        return [fixtures["student"]] + fixtures["tables"]["persons"]
+    if key == "organisations" and fixtures["school"]:
+        return [fixtures["school"]] + fixtures["tables"]["organisations"]
+    return fixtures["tables"].get(key) or []
+
+
+# --- Scenarier ---
+def _leaf_types(annotation):
+    args = get_args(annotation)
+    if not args:
+        yield annotation
+    for arg in args:
+        yield from _leaf_types(arg)
+
+def _annotation(field):
+    return getattr(field.field_info, "annotation", None) or getattr(field, "outer_type_", None)
+
+def _required(field) -> bool:
+    is_required = getattr(field.field_info, "is_required", None)
+    return is_required() if is_required else field.required
+
+def _enum_values(field) -> List[str]:
+    for leaf in _leaf_types(_annotation(field)):
+        if isinstance(leaf, type) and issubclass(leaf, Enum):
+            return [member.value for member in leaf]
+    # Query(..., enum=[...]) lagras som extra schema
+    extra = getattr(field.field_info, "json_schema_extra", None) or getattr(field.field_info, "extra", None) or {}
+    return list(extra.get("enum", [])) if isinstance(extra, dict) else []
+
+def _maximum(field) -> Optional[int]:
+    """Fältets le-gräns; i Pydantic 2 ligger den bland metadata."""
+    le = getattr(field.field_info, "le", None)
+    for constraint in getattr(field.field_info, "metadata", []):
+        le = getattr(constraint, "le", le)
+    return le
+
+def _format(value, field) -> str:
+    if isinstance(value, datetime) and date in set(_leaf_types(_annotation(field))):
+        return value.date().isoformat()
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+def _param_value(field, fixtures: dict):
+    name = field.alias
+    if name in REQUIRED_VALUES:
+        return REQUIRED_VALUES[name]
+    if name in REFERENCE_PARAMS:
+        value = fixtures.get(REFERENCE_PARAMS[name])
+    elif name in WINDOW_PARAMS:
+        value = fixtures[WINDOW_PARAMS[name]]
+    else:
+        return None
+    return _format(value, field) if value is not None else None
+
+def route_scenarios(route, fixtures: dict) -> Tuple[List[Scenario], Optional[str]]:
+    """
+    Scenarier för en rutt: ett basanrop med bara obligatoriska parametrar och sedan de
+    kombinationer som klienterna faktiskt använder – filter på organisation, person och
+    skolvecka, expand, sortering och stora sidor. Returnerar (scenarier, skäl att hoppa över).
+    """
+    method = sorted(route.methods)[0]
+    lookup = method == "POST" and route.path.endswith("/lookup")
+    if method != "GET" and not lookup:
+        return [], "ändrar data"
+
+    path = route.path
+    if route.param_convertors:
+        ids = _path_ids(path, fixtures)
+        if not ids:
+            return [], "tabellen är tom"
+        path = re.sub(r"\{[^}]+\}", ids[0], path)
+
+    base = []
+    params = {field.alias: field for field in route.dependant.query_params}
+    for field in params.values():
+        if _required(field):
+            value = _param_value(field, fixtures)
+            if value is None:
+                return [], f"inget värde för {field.alias}"
+            base.append((field.alias, value))
+
+    body = None
+    if lookup:
+        ids = _path_ids(path, fixtures)
+        if not ids:
+            return [], "tabellen är tom"
+        model = _annotation(route.body_field)
+        fields = getattr(model, "model_fields", None) or getattr(model, "__fields__", {})
+        # Första listfältet i uppslagsmodellen, t.ex. ids eller calendarEventIds
+        body = {next(iter(fields)): ids[:LOOKUP_IDS]}
+
+    variants = {"bas": base}
+    filters = [(alias, _param_value(field, fixtures)) for alias, field in params.items()
+               if not _required(field) and (alias in REFERENCE_PARAMS or alias in WINDOW_PARAMS)]
+    filters = [(alias, value) for alias, value in filters if value is not None]
+    if filters:
+        variants["filter"] = base + filters
+    expand = [("expand", value) for value in _enum_values(params["expand"])] if "expand" in params else []
+    if "expandReferenceNames" in params:
+        expand.append(("expandReferenceNames", "true"))
+    if expand:
+        variants["expand"] = base + expand
+    if "sortkey" in params:
+        variants["sort"] = base + [("sortkey", (_enum_values(params["sortkey"]) or ["ModifiedDesc"])[0])]
+    if "limit" in params:
+        # Största sidan som rutten tillåter, högst LARGE_PAGE
+        limit = [("limit", str(min(LARGE_PAGE, _maximum(params["limit"]) or LARGE_PAGE)))]
+        variants["stor sida"] = base + limit
+        if filters and expand:
+            variants["filter+expand+stor sida"] = base + filters + expand + limit
+
+    return [Scenario(f"{method} {route.path} [{variant}]", method, path, query, body) for variant, query in variants.items()], None
+
+def build_scenarios(app, fixtures: dict, pattern: Optional[str] = None) -> Tuple[List[Scenario], Dict[str, str]]:
+    from fastapi.routing import APIRoute
+
+    scenarios, skipped = [], {}
+    for route in app.routes:
+        if route.path in UNMEASURABLE_ROUTES:
+            skipped[route.path] = UNMEASURABLE_ROUTES[route.path]
+            continue
+        if not isinstance(route, APIRoute) or route.path.startswith(("/docs", "/openapi", "/redoc")):
+            continue
+        if route.path.startswith("/admin/") and not ADMIN_TOKEN:
+            skipped[f"{sorted(route.methods)[0]} {route.path}"] = "kräver ADMIN_TOKEN"
+            continue
+        found, reason = route_scenarios(route, fixtures)
+        if reason:
+            skipped[f"{sorted(route.methods)[0]} {route.path}"] = reason
+        scenarios.extend(s for s in found if not pattern or re.search(pattern, s.name))
+    return scenarios, skipped
+
+
+# --- Mätning ---
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS rapporterar byte, Linux kilobyte
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(percent / 100 * len(ordered) + 0.5)) - 1))]
+
+async def measure(app, scenario: Scenario, requests: int, warmup: int, concurrency: int) -> dict:
+    """
+    Mäter ett scenario: latens och SQL-satser med ett anrop i taget, därefter genomströmning
+    med concurrency samtidiga anrop. Latensen räknas bara på 2xx-svar; felsvar räknas i errors.
+    """
+    call = lambda: asgi_request(app, scenario.method, scenario.path, scenario.query, scenario.body)
+    for _ in range(warmup):
+        await call()
+
+    latencies, statuses, statements, sizes = [], Counter(), [], []
+    for _ in range(requests):
+        started = time.perf_counter()
+        status, size, count = await call()
+        if 200 <= status < 300:
+            latencies.append((time.perf_counter() - started) * 1000)
+        statuses[status] += 1
+        statements.append(count)
+        sizes.append(size)
+
+    limiter = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with limiter:
+            await call()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "method": scenario.method,
+        "path": scenario.path,
+        "query": scenario.query,
+        "requests": requests,
+        "status": {str(status): count for status, count in sorted(statuses.items())},
+        "errors": sum(count for status, count in statuses.items() if not 200 <= status < 300),
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies),
+            "p50": _percentile(latencies, 50),
+            "p90": _percentile(latencies, 90),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "max": max(latencies),
+        } if latencies else None,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "sql_statements": sum(statements) / len(statements),
+        "response_bytes": sum(sizes) / len(sizes),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+async def run_benchmark(database_url: str, requests: int = BENCHMARK_REQUESTS, warmup: int = BENCHMARK_WARMUP,
+                        concurrency: int = BENCHMARK_CONCURRENCY, pattern: Optional[str] = None, report=print) -> dict:
+    """Startar appen i processen mot database_url och mäter alla scenarier. Returnerar resultatet som dict."""
+    from sqlalchemy import event
+    import database
+    from main import app
+
+    def count_statement(*args):
+        counter = _statements.get()
+        if counter is not None:
+            counter[0] += 1
+
+    started = datetime.utcnow()
+    async with running(app):
+        await wait_until_ready(app)
+        event.listen(database.engine, "before_cursor_execute", count_statement)
+        db = database.SessionLocal()
+        try:
+            fixtures = load_fixtures(db)
+        finally:
+            db.close()
+
+        scenarios, skipped = build_scenarios(app, fixtures, pattern)
+        results, failed = {}, {}
+        for number, scenario in enumerate(scenarios, 1):
+            results[scenario.name] = await measure(app, scenario, requests, warmup, concurrency)
+            result = results[scenario.name]
+            if result["errors"]:
+                failed[scenario.name] = result["status"]
+                report(f"[{number}/{len(scenarios)}] {scenario.name}: FEL, status {','.join(result['status'])}")
+                continue
+            report(f"[{number}/{len(scenarios)}] {scenario.name}: p50 {result['latency_ms']['p50']:.1f} ms, "
+                   f"p95 {result['latency_ms']['p95']:.1f} ms, {result['throughput_rps']:.0f} anrop/s, "
+                   f"{result['sql_statements']:.1f} SQL, status {','.join(result['status'])}")
+        event.remove(database.engine, "before_cursor_execute", count_statement)
+
+    return {
+        "meta": {
+            "started": started.isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "dialect": database_url.split(":", 1)[0],
+            "requests": requests,
+            "warmup": warmup,
+            "concurrency": concurrency,
+        },
+        "peak_rss_kb": peak_rss_kb(),
+        "scenarios": results,
+        # Scenarier med svar utanför 2xx och deras statuskoder; de jämförs inte som latens
+        "failed": failed,
+        "skipped": skipped,
+    }
+
+
+# --- Jämförelse ---
+def compare_results(baseline: dict, current: dict, threshold: float = BENCHMARK_THRESHOLD,
+                    min_delta_ms: float = BENCHMARK_MIN_DELTA_MS) -> List[str]:
+    """
+    Regressioner mellan två körningar: latens (p50/p95) eller toppminne som ökat mer än
+    threshold, genomströmning som minskat mer än threshold, fler SQL-satser per anrop och
+    scenarier som svarar med fel. Scenarier med fel i någon av körningarna jämförs inte som latens.
+    """
+    regressions = []
+    for name, new in current["scenarios"].items():
+        if new["errors"]:
+            regressions.append(f"{name}: svarar med status {','.join(new['status'])}")
+            continue
+        old = baseline["scenarios"].get(name)
+        if old is None or old["errors"]:
+            continue
+        for key in ("p50", "p95"):
+            before, after = old["latency_ms"][key], new["latency_ms"][key]
+            if after - before > min_delta_ms and after > before * (1 + threshold):
+                regressions.append(f"{name}: {key} {before:.1f} -> {after:.1f} ms")
+        if new["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: genomströmning {old['throughput_rps']:.0f} -> {new['throughput_rps']:.0f} anrop/s")
+        if round(new["sql_statements"], 1) > round(old["sql_statements"], 1):
+            regressions.append(f"{name}: SQL-satser {old['sql_statements']:.1f} -> {new['sql_statements']:.1f}")
+
+    before, after = baseline.get("peak_rss_kb"), current.get("peak_rss_kb")
+    if before and after and after > before * (1 + threshold):
+        regressions.append(f"toppminne {before / 1024:.0f} -> {after / 1024:.0f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    from datagen import PRESETS
+
+    parser = argparse.ArgumentParser(description="Mät API:ets endpoints i processen mot ett genererat dataset.")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Jämför två resultatfiler i stället för att mäta.")
+    parser.add_argument("--threshold", type=float, default=BENCHMARK_THRESHOLD, help="Tillåten försämring som andel, t.ex. 0.15.")
+    parser.add_argument("--database-url", help="Mät mot denna databas, t.ex. MySQL, i stället för en genererad SQLite-fil.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="tiny")
+    parser.add_argument("--seed", type=int, default=12000)
+    parser.add_argument("--regenerate", action="store_true", help="Generera om datasetet. Tar bort alla tabeller i databasen.")
+    parser.add_argument("--requests", type=int, default=BENCHMARK_REQUESTS, help="Anrop per scenario.")
+    parser.add_argument("--warmup", type=int, default=BENCHMARK_WARMUP)
+    parser.add_argument("--concurrency", type=int, default=BENCHMARK_CONCURRENCY)
+    parser.add_argument("--routes", help="Mät bara scenarier vars namn matchar detta reguljära uttryck.")
+    parser.add_argument("--out", default="benchmark.json", help="Fil att skriva resultatet till.")
+    parser.add_argument("--baseline", help="Jämför resultatet med en tidigare körning.")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+    else:
+        database_url = prepare_database(args.database_url, args.preset, args.seed, args.regenerate)
+        current = asyncio.run(run_benchmark(database_url, args.requests, args.warmup, args.concurrency, args.routes))
+        current["meta"]["dataset"] = {"preset": args.preset, "seed": args.seed} if args.database_url is None or args.regenerate else None
+        with open(args.out, "w") as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+        print(f"Skrev {len(current['scenarios'])} scenarier till {args.out}; hoppade över {len(current['skipped'])} rutter")
+        for name, status in current["failed"].items():
+            print(f"FEL {name}: status {','.join(status)}")
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        elif current["failed"]:
+            # Felsvar mäter felhanteringen, inte endpointen; en sådan körning duger inte som baslinje
+            print(f"{len(current['failed'])} scenarier svarade med fel")
+            sys.exit(1)
+
+    if baseline is not None:
+        regressions = compare_results(baseline, current, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regressioner mot {baseline['meta'].get('commit') or 'baslinjen'}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,213 @@
+# broadcaster.py
+import asyncio
+import json
+import os
+from collections import deque
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Union
+
+from changelog import Change, ChangeTailer, read_changes
+from database import SessionLocal, INTERNAL_MODELS
+
+CHANGE_STREAM_MAX_CLIENTS = int(os.environ.get("CHANGE_STREAM_MAX_CLIENTS", "5000"))
+CHANGE_STREAM_CLIENT_BUFFER = int(os.environ.get("CHANGE_STREAM_CLIENT_BUFFER", "1000"))
+CHANGE_STREAM_HEARTBEAT_SECONDS = float(os.environ.get("CHANGE_STREAM_HEARTBEAT_SECONDS", "15"))
+CHANGE_STREAM_REPLAY_ROWS = int(os.environ.get("CHANGE_STREAM_REPLAY_ROWS", "10000"))
+CHANGE_STREAM_POLL_MS = float(os.environ.get("CHANGE_STREAM_POLL_MS", "100"))
+
+# Markörer i flödet utöver ändringar
+HEARTBEAT = "heartbeat"
+EVICTED = "evicted"
+RESET = "reset"
+
+
+class TooManyClients(Exception):
+    """Maxantalet anslutna klienter är nått."""
+
+
+def change_payload(change: Change) -> dict:
+    return {
+        "seq": change.seq,
+        "resource_type": change.resource_type,
+        "id": change.resource_id,
+        "operation": change.operation,
+        "changed_columns": change.changed_columns,
+        "organisation_id": change.organisation_id,
+        "timestamp": change.created.isoformat(),
+    }
+
+
+class ChangeClient:
+    """
+    En ansluten klient med en begränsad buffert. Bufferten fylls av broadcastern och töms av
+    klientens svar; en klient som inte hinner tömma den kopplas bort i stället för att låta
+    bufferten växa.
+    """
+
+    def __init__(self, resource_types: Optional[Iterable[str]], organisations: Optional[Iterable[str]],
+                 buffer_size: int = CHANGE_STREAM_CLIENT_BUFFER):
+        self.resource_types = frozenset(resource_types) if resource_types else None
+        self.organisations = frozenset(organisations) if organisations else None
+        self.buffer_size = buffer_size
+        self.evicted = False
+        self.replayed: Set[int] = set()
+        self._buffer: deque = deque()
+        self._ready = asyncio.Event()
+
+    def wants(self, change: Change) -> bool:
+        return self.organisations is None or change.organisation_id in self.organisations
+
+    def offer(self, change: Change) -> bool:
+        if self.evicted:
+            return False
+        if len(self._buffer) >= self.buffer_size:
+            self.evicted = True
+            self._buffer.clear()
+        else:
+            self._buffer.append(change)
+        self._ready.set()
+        return not self.evicted
+
+    async def next_batch(self, timeout: float) -> List[Change]:
+        """Väntar på ändringar i högst timeout sekunder och returnerar allt som finns i bufferten."""
+        if not self._buffer and not self.evicted:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._ready.clear()
+        batch = list(self._buffer)
+        self._buffer.clear()
+        return batch
+
+
+class ChangeBroadcaster:
+    """
+    Sprider ändringsloggen till anslutna klienter. En enda ChangeTailer läser loggen för alla
+    klienter; omgångarna lämnas över till händelseloopen och fördelas där per resurstyp, så
+    ingen låsning behövs mellan klienterna.
+    """
+
+    def __init__(self, max_clients: int = CHANGE_STREAM_MAX_CLIENTS, poll_ms: float = CHANGE_STREAM_POLL_MS):
+        self.max_clients = max_clients
+        self.delivered = 0
+        self.evictions = 0
+        self._clients: Dict[Optional[str], Set[ChangeClient]] = {}
+        self._count = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tailer = ChangeTailer(None, self._receive, poll_ms=poll_ms)
+
+    @property
+    def clients(self) -> int:
+        return self._count
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._tailer.start()
+
+    def stop(self):
+        self._tailer.stop()
+        self._loop = None
+
+    def connect(self, resource_types: Optional[List[str]] = None, organisations: Optional[List[str]] = None) -> ChangeClient:
+        if self._count >= self.max_clients:
+            raise TooManyClients()
+        client = ChangeClient(resource_types, organisations)
+        for key in client.resource_types or (None,):
+            self._clients.setdefault(key, set()).add(client)
+        self._count += 1
+        return client
+
+    def disconnect(self, client: ChangeClient):
+        removed = False
+        for key in client.resource_types or (None,):
+            clients = self._clients.get(key)
+            if clients and client in clients:
+                clients.discard(client)
+                removed = True
+                if not clients:
+                    del self._clients[key]
+        if removed:
+            self._count -= 1
+
+    def _receive(self, changes: List[Change]):
+        # Anropas i tailerns tråd
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._fan_out, changes)
+        except RuntimeError:
+            # Loopen har stängts under nedstängning
+            pass
+
+    def _fan_out(self, changes: List[Change]):
+        everything = self._clients.get(None, ())
+        for change in changes:
+            if change.resource_type in INTERNAL_MODELS:
+                continue
+            for clients in (self._clients.get(change.resource_type, ()), everything):
+                for client in clients:
+                    if client.wants(change):
+                        was_evicted = client.evicted
+                        if client.offer(change):
+                            self.delivered += 1
+                        elif not was_evicted:
+                            self.evictions += 1
+
+    def replay(self, client: ChangeClient, after: int) -> Union[List[Change], str]:
+        """
+        Ändringar efter seq after som klienten missade, t.ex. efter en återanslutning med
+        Last-Event-ID. Är de fler än CHANGE_STREAM_REPLAY_ROWS returneras RESET och klienten
+        får göra en full synkning.
+        """
+        db = SessionLocal()
+        try:
+            changes = read_changes(db, after, CHANGE_STREAM_REPLAY_ROWS + 1,
+                                   list(client.resource_types) if client.resource_types else None)
+        finally:
+            db.close()
+        if len(changes) > CHANGE_STREAM_REPLAY_ROWS:
+            return RESET
+        changes = [c for c in changes if c.resource_type not in INTERNAL_MODELS and client.wants(c)]
+        client.replayed = {c.seq for c in changes}
+        return changes
+
+    async def events(self, client: ChangeClient, replayed: Union[List[Change], str] = (),
+                     heartbeat: float = CHANGE_STREAM_HEARTBEAT_SECONDS) -> AsyncIterator[Union[Change, str]]:
+        """Ändringar till klienten, HEARTBEAT när inget har hänt och till sist EVICTED eller RESET."""
+        try:
+            if replayed == RESET:
+                yield RESET
+                return
+            for change in replayed:
+                yield change
+            while True:
+                batch = await client.next_batch(heartbeat)
+                if client.evicted:
+                    yield EVICTED
+                    return
+                if not batch:
+                    yield HEARTBEAT
+                    continue
+                for change in batch:
+                    # Ändringar som redan skickats vid återspelningen
+                    if change.seq in client.replayed:
+                        client.replayed.discard(change.seq)
+                        continue
+                    yield change
+        finally:
+            self.disconnect(client)
+
+    async def sse(self, client: ChangeClient, replayed: Union[List[Change], str] = ()) -> AsyncIterator[str]:
+        """Flödet som text/event-stream. Varje händelse har seq som id för Last-Event-ID."""
+        yield "retry: 3000\n\n"
+        async for item in self.events(client, replayed):
+            if item == HEARTBEAT:
+                yield ": ping\n\n"
+            elif isinstance(item, str):
+                yield f"event: {item}\ndata: {{}}\n\n"
+            else:
+                yield f"id: {item.seq}\nevent: {item.operation}\ndata: {json.dumps(change_payload(item))}\n\n"
+
+
+change_broadcaster = ChangeBroadcaster()
@@ -0,0 +1,112 @@
+# cache.py
+import threading
+import time
+from itertools import chain
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Organisation, Programme, Syllabus, AttendanceEvent
+
+
+class ReferenceCache:
+    """
+    Håller en liten referenstabell i minnet, indexerad på id.
+    Raderna lagras som SimpleNamespace-objekt så att de kan användas med from_orm
+    utan att vara knutna till en databassession. Ett id som saknas slås upp i databasen,
+    och cachen töms när en session committar ändringar i tabellen.
+    """
+
+    def __init__(self, model, ttl_seconds: int = 300):
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._rows: Dict[str, SimpleNamespace] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl_seconds
+
+    def _query(self, db: Session):
+        columns = [c.key for c in self.model.__table__.columns]
+        return columns, db.query(*[getattr(self.model, c) for c in columns])
+
+    def load(self, db: Session) -> int:
+        """Läser in hela tabellen och ersätter cachens innehåll."""
+        columns, query = self._query(db)
+        loaded = {row.id: SimpleNamespace(**dict(zip(columns, row))) for row in query.all()}
+        with self._lock:
+            self._rows = loaded
+            self._loaded_at = time.monotonic()
+        return len(loaded)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def get(self, db: Session, id: Optional[str]) -> Optional[SimpleNamespace]:
+        if id is None:
+            return None
+        if not self.loaded:
+            self.misses += 1
+            self.load(db)
+            return self._rows.get(id)
+        row = self._rows.get(id)
+        if row is not None:
+            self.hits += 1
+            return row
+        # Raden kan vara nyare än cachen; okända id:n sparas inte
+        self.misses += 1
+        columns, query = self._query(db)
+        found = query.filter(self.model.id == id).first()
+        if found is None:
+            return None
+        row = SimpleNamespace(**dict(zip(columns, found)))
+        with self._lock:
+            self._rows[id] = row
+        return row
+
+    def all(self, db: Session) -> List[SimpleNamespace]:
+        if not self.loaded:
+            self.misses += 1
+            self.load(db)
+        else:
+            self.hits += 1
+        return list(self._rows.values())
+
+
+organisation_cache = ReferenceCache(Organisation)
+programme_cache = ReferenceCache(Programme)
+syllabus_cache = ReferenceCache(Syllabus)
+attendance_event_cache = ReferenceCache(AttendanceEvent)
+
+REFERENCE_CACHES = {
+    "organisations": organisation_cache,
+    "programmes": programme_cache,
+    "syllabuses": syllabus_cache,
+    "attendanceEvents": attendance_event_cache,
+}
+
+_CACHES_BY_MODEL = {cache.model: cache for cache in REFERENCE_CACHES.values()}
+_STALE = "stale_reference_caches"
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _note_stale_caches(session, flush_context):
+    # Töms först när transaktionen avslutas, så att andra sessioner inte läser in ocommittade rader
+    for obj in chain(session.new, session.dirty, session.deleted):
+        cache = _CACHES_BY_MODEL.get(type(obj))
+        if cache is not None:
+            session.info.setdefault(_STALE, set()).add(cache)
+
+@event.listens_for(SessionLocal, "after_commit")
+@event.listens_for(SessionLocal, "after_rollback")
+def _invalidate_stale_caches(session):
+    # Även vid rollback, eftersom sessionen själv kan ha slagit upp sina ocommittade rader
+    for cache in session.info.pop(_STALE, ()):
+        cache.invalidate()
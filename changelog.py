@@ -0,0 +1,409 @@
+# changelog.py
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import delete, event, func, inspect, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Activity, ChangeLog, ChangeLogCursor, Organisation, resource_type_of, upsert_rows
+
+logger = logging.getLogger("ss12000.changelog")
+
+CHANGELOG_POLL_MS = float(os.environ.get("CHANGELOG_POLL_MS", "200"))
+CHANGELOG_BATCH_ROWS = int(os.environ.get("CHANGELOG_BATCH_ROWS", "1000"))
+CHANGELOG_GAP_TIMEOUT_SECONDS = float(os.environ.get("CHANGELOG_GAP_TIMEOUT_SECONDS", "10"))
+CHANGELOG_RETENTION_DAYS = int(os.environ.get("CHANGELOG_RETENTION_DAYS", "30"))
+# Så länge en process får läsa för en konsument utan att förnya; förnyas vid varje läsning
+CHANGELOG_LEASE_SECONDS = float(os.environ.get("CHANGELOG_LEASE_SECONDS", "30"))
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+
+class Change(NamedTuple):
+    seq: int
+    resource_type: str
+    resource_id: str
+    operation: str
+    changed_columns: List[str]
+    organisation_id: Optional[str]
+    created: datetime
+
+
+def _identity(obj) -> str:
+    key = inspect(obj).mapper.primary_key_from_instance(obj)
+    return ",".join(str(part) for part in key)
+
+def _changed_columns(obj, operation: str) -> List[str]:
+    if operation == DELETE:
+        return []
+    state = inspect(obj)
+    columns = []
+    for prop in state.mapper.column_attrs:
+        if operation == INSERT:
+            changed = getattr(obj, prop.key, None) is not None
+        else:
+            changed = state.attrs[prop.key].history.has_changes()
+        if changed:
+            columns.append(prop.columns[0].name)
+    return columns
+
+
+def activity_organisations(conn, activity_ids: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Organisationen för varje aktivitet, för resurser som bara är knutna till en aktivitet."""
+    activity_ids = {id for id in activity_ids if id}
+    if not activity_ids:
+        return {}
+    table = Activity.__table__
+    return dict(conn.execute(select(table.c.id, table.c.organisation_id).where(table.c.id.in_(activity_ids))).all())
+
+def _organisation_of(obj, activity_orgs: Dict[str, Optional[str]]) -> Optional[str]:
+    # Läs bara redan laddade värden; borttagna rader kan inte laddas om
+    values = inspect(obj).dict
+    if isinstance(obj, Organisation):
+        return values.get("id")
+    if values.get("organisation_id"):
+        return values["organisation_id"]
+    return activity_orgs.get(values.get("activity_id"))
+
+
+def append_changes(conn, changes: Iterable[Tuple[str, str, str, List[str], Optional[str]]]) -> int:
+    """
+    Skriver (resource_type, resource_id, operation, changed_columns, organisation_id) till
+    ändringsloggen. Används av lyssnaren nedan och av kod som skriver med Core-satser förbi sessionen.
+    """
+    now = datetime.utcnow()
+    rows = [
+        {"resource_type": resource_type, "resource_id": resource_id, "operation": operation,
+         "changed_columns": ",".join(columns), "organisation_id": organisation_id, "created": now}
+        for resource_type, resource_id, operation, columns, organisation_id in changes
+    ]
+    if rows:
+        conn.execute(insert(ChangeLog.__table__), rows)
+    return len(rows)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _append_changes(session, flush_context):
+    pending = []
+    for operation, objects in ((INSERT, session.new), (UPDATE, session.dirty), (DELETE, session.deleted)):
+        for obj in objects:
+            resource_type = resource_type_of(obj, include_internal=True)
+            if resource_type is None:
+                continue
+            columns = _changed_columns(obj, operation)
+            # Ändringar som bara rör relationer ger ingen rad i tabellen
+            if operation == UPDATE and not columns:
+                continue
+            pending.append((obj, resource_type, operation, columns))
+    if not pending:
+        return
+
+    conn = session.connection()
+    activity_orgs = activity_organisations(conn, (
+        inspect(obj).dict.get("activity_id") for obj, *_ in pending if not inspect(obj).dict.get("organisation_id")
+    ))
+    append_changes(conn, [
+        (resource_type, _identity(obj), operation, columns, _organisation_of(obj, activity_orgs))
+        for obj, resource_type, operation, columns in pending
+    ])
+
+
+def latest_seq(db: Session) -> int:
+    return db.query(func.max(ChangeLog.seq)).scalar() or 0
+
+def _change(row) -> Change:
+    return Change(row.seq, row.resource_type, row.resource_id, row.operation,
+                  row.changed_columns.split(",") if row.changed_columns else [], row.organisation_id, row.created)
+
+def read_changes(db: Session, after: int, limit: int = CHANGELOG_BATCH_ROWS,
+                 resource_types: Optional[List[str]] = None) -> List[Change]:
+    """Ändringar med seq större än after, i seq-ordning. Luckor hanteras av ChangeLogReader."""
+    query = db.query(ChangeLog).filter(ChangeLog.seq > after)
+    if resource_types:
+        query = query.filter(ChangeLog.resource_type.in_(resource_types))
+    return [_change(row) for row in query.order_by(ChangeLog.seq).limit(limit)]
+
+def read_ranges(db: Session, ranges: Iterable[Tuple[int, int]], limit: int = CHANGELOG_BATCH_ROWS) -> List[Change]:
+    """Ändringar inom de slutna intervallen (first, last), i seq-ordning."""
+    conditions = [ChangeLog.seq.between(first, last) for first, last in ranges]
+    if not conditions:
+        return []
+    return [_change(row) for row in db.query(ChangeLog).filter(or_(*conditions)).order_by(ChangeLog.seq).limit(limit)]
+
+
+class ChangeLogReader:
+    """
+    Läser ändringsloggen från en markör. seq tilldelas när raden skrivs men blir synlig först vid
+    commit, så en transaktion som pågår kan lämna en lucka som fylls senare. Läsaren väntar inte
+    vid luckor utan läser vidare och sparar de överhoppade intervallen. De läses om vid varje poll,
+    och rader som har dykt upp levereras då i efterhand. Ett intervall som fortfarande är tomt
+    efter gap_timeout sekunder läses en sista gång; därefter antas transaktionen ha rullats
+    tillbaka och intervallet släpps med en varning.
+
+    Med ett konsumentnamn sparas markören i change_log_cursors vid commit(), så att läsningen
+    fortsätter där den slutade efter en omstart. Markören som sparas stannar före den äldsta
+    öppna luckan, så efter en omstart läses luckan om och ändringarna efter den levereras igen.
+    Utan sparad markör börjar läsaren vid start, eller vid loggens slut om start saknas.
+    """
+
+    def __init__(self, consumer: Optional[str] = None, start: Optional[int] = None,
+                 resource_types: Optional[List[str]] = None, gap_timeout: float = CHANGELOG_GAP_TIMEOUT_SECONDS):
+        self.consumer = consumer
+        self.resource_types = resource_types
+        self.gap_timeout = gap_timeout
+        self.cursor: Optional[int] = start
+        self._loaded = False
+        # Första seq i varje överhoppat intervall -> (sista seq, när luckan upptäcktes)
+        self._gaps: Dict[int, Tuple[int, float]] = {}
+
+    @property
+    def position(self) -> Optional[int]:
+        """Högsta seq som allt före är läst eller släppt; det är den som sparas."""
+        if self._gaps:
+            return min(self._gaps) - 1
+        return self.cursor
+
+    def _load_cursor(self, db: Session) -> int:
+        if self.consumer:
+            stored = db.query(ChangeLogCursor.seq).filter(ChangeLogCursor.consumer == self.consumer).scalar()
+            if stored is not None:
+                return stored
+        return self.cursor if self.cursor is not None else latest_seq(db)
+
+    def _read_gaps(self, db: Session, limit: int, now: float) -> List[Change]:
+        late = read_ranges(db, ((first, last) for first, (last, _) in self._gaps.items()), limit)
+        found = [change.seq for change in late]
+        gaps = {}
+        for first, (last, seen) in self._gaps.items():
+            for seq in [seq for seq in found if first <= seq <= last]:
+                if seq > first:
+                    gaps[first] = (seq - 1, seen)
+                first = seq + 1
+            if first <= last:
+                gaps[first] = (last, seen)
+        # Har omläsningen kapats kan resten av intervallen ha rader; de släpps inte förrän nästa poll
+        if len(late) < limit:
+            for first, (last, seen) in list(gaps.items()):
+                if now - seen >= self.gap_timeout:
+                    logger.warning("Hoppar över seq %d-%d i ändringsloggen; transaktionen har troligen rullats tillbaka", first, last)
+                    del gaps[first]
+        self._gaps = gaps
+        return late
+
+    def poll(self, db: Session, limit: int = CHANGELOG_BATCH_ROWS) -> List[Change]:
+        if not self._loaded:
+            self.cursor = self._load_cursor(db)
+            self._gaps = {}
+            self._loaded = True
+
+        now = time.monotonic()
+        late = self._read_gaps(db, limit, now) if self._gaps else []
+        # Luckor avgörs på hela loggen, så typfiltret tillämpas först efteråt
+        rows = read_changes(db, self.cursor, limit)
+        expected = self.cursor + 1
+        for change in rows:
+            if change.seq != expected:
+                self._gaps[expected] = (change.seq - 1, now)
+            expected = change.seq + 1
+        if rows:
+            self.cursor = rows[-1].seq
+        accepted = late + rows
+        if self.resource_types:
+            accepted = [change for change in accepted if change.resource_type in self.resource_types]
+        return accepted
+
+    def reload(self):
+        """Läser markören från databasen igen vid nästa poll."""
+        self._loaded = False
+
+    def commit(self, db: Session):
+        """Sparar markören för konsumenten i den pågående transaktionen."""
+        if self.consumer and self.cursor is not None:
+            upsert_rows(db.connection(), ChangeLogCursor.__table__,
+                        [{"consumer": self.consumer, "seq": self.position, "modified": datetime.utcnow()}],
+                        ("consumer",), update=("seq", "modified"))
+
+
+class ChangeTailer:
+    """
+    Följer ändringsloggen i en egen tråd och anropar handler med varje omgång ändringar. Markören
+    sparas först när handler har returnerat, så en omgång som misslyckas läses igen.
+
+    Med with_session anropas handler(changes, db) i transaktionen som flyttar markören, så att det
+    handler skriver sparas tillsammans med markören. Returnerar handler något anropbart körs det
+    efter commit.
+
+    Med ett konsumentnamn läser bara en process i taget: markörens rad i change_log_cursors hyrs
+    ut i lease_seconds och förnyas i samma transaktion som markören flyttas. Övriga processer
+    väntar tills hyran gått ut. on_lease anropas när processen tar över läsningen.
+    """
+
+    def __init__(self, consumer: Optional[str], handler: Callable, poll_ms: float = CHANGELOG_POLL_MS,
+                 resource_types: Optional[List[str]] = None, session_factory: Callable[[], Session] = SessionLocal,
+                 with_session: bool = False, lease_seconds: float = CHANGELOG_LEASE_SECONDS,
+                 on_lease: Optional[Callable[[], None]] = None):
+        self.reader = ChangeLogReader(consumer, resource_types=resource_types)
+        self.handler = handler
+        self.poll_interval = poll_ms / 1000
+        self.session_factory = session_factory
+        self.with_session = with_session
+        self.lease_seconds = lease_seconds if consumer else None
+        self.on_lease = on_lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"changelog-{self.reader.consumer}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        if self.leader:
+            self._release_lease()
+
+    def _hold_lease(self, db: Session) -> bool:
+        """Tar eller förnyar hyran i db:s transaktion. Raden förblir låst tills transaktionen avslutas."""
+        table = ChangeLogCursor.__table__
+        conn = db.connection()
+        now = datetime.utcnow()
+        consumer = self.reader.consumer
+        if conn.execute(select(table.c.consumer).where(table.c.consumer == consumer)).first() is None:
+            # Utan rad finns inget att hyra; en samtidig process som hinner först vinner
+            upsert_rows(conn, table, [{"consumer": consumer, "seq": self.reader._load_cursor(db), "modified": now}], ("consumer",))
+        taken = conn.execute(update(table).where(
+            table.c.consumer == consumer,
+            or_(table.c.owner.is_(None), table.c.owner == self.owner, table.c.lease_until < now),
+        ).values(owner=self.owner, lease_until=now + timedelta(seconds=self.lease_seconds)))
+        return taken.rowcount == 1
+
+    def _release_lease(self):
+        table = ChangeLogCursor.__table__
+        db = self.session_factory()
+        try:
+            db.execute(update(table).where(table.c.consumer == self.reader.consumer, table.c.owner == self.owner)
+                       .values(owner=None, lease_until=None))
+            db.commit()
+        except Exception:
+            logger.exception("Kunde inte lämna ifrån sig läsningen för %s", self.reader.consumer)
+        finally:
+            db.close()
+        self.leader = False
+
+    def poll_once(self) -> int:
+        db = self.session_factory()
+        cursor, gaps, position = self.reader.cursor, dict(self.reader._gaps), self.reader.position
+        try:
+            if self.lease_seconds:
+                if not self._hold_lease(db):
+                    db.rollback()
+                    self.leader = False
+                    return 0
+                if not self.leader:
+                    # En annan process kan ha flyttat markören sedan den lästes
+                    self.reader.reload()
+                    if self.on_lease:
+                        self.on_lease()
+                    self.leader = True
+            changes = self.reader.poll(db)
+            after_commit = None
+            if changes:
+                after_commit = self.handler(changes, db) if self.with_session else self.handler(changes)
+            if self.reader.position != position:
+                self.reader.commit(db)
+            db.commit()
+            if callable(after_commit):
+                after_commit()
+            return len(changes)
+        except Exception:
+            db.rollback()
+            self.reader.cursor, self.reader._gaps = cursor, gaps
+            # Markören läses om från databasen när hyran tas igen
+            self.leader = False
+            raise
+        finally:
+            db.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                read = self.poll_once()
+            except Exception:
+                logger.exception("Kunde inte läsa ändringsloggen för %s", self.reader.consumer)
+                read = 0
+            # Läs vidare direkt så länge det finns mer att hämta
+            if read < CHANGELOG_BATCH_ROWS:
+                self._stop.wait(self.poll_interval)
+
+
+def compact_change_log(bind, older_than_days: int = CHANGELOG_RETENTION_DAYS, batch_size: int = 10000) -> int:
+    """
+    Tar bort ändringar äldre än older_than_days, men aldrig sådana som en sparad konsumentmarkör
+    ännu inte har passerat.
+    """
+    table = ChangeLog.__table__
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    with bind.connect() as conn:
+        oldest_cursor = conn.execute(select(func.min(ChangeLogCursor.__table__.c.seq))).scalar()
+        last = conn.execute(select(func.max(table.c.seq)).where(table.c.created < cutoff)).scalar()
+    if last is None:
+        return 0
+    if oldest_cursor is not None:
+        last = min(last, oldest_cursor)
+
+    removed = 0
+    while True:
+        with bind.begin() as conn:
+            seqs = [row[0] for row in conn.execute(select(table.c.seq).where(table.c.seq <= last).order_by(table.c.seq).limit(batch_size))]
+            if seqs:
+                conn.execute(delete(table).where(table.c.seq.in_(seqs)))
+        removed += len(seqs)
+        if len(seqs) < batch_size:
+            return removed
+
+
+if __name__ == "__main__":
+    from database import init_engine
+
+    parser = argparse.ArgumentParser(description="Ändringsloggen: följ eller rensa.")
+    parser.add_argument("--tail", action="store_true", help="Skriv ut nya ändringar när de committas.")
+    parser.add_argument("--from-seq", type=int, default=None, help="Börja efter denna seq i stället för vid loggens slut.")
+    parser.add_argument("--compact", action="store_true", help="Ta bort gamla ändringar.")
+    parser.add_argument("--days", type=int, default=CHANGELOG_RETENTION_DAYS)
+    args = parser.parse_args()
+
+    engine = init_engine()
+    if args.compact:
+        print(f"Tog bort {compact_change_log(engine, args.days)} ändringar")
+    elif args.tail:
+        def show(changes: List[Change]):
+            for change in changes:
+                print(f"{change.seq} {change.created.isoformat()} {change.operation} {change.resource_type} {change.resource_id} {','.join(change.changed_columns)}", flush=True)
+
+        tailer = ChangeTailer(None, show)
+        tailer.reader.cursor = args.from_seq
+        try:
+            while True:
+                if tailer.poll_once() < CHANGELOG_BATCH_ROWS:
+                    time.sleep(tailer.poll_interval)
+        except KeyboardInterrupt:
+            pass
+    else:
+        parser.error("Ange --tail eller --compact")
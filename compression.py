@@ -0,0 +1,259 @@
+# compression.py
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Mindre svar än så skickas okomprimerade; vinsten äts upp av huvudena
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+# Brotli och zstd på nivåer som är snabba nog för dynamiska svar
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", "3"))
+# Serverns ordning när klienten anger samma q-värde; kodningar vars paket saknas hoppas över
+COMPRESSION_ENCODINGS = os.environ.get("COMPRESSION_ENCODINGS", "zstd,br,gzip")
+COMPRESSION_CACHE_MB = float(os.environ.get("COMPRESSION_CACHE_MB", "32"))
+
+# Server-Sent Events lämnas orörda så att varje händelse når klienten direkt
+COMPRESSIBLE = ("text/", "application/json", "application/xml", "application/javascript")
+INCOMPRESSIBLE = ("text/event-stream",)
+
+
+class _Gzip:
+    def __init__(self):
+        self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        # Z_SYNC_FLUSH så att varje strömmad del kan packas upp hos klienten direkt
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class _Brotli:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self._compressor.process(data) + (self._compressor.finish() if final else self._compressor.flush())
+
+class _Zstd:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+ENCODERS: Dict[str, Callable] = {"gzip": _Gzip}
+if brotli is not None:
+    ENCODERS["br"] = _Brotli
+if zstandard is not None:
+    ENCODERS["zstd"] = _Zstd
+
+
+def negotiate(accept_encoding: str, available: Sequence[str]) -> Optional[str]:
+    """Kodningen med högst q-värde i Accept-Encoding som servern stöder, eller None."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    wildcard = accepted.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class CompressedCache:
+    """
+    LRU-cache för komprimerade svar, nycklad på (sökväg, ETag, kodning) och begränsad i byte.
+    Ett svar med samma ETag är samma bytes, så den komprimerade varianten kan återanvändas.
+    """
+
+    def __init__(self, max_bytes: int = int(COMPRESSION_CACHE_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key: tuple, body: bytes):
+        # Ett enskilt svar får inte tränga undan mer än en fjärdedel av cachen
+        if len(body) > self.max_bytes // 4:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+compressed_responses = CompressedCache()
+
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+def _compressible(headers: List[Tuple[bytes, bytes]]) -> bool:
+    if _header(headers, b"content-encoding") is not None:
+        return False
+    content_type = (_header(headers, b"content-type") or b"").decode("latin-1").split(";", 1)[0].strip().lower()
+    if content_type.startswith(INCOMPRESSIBLE):
+        return False
+    return content_type.startswith(COMPRESSIBLE) or content_type.endswith(("+json", "+xml"))
+
+def _compressed_headers(headers: List[Tuple[bytes, bytes]], encoding: str, length: Optional[int]) -> List[Tuple[bytes, bytes]]:
+    result = [(key, value) for key, value in headers if key.lower() not in (b"content-length", b"etag")]
+    result.append((b"content-encoding", encoding.encode()))
+    vary = _header(headers, b"vary")
+    if vary is None:
+        result.append((b"vary", b"Accept-Encoding"))
+    elif b"accept-encoding" not in vary.lower():
+        result = [(key, value + b", Accept-Encoding" if key.lower() == b"vary" else value) for key, value in result]
+    if length is not None:
+        result.append((b"content-length", str(length).encode()))
+    # En komprimerad representation är inte bytevis lika med originalet, så ETag blir svag
+    etag = _header(headers, b"etag")
+    if etag is not None:
+        result.append((b"etag", etag if etag.startswith(b"W/") else b"W/" + etag))
+    return result
+
+
+class CompressionMiddleware:
+    """
+    ASGI-middleware som komprimerar svar med gzip, brotli eller zstd efter Accept-Encoding.
+    Svar under minimum_size skickas som de är. Strömmade svar komprimeras del för del när
+    tröskeln nåtts, och varje del töms direkt till klienten. Svar med ETag sparas komprimerade i cachen, och
+    nästa svar med samma ETag skickas därifrån medan appens egen kropp slängs.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE, encodings: Optional[Sequence[str]] = None,
+                 cache: Optional[CompressedCache] = compressed_responses):
+        self.app = app
+        self.minimum_size = minimum_size
+        names = COMPRESSION_ENCODINGS.split(",") if encodings is None else encodings
+        self.encodings = [name.strip() for name in names if name.strip() in ENCODERS]
+        self.cache = cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = _header(scope["headers"], b"accept-encoding")
+        encoding = negotiate(accept_encoding.decode("latin-1"), self.encodings) if accept_encoding else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        mode = None  # None tills första delen av kroppen kommit, sedan "plain", "compress" eller "cached"
+        compressor = None
+        cache_key = None
+        cached_parts: Optional[List[bytes]] = None
+        cached_size = 0
+        pending: List[bytes] = []
+        pending_size = 0
+
+        async def send_compressed(message):
+            nonlocal start, mode, compressor, cache_key, cached_parts, cached_size, pending_size
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                length = _header(headers, b"content-length")
+                too_small = length is not None and int(length) < self.minimum_size
+                if message["status"] < 200 or message["status"] in (204, 304) or too_small or not _compressible(headers):
+                    mode = "plain"
+                    await send(message)
+                    return
+                etag = _header(headers, b"etag")
+                if etag is not None and message["status"] == 200 and self.cache is not None:
+                    cache_key = (scope["path"], etag, encoding)
+                    body = self.cache.get(cache_key)
+                    if body is not None:
+                        mode = "cached"
+                        await send({**message, "headers": _compressed_headers(headers, encoding, len(body))})
+                        await send({"type": "http.response.body", "body": body})
+                        return
+                    cached_parts = []
+                start = message
+                return
+
+            if mode == "cached":
+                return
+            if mode == "plain" or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if mode is None:
+                # Strömmade svar saknar längd; de första delarna hålls kvar tills tröskeln nåtts
+                pending.append(body)
+                pending_size += len(body)
+                if more_body and pending_size < self.minimum_size:
+                    return
+                body = b"".join(pending)
+                pending.clear()
+                headers = list(start.get("headers", []))
+                if pending_size < self.minimum_size:
+                    mode = "plain"
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                mode = "compress"
+                compressor = ENCODERS[encoding]()
+                if not more_body:
+                    data = compressor.compress(body, True)
+                    await send({**start, "headers": _compressed_headers(headers, encoding, len(data))})
+                    await send({"type": "http.response.body", "body": data})
+                    if cached_parts is not None:
+                        self.cache.put(cache_key, data)
+                    return
+                await send({**start, "headers": _compressed_headers(headers, encoding, None)})
+
+            data = compressor.compress(body, not more_body)
+            if cached_parts is not None:
+                cached_parts.append(data)
+                cached_size += len(data)
+                if cached_size > self.cache.max_bytes // 4:
+                    cached_parts = None
+                elif not more_body:
+                    self.cache.put(cache_key, b"".join(cached_parts))
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,16 +1,20 @@
 # database.py
 import os
-from datetime import date, datetime
+from datetime import datetime
+from typing import Optional
 
-from sqlalchemy import create_engine, Column, String, DateTime, ForeignKey, Float, Text, Integer, Table
-from sqlalchemy.orm import declarative_base, sessionmaker, Session, relationship
+from sqlalchemy import create_engine, text, Column, String, Date, DateTime, ForeignKey, Float, Text, Integer, BigInteger, Table, Index
+from sqlalchemy.orm import declarative_base, sessionmaker, Session, relationship, synonym
 
 # --- Databas configuration ---
+# Motorn skapas först i applikationens lifespan (se init_engine) så att import
+# av modulen är billig och fri från sidoeffekter.
 DATABASE_URL = os.environ.get("DATABASE_URL")
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL-miljövariabeln är inte inställd")
 
-engine = create_engine(DATABASE_URL)
+# Ökas när tabellstrukturen i database.sql/modellerna ändras.
+SCHEMA_VERSION = 13
+
+engine = None
 
 Base = declarative_base()
 
@@ -41,14 +45,15 @@ class Organisation(Base):
     municipality_code = Column(String(255))
     type = Column(String(50))
     school_types = Column(String(255)) # Lagras som en komma-separerad sträng
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
     
     # Define the relationship to itself for parent-child relationships
     parent = relationship("Organisation", remote_side=[id], back_populates="children")
     children = relationship("Organisation", back_populates="parent")
+    school_unit_offerings = relationship("SchoolUnitOffering", back_populates="offered_at")
 
 class Person(Base):
     __tablename__ = "persons"
@@ -65,13 +70,17 @@ class Person(Base):
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
 
-    placements_child = relationship("Placement", foreign_keys="Placement.child_id", back_populates="child")
+    placements_child = relationship("Placement", foreign_keys="Placement.person_id", back_populates="child")
     placements_owner = relationship("Placement", foreign_keys="Placement.owner_id", back_populates="owner")
     duties = relationship("Duty", back_populates="person")
     group_memberships = relationship("GroupMembership", back_populates="person")
     responsible_for_children = relationship("ResponsibleFor", foreign_keys="ResponsibleFor.responsible_id", back_populates="responsible")
-    responsible_for_enrolments = relationship("ResponsibleFor", foreign_keys="ResponsibleFor.responsible_id", back_populates="responsible") # Placeholder for now
-    responsible_for_placements = relationship("ResponsibleFor", foreign_keys="ResponsibleFor.responsible_id", back_populates="responsible") # Placeholder for now
+    responsible_for_enrolments = relationship("ResponsibleFor", foreign_keys="ResponsibleFor.responsible_id", back_populates="responsible", viewonly=True) # Placeholder for now
+    responsible_for_placements = relationship("ResponsibleFor", foreign_keys="ResponsibleFor.responsible_id", back_populates="responsible", viewonly=True) # Placeholder for now
+    studyplans = relationship("StudyPlan", back_populates="student")
+    attendance = relationship("Attendance", back_populates="person")
+    grades = relationship("Grade", back_populates="person")
+    aggregated_attendance = relationship("AggregatedAttendance", back_populates="person")
     
 class Placement(Base):
     """Mappar mot tabellen 'placements'. Representerar en placering för en person."""
@@ -81,15 +90,15 @@ class Placement(Base):
     group_id = Column(String(36), ForeignKey('groups.id'))
     person_id = Column(String(36), ForeignKey('persons.id'))  # Representerar 'child' i specen
     owner_id = Column(String(36), ForeignKey('persons.id'))
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
     
     placed_at = relationship("Organisation")
     group = relationship("Group")
-    child = relationship("Person", foreign_keys=[person_id], primaryjoin="Placement.person_id == Person.id")
-    owner = relationship("Person", foreign_keys=[owner_id], primaryjoin="Placement.owner_id == Person.id")
+    child = relationship("Person", foreign_keys=[person_id], back_populates="placements_child")
+    owner = relationship("Person", foreign_keys=[owner_id], back_populates="placements_owner")
 
 class PlacementOwner(Base):
     __tablename__ = "placement_owners"
@@ -102,13 +111,13 @@ class Duty(Base):
     person_id = Column(String(36), ForeignKey('persons.id'))
     organisation_id = Column(String(36), ForeignKey('organisations.id'))
     duty_role = Column(String(255), nullable=False)
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
-    person = relationship("Person", foreign_keys=[person_id])
+    person = relationship("Person", foreign_keys=[person_id], back_populates="duties")
     organisation = relationship("Organisation", foreign_keys=[organisation_id])
 
 class Group(Base):
@@ -117,8 +126,8 @@ class Group(Base):
     display_name = Column(String(255), nullable=False)
     group_type = Column(String(50), nullable=False)
     school_types = Column(String(255)) # Lagras som en komma-separerad sträng
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     organisation_id = Column(String(36), ForeignKey('organisations.id'))
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
@@ -135,8 +144,8 @@ class AssignmentRole(Base):
     group_id = Column(String(36), ForeignKey('groups.id'))
     person_id = Column(String(36), ForeignKey('persons.id'))
     assignment_role = Column(String(255), nullable=False)
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
 
@@ -149,8 +158,8 @@ class GroupMembership(Base):
     id = Column(String(36), primary_key=True)
     person_id = Column(String(36), ForeignKey('persons.id'))
     group_id = Column(String(36), ForeignKey('groups.id'))
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
 
@@ -162,8 +171,8 @@ class ResponsibleFor(Base):
     id = Column(String(36), primary_key=True)
     responsible_id = Column(String(36), ForeignKey('persons.id'))
     child_id = Column(String(36), ForeignKey('persons.id'))
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
     
@@ -189,8 +198,8 @@ class StudyPlan(Base):
     title = Column(String(255), nullable=False)
     description = Column(Text)
     student_id = Column(String(36), ForeignKey('persons.id'))
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
 
@@ -206,8 +215,8 @@ class Syllabus(Base):
     subject_designation = Column(String(255))
     level = Column(String(50))
     points = Column(Integer)
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     description = Column(Text)
     last_published_version = Column(String(50))
     published_at = Column(DateTime)
@@ -222,8 +231,8 @@ class SchoolUnitOffering(Base):
     id = Column(String(36), primary_key=True)
     name = Column(String(255))
     code = Column(String(50))
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     offered_at_id = Column(String(36), ForeignKey('organisations.id'))
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
@@ -237,8 +246,8 @@ class Activity(Base):
     display_name = Column(String(255), nullable=False)
     organisation_id = Column(String(36), ForeignKey('organisations.id'))
     syllabus_id = Column(String(36), ForeignKey('syllabuses.id'))
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
 
@@ -247,6 +256,7 @@ class Activity(Base):
     syllabus = relationship("Syllabus")
     organisation = relationship("Organisation")
     calendar_events = relationship("CalendarEvent", back_populates="activity")
+    attendance_records = relationship("Attendance", back_populates="activity")
 
 
 class CalendarEvent(Base):
@@ -259,10 +269,21 @@ class CalendarEvent(Base):
     location = Column(String(255))
     activity_id = Column(String(36), ForeignKey("activities.id"))
     created = Column(DateTime, default=datetime.utcnow)
-    modified = Column(DateTime, default=datetime.utcnow)
+    modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow) # Ingår i iCalendar-flödenas fingeravtryck
+    # Svarsschemat heter startTime/endTime som i SS12000
+    startTime = synonym("start_time")
+    endTime = synonym("end_time")
 
     activity = relationship("Activity", back_populates="calendar_events")
-    attendance = relationship("Attendance", back_populates="calendar_event")
+    # calendarEvents är partitionerad och kan inte vara mål för en främmande nyckel i MySQL
+    attendance = relationship("Attendance", primaryjoin="CalendarEvent.id == foreign(Attendance.calendar_event_id)", back_populates="calendar_event")
+
+    __table_args__ = (
+        # Intervallindex för tidsfönster; id gör indexet täckande för sortering och paginering
+        Index('ix_calendarEvents_window', 'start_time', 'end_time', 'id'),
+        # Används när deltagarindexet joinas mot händelser inom ett tidsfönster
+        Index('ix_calendarEvents_activity_start', 'activity_id', 'start_time'),
+    )
 
 class Attendance(Base):
     """Mappar mot tabellen 'attendance'."""
@@ -271,13 +292,19 @@ class Attendance(Base):
     person_id = Column(String(36), ForeignKey("persons.id"))
     activity_id = Column(String(36), ForeignKey("activities.id"))
     attendance_event_id = Column(String(36), ForeignKey("attendanceEvents.id"))
+    calendar_event_id = Column(String(36)) # Lektionstillfället; kan även vara en genererad förekomst
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
 
     person = relationship("Person", back_populates="attendance")
     activity = relationship("Activity", back_populates="attendance_records")
     attendance_event = relationship("AttendanceEvent", back_populates="attendance_records")
-    calendar_event = relationship("CalendarEvent", back_populates="attendance")
+    calendar_event = relationship("CalendarEvent", primaryjoin="foreign(Attendance.calendar_event_id) == CalendarEvent.id", back_populates="attendance")
+
+    __table_args__ = (
+        # En registrering per person och lektionstillfälle; används som konfliktnyckel vid massregistrering
+        Index('ux_attendance_registration', 'calendar_event_id', 'person_id', unique=True),
+    )
 
 class AttendanceEvent(Base):
     """Mappar mot tabellen 'attendanceEvents'."""
@@ -321,6 +348,11 @@ class AggregatedAttendance(Base):
     # Relation till Person
     person = relationship("Person", back_populates="aggregated_attendance")
 
+    __table_args__ = (
+        # En rad per person; underhålls av aggregation.py
+        Index('ux_aggregatedAttendance_person', 'person_id', unique=True),
+    )
+
 class Resource(Base):
     """Mappar mot tabellen 'resources'."""
     __tablename__ = "resources"
@@ -344,6 +376,7 @@ class Subscription(Base):
     resource_type = Column(String(255), nullable=False)
     resource_id = Column(String(36), nullable=False)
     user_id = Column(String(36), nullable=False)
+    target = Column(String(2048)) # URL som notiser levereras till; utan target levereras inget
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
 
@@ -356,6 +389,12 @@ class DeletedEntity(Base):
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index('ix_deletedEntities_type_deleted', 'resource_type', 'deleted_at'),
+        # Nyckelbaserad paginering på meta.created
+        Index('ix_deletedEntities_created', 'created', 'id'),
+    )
+
 class Log(Base):
     """Mappar mot tabellen 'log'."""
     __tablename__ = "log"
@@ -370,17 +409,263 @@ class Enrolment(Base):
     id = Column(String(36), primary_key=True)
     person_id = Column(String(36), ForeignKey('persons.id'))
     enroled_at_id = Column(String(36), ForeignKey('organisations.id'))
-    start_date = Column(date)
-    end_date = Column(date)
+    start_date = Column(Date)
+    end_date = Column(Date)
     created = Column(DateTime, default=datetime.utcnow)
     modified = Column(DateTime, default=datetime.utcnow)
     
     person = relationship("Person")
     enroled_at = relationship("Organisation")
 
-Base.metadata.create_all(engine)
+class ActivityParticipant(Base):
+    """
+    Mappar mot tabellen 'activity_participants'. Deltagarindex som kopplar personer till aktiviteter,
+    antingen som elev (via grupp och gruppmedlemskap) eller som lärare (via tjänstgöring), under
+    medlemskapets eller tjänstgöringens giltighetstid. Underhålls av participation.py.
+    """
+    __tablename__ = "activity_participants"
+    activity_id = Column(String(36), ForeignKey('activities.id'), primary_key=True)
+    person_id = Column(String(36), ForeignKey('persons.id'), primary_key=True)
+    role = Column(String(20), primary_key=True) # 'student' eller 'teacher'
+    valid_from = Column(Date, primary_key=True) # 1000-01-01 när startdatum saknas
+    valid_to = Column(Date, nullable=False) # 9999-12-31 när slutdatum saknas
+
+    __table_args__ = (
+        Index('ix_activity_participants_person', 'person_id', 'role', 'activity_id', 'valid_from', 'valid_to'),
+    )
+
+class RecurrenceRule(Base):
+    """
+    Mappar mot tabellen 'recurrence_rules'. En återkommande regel (RRULE-liknande) för en aktivitet
+    eller ett närvaroschema. Förekomsterna genereras vid behov av recurrence.py i stället för att lagras.
+    """
+    __tablename__ = "recurrence_rules"
+    id = Column(String(36), primary_key=True)
+    activity_id = Column(String(36), ForeignKey('activities.id'))
+    attendance_schedule_id = Column(String(36), ForeignKey('attendanceSchedules.id'))
+    name = Column(String(255))
+    location = Column(String(255))
+    rrule = Column(String(255), nullable=False) # t.ex. "FREQ=WEEKLY;BYDAY=MO,WE;UNTIL=20250613T000000"
+    dtstart = Column(DateTime, nullable=False)
+    until = Column(DateTime) # Sista möjliga förekomst, härledd ur regeln; NULL betyder obegränsad
+    duration_minutes = Column(Integer, nullable=False)
+    exdates = Column(Text) # Lagras som en komma-separerad sträng av ISO-tidpunkter
+    created = Column(DateTime, default=datetime.utcnow)
+    modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    activity = relationship("Activity")
+
+    __table_args__ = (
+        Index('ix_recurrence_rules_activity_window', 'activity_id', 'dtstart', 'until'),
+        Index('ix_recurrence_rules_schedule', 'attendance_schedule_id'),
+    )
+
+class AttendanceRollup(Base):
+    """
+    Mappar mot tabellen 'attendance_rollups'. Förberäknade närvarosummor per person, aktivitet,
+    grupp eller period (scope_type). period är "" för hela tiden eller "ÅÅÅÅ-MM" för en månad.
+    Underhålls inkrementellt av aggregation.py när närvaroposter skrivs.
+    """
+    __tablename__ = "attendance_rollups"
+    scope_type = Column(String(16), primary_key=True) # 'person', 'activity', 'group' eller 'period'
+    scope_id = Column(String(36), primary_key=True)
+    period = Column(String(7), primary_key=True, default="")
+    present_count = Column(Integer, nullable=False, default=0)
+    total_count = Column(Integer, nullable=False, default=0)
+    modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class StatisticsRollup(Base):
+    """
+    Mappar mot tabellen 'statistics_rollups'. Förberäknade antal aktiva personer, inskrivningar,
+    placeringar, tjänstgöringar, grupper och aktiviteter per organisationsenhet och skolform.
+    own_count gäller enheten själv, total_count även dess underliggande enheter.
+    Underhålls av org_statistics.py.
+    """
+    __tablename__ = "statistics_rollups"
+    organisation_id = Column(String(36), primary_key=True)
+    school_type = Column(String(50), primary_key=True, default="") # "" när skolformen inte kan avgöras
+    metric = Column(String(20), primary_key=True)
+    own_count = Column(Integer, nullable=False, default=0)
+    total_count = Column(Integer, nullable=False, default=0)
+    computed_on = Column(Date, nullable=False) # Dagen som "aktiv" avser
+    modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class WebhookDeadLetter(Base):
+    """
+    Mappar mot tabellen 'webhook_dead_letters'. Leveranser som misslyckats efter alla försök.
+    payload är den JSON som skulle ha levererats. Skrivs av webhooks.py.
+    """
+    __tablename__ = "webhook_dead_letters"
+    id = Column(String(36), primary_key=True)
+    target = Column(String(2048), nullable=False)
+    payload = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    last_error = Column(Text)
+    created = Column(DateTime, default=datetime.utcnow)
+
+class WebhookOutbox(Base):
+    """
+    Mappar mot tabellen 'webhook_outbox'. Leveranser som matchats mot en prenumeration men ännu inte
+    levererats. Skrivs i samma transaktion som ändringsloggens markör flyttas och tas bort när
+    leveransen lyckats eller blivit en dead letter. Skrivs av webhooks.py.
+    """
+    __tablename__ = "webhook_outbox"
+    id = Column(String(36), primary_key=True)
+    target = Column(String(2048), nullable=False)
+    item = Column(Text, nullable=False) # Ändringen som JSON, som den levereras
+    created = Column(DateTime, default=datetime.utcnow)
+
+class ChangeLog(Base):
+    """
+    Mappar mot tabellen 'change_log'. Varje insert, update och delete på modellerna skrivs här
+    i samma transaktion som ändringen, i stigande seq-ordning. Skrivs och läses av changelog.py.
+    """
+    __tablename__ = "change_log"
+    # SQLite räknar bara upp INTEGER PRIMARY KEY automatiskt
+    seq = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    resource_type = Column(String(255), nullable=False)
+    resource_id = Column(String(255), nullable=False)
+    operation = Column(String(10), nullable=False) # insert, update eller delete
+    changed_columns = Column(Text) # Lagras som en komma-separerad sträng
+    organisation_id = Column(String(36)) # Organisationen resursen hörde till, för filtrering av ändringsflöden
+    created = Column(DateTime, default=datetime.utcnow)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    __table_args__ = (
+        Index('ix_change_log_created', 'created'),
+    )
+
+class ChangeLogCursor(Base):
+    """
+    Mappar mot tabellen 'change_log_cursors'. Senast lästa seq per konsument av ändringsloggen, och
+    vilken process som läser för konsumenten just nu (owner) och hur länge (lease_until).
+    """
+    __tablename__ = "change_log_cursors"
+    consumer = Column(String(100), primary_key=True)
+    seq = Column(BigInteger, nullable=False)
+    owner = Column(String(100))
+    lease_until = Column(DateTime)
+    modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SchemaVersion(Base):
+    """Mappar mot tabellen 'schema_version'. Innehåller databasens schemaversion."""
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    applied = Column(DateTime, default=datetime.utcnow)
+
+# Tabeller som bara är bokföring (index, summor, loggar). De ger varken notiser eller tombstones.
+BOOKKEEPING_MODELS = {
+    "ActivityParticipant", "AttendanceRollup", "StatisticsRollup", "DeletedEntity", "Log", "WebhookDeadLetter",
+    "WebhookOutbox", "ChangeLog", "ChangeLogCursor", "SchemaVersion",
+}
+# Tabeller som är interna för servern och inte SS12000-resurser. De ger inga notiser.
+INTERNAL_MODELS = BOOKKEEPING_MODELS | {"RecurrenceRule", "PlacementOwner", "Subscription"}
+
+def resource_type_of(obj, include_internal: bool = False) -> Optional[str]:
+    """
+    Resurstypen för en modellinstans, t.ex. 'Person'. None för bokföringstabeller och,
+    om inte include_internal anges, för serverns interna tabeller.
+    """
+    name = type(obj).__name__
+    if name in (BOOKKEEPING_MODELS if include_internal else INTERNAL_MODELS):
+        return None
+    return name
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+def init_engine(database_url: str = None, **engine_kwargs):
+    """
+    Skapar databasmotorn och binder SessionLocal till den.
+    Anropas från applikationens lifespan i stället för vid import.
+    """
+    global engine
+    database_url = database_url or DATABASE_URL or os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise ValueError("DATABASE_URL-miljövariabeln är inte inställd")
+
+    if not database_url.startswith("sqlite"):
+        engine_kwargs.setdefault("pool_size", int(os.environ.get("DB_POOL_SIZE", "10")))
+        engine_kwargs.setdefault("max_overflow", int(os.environ.get("DB_MAX_OVERFLOW", "20")))
+
+    engine = create_engine(database_url, pool_pre_ping=True, **engine_kwargs)
+    SessionLocal.configure(bind=engine)
+    return engine
+
+def dispose_engine():
+    """Stänger alla anslutningar i poolen vid nedstängning."""
+    global engine
+    if engine is not None:
+        engine.dispose()
+        engine = None
+
+def check_schema_version(bind):
+    """
+    Kontrollerar att databasens schemaversion matchar SCHEMA_VERSION.
+    Ersätter create_all vid uppstart: en enda SELECT i stället för reflektion av varje tabell.
+    """
+    try:
+        with bind.connect() as conn:
+            version = conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    except Exception as e:
+        raise RuntimeError("Databasen saknar tabellen 'schema_version'. Kör database.sql eller create_schema().") from e
+
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(f"Databasens schemaversion är {version}, applikationen förväntar sig {SCHEMA_VERSION}.")
+    return version
+
+def create_schema(bind):
+    """
+    Skapar alla tabeller och registrerar schemaversionen.
+    Används explicit av utvecklingsverktyg (t.ex. mot SQLite), aldrig vid import.
+    """
+    Base.metadata.create_all(bind)
+    with bind.begin() as conn:
+        if conn.execute(text("SELECT COUNT(*) FROM schema_version WHERE version = :v"), {"v": SCHEMA_VERSION}).scalar() == 0:
+            conn.execute(SchemaVersion.__table__.insert(), {"version": SCHEMA_VERSION, "applied": datetime.utcnow()})
+
+def upsert_rows(conn, table, rows, index_elements, increment=(), update=(), chunk_size=1000):
+    """
+    Skriver rader med flerradiga INSERT-satser och hanterar konflikter på index_elements.
+    Kolumner i increment adderas till det befintliga värdet, kolumner i update skrivs över.
+    Utan increment/update ignoreras befintliga rader. Alla rader måste ha samma nycklar.
+    """
+    if not rows:
+        return
+    dialect = conn.dialect.name
+
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+
+        if dialect == "mysql":
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+            stmt = mysql_insert(table).values(chunk)
+            values = {c: table.c[c] + stmt.inserted[c] for c in increment}
+            values.update({c: stmt.inserted[c] for c in update})
+            if not values:
+                # Ingen kolumn att uppdatera: skriv tillbaka nyckeln, dvs. INSERT IGNORE utan att tysta andra fel
+                values = {index_elements[0]: table.c[index_elements[0]]}
+            conn.execute(stmt.on_duplicate_key_update(**values))
+
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+            stmt = sqlite_insert(table).values(chunk)
+            values = {c: table.c[c] + stmt.excluded[c] for c in increment}
+            values.update({c: stmt.excluded[c] for c in update})
+            if values:
+                conn.execute(stmt.on_conflict_do_update(index_elements=list(index_elements), set_=values))
+            else:
+                conn.execute(stmt.on_conflict_do_nothing(index_elements=list(index_elements)))
+
+        else:
+            # Generisk väg för övriga dialekter: UPDATE och vid miss INSERT, rad för rad
+            for row in chunk:
+                key = [table.c[c] == row[c] for c in index_elements]
+                values = {c: table.c[c] + row[c] for c in increment}
+                values.update({c: row[c] for c in update})
+                if values and conn.execute(table.update().where(*key).values(**values)).rowcount:
+                    continue
+                if not values and conn.execute(table.select().where(*key)).first():
+                    continue
+                conn.execute(table.insert().values(**row))
 
 def get_db():
     db = SessionLocal()
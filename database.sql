@@ -5,6 +5,14 @@ USE ss12000_db;
 
 -- Drop tables if they exist to allow for clean re-creation
 -- The order is important due to foreign key constraints
+DROP TABLE IF EXISTS change_log_cursors;
+DROP TABLE IF EXISTS change_log;
+DROP TABLE IF EXISTS webhook_outbox;
+DROP TABLE IF EXISTS webhook_dead_letters;
+DROP TABLE IF EXISTS statistics_rollups;
+DROP TABLE IF EXISTS attendance_rollups;
+DROP TABLE IF EXISTS activity_participants;
+DROP TABLE IF EXISTS recurrence_rules;
 DROP TABLE IF EXISTS subscriptions;
 DROP TABLE IF EXISTS log;
 DROP TABLE IF EXISTS deletedEntities;
@@ -26,6 +34,7 @@ DROP TABLE IF EXISTS organisations;
 DROP TABLE IF EXISTS attendanceSchedules;
 DROP TABLE IF EXISTS resources;
 DROP TABLE IF EXISTS rooms;
+DROP TABLE IF EXISTS schema_version;
 
 -- Organisations table
 CREATE TABLE organisations (
@@ -123,14 +132,34 @@ CREATE TABLE activities (
 );
 
 -- CalendarEvents table
+-- Partitioned by month on start_time so that a time window only reads the partitions it covers.
+-- MySQL requires the partitioning column in the primary key and does not allow foreign keys on
+-- partitioned tables, so activity_id is only indexed. New months are added with partitions.py.
 CREATE TABLE calendarEvents (
-    id VARCHAR(36) PRIMARY KEY,
+    id VARCHAR(36) NOT NULL,
     activity_id VARCHAR(36),
-    start_time TIMESTAMP,
-    end_time TIMESTAMP,
-    FOREIGN KEY (activity_id) REFERENCES activities(id),
+    start_time DATETIME NOT NULL,
+    end_time DATETIME NOT NULL,
     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, start_time),
+    INDEX ix_calendarEvents_window (start_time, end_time, id),
+    INDEX ix_calendarEvents_activity_start (activity_id, start_time)
+)
+PARTITION BY RANGE (TO_DAYS(start_time)) (
+    PARTITION p202408 VALUES LESS THAN (TO_DAYS('2024-09-01')),
+    PARTITION p202409 VALUES LESS THAN (TO_DAYS('2024-10-01')),
+    PARTITION p202410 VALUES LESS THAN (TO_DAYS('2024-11-01')),
+    PARTITION p202411 VALUES LESS THAN (TO_DAYS('2024-12-01')),
+    PARTITION p202412 VALUES LESS THAN (TO_DAYS('2025-01-01')),
+    PARTITION p202501 VALUES LESS THAN (TO_DAYS('2025-02-01')),
+    PARTITION p202502 VALUES LESS THAN (TO_DAYS('2025-03-01')),
+    PARTITION p202503 VALUES LESS THAN (TO_DAYS('2025-04-01')),
+    PARTITION p202504 VALUES LESS THAN (TO_DAYS('2025-05-01')),
+    PARTITION p202505 VALUES LESS THAN (TO_DAYS('2025-06-01')),
+    PARTITION p202506 VALUES LESS THAN (TO_DAYS('2025-07-01')),
+    PARTITION p202507 VALUES LESS THAN (TO_DAYS('2025-08-01')),
+    PARTITION pmax VALUES LESS THAN MAXVALUE
 );
 
 -- AttendanceEvents table
@@ -147,6 +176,8 @@ CREATE TABLE attendance (
     person_id VARCHAR(36),
     activity_id VARCHAR(36),
     attendance_event_id VARCHAR(36),
+    calendar_event_id VARCHAR(36),
+    UNIQUE INDEX ux_attendance_registration (calendar_event_id, person_id),
     FOREIGN KEY (person_id) REFERENCES persons(id),
     FOREIGN KEY (activity_id) REFERENCES activities(id),
     FOREIGN KEY (attendance_event_id) REFERENCES attendanceEvents(id),
@@ -177,6 +208,7 @@ CREATE TABLE aggregatedAttendance (
     id VARCHAR(36) PRIMARY KEY,
     person_id VARCHAR(36),
     attendance_percentage FLOAT,
+    UNIQUE INDEX ux_aggregatedAttendance_person (person_id),
     FOREIGN KEY (person_id) REFERENCES persons(id),
     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
@@ -204,6 +236,7 @@ CREATE TABLE subscriptions (
     resource_type VARCHAR(255) NOT NULL,
     resource_id VARCHAR(36) NOT NULL,
     user_id VARCHAR(36) NOT NULL,
+    target VARCHAR(2048),
     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
 );
@@ -214,7 +247,9 @@ CREATE TABLE deletedEntities (
     resource_type VARCHAR(255) NOT NULL,
     deleted_at TIMESTAMP NOT NULL,
     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX ix_deletedEntities_type_deleted (resource_type, deleted_at),
+    INDEX ix_deletedEntities_created (created, id)
 );
 
 -- Log table
@@ -226,6 +261,115 @@ CREATE TABLE log (
     modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
 );
 
+-- Participation index: which persons take part in which activities, as student (via group membership)
+-- or teacher (via duty), with the membership's or duty's validity dates. Open-ended dates are stored as
+-- 1000-01-01 and 9999-12-31. Maintained by the application, see participation.py
+CREATE TABLE activity_participants (
+    activity_id VARCHAR(36) NOT NULL,
+    person_id VARCHAR(36) NOT NULL,
+    role VARCHAR(20) NOT NULL,
+    valid_from DATE NOT NULL,
+    valid_to DATE NOT NULL,
+    PRIMARY KEY (activity_id, person_id, role, valid_from),
+    INDEX ix_activity_participants_person (person_id, role, activity_id, valid_from, valid_to),
+    FOREIGN KEY (activity_id) REFERENCES activities(id),
+    FOREIGN KEY (person_id) REFERENCES persons(id)
+);
+
+-- Recurrence rules for activities and attendance schedules. Occurrences are expanded
+-- on demand by the application (see recurrence.py) instead of being stored as calendarEvents
+CREATE TABLE recurrence_rules (
+    id VARCHAR(36) PRIMARY KEY,
+    activity_id VARCHAR(36),
+    attendance_schedule_id VARCHAR(36),
+    name VARCHAR(255),
+    location VARCHAR(255),
+    rrule VARCHAR(255) NOT NULL,
+    dtstart DATETIME NOT NULL,
+    until DATETIME,
+    duration_minutes INT NOT NULL,
+    exdates TEXT,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX ix_recurrence_rules_activity_window (activity_id, dtstart, until),
+    INDEX ix_recurrence_rules_schedule (attendance_schedule_id),
+    FOREIGN KEY (activity_id) REFERENCES activities(id),
+    FOREIGN KEY (attendance_schedule_id) REFERENCES attendanceSchedules(id)
+);
+
+-- Precomputed attendance totals per person, activity, group and month. Maintained incrementally
+-- by the application (see aggregation.py); rebuild with "python aggregation.py --rebuild"
+CREATE TABLE attendance_rollups (
+    scope_type VARCHAR(16) NOT NULL,
+    scope_id VARCHAR(36) NOT NULL,
+    period VARCHAR(7) NOT NULL DEFAULT '',
+    present_count INT NOT NULL DEFAULT 0,
+    total_count INT NOT NULL DEFAULT 0,
+    modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (scope_type, scope_id, period)
+);
+
+-- Precomputed counts of active persons, enrolments, placements, duties, groups and activities per
+-- organisation unit and school type, including descendant units. Maintained by the application
+-- (see org_statistics.py) and recomputed in full once per day
+CREATE TABLE statistics_rollups (
+    organisation_id VARCHAR(36) NOT NULL,
+    school_type VARCHAR(50) NOT NULL DEFAULT '',
+    metric VARCHAR(20) NOT NULL,
+    own_count INT NOT NULL DEFAULT 0,
+    total_count INT NOT NULL DEFAULT 0,
+    computed_on DATE NOT NULL,
+    modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (organisation_id, school_type, metric)
+);
+
+-- Webhook deliveries that failed after all attempts (see webhooks.py)
+CREATE TABLE webhook_dead_letters (
+    id VARCHAR(36) PRIMARY KEY,
+    target VARCHAR(2048) NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INT NOT NULL,
+    last_error TEXT,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Matched webhook deliveries that have not been delivered yet, written together with the
+-- change log cursor so that a crash does not lose them
+CREATE TABLE webhook_outbox (
+    id VARCHAR(36) PRIMARY KEY,
+    target VARCHAR(2048) NOT NULL,
+    item TEXT NOT NULL,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Ordered change log written in the same transaction as each change
+CREATE TABLE change_log (
+    seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+    resource_type VARCHAR(255) NOT NULL,
+    resource_id VARCHAR(255) NOT NULL,
+    operation VARCHAR(10) NOT NULL,
+    changed_columns TEXT,
+    organisation_id VARCHAR(36),
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_change_log_created (created)
+);
+
+-- One reader per consumer at a time: owner holds the lease until lease_until
+CREATE TABLE change_log_cursors (
+    consumer VARCHAR(100) PRIMARY KEY,
+    seq BIGINT NOT NULL,
+    owner VARCHAR(100),
+    lease_until DATETIME,
+    modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Schema version table, checked by the application at startup instead of create_all
+CREATE TABLE schema_version (
+    version INT PRIMARY KEY,
+    applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO schema_version (version) VALUES (13);
 
 --
 -- Sample data
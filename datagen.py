@@ -0,0 +1,472 @@
+# datagen.py
+import argparse
+import csv
+import json
+import os
+import random
+import time
+import uuid
+import zlib
+from array import array
+from datetime import date, datetime, time as dtime, timedelta
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+from sqlalchemy import Table
+
+from database import (
+    Activity, Attendance, AttendanceEvent, CalendarEvent, Duty, Group, GroupMembership, Organisation, Person,
+    Room, Syllabus, activity_group_association, activity_teacher_association,
+)
+
+DATAGEN_CHUNK_ROWS = int(os.environ.get("DATAGEN_CHUNK_ROWS", "5000"))
+DATAGEN_TRANSACTION_ROWS = int(os.environ.get("DATAGEN_TRANSACTION_ROWS", "100000"))
+
+
+class Scale(NamedTuple):
+    municipalities: int = 1
+    school_units: int = 20
+    persons: int = 5000
+    groups: int = 250
+    memberships: int = 25000
+    activities: int = 500
+    events: int = 100000
+    attendance: int = 200000
+    staff_share: float = 0.1
+    rooms_per_unit: int = 20
+
+
+PRESETS = {
+    "tiny": Scale(1, 3, 300, 15, 1200, 30, 3000, 5000),
+    "small": Scale(),
+    "municipality": Scale(1, 500, 200_000, 10_000, 2_000_000, 20_000, 20_000_000, 20_000_000),
+}
+
+GIVEN_NAMES = [
+    "Alice", "Alva", "Astrid", "Ebba", "Elsa", "Ella", "Freja", "Maja", "Olivia", "Saga", "Selma", "Vera", "Wilma",
+    "Agnes", "Alma", "Signe", "Nora", "Ines", "Leah", "Lilly", "Aisha", "Fatima", "Amina", "Sara", "Maria", "Anna",
+    "Erik", "Hugo", "Liam", "Lucas", "Noah", "Oscar", "William", "Elias", "Adam", "Alexander", "Leo", "Ludvig",
+    "Theo", "Viktor", "Axel", "Filip", "Isak", "Nils", "Omar", "Ali", "Mohammed", "Johan", "Karl", "Lars", "Per",
+]
+FAMILY_NAMES = [
+    "Andersson", "Johansson", "Karlsson", "Nilsson", "Eriksson", "Larsson", "Olsson", "Persson", "Svensson",
+    "Gustafsson", "Pettersson", "Jonsson", "Jansson", "Hansson", "Bengtsson", "Jönsson", "Lindberg", "Jakobsson",
+    "Magnusson", "Lindström", "Olofsson", "Lindqvist", "Lindgren", "Berg", "Axelsson", "Bergström", "Lundberg",
+    "Lind", "Lundgren", "Lundqvist", "Mattsson", "Berglund", "Fredriksson", "Sandberg", "Henriksson", "Ahmed",
+    "Ali", "Hassan", "Mohamed", "Nguyen", "Kaya", "Yilmaz", "Novak", "Forsberg", "Sjöberg", "Wallin", "Engström",
+]
+SUBJECTS = [
+    ("Svenska", "SVE"), ("Matematik", "MA"), ("Engelska", "ENG"), ("Biologi", "BI"), ("Fysik", "FY"),
+    ("Kemi", "KE"), ("Historia", "HI"), ("Geografi", "GE"), ("Samhällskunskap", "SH"), ("Religionskunskap", "RE"),
+    ("Idrott och hälsa", "IDH"), ("Bild", "BL"), ("Musik", "MU"), ("Slöjd", "SL"), ("Teknik", "TK"),
+    ("Hem- och konsumentkunskap", "HKK"), ("Moderna språk", "M2"), ("Modersmål", "MOD"),
+]
+# Närvarotyperna i exempeldata; fördelningen gäller en elev med genomsnittlig frånvaro
+ATTENDANCE_EVENTS = ["Närvarande", "Sen ankomst", "Frånvarande", "Sjuk"]
+LESSON_STARTS = [dtime(8, 10), dtime(9, 20), dtime(10, 30), dtime(12, 30), dtime(13, 40), dtime(14, 50)]
+LESSON_MINUTES = [40, 60, 60, 60, 80]
+
+
+def _luhn(digits: str) -> int:
+    total = 0
+    for i, d in enumerate(int(c) for c in digits):
+        d = d * 2 if i % 2 == 0 else d
+        total += d - 9 if d > 9 else d
+    return (10 - total % 10) % 10
+
+
+class DatasetGenerator:
+    """
+    Genererar ett deterministiskt SS12000-dataset i given skala. Samma seed och skala ger alltid
+    samma rader, inklusive ID:n (UUID v5 från seed, typ och löpnummer). Varje tabell genereras
+    som en ström av rader i beroendeordning; bara index som behövs för referenserna (enhet per
+    person, medlemmar per grupp) hålls i minnet, som kompakta arrayer.
+    """
+
+    def __init__(self, scale: Scale, seed: int = 12000, start: date = date(2025, 8, 18)):
+        if scale.school_units < 1 or scale.persons < scale.school_units or scale.groups < scale.school_units:
+            raise ValueError("Skalan behöver minst en enhet och minst lika många personer och grupper som enheter")
+        self.scale = scale
+        self.seed = seed
+        # Terminsstart på en måndag
+        self.start = start - timedelta(days=start.weekday())
+        self.timestamp = datetime.combine(self.start, dtime(0, 0))
+        self._namespace = uuid.uuid5(uuid.NAMESPACE_URL, f"ss12000-datagen:{seed}")
+
+        # Index som byggs upp av persons(), groups() och group_memberships()
+        self.person_unit = array("I")
+        self.unit_students: List[array] = []
+        self.unit_staff: List[array] = []
+        self.group_unit = array("I")
+        self.unit_groups: List[List[int]] = []
+        self.group_members: List[array] = []
+        self.activity_group = array("I")
+
+    def _rng(self, name: str) -> random.Random:
+        return random.Random(self.seed * 1_000_003 + zlib.crc32(name.encode()))
+
+    def id(self, kind: str, index: int) -> str:
+        return str(uuid.uuid5(self._namespace, f"{kind}-{index}"))
+
+    def _meta(self) -> dict:
+        return {"created": self.timestamp, "modified": self.timestamp}
+
+    # --- Organisationer och personer ---
+    def organisations(self) -> Iterator[dict]:
+        scale = self.scale
+        rng = self._rng("organisations")
+        for m in range(scale.municipalities):
+            code = f"{1200 + m * 3:04d}"
+            yield {"id": self.id("municipality", m), "name": f"Kommun {m + 1}", "parent_id": None, "school_unit_code": None,
+                   "organisation_code": code, "municipality_code": code, "type": "Kommun", "school_types": None,
+                   "start_date": None, "end_date": None, **self._meta()}
+        for u in range(scale.school_units):
+            m = u % scale.municipalities
+            school_types = "Gymnasium" if u % 7 == 6 else "Grundskola"
+            yield {"id": self.id("unit", u), "name": f"{rng.choice(FAMILY_NAMES)}skolan {u + 1}",
+                   "parent_id": self.id("municipality", m), "school_unit_code": f"{10_000_000 + u * 37:08d}",
+                   "organisation_code": None, "municipality_code": f"{1200 + m * 3:04d}", "type": "Skola",
+                   "school_types": school_types, "start_date": None, "end_date": None, **self._meta()}
+
+    def rooms(self) -> Iterator[dict]:
+        for u in range(self.scale.school_units):
+            for r in range(self.scale.rooms_per_unit):
+                yield {"id": self.id("room", u * self.scale.rooms_per_unit + r), "name": self._room_name(u, r), **self._meta()}
+
+    def _room_name(self, unit: int, room: int) -> str:
+        return f"Enhet {unit + 1} sal {room + 1:02d}"
+
+    def persons(self) -> Iterator[dict]:
+        scale = self.scale
+        rng = self._rng("persons")
+        # Enheterna har olika storlek; vikterna ger realistisk spridning mellan små och stora skolor
+        units = range(scale.school_units)
+        cumulative = []
+        for _ in units:
+            cumulative.append((cumulative[-1] if cumulative else 0) + 0.3 + rng.random() * 1.7)
+        self.unit_students = [array("I") for _ in range(scale.school_units)]
+        self.unit_staff = [array("I") for _ in range(scale.school_units)]
+        self.person_unit = array("I")
+        staff_every = max(1, round(1 / scale.staff_share)) if scale.staff_share > 0 else 0
+        span_days = 365 * 12
+        for i in range(scale.persons):
+            # De första personerna blir rektor på var sin enhet så att ingen enhet saknar personal
+            unit = i if i < scale.school_units else rng.choices(units, cum_weights=cumulative)[0]
+            self.person_unit.append(unit)
+            staff = i < scale.school_units or (bool(staff_every) and i % staff_every == 0)
+            (self.unit_staff if staff else self.unit_students)[unit].append(i)
+
+            given, family = rng.choice(GIVEN_NAMES), rng.choice(FAMILY_NAMES)
+            # Unika personnummer: dag och löpnummer härleds ur indexet
+            born = date(1962 if staff else 2008, 1, 1) + timedelta(days=(i * 7919) % span_days)
+            serial = f"{(i // span_days) % 1000:03d}"
+            digits = born.strftime("%y%m%d") + serial
+            yield {
+                "id": self.id("person", i), "display_name": f"{given} {family}", "given_name": given, "family_name": family,
+                "email": f"{given}.{family}.{i}@example.com".lower(), "civic_no": f"{born.strftime('%Y%m%d')}-{serial}{_luhn(digits)}",
+                "edu_person_principal_name": f"p{i}@skola.example.com", "external_identifier_value": None,
+                "external_identifier_context": None,
+                "securityMarking": "Sekretessmarkering" if rng.random() < 0.005 else "Ingen", **self._meta(),
+            }
+
+    def duties(self) -> Iterator[dict]:
+        for u, staff in enumerate(self.unit_staff):
+            for k, person in enumerate(staff):
+                yield {"id": self.id("duty", person), "person_id": self.id("person", person), "organisation_id": self.id("unit", u),
+                       "duty_role": "Principal" if k == 0 else "Teacher", "start_date": self.start, "end_date": None, **self._meta()}
+
+    # --- Grupper och medlemskap ---
+    def groups(self) -> Iterator[dict]:
+        scale = self.scale
+        students = [len(s) for s in self.unit_students]
+        total = sum(students) or 1
+        # Grupper per enhet i proportion till antalet elever, minst en
+        counts = [max(1, scale.groups * n // total) for n in students]
+        counts[0] += scale.groups - sum(counts)
+        if counts[0] < 1:
+            raise ValueError("För få grupper för antalet enheter")
+        self.group_unit = array("I")
+        self.unit_groups = [[] for _ in range(scale.school_units)]
+        g = 0
+        for u, count in enumerate(counts):
+            classes = max(1, count * 2 // 5)
+            for k in range(count):
+                self.group_unit.append(u)
+                self.unit_groups[u].append(g)
+                class_group = k < classes
+                yield {"id": self.id("group", g), "display_name": f"{k + 1}{'ABCDEFGH'[k % 8]}" if class_group else f"Undervisningsgrupp {k + 1}",
+                       "group_type": "ClassGroup" if class_group else "TeachingGroup", "school_types": None,
+                       "start_date": self.start, "end_date": None, "organisation_id": self.id("unit", u), **self._meta()}
+                g += 1
+
+    def group_memberships(self) -> Iterator[dict]:
+        scale = self.scale
+        rng = self._rng("memberships")
+        self.group_members = [array("I") for _ in range(len(self.group_unit))]
+        student_count = sum(len(s) for s in self.unit_students) or 1
+        per_student, extra = divmod(scale.memberships, student_count)
+        m = 0
+        s_index = 0
+        for u, students in enumerate(self.unit_students):
+            groups = self.unit_groups[u]
+            classes = max(1, len(groups) * 2 // 5)
+            for k, person in enumerate(students):
+                quota = min(per_student + (1 if s_index < extra else 0), len(groups))
+                s_index += 1
+                if not quota:
+                    continue
+                # En klass och därefter undervisningsgrupper
+                chosen = [groups[k % classes]]
+                teaching = groups[classes:]
+                if quota > 1 and teaching:
+                    chosen += rng.sample(teaching, min(quota - 1, len(teaching)))
+                for g in chosen:
+                    self.group_members[g].append(person)
+                    yield {"id": self.id("membership", m), "person_id": self.id("person", person), "group_id": self.id("group", g),
+                           "start_date": self.start, "end_date": None, **self._meta()}
+                    m += 1
+
+    # --- Undervisning ---
+    def syllabuses(self) -> Iterator[dict]:
+        for k, (name, code) in enumerate(SUBJECTS):
+            yield {"id": self.id("syllabus", k), "subject_name": name, "subject_code": code, "course_name": None, "course_code": None,
+                   "subject_designation": name, "level": None, "points": None, "start_date": None, "end_date": None,
+                   "description": None, "last_published_version": None, "published_at": None, "status": "Aktiv",
+                   "school_unit_offerings": None, "programmes": None, **self._meta()}
+
+    def activities(self) -> Iterator[dict]:
+        groups = len(self.group_unit)
+        self.activity_group = array("I", (a % groups for a in range(self.scale.activities)))
+        for a, g in enumerate(self.activity_group):
+            k = a // groups
+            subject = SUBJECTS[(g + k * 5) % len(SUBJECTS)][0]
+            yield {"id": self.id("activity", a), "display_name": f"{subject} grupp {g + 1}", "organisation_id": self.id("unit", self.group_unit[g]),
+                   "syllabus_id": self.id("syllabus", (g + k * 5) % len(SUBJECTS)), "start_date": self.start, "end_date": None, **self._meta()}
+
+    def activity_groups(self) -> Iterator[dict]:
+        for a, g in enumerate(self.activity_group):
+            yield {"activity_id": self.id("activity", a), "group_id": self.id("group", g)}
+
+    def activity_teachers(self) -> Iterator[dict]:
+        rng = self._rng("teachers")
+        for a, g in enumerate(self.activity_group):
+            staff = self.unit_staff[self.group_unit[g]]
+            if staff:
+                yield {"activity_id": self.id("activity", a), "teacher_duty_id": self.id("duty", rng.choice(staff))}
+
+    def _lessons(self) -> Iterator[Tuple[int, int, datetime, datetime, str]]:
+        """(händelsens nummer, aktivitet, start, slut, sal) vecka för vecka; samma följd vid varje anrop."""
+        scale = self.scale
+        rng = self._rng("lessons")
+        activities = scale.activities
+        if not activities or not scale.events:
+            return
+        per_activity, extra = divmod(scale.events, activities)
+        remaining = [per_activity + (1 if a < extra else 0) for a in range(activities)]
+        slots = []
+        for a in range(activities):
+            per_week = 1 + rng.randrange(4)
+            slots.append([(rng.randrange(5), rng.randrange(len(LESSON_STARTS)), rng.choice(LESSON_MINUTES),
+                           rng.randrange(self.scale.rooms_per_unit)) for _ in range(per_week)])
+        e = 0
+        week = 0
+        active = [a for a in range(activities) if remaining[a]]
+        while active:
+            monday = self.start + timedelta(weeks=week)
+            for a in active:
+                for weekday, slot, minutes, room in slots[a]:
+                    if not remaining[a]:
+                        break
+                    start = datetime.combine(monday + timedelta(days=weekday), LESSON_STARTS[slot])
+                    yield e, a, start, start + timedelta(minutes=minutes), self._room_name(self.group_unit[self.activity_group[a]], room)
+                    remaining[a] -= 1
+                    e += 1
+            active = [a for a in active if remaining[a]]
+            week += 1
+
+    def calendar_events(self) -> Iterator[dict]:
+        for e, a, start, end, room in self._lessons():
+            yield {"id": self.id("event", e), "name": f"Lektion {a + 1}", "start_time": start, "end_time": end, "location": room,
+                   "activity_id": self.id("activity", a), "created": self.timestamp, "modified": self.timestamp}
+
+    def attendance_events(self) -> Iterator[dict]:
+        for k, name in enumerate(ATTENDANCE_EVENTS):
+            yield {"id": self.id("attendance-event", k), "name": name, **self._meta()}
+
+    def attendance(self) -> Iterator[dict]:
+        """Närvaro för lektionerna i tidsordning tills scale.attendance rader har skapats."""
+        target = self.scale.attendance
+        if not target:
+            return
+        rng = self._rng("attendance")
+        # Varje elev har en egen benägenhet till frånvaro; de flesta har låg, ett fåtal hög
+        propensity = [rng.random() ** 3 * 0.4 for _ in range(len(self.person_unit))]
+        event_ids = [self.id("attendance-event", k) for k in range(len(ATTENDANCE_EVENTS))]
+        count = 0
+        for e, a, start, end, room in self._lessons():
+            event_id = self.id("event", e)
+            activity_id = self.id("activity", a)
+            for person in self.group_members[self.activity_group[a]]:
+                roll = rng.random()
+                absent = propensity[person]
+                if roll < absent * 0.6:
+                    status = 3
+                elif roll < absent:
+                    status = 2
+                elif roll < absent + 0.04:
+                    status = 1
+                else:
+                    status = 0
+                yield {"id": self.id("attendance", count), "person_id": self.id("person", person), "activity_id": activity_id,
+                       "attendance_event_id": event_ids[status], "calendar_event_id": event_id,
+                       "created": end, "modified": end}
+                count += 1
+                if count >= target:
+                    return
+
+    def tables(self) -> Iterator[Tuple[Table, Iterator[dict]]]:
+        """Tabellerna i beroendeordning med en radström för varje."""
+        yield Organisation.__table__, self.organisations()
+        yield Room.__table__, self.rooms()
+        yield Person.__table__, self.persons()
+        yield Duty.__table__, self.duties()
+        yield Group.__table__, self.groups()
+        yield GroupMembership.__table__, self.group_memberships()
+        yield Syllabus.__table__, self.syllabuses()
+        yield Activity.__table__, self.activities()
+        yield activity_group_association, self.activity_groups()
+        yield activity_teacher_association, self.activity_teachers()
+        yield CalendarEvent.__table__, self.calendar_events()
+        yield AttendanceEvent.__table__, self.attendance_events()
+        yield Attendance.__table__, self.attendance()
+
+
+def _chunks(rows: Iterator[dict], size: int) -> Iterator[List[dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_database(generator: DatasetGenerator, bind, chunk_rows: int = DATAGEN_CHUNK_ROWS, report=print) -> Dict[str, int]:
+    """
+    Skriver datasetet med flerradiga INSERT-satser direkt i tabellerna, utan ändringslogg, och
+    bygger sedan om härledda tabeller. Tabellerna förutsätts vara tomma.
+    """
+    from aggregation import rebuild_rollups
+    from database import SessionLocal
+    from org_statistics import refresh_statistics
+    from participation import rebuild_participation
+
+    counts = {}
+    for table, rows in generator.tables():
+        started = time.monotonic()
+        written = 0
+        conn = bind.connect()
+        transaction = conn.begin()
+        try:
+            for chunk in _chunks(rows, chunk_rows):
+                conn.execute(table.insert(), chunk)
+                written += len(chunk)
+                if written % DATAGEN_TRANSACTION_ROWS < len(chunk):
+                    transaction.commit()
+                    transaction = conn.begin()
+            transaction.commit()
+        finally:
+            conn.close()
+        counts[table.name] = written
+        seconds = time.monotonic() - started
+        report(f"{table.name}: {written} rader på {seconds:.1f} s ({written / seconds if seconds else 0:.0f} rader/s)")
+
+    started = time.monotonic()
+    with bind.begin() as conn:
+        rebuild_participation(conn)
+        rebuild_rollups(conn)
+    db = SessionLocal(bind=bind)
+    try:
+        refresh_statistics(db)
+        db.commit()
+    finally:
+        db.close()
+    report(f"Härledda tabeller ombyggda på {time.monotonic() - started:.1f} s")
+    return counts
+
+
+# Tabellerna som importer.py kan läsa, med importens namn
+IMPORT_FILES = {
+    "organisations": "organisations", "persons": "persons", "duties": "duties", "groups": "groups",
+    "group_memberships": "groupMemberships", "activities": "activities", "activity_group": "activityGroups",
+    "activity_teacher": "activityTeachers", "calendarEvents": "calendarEvents",
+}
+
+def _file_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def write_files(generator: DatasetGenerator, directory: str, format: str = "jsonl", report=print) -> Dict[str, int]:
+    """
+    Skriver tabellerna som importer.py kan läsa till filer i directory (JSON Lines eller CSV).
+    Övriga tabeller genereras ändå, eftersom de bygger index som senare tabeller behöver, men sparas inte.
+    """
+    from importer import ENTITIES
+
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for table, rows in generator.tables():
+        entity = IMPORT_FILES.get(table.name)
+        if entity is None:
+            for _ in rows:
+                pass
+            continue
+        renames = {column: field for field, column in ENTITIES[entity].renames.items()}
+        path = os.path.join(directory, f"{entity}.{format}")
+        written = 0
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = None
+            for row in rows:
+                record = {renames.get(key, key): _file_value(value) for key, value in row.items()}
+                if format == "csv":
+                    if writer is None:
+                        writer = csv.DictWriter(f, fieldnames=list(record))
+                        writer.writeheader()
+                    writer.writerow(record)
+                else:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                written += 1
+        counts[entity] = written
+        report(f"{path}: {written} rader")
+    return counts
+
+
+if __name__ == "__main__":
+    from database import Base, create_schema, init_engine
+
+    parser = argparse.ArgumentParser(description="Generera ett deterministiskt SS12000-dataset.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    for field in Scale._fields:
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(Scale._field_defaults[field]), default=None)
+    parser.add_argument("--seed", type=int, default=12000)
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2025, 8, 18), help="Terminsstart, t.ex. 2025-08-18.")
+    parser.add_argument("--database-url", help="Skriv direkt till databasen; annars DATABASE_URL.")
+    parser.add_argument("--reset", action="store_true", help="Ta bort och skapa om alla tabeller först.")
+    parser.add_argument("--out", help="Skriv importfiler till katalogen i stället för till databasen.")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    args = parser.parse_args()
+
+    scale = PRESETS[args.preset]._replace(**{
+        field: getattr(args, field) for field in Scale._fields if getattr(args, field) is not None
+    })
+    generator = DatasetGenerator(scale, args.seed, args.start)
+    print(f"Genererar {scale} med seed {args.seed}")
+    if args.out:
+        write_files(generator, args.out, args.format)
+    else:
+        engine = init_engine(args.database_url) if args.database_url else init_engine()
+        if args.reset:
+            Base.metadata.drop_all(engine)
+            create_schema(engine)
+        write_database(generator, engine)
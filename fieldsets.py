@@ -0,0 +1,83 @@
+# fieldsets.py
+import re
+import typing
+from typing import List, Optional, Set
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+
+FIELDS_DESCRIPTION = "Kommaseparerad lista med fält som ska returneras, t.ex. id,displayName,email. Kan inte kombineras med expand."
+
+_CAMEL = re.compile(r"(?<!^)(?=[A-Z])")
+
+
+def _schema_fields(schema) -> dict:
+    return getattr(schema, "model_fields", None) or schema.__fields__
+
+def _is_list(field) -> bool:
+    annotation = getattr(field, "annotation", None) or getattr(field, "outer_type_", None)
+    if typing.get_origin(annotation) is typing.Union:
+        return any(typing.get_origin(arg) is list for arg in typing.get_args(annotation))
+    return typing.get_origin(annotation) is list
+
+
+class FieldSelection:
+    """
+    Fälten som klienten bett om. Frågan läser bara deras kolumner och svaret byggs direkt
+    från ORM-objekten, eftersom schemat kräver fält som aldrig lästes in.
+    """
+
+    def __init__(self, model, names: List[str], lists: Set[str]):
+        self.model = model
+        self.names = names
+        self.lists = lists
+
+    def apply(self, query, *extra: str):
+        """extra är kolumner som rutten själv behöver, t.ex. för att sortera i Python."""
+        # Primärnyckeln läses alltid in av SQLAlchemy även om den inte efterfrågats
+        return query.options(load_only(*(getattr(self.model, name) for name in (*self.names, *extra))))
+
+    def row(self, obj) -> dict:
+        row = {}
+        for name in self.names:
+            value = getattr(obj, name)
+            # Listor lagras som kommaseparerade strängar, jfr OrganisationBase.from_orm
+            if name in self.lists and isinstance(value, str):
+                value = value.split(",")
+            row[name] = value
+        return row
+
+    def response(self, objects: list) -> JSONResponse:
+        return JSONResponse(jsonable_encoder([self.row(obj) for obj in objects]))
+
+
+def select_fields(fields: Optional[str], model, schema, expand=None) -> Optional[FieldSelection]:
+    """
+    Tolkar fields-parametern mot svarsschemat. Fält anges som i svaret eller i camelCase
+    (displayName för display_name). Bara fält som är kolumner, eller synonymer för kolumner,
+    i modellen kan väljas.
+    """
+    if fields is None:
+        return None
+    if expand:
+        raise HTTPException(status_code=400, detail="fields kan inte kombineras med expand eller expandReferenceNames.")
+
+    mapper = inspect(model)
+    columns = {attribute.key for attribute in mapper.column_attrs} | set(mapper.synonyms.keys())
+    schema_fields = _schema_fields(schema)
+    allowed = [name for name in schema_fields if name in columns]
+    names, unknown = [], []
+    for requested in filter(None, (part.strip() for part in fields.split(","))):
+        name = requested if requested in allowed else _CAMEL.sub("_", requested).lower()
+        if name not in allowed:
+            unknown.append(requested)
+        elif name not in names:
+            names.append(name)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Okända fält: {', '.join(unknown)}. Tillåtna fält: {', '.join(allowed)}.")
+    if not names:
+        raise HTTPException(status_code=400, detail="fields måste innehålla minst ett fält.")
+    return FieldSelection(model, names, {name for name in names if _is_list(schema_fields[name])})
@@ -1,12 +1,50 @@
-from fastapi import HTTPException
-from sqlalchemy.orm import joinedload
+import hmac
+import os
+
+from fastapi import Header, HTTPException
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import desc, asc, func, or_
 
-from datetime import date
+from datetime import date, datetime, timedelta
 from typing import List, Optional
-from database import *
-from schemas import *
+# Schemana som heter som ORM-modellerna (Person, CalendarEvent m.fl.) används som schemas.<namn>
+import schemas
+from database import (
+    Activity, CalendarEvent, Duty, Group, GroupMembership, Organisation, Person, Placement, ResponsibleFor,
+    SchoolUnitOffering, StudyPlan, Syllabus, activity_group_association, activity_teacher_association,
+)
+from schemas import (
+    ActivityExpandEnum, ActivityExpanded, ActivitySchema, AttendanceRegistration, DutyExpandEnum, DutySchema,
+    GroupExpandEnum, GroupMembershipSchema, GroupSchema, OrganisationBase, OrganisationExpanded, PersonExpandEnum,
+    PersonExpanded, PlacementExpandEnum, PlacementSchema, ResponsibleForSchema, SchoolTypesEnum,
+    SchoolUnitOfferingExpanded, SchoolUnitOfferingSchema,
+)
+from cache import attendance_event_cache, organisation_cache, syllabus_cache
+from participation import apply_participation_filters
+from partitions import prune_partitions
+from recurrence import occurrence_activities
+from tracing import traced
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# Närvaro kan registreras för genererade lektionstillfällen som startar högst så här långt fram
+ATTENDANCE_MAX_DAYS_AHEAD = int(os.environ.get("ATTENDANCE_MAX_DAYS_AHEAD", "7"))
+# ... och högst så här långt bak; äldre förekomster måste sparas som kalenderhändelser först
+ATTENDANCE_MAX_DAYS_BACK = int(os.environ.get("ATTENDANCE_MAX_DAYS_BACK", "30"))
+
+def admin_token_valid(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN and token and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()))
+
+def require_admin(x_admin_token: Optional[str] = Header(None, alias="X-Admin-Token")):
+    """
+    Beroende för administrativa endpoints. Anroparen måste skicka ADMIN_TOKEN i X-Admin-Token;
+    utan konfigurerad nyckel är endpointsen avstängda.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Administrativa endpoints är inte aktiverade.")
+    if not admin_token_valid(x_admin_token):
+        raise HTTPException(status_code=403, detail="Ogiltig administratörsnyckel.")
 
+@traced
 def apply_sorting(query, model, sortkey: Optional[str]):
     """
     Applicerar sortering på en SQLAlchemy-fråga baserat på sortkey-parametern.
@@ -15,24 +53,24 @@ def apply_sorting(query, model, sortkey: Optional[str]):
         return query
 
     sort_mapping = {
-        "ModifiedDesc": (model.modified, desc),
-        "ModifiedAsc": (model.modified, asc),
-        "CreatedDesc": (model.created, desc),
-        "CreatedAsc": (model.created, asc),
-        "DisplayNameAsc": (model.display_name, asc),
-        "DisplayNameDesc": (model.display_name, desc),
-        "GivenNameAsc": (model.given_name, asc),
-        "GivenNameDesc": (model.given_name, desc),
-        "FamilyNameAsc": (model.family_name, asc),
-        "FamilyNameDesc": (model.family_name, desc),
-        "CivicNoAsc": (model.civic_no, asc),
-        "CivicNoDesc": (model.civic_no, desc),
-        "StartDateDesc": (model.start_date, desc),
-        "StartDateAsc": (model.start_date, asc),
-        "EndDateAsc": (model.end_date, asc),
-        "EndDateDesc": (model.end_date, desc),
-        "NameAsc": (model.name, asc),
-        "NameDesc": (model.name, desc),
+        "ModifiedDesc": ("modified", desc),
+        "ModifiedAsc": ("modified", asc),
+        "CreatedDesc": ("created", desc),
+        "CreatedAsc": ("created", asc),
+        "DisplayNameAsc": ("display_name", asc),
+        "DisplayNameDesc": ("display_name", desc),
+        "GivenNameAsc": ("given_name", asc),
+        "GivenNameDesc": ("given_name", desc),
+        "FamilyNameAsc": ("family_name", asc),
+        "FamilyNameDesc": ("family_name", desc),
+        "CivicNoAsc": ("civic_no", asc),
+        "CivicNoDesc": ("civic_no", desc),
+        "StartDateDesc": ("start_date", desc),
+        "StartDateAsc": ("start_date", asc),
+        "EndDateAsc": ("end_date", asc),
+        "EndDateDesc": ("end_date", desc),
+        "NameAsc": ("name", asc),
+        "NameDesc": ("name", desc),
         "StartTimeAsc": (CalendarEvent.start_time, asc),
         "StartTimeDesc": (CalendarEvent.start_time, desc),
     }
@@ -47,6 +85,8 @@ def apply_sorting(query, model, sortkey: Optional[str]):
     # For example 'DisplayNameAsc' is only valid for Person and not for other Models.
     try:
         if column and direction:
+            # Kolumnerna slås upp först här, så att en saknad kolumn ger 400 och inte 500
+            column = getattr(model, column) if isinstance(column, str) else column
             query = query.order_by(direction(column))
     except AttributeError:
         # Handle case where the column does not exist on the model
@@ -56,6 +96,7 @@ def apply_sorting(query, model, sortkey: Optional[str]):
     return query
 
 # Hjälpfunktion för att applicera meta-filter
+@traced
 def apply_meta_filters(query, model, metaCreatedBefore: Optional[datetime], metaCreatedAfter: Optional[datetime], metaModifiedBefore: Optional[datetime], metaModifiedAfter: Optional[datetime]):
     """Applicerar meta-filter på en SQLAlchemy-fråga."""
     if metaCreatedBefore:
@@ -68,47 +109,35 @@ def apply_meta_filters(query, model, metaCreatedBefore: Optional[datetime], meta
         query = query.filter(model.modified > metaModifiedAfter)
     return query
 
+@traced
 def apply_time_filters(query, model, startTime_onOrAfter, startTime_onOrBefore, endTime_onOrAfter, endTime_onOrBefore):
-    """Applicerar tidsbaserade filter på en SQLAlchemy-fråga."""
+    """
+    Applicerar tidsbaserade filter på en SQLAlchemy-fråga.
+    I MySQL begränsas frågan dessutom till de månadspartitioner som fönstret berör.
+    """
     query = query.filter(
         model.start_time >= startTime_onOrAfter,
         model.start_time <= startTime_onOrBefore
     )
+    query = prune_partitions(query, model, startTime_onOrAfter, startTime_onOrBefore)
     if endTime_onOrAfter:
         query = query.filter(model.end_time >= endTime_onOrAfter)
     if endTime_onOrBefore:
         query = query.filter(model.end_time <= endTime_onOrBefore)
     return query
 
+@traced
 def apply_relational_filters(query, activity, student, teacher, organisation, group):
-    """Applicerar relationsbaserade filter (mock-implementation) på en SQLAlchemy-fråga."""
+    """
+    Applicerar relationsbaserade filter på en SQLAlchemy-fråga mot kalenderhändelser.
+    Elev- och lärarfiltren besvaras via deltagarindexet (se participation.py) i en och samma fråga.
+    """
     if activity:
         query = query.filter(CalendarEvent.activity_id == str(activity))
-    
-    if student:
-        # I en fullständig app skulle detta kräva komplexa join-operationer
-        # Här är en mock-implementation
-        query = query.filter(or_(
-            CalendarEvent.id == "some_mock_event_for_student_" + str(student),
-        ))
-    
-    if teacher:
-        # I en fullständig app skulle detta kräva komplexa join-operationer
-        # Här är en mock-implementation
-        query = query.filter(or_(
-            CalendarEvent.id == "some_mock_event_for_teacher_" + str(teacher),
-        ))
-
-    if organisation:
-        # Mock-implementation
-        query = query.filter(CalendarEvent.id.like("%organisation_" + str(organisation) + "%"))
 
-    if group:
-        # Mock-implementation
-        query = query.filter(CalendarEvent.id.like("%group_" + str(group) + "%"))
-
-    return query
+    return apply_participation_filters(query, student, teacher, organisation, group)
 
+@traced
 def apply_pagination(query, limit, pageToken):
     """Hanterar paginering med limit och pageToken (mock-implementation)."""
     if pageToken:
@@ -119,6 +148,7 @@ def apply_pagination(query, limit, pageToken):
         query = query.limit(limit)
     return query
 
+@traced
 def expand_organisations(organisations: List[Organisation], db: Session) -> List[OrganisationExpanded]:
     """
     Hjälpfunktion för att expandera organisationsobjekt med parent_name.
@@ -127,7 +157,7 @@ def expand_organisations(organisations: List[Organisation], db: Session) -> List
     for org in organisations:
         expanded_org = org.__dict__.copy()
         if org.parent_id:
-            parent_org = db.query(Organisation).filter(Organisation.id == org.parent_id).first()
+            parent_org = organisation_cache.get(db, org.parent_id)
             if parent_org:
                 expanded_org['parent_name'] = parent_org.name
         
@@ -138,6 +168,7 @@ def expand_organisations(organisations: List[Organisation], db: Session) -> List
         expanded_list.append(OrganisationExpanded(**expanded_org))
     return expanded_list
 
+@traced
 def expand_persons_data(persons: List[Person], expand: List[PersonExpandEnum], expand_ref_names: bool, db: Session) -> List[PersonExpanded]:
     """
     Hjälpfunktion för att expandera personobjekt med relaterad data.
@@ -223,6 +254,7 @@ def expand_persons_data(persons: List[Person], expand: List[PersonExpandEnum], e
         expanded_list.append(expanded_person)
     return expanded_list
 
+@traced
 def apply_expand_for_placements(query, expands: Optional[List[PlacementExpandEnum]]):
     """
     Hjälpfunktion för att dynamiskt lägga till 'joinedload' för placeringar.
@@ -237,6 +269,7 @@ def apply_expand_for_placements(query, expands: Optional[List[PlacementExpandEnu
     
     return query
 
+@traced
 def apply_expand_for_duties(query, expands: Optional[List[DutyExpandEnum]]):
     """
     Hjälpfunktion för att dynamiskt lägga till 'joinedload' för tjänstgöringar.
@@ -249,6 +282,7 @@ def apply_expand_for_duties(query, expands: Optional[List[DutyExpandEnum]]):
     
     return query
 
+@traced
 def apply_expand_for_groups(query, expands: Optional[List[GroupExpandEnum]]):
     """
     Hjälpfunktion för att dynamiskt lägga till 'joinedload' för grupper.
@@ -261,6 +295,7 @@ def apply_expand_for_groups(query, expands: Optional[List[GroupExpandEnum]]):
         
     return query
 
+@traced
 def apply_studyplan_filters(query, student_ids: Optional[List[str]],
                             startDate_onOrBefore: Optional[date], startDate_onOrAfter: Optional[date],
                             endDate_onOrBefore: Optional[date], endDate_onOrAfter: Optional[date]):
@@ -280,6 +315,7 @@ def apply_studyplan_filters(query, student_ids: Optional[List[str]],
         
     return query
 
+@traced
 def apply_syllabus_filters(query, subject_code: Optional[List[str]], course_code: Optional[List[str]],
                            school_unit_offerings: Optional[List[str]], programmes: Optional[List[str]],
                            start_date_onOrBefore: Optional[date], start_date_onOrAfter: Optional[date],
@@ -305,16 +341,18 @@ def apply_syllabus_filters(query, subject_code: Optional[List[str]], course_code
         query = query.filter(Syllabus.end_date >= end_date_onOrAfter)
     return query
 
+@traced
 def expand_school_unit_offering(offering: SchoolUnitOffering, expandReferenceNames: bool, db: Session):
     if expandReferenceNames:
         offering_dict = offering.__dict__.copy()
         if offering.offered_at_id:
-            organisation = db.query(Organisation).get(offering.offered_at_id)
+            organisation = organisation_cache.get(db, offering.offered_at_id)
             if organisation:
                 offering_dict['offered_at'] = OrganisationBase.from_orm(organisation)
         return SchoolUnitOfferingExpanded(**offering_dict)
     return SchoolUnitOfferingSchema.from_orm(offering)
 
+@traced
 def apply_activity_filters(query, member, teacher, organisation, group, startDate_onOrBefore, startDate_onOrAfter, endDate_onOrBefore, endDate_onOrAfter):
     """Applicerar filter på en SQLAlchemy-fråga för aktiviteter."""
     if member:
@@ -341,6 +379,7 @@ def apply_activity_filters(query, member, teacher, organisation, group, startDat
 
     return query
 
+@traced
 def expand_activity(activity: Activity, expand: Optional[List[ActivityExpandEnum]], expandReferenceNames: bool, db: Session):
     activity_data = ActivitySchema.from_orm(activity).dict()
 
@@ -356,16 +395,73 @@ def expand_activity(activity: Activity, expand: Optional[List[ActivityExpandEnum
         # Ladda och expandera refererad kursplan
         if ActivityExpandEnum.syllabus in expand:
             if activity.syllabus_id:
-                syllabus = db.query(Syllabus).get(activity.syllabus_id)
+                syllabus = syllabus_cache.get(db, activity.syllabus_id)
                 if syllabus:
-                    activity_data["syllabus"] = Syllabus.from_orm(syllabus)
+                    activity_data["syllabus"] = schemas.Syllabus.from_orm(syllabus)
 
     if expandReferenceNames:
         # Ladda display names för refererade objekt
         if activity.organisation_id:
-            org = db.query(Organisation).get(activity.organisation_id)
+            org = organisation_cache.get(db, activity.organisation_id)
             if org:
                 # Assuming OrganisationSchema is already created, which it is
                 activity_data["organisation"] = Organisation.from_orm(org)
     
-    return ActivityExpanded(**activity_data)
\ No newline at end of file
+    return ActivityExpanded(**activity_data)
+
+def calendar_event_errors(payload: List[AttendanceRegistration], db: Session) -> List[dict]:
+    """Lektionstillfällena måste vara lagrade händelser eller genererade förekomster av aktivitetens regler."""
+    calendar_event_ids = {c.calendar_event_id for c in payload}
+    activities = dict(db.query(CalendarEvent.id, CalendarEvent.activity_id).filter(CalendarEvent.id.in_(calendar_event_ids)))
+    if calendar_event_ids - set(activities):
+        now = datetime.utcnow()
+        activities.update(occurrence_activities(
+            db, {c.activity_id for c in payload if c.calendar_event_id not in activities},
+            now - timedelta(days=ATTENDANCE_MAX_DAYS_BACK), now + timedelta(days=ATTENDANCE_MAX_DAYS_AHEAD),
+        ))
+
+    errors = []
+    for i, registration in enumerate(payload):
+        if registration.calendar_event_id not in activities:
+            errors.append({"loc": [i, "calendar_event_id"], "msg": f"Okänt lektionstillfälle: {registration.calendar_event_id}"})
+        elif activities[registration.calendar_event_id] not in (None, registration.activity_id):
+            errors.append({"loc": [i, "calendar_event_id"], "msg": f"Lektionstillfället {registration.calendar_event_id} hör till en annan aktivitet"})
+    return errors
+
+def validate_attendance_registrations(payload: List[AttendanceRegistration], db: Session) -> List[dict]:
+    """
+    Validerar en massregistrering av närvaro med en fråga per refererad tabell och returnerar
+    raderna som ska skrivas. Alla fel, även okända lektionstillfällen eller sådana som hör till en
+    annan aktivitet, samlas ihop och returneras tillsammans som 422 innan något köas.
+    """
+    activity_ids = {c.activity_id for c in payload}
+    person_ids = {r.person_id for c in payload for r in c.registrations}
+    known_activities = {id for (id,) in db.query(Activity.id).filter(Activity.id.in_(activity_ids))} if activity_ids else set()
+    known_persons = {id for (id,) in db.query(Person.id).filter(Person.id.in_(person_ids))} if person_ids else set()
+    known_events = {e.id for e in attendance_event_cache.all(db)}
+
+    errors = calendar_event_errors(payload, db)
+    rows = []
+    seen = set()
+    for i, registration in enumerate(payload):
+        if registration.activity_id not in known_activities:
+            errors.append({"loc": [i, "activity_id"], "msg": f"Okänd aktivitet: {registration.activity_id}"})
+        for j, entry in enumerate(registration.registrations):
+            if entry.person_id not in known_persons:
+                errors.append({"loc": [i, "registrations", j, "person_id"], "msg": f"Okänd person: {entry.person_id}"})
+            if entry.attendance_event_id not in known_events:
+                errors.append({"loc": [i, "registrations", j, "attendance_event_id"], "msg": f"Okänd närvarohändelse: {entry.attendance_event_id}"})
+            key = (registration.calendar_event_id, entry.person_id)
+            if key in seen:
+                errors.append({"loc": [i, "registrations", j], "msg": f"Personen {entry.person_id} är registrerad flera gånger för samma lektionstillfälle"})
+            seen.add(key)
+            rows.append({
+                "person_id": entry.person_id,
+                "activity_id": registration.activity_id,
+                "calendar_event_id": registration.calendar_event_id,
+                "attendance_event_id": entry.attendance_event_id,
+            })
+
+    if errors:
+        raise HTTPException(status_code=422, detail=errors)
+    return rows
@@ -0,0 +1,214 @@
+# ical.py
+import hashlib
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, CalendarEvent, Group, Person, Room
+from participation import apply_participation_filters, participating
+from partitions import prune_partitions
+from recurrence import expand_recurring_events
+
+ICAL_WEEKS_BEHIND = int(os.environ.get("ICAL_WEEKS_BEHIND", "2"))
+ICAL_WEEKS_AHEAD = int(os.environ.get("ICAL_WEEKS_AHEAD", "12"))
+ICAL_CACHE_WEEKS = int(os.environ.get("ICAL_CACHE_WEEKS", "20000"))
+
+PERSON = "person"
+GROUP = "group"
+ROOM = "room"
+
+
+def week_start(value: datetime) -> datetime:
+    return datetime.combine((value - timedelta(days=value.weekday())).date(), datetime.min.time())
+
+def feed_weeks(now: Optional[datetime] = None) -> List[datetime]:
+    first = week_start(now or datetime.now()) - timedelta(weeks=ICAL_WEEKS_BEHIND)
+    return [first + timedelta(weeks=i) for i in range(ICAL_WEEKS_BEHIND + ICAL_WEEKS_AHEAD + 1)]
+
+def _escape(value: Optional[str]) -> str:
+    return (value or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n")
+
+def _fold(line: str) -> str:
+    """Radbryter enligt RFC 5545: högst 75 oktetter per rad, fortsättningsrader börjar med mellanslag."""
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts = []
+    while encoded:
+        limit = 75 if not parts else 74
+        cut = min(limit, len(encoded))
+        # Dela inte mitt i ett flerbytestecken
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+    return "\r\n ".join(parts) + "\r\n"
+
+def _local(value: datetime) -> str:
+    # Händelsernas tider saknar tidszon och skrivs därför som flytande lokal tid
+    return value.strftime("%Y%m%dT%H%M%S")
+
+def _utc(value: Optional[datetime]) -> str:
+    return (value or datetime.utcnow()).strftime("%Y%m%dT%H%M%SZ")
+
+def render_event(event: CalendarEvent) -> str:
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{event.id}@ss12000",
+        f"DTSTAMP:{_utc(event.modified)}",
+        f"DTSTART:{_local(event.start_time)}",
+        f"DTEND:{_local(event.end_time)}",
+        f"SUMMARY:{_escape(event.name)}",
+    ]
+    if event.location:
+        lines.append(f"LOCATION:{_escape(event.location)}")
+    if event.modified:
+        lines.append(f"LAST-MODIFIED:{_utc(event.modified)}")
+    lines.append("END:VEVENT")
+    return "".join(_fold(line) for line in lines)
+
+def render_header(name: str) -> str:
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//SS12000//Schema//SV", "CALSCALE:GREGORIAN",
+             "METHOD:PUBLISH", f"X-WR-CALNAME:{_escape(name)}"]
+    return "".join(_fold(line) for line in lines)
+
+def render_footer() -> str:
+    return "END:VCALENDAR\r\n"
+
+
+class FeedSubject:
+    """En person, grupp eller sal vars schema publiceras som flöde."""
+
+    def __init__(self, kind: str, id: str, name: str):
+        self.kind = kind
+        self.id = id
+        self.name = name
+
+    def filter(self, query):
+        if self.kind == PERSON:
+            return query.filter(participating([self.id]))
+        if self.kind == GROUP:
+            return apply_participation_filters(query, group=self.id)
+        # Salar har ingen koppling till händelserna utöver platsens namn
+        return query.filter(CalendarEvent.location == self.name)
+
+    def generated_events(self, db: Session, start: datetime, end: datetime) -> List[CalendarEvent]:
+        if self.kind == PERSON:
+            return expand_recurring_events(db, start, end, participant=self.id)
+        if self.kind == GROUP:
+            return expand_recurring_events(db, start, end, group=self.id)
+        return expand_recurring_events(db, start, end, location=self.name)
+
+
+def load_subject(db: Session, kind: str, id: str) -> Optional[FeedSubject]:
+    model, name = {PERSON: (Person, Person.display_name), GROUP: (Group, Group.display_name), ROOM: (Room, Room.name)}[kind]
+    row = db.query(model.id, name).filter(model.id == id).first()
+    return FeedSubject(kind, row[0], row[1]) if row else None
+
+
+class WeekCache:
+    """LRU-cache för renderade veckor, nycklad på (typ, id, veckans början) och giltig för ett fingeravtryck."""
+
+    def __init__(self, max_weeks: int = ICAL_CACHE_WEEKS):
+        self.max_weeks = max_weeks
+        self.hits = 0
+        self.misses = 0
+        self._weeks: "OrderedDict[tuple, Tuple[str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, fingerprint: str) -> Optional[str]:
+        with self._lock:
+            cached = self._weeks.get(key)
+            if cached is None or cached[0] != fingerprint:
+                self.misses += 1
+                return None
+            self._weeks.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+    def put(self, key: tuple, fingerprint: str, rendered: str):
+        with self._lock:
+            self._weeks[key] = (fingerprint, rendered)
+            self._weeks.move_to_end(key)
+            while len(self._weeks) > self.max_weeks:
+                self._weeks.popitem(last=False)
+
+
+week_cache = WeekCache()
+
+
+class Feed:
+    """
+    Ett flöde uppdelat i veckor. Fingeravtrycken beräknas från händelsernas ID, starttid och
+    ändringstid med en lätt fråga, så att ETag kan jämföras utan att något renderas och bara
+    ändrade veckor behöver renderas om.
+    """
+
+    def __init__(self, subject: FeedSubject, weeks: List[datetime], fingerprints: Dict[datetime, str],
+                 generated: Dict[datetime, List[CalendarEvent]]):
+        self.subject = subject
+        self.weeks = weeks
+        self.fingerprints = fingerprints
+        self.generated = generated
+
+    @classmethod
+    def prepare(cls, db: Session, subject: FeedSubject, now: Optional[datetime] = None) -> "Feed":
+        weeks = feed_weeks(now)
+        start, end = weeks[0], weeks[-1] + timedelta(weeks=1) - timedelta(microseconds=1)
+
+        entries = defaultdict(list)
+        query = db.query(CalendarEvent.id, CalendarEvent.start_time, CalendarEvent.modified).filter(
+            CalendarEvent.start_time >= start, CalendarEvent.start_time <= end,
+        )
+        query = prune_partitions(subject.filter(query), CalendarEvent, start, end)
+        for id, start_time, modified in query:
+            entries[week_start(start_time)].append((id, start_time.isoformat(), modified.isoformat() if modified else ""))
+
+        generated = defaultdict(list)
+        for event in subject.generated_events(db, start, end):
+            week = week_start(event.start_time)
+            generated[week].append(event)
+            entries[week].append((event.id, event.start_time.isoformat(), event.modified.isoformat() if event.modified else ""))
+
+        fingerprints = {
+            week: hashlib.sha1(repr(sorted(entries.get(week, []))).encode()).hexdigest()
+            for week in weeks
+        }
+        return cls(subject, weeks, fingerprints, generated)
+
+    @property
+    def etag(self) -> str:
+        digest = hashlib.sha1(repr((self.subject.kind, self.subject.id, self.subject.name,
+                                    [(week.isoformat(), self.fingerprints[week]) for week in self.weeks])).encode())
+        return f'"{digest.hexdigest()}"'
+
+    def _render_week(self, db: Session, week: datetime) -> str:
+        end = week + timedelta(weeks=1) - timedelta(microseconds=1)
+        query = db.query(CalendarEvent).filter(CalendarEvent.start_time >= week, CalendarEvent.start_time <= end)
+        query = prune_partitions(self.subject.filter(query), CalendarEvent, week, end)
+        events = query.all() + self.generated.get(week, [])
+        return "".join(render_event(e) for e in sorted(events, key=lambda e: (e.start_time, e.id)))
+
+    def stream(self, session_factory: Callable[[], Session] = SessionLocal) -> Iterator[bytes]:
+        """Strömmar flödet vecka för vecka; cachade veckor med oförändrat fingeravtryck återanvänds."""
+        yield render_header(self.subject.name).encode("utf-8")
+        db = None
+        try:
+            for week in self.weeks:
+                key = (self.subject.kind, self.subject.id, week)
+                rendered = week_cache.get(key, self.fingerprints[week])
+                if rendered is None:
+                    if db is None:
+                        db = session_factory()
+                    rendered = self._render_week(db, week)
+                    week_cache.put(key, self.fingerprints[week], rendered)
+                if rendered:
+                    yield rendered.encode("utf-8")
+        finally:
+            if db is not None:
+                db.close()
+        yield render_footer().encode("utf-8")
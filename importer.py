@@ -0,0 +1,538 @@
+# importer.py
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import threading
+import time
+import typing
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from enum import Enum
+from typing import IO, Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import Table, bindparam, select
+from sqlalchemy.exc import DBAPIError
+
+import schemas
+from aggregation import rebuild_group_rollups
+from cache import organisation_cache
+from changelog import INSERT, UPDATE, activity_organisations, append_changes
+from database import (
+    SessionLocal, Activity, CalendarEvent, Duty, Group, GroupMembership, Organisation, Person,
+    activity_group_association, activity_teacher_association, upsert_rows,
+)
+from org_statistics import refresh_statistics
+from participation import rebuild_participation
+
+logger = logging.getLogger("ss12000.importer")
+
+IMPORT_BATCH_ROWS = int(os.environ.get("IMPORT_BATCH_ROWS", "2000"))
+IMPORT_CHUNK_ROWS = int(os.environ.get("IMPORT_CHUNK_ROWS", "500"))
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", "4"))
+IMPORT_MAX_ERRORS = int(os.environ.get("IMPORT_MAX_ERRORS", "100"))
+
+JSON = "json"
+JSON_LINES = "jsonl"
+CSV = "csv"
+FORMATS = {".json": JSON, ".jsonl": JSON_LINES, ".ndjson": JSON_LINES, ".csv": CSV}
+
+
+class EntitySpec(NamedTuple):
+    name: str
+    model: object # Modellklass, eller Table för kopplingstabeller
+    schema: type
+    renames: Dict[str, str] = {}
+    # Kolumn som pekar på samma tabell och skrivs i efterhand när föräldern finns
+    self_reference: Optional[str] = None
+    key: Tuple[str, ...] = ("id",)
+    # Kopplingstabeller loggas som en ändring av aktiviteten: (aktivitetens kolumn, ändrat fält)
+    activity_field: Optional[Tuple[str, str]] = None
+
+    @property
+    def table(self) -> Table:
+        return self.model if isinstance(self.model, Table) else self.model.__table__
+
+
+# Beroendeordning: varje typ refererar bara till typer före den
+ENTITIES = OrderedDict((spec.name, spec) for spec in (
+    EntitySpec("organisations", Organisation, schemas.OrganisationBase, self_reference="parent_id"),
+    EntitySpec("persons", Person, schemas.PersonBase),
+    EntitySpec("duties", Duty, schemas.DutyBase),
+    EntitySpec("groups", Group, schemas.GroupBase),
+    EntitySpec("groupMemberships", GroupMembership, schemas.GroupMembershipSchema),
+    EntitySpec("activities", Activity, schemas.ActivitySchema),
+    EntitySpec("activityGroups", activity_group_association, schemas.ActivityGroupImport,
+               key=("activity_id", "group_id"), activity_field=("activity_id", "groups")),
+    EntitySpec("activityTeachers", activity_teacher_association, schemas.ActivityTeacherImport,
+               key=("activity_id", "teacher_duty_id"), activity_field=("activity_id", "teachers")),
+    EntitySpec("calendarEvents", CalendarEvent, schemas.CalendarEventImport, {"startTime": "start_time", "endTime": "end_time"}),
+))
+
+
+class ImportFormatError(Exception):
+    """Filen kan inte läsas som det angivna formatet."""
+
+
+# --- Läsning ---
+def _iter_json_lines(stream: IO[str]) -> Iterator[Tuple[int, dict]]:
+    for line_no, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield line_no, json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ImportFormatError(f"Rad {line_no} är inte JSON: {e}")
+
+def _iter_json_array(stream: IO[str], chunk_size: int = 1 << 16) -> Iterator[Tuple[int, dict]]:
+    """
+    Läser objekten i en JSON-array ett i taget utan att läsa in hela filen. Accepterar både en
+    array och ett SS12000-svar på formen {"data": [...]}. Numret är objektets ordning i arrayen.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buffer, position, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+
+    def skip_whitespace():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            if position < len(buffer) or not fill():
+                return
+
+    skip_whitespace()
+    if buffer[position:position + 1] == "{":
+        # Leta upp arrayen under "data"
+        while '"data"' not in buffer[position:] and fill():
+            pass
+        start = buffer.find('"data"', position)
+        if start < 0:
+            raise ImportFormatError('JSON-objektet saknar "data"')
+        position = start + len('"data"')
+        skip_whitespace()
+        if buffer[position:position + 1] != ":":
+            raise ImportFormatError('Förväntade ":" efter "data"')
+        position += 1
+        skip_whitespace()
+    if buffer[position:position + 1] != "[":
+        raise ImportFormatError("Förväntade en JSON-array")
+    position += 1
+
+    index = 0
+    while True:
+        skip_whitespace()
+        if buffer[position:position + 1] == "]":
+            return
+        if index and buffer[position:position + 1] == ",":
+            position += 1
+            skip_whitespace()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError:
+                if eof or not fill():
+                    raise ImportFormatError(f"Ofullständigt JSON-objekt nummer {index + 1}")
+        position = end
+        index += 1
+        yield index, item
+
+def _iter_csv(stream: IO[str]) -> Iterator[Tuple[int, dict]]:
+    reader = csv.DictReader(stream)
+    for row in reader:
+        # Tomma celler betyder att värdet saknas
+        yield reader.line_num, {key: (value if value != "" else None) for key, value in row.items()}
+
+def read_records(stream: IO[str], format: str) -> Iterator[Tuple[int, dict]]:
+    """(rad- eller objektnummer, post) för varje post i strömmen."""
+    if format == JSON_LINES:
+        return _iter_json_lines(stream)
+    if format == JSON:
+        return _iter_json_array(stream)
+    if format == CSV:
+        return _iter_csv(stream)
+    raise ImportFormatError(f"Okänt format: {format}")
+
+def format_of(path: str) -> str:
+    format = FORMATS.get(os.path.splitext(path)[1].lower())
+    if format is None:
+        raise ImportFormatError(f"Okänd filändelse för {path}; använd {', '.join(FORMATS)}")
+    return format
+
+
+# --- Validering ---
+def _list_fields(schema: type) -> Set[str]:
+    """Fält som är listor i schemat; i CSV anges de som kommaseparerade strängar."""
+    fields = set()
+    # Pydantic 2 har model_fields med annotation, Pydantic 1 __fields__ med outer_type_
+    for name, field in (getattr(schema, "model_fields", None) or schema.__fields__).items():
+        annotation = getattr(field, "annotation", None) or getattr(field, "outer_type_", None)
+        if typing.get_origin(annotation) is typing.Union:
+            annotation = next(a for a in typing.get_args(annotation) if a is not type(None))
+        if typing.get_origin(annotation) is list:
+            fields.add(name)
+    return fields
+
+def _column_value(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, list):
+        return ",".join(str(_column_value(v)) for v in value)
+    return value
+
+def validate_batch(spec: EntitySpec, records: List[Tuple[int, dict]], now: datetime) -> Tuple[List[dict], List[int], List[dict]]:
+    """
+    Validerar posterna med API:ets schema och gör om dem till tabellrader. Returnerar
+    (rader, radernas nummer, fel) där varje fel har postens nummer och orsak. Raderna har bara
+    de kolumner som finns i posten, så att en befintlig rad behåller övriga värden. I CSV finns
+    alla kolumner i rubrikraden med, och en tom cell skriver NULL.
+    """
+    columns = [column.name for column in spec.table.columns]
+    list_fields = _list_fields(spec.schema)
+    rows, lines, errors = [], [], []
+    for line, record in records:
+        if not isinstance(record, dict):
+            errors.append({"line": line, "error": "Posten är inget objekt"})
+            continue
+        record = dict(record)
+        for name in ("created", "modified"):
+            if record.get(name) is None:
+                record[name] = now
+        for name in list_fields:
+            if isinstance(record.get(name), str):
+                record[name] = [part.strip() for part in record[name].split(",") if part.strip()]
+        try:
+            item = (getattr(spec.schema, "model_validate", None) or spec.schema.parse_obj)(record)
+        except ValidationError as e:
+            errors.append({"line": line, "error": "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())})
+            continue
+        dump = getattr(item, "model_dump", None) or item.dict
+        data = {spec.renames.get(key, key): value for key, value in dump(exclude_unset=True).items()}
+        rows.append({column: _column_value(data[column]) for column in columns if column in data})
+        lines.append(line)
+    return rows, lines, errors
+
+
+# --- Framsteg ---
+class ImportProgress:
+    def __init__(self, entity: str):
+        self.entity = entity
+        self.read = 0
+        self.invalid = 0
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def add(self, inserted: int = 0, updated: int = 0, invalid: int = 0, failed: int = 0, errors: List[dict] = ()):
+        with self._lock:
+            self.inserted += inserted
+            self.updated += updated
+            self.invalid += invalid
+            self.failed += failed
+            self.errors.extend(errors[:max(0, IMPORT_MAX_ERRORS - len(self.errors))])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            seconds = (self.finished or time.monotonic()) - self.started
+            written = self.inserted + self.updated
+            return {
+                "entity": self.entity, "read": self.read, "invalid": self.invalid, "inserted": self.inserted,
+                "updated": self.updated, "failed": self.failed, "seconds": round(seconds, 3),
+                "rows_per_second": round(written / seconds, 1) if seconds > 0 else 0.0, "errors": list(self.errors),
+            }
+
+
+# --- Skrivning ---
+class _EntityWriter:
+    """Skriver validerade omgångar för en typ. Används från flera trådar samtidigt."""
+
+    def __init__(self, bind, spec: EntitySpec, progress: ImportProgress, chunk_rows: int, log_changes: bool):
+        self.bind = bind
+        self.spec = spec
+        self.progress = progress
+        self.chunk_rows = chunk_rows
+        self.log_changes = log_changes
+        self.table = spec.table
+        self.update_columns = tuple(c.name for c in self.table.columns if c.name not in spec.key and c.name != "created")
+        self.deferred: Dict[str, str] = {}
+        self._known: Set[str] = set()
+        self._lock = threading.Lock()
+        if spec.self_reference:
+            with bind.connect() as conn:
+                self._known = {row[0] for row in conn.execute(select(self.table.c.id))}
+
+    def _defer_self_references(self, rows: List[dict]):
+        # Föräldern måste finnas innan raden skrivs; annars sätts referensen efter hela typen
+        column = self.spec.self_reference
+        with self._lock:
+            for row in rows:
+                parent = row.get(column)
+                if parent and parent not in self._known:
+                    self.deferred[row["id"]] = parent
+                    row[column] = None
+
+    def _existing(self, conn, rows: List[dict]) -> Set[tuple]:
+        key = self.spec.key
+        first = self.table.c[key[0]]
+        found = conn.execute(select(*(self.table.c[k] for k in key)).where(first.in_({row[key[0]] for row in rows})))
+        return {tuple(row) for row in found}
+
+    def _changes(self, conn, rows: List[dict], existing: Set[tuple]) -> list:
+        spec = self.spec
+        if spec.activity_field:
+            # En ny koppling ändrar aktivitetens lista; en befintlig ändrar ingenting
+            column, field = spec.activity_field
+            activity_ids = {row[column] for row in rows if tuple(row[k] for k in spec.key) not in existing}
+            organisations = activity_organisations(conn, activity_ids)
+            return [("Activity", id, UPDATE, [field], organisations.get(id)) for id in activity_ids]
+        organisations = activity_organisations(conn, (row.get("activity_id") for row in rows)) if "activity_id" in self.table.c else {}
+        return [
+            (spec.model.__name__, row["id"], UPDATE if (row["id"],) in existing else INSERT,
+             [c for c in self.update_columns if c in row] if (row["id"],) in existing else list(row),
+             row["id"] if spec.model is Organisation else row.get("organisation_id") or organisations.get(row.get("activity_id")))
+            for row in rows
+        ]
+
+    def _write(self, conn, rows: List[dict]) -> Tuple[int, int]:
+        existing = self._existing(conn, rows)
+        # Rader med samma kolumner skrivs med samma flerradiga sats och uppdaterar bara sina kolumner
+        by_columns: Dict[Tuple[str, ...], List[dict]] = {}
+        for row in rows:
+            by_columns.setdefault(tuple(row), []).append(row)
+        for columns, group in by_columns.items():
+            update = tuple(c for c in self.update_columns if c in columns)
+            upsert_rows(conn, self.table, group, self.spec.key, update=update, chunk_size=self.chunk_rows)
+        if self.log_changes:
+            append_changes(conn, self._changes(conn, rows, existing))
+        updated = sum(1 for row in rows if tuple(row[k] for k in self.spec.key) in existing)
+        return len(rows) - updated, updated
+
+    def write(self, rows: List[dict], lines: List[int]):
+        if self.spec.self_reference:
+            self._defer_self_references(rows)
+        try:
+            with self.bind.begin() as conn:
+                inserted, updated = self._write(conn, rows)
+        except DBAPIError as e:
+            if len(rows) == 1:
+                self.progress.add(failed=1, errors=[{"line": lines[0], "error": str(e.orig)}])
+                return
+            # Skriv raderna var för sig så att bara de felaktiga, t.ex. med saknade referenser, faller bort
+            for row, line in zip(rows, lines):
+                self.write([row], [line])
+            return
+        if self.spec.self_reference:
+            with self._lock:
+                self._known.update(row["id"] for row in rows)
+        self.progress.add(inserted=inserted, updated=updated)
+
+    def finish(self):
+        if not self.deferred:
+            return
+        column = self.spec.self_reference
+        table = self.table
+        with self.bind.begin() as conn:
+            conn.execute(
+                table.update().where(table.c.id == bindparam("row_id")).values({column: bindparam("parent")}),
+                [{"row_id": id, "parent": parent} for id, parent in self.deferred.items()],
+            )
+
+
+def import_stream(bind, entity: str, stream: IO[str], format: str, workers: int = IMPORT_WORKERS,
+                  batch_rows: int = IMPORT_BATCH_ROWS, chunk_rows: int = IMPORT_CHUNK_ROWS, log_changes: bool = True,
+                  progress: Optional[ImportProgress] = None,
+                  on_progress: Optional[Callable[[ImportProgress], None]] = None) -> ImportProgress:
+    """
+    Importerar en typ från en ström. Posterna läses i omgångar om batch_rows som valideras och
+    skrivs av workers trådar parallellt, med UPSERT-satser om chunk_rows rader per sats. Högst
+    två omgångar per tråd läses i förväg så att minnet inte växer med filens storlek. Poster som
+    inte går att validera eller skriva hoppar över och rapporteras i progress.errors.
+    """
+    spec = ENTITIES[entity]
+    progress = progress or ImportProgress(entity)
+    # Självrefererande typer skrivs i ordning så att föräldrar hinner bli kända
+    workers = 1 if spec.self_reference else max(1, workers)
+    writer = _EntityWriter(bind, spec, progress, chunk_rows, log_changes)
+    slots = threading.BoundedSemaphore(workers * 2)
+    now = datetime.utcnow()
+
+    def process(records: List[Tuple[int, dict]]):
+        try:
+            rows, lines, errors = validate_batch(spec, records, now)
+            progress.add(invalid=len(errors), errors=errors)
+            if rows:
+                writer.write(rows, lines)
+            if on_progress:
+                on_progress(progress)
+        except Exception:
+            logger.exception("Import av %s misslyckades för en omgång", entity)
+            progress.add(failed=len(records), errors=[{"line": records[0][0], "error": "Oväntat fel, se serverloggen"}])
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"import-{entity}") as executor:
+        batch = []
+        for record in read_records(stream, format):
+            batch.append(record)
+            progress.read += 1
+            if len(batch) >= batch_rows:
+                slots.acquire()
+                executor.submit(process, batch)
+                batch = []
+        if batch:
+            slots.acquire()
+            executor.submit(process, batch)
+
+    writer.finish()
+    progress.finished = time.monotonic()
+    return progress
+
+
+def refresh_derived(bind, entities: List[str]):
+    """Bygger om deltagarindex, gruppsummor, statistik och referenscache efter en import av entities."""
+    if {"duties", "groups", "groupMemberships", "activities", "activityGroups", "activityTeachers"} & set(entities):
+        with bind.begin() as conn:
+            rebuild_participation(conn)
+    if "activityGroups" in entities:
+        with bind.begin() as conn:
+            rebuild_group_rollups(conn)
+    db = SessionLocal(bind=bind)
+    try:
+        refresh_statistics(db)
+        db.commit()
+    finally:
+        db.close()
+    organisation_cache.invalidate()
+
+
+def import_files(bind, files: Dict[str, str], **options) -> List[ImportProgress]:
+    """Importerar filer per typ i beroendeordning och bygger sedan om härledda data."""
+    unknown = set(files) - set(ENTITIES)
+    if unknown:
+        raise ImportFormatError(f"Okända typer: {', '.join(sorted(unknown))}")
+    results = []
+    for entity in ENTITIES:
+        if entity in files:
+            with open(files[entity], encoding="utf-8", newline="") as stream:
+                results.append(import_stream(bind, entity, stream, format_of(files[entity]), **options))
+    refresh_derived(bind, [progress.entity for progress in results])
+    return results
+
+
+def files_in(directory: str) -> Dict[str, str]:
+    """Filer i katalogen som heter som en typ, t.ex. persons.csv eller calendarEvents.jsonl."""
+    files = {}
+    for name in os.listdir(directory):
+        entity, extension = os.path.splitext(name)
+        if entity in ENTITIES and extension.lower() in FORMATS:
+            files[entity] = os.path.join(directory, name)
+    return files
+
+
+# --- Importjobb via API ---
+class ImportJob:
+    def __init__(self, entity: str):
+        self.id = str(uuid.uuid4())
+        self.entity = entity
+        self.status = "queued"
+        self.progress = ImportProgress(entity)
+        self.error: Optional[str] = None
+
+    def snapshot(self) -> dict:
+        return {"id": self.id, "entity": self.entity, "status": self.status, "progress": self.progress.snapshot(), "error": self.error}
+
+
+class ImportJobs:
+    """Kör importer som skickats till API:et en i taget i bakgrunden och minns de senaste."""
+
+    def __init__(self, keep: int = 50):
+        self.keep = keep
+        self._jobs: "OrderedDict[str, ImportJob]" = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="import-job")
+
+    def get(self, id: str) -> Optional[ImportJob]:
+        return self._jobs.get(id)
+
+    def submit(self, bind, entity: str, upload: IO[bytes], format: str) -> ImportJob:
+        if entity not in ENTITIES:
+            raise ImportFormatError(f"Okänd typ: {entity}")
+        job = ImportJob(entity)
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.keep:
+            self._jobs.popitem(last=False)
+        self._executor.submit(self._run, bind, job, upload, format)
+        return job
+
+    def _run(self, bind, job: ImportJob, upload: IO[bytes], format: str):
+        job.status = "running"
+        job.progress.started = time.monotonic()
+        try:
+            stream = io.TextIOWrapper(upload, encoding="utf-8", newline="")
+            import_stream(bind, job.entity, stream, format, progress=job.progress)
+            refresh_derived(bind, [job.entity])
+            job.status = "done"
+        except Exception as e:
+            logger.exception("Importjobb %s misslyckades", job.id)
+            job.status = "failed"
+            job.error = str(e)
+            job.progress.finished = time.monotonic()
+        finally:
+            upload.close()
+
+
+import_jobs = ImportJobs()
+
+
+if __name__ == "__main__":
+    from database import init_engine
+
+    parser = argparse.ArgumentParser(description="Importera SS12000-data från JSON, JSON Lines eller CSV.")
+    parser.add_argument("directory", nargs="?", help="Katalog med filer som heter som typerna, t.ex. persons.csv.")
+    for entity in ENTITIES:
+        parser.add_argument(f"--{entity}", metavar="FIL", help=f"Fil med {entity}.")
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS)
+    parser.add_argument("--batch-rows", type=int, default=IMPORT_BATCH_ROWS)
+    parser.add_argument("--chunk-rows", type=int, default=IMPORT_CHUNK_ROWS)
+    parser.add_argument("--no-change-log", action="store_true", help="Skriv inte till ändringsloggen, t.ex. vid första laddningen.")
+    args = parser.parse_args()
+
+    files = files_in(args.directory) if args.directory else {}
+    files.update({entity: getattr(args, entity) for entity in ENTITIES if getattr(args, entity)})
+    if not files:
+        parser.error("Ange en katalog eller minst en fil")
+
+    last_report = [0.0]
+
+    def report(progress: ImportProgress, force: bool = False):
+        now = time.monotonic()
+        if force or now - last_report[0] >= 2:
+            last_report[0] = now
+            s = progress.snapshot()
+            print(f"{s['entity']}: {s['read']} lästa, {s['inserted']} nya, {s['updated']} uppdaterade, "
+                  f"{s['invalid']} ogiltiga, {s['failed']} misslyckade, {s['rows_per_second']} rader/s", flush=True)
+
+    for progress in import_files(init_engine(), files, workers=args.workers, batch_rows=args.batch_rows,
+                                 chunk_rows=args.chunk_rows, log_changes=not args.no_change_log, on_progress=report):
+        report(progress, force=True)
+        for error in progress.errors[:10]:
+            print(f"  rad {error['line']}: {error['error']}")
@@ -1,20 +1,138 @@
 # main.py
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import tempfile
+import logging
 import uuid
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import date, datetime
 from typing import List, Optional, Union
 
-from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import desc, asc, func, or_
 
-from database import *
-from schemas import *
+# Schemana som heter som ORM-modellerna (Person, CalendarEvent m.fl.) används som schemas.<namn>
+import schemas
+from database import (
+    Activity, AggregatedAttendance, Attendance, AttendanceEvent, AttendanceRollup, AttendanceSchedule,
+    CalendarEvent, DeletedEntity, Duty, Enrolment, Grade, Group, GroupMembership, Log, Organisation, Person,
+    Placement, Programme, RecurrenceRule, Resource, ResponsibleFor, Room, SchoolUnitOffering, StudyPlan,
+    Subscription, Syllabus, WebhookDeadLetter, check_schema_version, dispose_engine, get_db, init_engine,
+)
+from schemas import (
+    ActivityExpandEnum, ActivityExpanded, ActivitySchema, AggregatedAttendanceWithPerson, AttendanceEventBase,
+    AttendanceRegistration, AttendanceRegistrationResult, AttendanceRollupSchema, AttendanceWithRelations,
+    CalendarEventExpandEnum, CalendarEventExpanded, CalendarEventSortkeyEnum, CalendarEventsLookupRequest,
+    DutiesArray, DutyBase, DutyExpandEnum, DutyExpanded, DutyRoleEnum, GradeWithPerson, GroupAttendanceReport,
+    GroupBase, GroupExpandEnum, GroupExpanded, GroupTypesEnum, GroupsExpanded, ImportJobSchema, LookupRequest,
+    OccurrenceSchema, OrganisationBase, OrganisationExpanded, OrganisationTypeEnum, PersonBase, PersonExpandEnum,
+    PersonExpanded, PersonRelationshipTypeEnum, PersonSchema, PlacementBase, PlacementExpandEnum,
+    PlacementExpanded, PlacementExpandedArray, ProgrammeSortkeyEnum, ProgrammesArray, RecurrenceRuleCreate,
+    RecurrenceRuleSchema, SchoolTypesEnum, SchoolUnitOfferingExpanded, SchoolUnitOfferingSchema,
+    SlotAttendanceReport, SlowQuerySchema, StatisticsSchema, StudentAttendanceReport, StudyPlanExpanded,
+    StudyPlanSchema, StudyPlans, StudyPlansExpandedArray, SubscriptionBase, SubscriptionCreate,
+    SubscriptionUpdate, SyllabusBase, WebhookDeadLetterSchema,
+)
 
 # Expand helper functions
-from helpers import *
+from helpers import (
+    ADMIN_TOKEN, apply_activity_filters, apply_expand_for_duties, apply_expand_for_groups,
+    apply_expand_for_placements, apply_meta_filters, apply_pagination, apply_relational_filters, apply_sorting,
+    apply_studyplan_filters, apply_syllabus_filters, apply_time_filters, expand_activity, expand_organisations,
+    expand_persons_data, expand_school_unit_offering, require_admin, validate_attendance_registrations,
+)
+
+from aggregation import ALL_TIME, attendance_percentage
+from analytics import CHRONIC_ABSENCE_MIN_LESSONS, CHRONIC_ABSENCE_THRESHOLD, get_snapshot, group_report, slot_report, student_report
+from broadcaster import EVICTED, HEARTBEAT, RESET, TooManyClients, change_broadcaster, change_payload
+from cache import organisation_cache
+from compression import CompressionMiddleware
+from fieldsets import FIELDS_DESCRIPTION, select_fields
+from ical import Feed, load_subject
+from importer import CSV, ENTITIES, JSON, JSON_LINES, ImportFormatError, import_jobs
+from memprofile import GROUP_BY as MEMORY_GROUP_BY, MemoryMiddleware, memory
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, render_metrics, threadpool_stats
+from org_statistics import statistics_rows
+from participation import participating
+from profiler import ProfilerMiddleware, profiles
+from recurrence import expand_recurring_events, last_occurrence, merge_occurrences, schedule_occurrences
+from slowlog import SORTKEYS as SLOW_QUERY_SORTKEYS, slow_queries
+from sqlstats import SQLStatsMiddleware
+from tombstones import tombstone_page
+from tracing import TracedRoute, TracingMiddleware, tracer
+from warmup import run_warmup
+from webhooks import change_tailer, dispatcher
+from writebehind import WriterBusy, attendance_writer
+
+logger = logging.getLogger("ss12000")
+
+# --- Applikationens livscykel ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Skapar databasmotorn och kontrollerar schemaversionen vid uppstart.
+    Varje steg tidsmäts och sparas i app.state.startup_profile.
+    Uppvärmningen körs i bakgrunden; /health/ready svarar 503 tills den är klar.
+    """
+    app.state.ready = False
+    profile = {"import_ms": (time.perf_counter() - _IMPORT_STARTED) * 1000}
+
+    started = time.perf_counter()
+    db_engine = init_engine()
+    profile["engine_ms"] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    check_schema_version(db_engine)
+    profile["schema_check_ms"] = (time.perf_counter() - started) * 1000
+
+    profile["total_ms"] = (time.perf_counter() - _IMPORT_STARTED) * 1000
+    app.state.startup_profile = profile
+    logger.info("Uppstart klar: %s", ", ".join(f"{k}={v:.1f}" for k, v in profile.items()))
+
+    async def warm_up():
+        app.state.warmup_profile = await asyncio.to_thread(run_warmup, app, db_engine)
+        app.state.ready = True
+        logger.info("Uppvärmning klar: %s", app.state.warmup_profile)
+
+    warmup_task = asyncio.create_task(warm_up())
+    attendance_writer.start()
+    dispatcher.start()
+    change_tailer.start()
+    change_broadcaster.start(asyncio.get_running_loop())
+    slow_queries.start(db_engine)
+    tracer.start()
+
+    yield
+
+    warmup_task.cancel()
+    # Töm skrivkön innan motorn stängs så att bekräftade registreringar hinner skrivas
+    await asyncio.to_thread(attendance_writer.stop)
+    await asyncio.to_thread(change_tailer.stop)
+    await asyncio.to_thread(change_broadcaster.stop)
+    await asyncio.to_thread(dispatcher.stop)
+    await asyncio.to_thread(slow_queries.stop)
+    await asyncio.to_thread(tracer.stop)
+    dispose_engine()
 
 # --- FastAPI-applikation ---
-app = FastAPI(title="SS12000 Mock API med MySQL")
+app = FastAPI(title="SS12000 Mock API med MySQL", lifespan=lifespan)
+app.add_middleware(SQLStatsMiddleware)
+app.add_middleware(CompressionMiddleware)
+# Profilering på begäran kräver en administratörsnyckel; utan den läggs middlewaren inte ens till
+if ADMIN_TOKEN:
+    app.add_middleware(MemoryMiddleware)
+    app.add_middleware(ProfilerMiddleware)
+# Spårningen läggs till först när en exportör är vald; rutterna måste skapas med TracedRoute
+if tracer.enabled:
+    app.router.route_class = TracedRoute
+    app.add_middleware(TracingMiddleware)
+# Läggs till sist och hamnar därmed ytterst, så att svarstiden även omfattar övrig middleware
+app.add_middleware(MetricsMiddleware)
 
 
 # --- API Endpoints ---
@@ -40,7 +158,8 @@ def get_organisations(
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "DisplayNameAsc".'),
     limit: int = 100,
     offset: int = 0,
-    pageToken: Optional[str] = Query(None, description="Ett opakt värde som servern givit som svar på en tidigare ställd fråga.")
+    pageToken: Optional[str] = Query(None, description="Ett opakt värde som servern givit som svar på en tidigare ställd fråga."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """
     Hämta en lista med organisationer med stöd för filtrering, sortering och paginering.
@@ -52,6 +171,8 @@ def get_organisations(
             detail="Filter can not be combined with pageToken."
         )
 
+    selection = select_fields(fields, Organisation, OrganisationBase, expandReferenceNames)
+
     # Bygg upp SQLAlchemy-frågan
     query = db.query(Organisation)
 
@@ -91,6 +212,8 @@ def get_organisations(
     query = apply_sorting(query, Organisation, sortkey)
     
     # Applicera paginering
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     organisations = query.offset(offset).limit(limit).all()
 
     if expandReferenceNames:
@@ -123,13 +246,18 @@ def get_organisation_by_id(
 def lookup_organisations(
     request_body: LookupRequest,
     db: Session = Depends(get_db),
-    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returnera `displayName` för alla refererade objekt.")
+    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returnera `displayName` för alla refererade objekt."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """
     Hämtar en lista med organisationer baserat på en lista av ID:n som skickas i request body.
     """
+    selection = select_fields(fields, Organisation, OrganisationBase, expandReferenceNames)
     # Hämta en lista med organisationer vars ID finns i request_body.organisations
-    organisations = db.query(Organisation).filter(Organisation.id.in_(request_body.organisations)).all()
+    query = db.query(Organisation).filter(Organisation.id.in_(request_body.organisations))
+    if selection:
+        return selection.response(selection.apply(query).all())
+    organisations = query.all()
     
     if expandReferenceNames:
         return expand_organisations(organisations, db)
@@ -161,7 +289,8 @@ def get_persons(
     sortkey: Optional[str] = Query(None, description='Anger hur resultatet ska sorteras.'),
     limit: int = 100,
     offset: int = 0,
-    pageToken: Optional[str] = Query(None, description="Ett opakt värde som servern givit som svar på en tidigare ställd fråga.")
+    pageToken: Optional[str] = Query(None, description="Ett opakt värde som servern givit som svar på en tidigare ställd fråga."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """
     Hämtar en lista med personer med stöd för avancerad filtrering, sortering och paginering.
@@ -172,6 +301,8 @@ def get_persons(
             detail="Filter can not be combined with pageToken."
         )
 
+    selection = select_fields(fields, Person, PersonBase, expand or expandReferenceNames)
+
     query = db.query(Person)
 
     # Filtrering på namn
@@ -216,7 +347,7 @@ def get_persons(
         elif relationship_entity_type == PersonRelationshipTypeEnum.duty:
             query = query.join(Duty, Duty.person_id == Person.id)
             if relationship_organisation:
-                query = query.filter(Duty.duty_at_id == relationship_organisation)
+                query = query.filter(Duty.organisation_id == relationship_organisation)
             if relationship_start_date_onOrBefore:
                 query = query.filter(Duty.start_date <= relationship_start_date_onOrBefore)
             if relationship_start_date_onOrAfter:
@@ -227,7 +358,7 @@ def get_persons(
                 query = query.filter(Duty.end_date >= relationship_end_date_onOrAfter)
 
         elif relationship_entity_type == PersonRelationshipTypeEnum.placement_child:
-            query = query.join(Placement, Placement.child_id == Person.id)
+            query = query.join(Placement, Placement.person_id == Person.id)
             if relationship_organisation:
                 query = query.filter(Placement.placed_at_id == relationship_organisation)
             if relationship_start_date_onOrBefore:
@@ -285,6 +416,8 @@ def get_persons(
         query = query.order_by(Person.display_name.asc()) # Standard sortering
 
     # Applicera paginering
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     persons = query.offset(offset).limit(limit).all()
     
     # Expanderade data
@@ -298,18 +431,23 @@ def persons_lookup(
     request_body: LookupRequest,
     db: Session = Depends(get_db),
     expand: Optional[List[str]] = Query(None, description="Expands related data for the person, e.g., 'duties', 'placements'."),
-    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returns expanded reference names in the response.")
+    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returns expanded reference names in the response."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """
     Fetches multiple persons based on a list of IDs or social security numbers.
     """
-    if not request_body.identifiers:
+    selection = select_fields(fields, Person, PersonBase, expand or expandReferenceNames)
+    if not request_body.ids:
         return []
 
     # Get persons from the database
-    persons = db.query(Person).filter(
-        Person.id.in_(request_body.identifiers) | Person.civic_no.in_(request_body.identifiers) 
-    ).all()
+    query = db.query(Person).filter(
+        Person.id.in_(request_body.ids) | Person.civic_no.in_(request_body.ids) 
+    )
+    if selection:
+        return selection.response(selection.apply(query).all())
+    persons = query.all()
 
     if expand or expandReferenceNames:
         return expand_persons_data(persons, expand, expandReferenceNames, db)
@@ -360,10 +498,12 @@ def get_placements(
     sortkey: Optional[str] = Query(None, description='Sorteringsordning, t.ex. "ModifiedDesc" eller "CreatedAsc".'),
     limit: int = 100,
     offset: int = 0,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """
     Hämta en lista med placeringar baserat på filter och sorteringsparametrar.
     """
+    selection = select_fields(fields, Placement, PlacementBase, expand)
     query = db.query(Placement)
     
     # Apply filters
@@ -376,6 +516,8 @@ def get_placements(
     query = apply_sorting(query, Placement, sortkey)
     query = apply_expand_for_placements(query, expand)
     
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     placements = query.offset(offset).limit(limit).all()
 
     return placements
@@ -405,11 +547,13 @@ def lookup_placements(
     lookup_data: LookupRequest,
     db: Session = Depends(get_db),
     expand: Optional[List[PlacementExpandEnum]] = Query(None, alias="expand"),
-    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returnera 'displayName' för alla refererade objekt.")
+    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returnera 'displayName' för alla refererade objekt."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """
     Istället för att hämta placeringar en i taget med en loop av GET-anrop så finns det även möjlighet att hämta många placeringar på en gång genom att skicka ett anrop med en lista med önskade placeringar.
     """
+    selection = select_fields(fields, Placement, PlacementBase, expand or expandReferenceNames)
     query = db.query(Placement)
     
     # Handle the lookup logic based on placement IDs and person IDs
@@ -428,6 +572,8 @@ def lookup_placements(
 
     query = apply_expand_for_placements(query, expand)
     
+    if selection:
+        return selection.response(selection.apply(query).all())
     placements = query.all()
     
     return placements
@@ -452,10 +598,12 @@ def get_duties(
     sortkey: Optional[str] = Query(None, description="Anger hur resultatet ska sorteras."),
     limit: int = 100,
     offset: int = 0,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """
     Hämta en lista med tjänstgöringar baserat på filter och sorteringsparametrar.
     """
+    selection = select_fields(fields, Duty, DutyBase, expand or expandReferenceNames)
     if organisation:
         # NOTE: A full implementation for a real-world scenario would need to recursively
         # find all descendants of the given organisation, but for this mock API,
@@ -483,6 +631,8 @@ def get_duties(
     query = apply_expand_for_duties(query, expand)
     query = apply_sorting(query, Duty, sortkey)
 
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     duties = query.offset(offset).limit(limit).all()
     return duties
 
@@ -511,16 +661,20 @@ def lookup_duties(
     lookup_data: LookupRequest,
     db: Session = Depends(get_db),
     expand: Optional[List[DutyExpandEnum]] = Query(None, alias="expand"),
-    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames")
+    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """
     Istället för att hämta tjänstgöringar en i taget med en loop av GET-anrop så finns det även möjlighet att hämta många tjänstgöringar på en gång genom att skicka ett anrop med en lista med önskade tjänstgöringar.
     """
+    selection = select_fields(fields, Duty, DutyBase, expand or expandReferenceNames)
     if not lookup_data.ids:
         return []
 
     query = db.query(Duty).filter(Duty.id.in_(lookup_data.ids))
     query = apply_expand_for_duties(query, expand)
+    if selection:
+        return selection.response(selection.apply(query).all())
     duties = query.all()
     return duties
 
@@ -544,6 +698,7 @@ def get_groups(
     limit: int = 100,
     offset: int = 0,
     pageToken: Optional[str] = Query(None, alias="pageToken", description="Ett opakt värde som servern givit som svar på en tidigare ställd fråga. Kan inte kombineras med andra filter men väl med 'limit'."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """
     Hämta en lista med grupper baserat på filter och sorteringsparametrar.
@@ -557,6 +712,7 @@ def get_groups(
         # TODO: Implement pageToken logic if needed in the future
         raise HTTPException(status_code=501, detail="PageToken-funktionalitet är inte implementerad.")
         
+    selection = select_fields(fields, Group, GroupBase, expand or expandReferenceNames)
     query = db.query(Group)
 
     if groupType:
@@ -580,6 +736,8 @@ def get_groups(
     query = apply_expand_for_groups(query, expand)
     query = apply_sorting(query, Group, sortkey)
 
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     groups = query.offset(offset).limit(limit).all()
     
     # TODO: Handle expandReferenceNames for groups
@@ -592,16 +750,20 @@ def lookup_groups(
     lookup_data: LookupRequest,
     db: Session = Depends(get_db),
     expand: Optional[List[GroupExpandEnum]] = Query(None, alias="expand"),
-    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames")
+    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """
     Istället för att hämta grupper en i taget med en loop av GET-anrop så finns det även möjlighet att hämta många grupper på en gång genom att skicka ett anrop med en lista med önskade grupper.
     """
+    selection = select_fields(fields, Group, GroupBase, expand or expandReferenceNames)
     if not lookup_data.ids:
         return []
 
     query = db.query(Group).filter(Group.id.in_(lookup_data.ids))
     query = apply_expand_for_groups(query, expand)
+    if selection:
+        return selection.response(selection.apply(query).all())
     groups = query.all()
     return {"__root__": groups}
 
@@ -640,6 +802,7 @@ def get_programmes(
     limit: int = 100,
     offset: int = 0,
     pageToken: Optional[str] = Query(None, alias="pageToken", description="Ett opakt värde som servern givit som svar på en tidigare ställd fråga. Kan inte kombineras med andra filter men väl med 'limit'."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """
     Hämta en lista med program baserat på filter och sorteringsparametrar.
@@ -651,6 +814,7 @@ def get_programmes(
         # TODO: Implement pageToken logic if needed in the future
         raise HTTPException(status_code=501, detail="PageToken-funktionalitet är inte implementerad.")
         
+    selection = select_fields(fields, Programme, schemas.Programme, expandReferenceNames)
     query = db.query(Programme)
     
     if schoolTypes:
@@ -664,6 +828,8 @@ def get_programmes(
     query = apply_meta_filters(query, Programme, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, Programme, sortkey)
     
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     programmes = query.offset(offset).limit(limit).all()
     
     return programmes
@@ -672,18 +838,23 @@ def get_programmes(
 def lookup_programmes(
     lookup_data: LookupRequest,
     db: Session = Depends(get_db),
-    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames")
+    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """
     Istället för att hämta program en i taget med en loop av GET-anrop så finns det även möjlighet att hämta många program på en gång genom att skicka ett anrop med en lista med önskade program.
     """
+    selection = select_fields(fields, Programme, schemas.Programme, expandReferenceNames)
     if not lookup_data.ids:
         return []
     
-    programmes = db.query(Programme).filter(Programme.id.in_(lookup_data.ids)).all()
+    query = db.query(Programme).filter(Programme.id.in_(lookup_data.ids))
+    if selection:
+        return selection.response(selection.apply(query).all())
+    programmes = query.all()
     return programmes
 
-@app.get("/programmes/{id}", response_model=Programme, summary="Hämta program baserat på ID")
+@app.get("/programmes/{id}", response_model=schemas.Programme, summary="Hämta program baserat på ID")
 def get_programme_by_id(
     id: str,
     db: Session = Depends(get_db),
@@ -715,9 +886,11 @@ def get_studyplans(
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = Query(100, ge=1, le=100),
     offset: int = 0,
-    pageToken: Optional[str] = Query(None, description="Ett opakt värde för sidnumrering. Kan inte kombineras med andra filter.")
+    pageToken: Optional[str] = Query(None, description="Ett opakt värde för sidnumrering. Kan inte kombineras med andra filter."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """Hämta en lista med studieplaner."""
+    selection = select_fields(fields, StudyPlan, StudyPlanSchema, expandReferenceNames)
     if pageToken and any([student, startDate_onOrBefore, startDate_onOrAfter, endDate_onOrBefore, endDate_onOrAfter, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter, sortkey, offset]):
         raise HTTPException(status_code=400, detail="Filter och sortkey kan inte kombineras med pageToken.")
     
@@ -730,6 +903,8 @@ def get_studyplans(
     query = apply_meta_filters(query, StudyPlan, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, StudyPlan, sortkey)
     
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     studyplans = query.offset(offset).limit(limit).all()
     
     # Hantera 'expandReferenceNames'
@@ -762,7 +937,6 @@ def get_studyplan_by_id(
         return expanded_sp
     
     return studyplan
-    return study_plans
 
 @app.get("/syllabuses", response_model=List[SyllabusBase])
 def get_syllabuses(
@@ -782,13 +956,17 @@ def get_syllabuses(
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = Query(100, ge=1, le=100),
     offset: int = 0,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """Hämta en lista med läroplaner."""
+    selection = select_fields(fields, Syllabus, SyllabusBase)
     query = db.query(Syllabus)
     query = apply_syllabus_filters(query, subject_code, course_code, school_unit_offerings, programmes, startDate_onOrBefore, startDate_onOrAfter, endDate_onOrBefore, endDate_onOrAfter)
     query = apply_meta_filters(query, Syllabus, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, Syllabus, sortkey)
     
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     return query.offset(offset).limit(limit).all()
 
 @app.get("/syllabuses/{id}", response_model=SyllabusBase)
@@ -810,11 +988,15 @@ def get_school_unit_offerings(
     limit: int = 100,
     offset: int = 0,
     expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returns expanded reference names in the response."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """Hämtar en lista över skolenhetserbjudanden."""
+    selection = select_fields(fields, SchoolUnitOffering, SchoolUnitOfferingSchema, expandReferenceNames)
     query = db.query(SchoolUnitOffering)
     query = apply_meta_filters(query, SchoolUnitOffering, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, SchoolUnitOffering, sortkey)
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     offerings = query.offset(offset).limit(limit).all()
 
     if expandReferenceNames:
@@ -826,10 +1008,15 @@ def get_school_unit_offerings(
 def lookup_school_unit_offerings(
     lookup_data: LookupRequest,
     db: Session = Depends(get_db),
-    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returnerar expanderade referensnamn i responsen.")
+    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returnerar expanderade referensnamn i responsen."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """Hämtar en lista med skolenhetserbjudanden baserat på en lista med ID:n."""
-    offerings = db.query(SchoolUnitOffering).filter(SchoolUnitOffering.id.in_(lookup_data.ids)).all()
+    selection = select_fields(fields, SchoolUnitOffering, SchoolUnitOfferingSchema, expandReferenceNames)
+    query = db.query(SchoolUnitOffering).filter(SchoolUnitOffering.id.in_(lookup_data.ids))
+    if selection:
+        return selection.response(selection.apply(query).all())
+    offerings = query.all()
     
     if expandReferenceNames:
         return [expand_school_unit_offering(o, True, db) for o in offerings]
@@ -872,8 +1059,10 @@ def get_activities(
     sortkey: Optional[str] = Query(None, enum=["ModifiedDesc", "DisplayNameAsc"]),
     limit: int = 100,
     pageToken: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """Hämta en lista med aktiviteter baserat på ett antal sökparametrar."""
+    selection = select_fields(fields, Activity, ActivitySchema, expand or expandReferenceNames)
     
     if pageToken and (member or teacher or organisation or group or startDate_onOrBefore or startDate_onOrAfter or endDate_onOrBefore or endDate_onOrAfter or metaCreatedBefore or metaCreatedAfter or metaModifiedBefore or metaModifiedAfter or expand or expandReferenceNames or sortkey):
         raise HTTPException(status_code=400, detail="pageToken kan inte kombineras med andra filter.")
@@ -895,6 +1084,8 @@ def get_activities(
     query = apply_meta_filters(query, Activity, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, Activity, sortkey)
     
+    if selection:
+        return selection.response(selection.apply(query).limit(limit).all())
     activities = query.limit(limit).all()
 
     if expand or expandReferenceNames:
@@ -907,10 +1098,15 @@ def lookup_activities(
     lookup_data: LookupRequest,
     db: Session = Depends(get_db),
     expand: Optional[List[ActivityExpandEnum]] = Query(None),
-    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames")
+    expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
 ):
     """Hämta en lista med aktiviteter baserat på en lista med ID:n."""
-    activities = db.query(Activity).filter(Activity.id.in_(lookup_data.ids)).all()
+    selection = select_fields(fields, Activity, ActivitySchema, expand or expandReferenceNames)
+    query = db.query(Activity).filter(Activity.id.in_(lookup_data.ids))
+    if selection:
+        return selection.response(selection.apply(query).all())
+    activities = query.all()
 
     if expand or expandReferenceNames:
         return [expand_activity(a, expand, expandReferenceNames, db) for a in activities]
@@ -931,7 +1127,7 @@ def get_activity_by_id(
     
     return expand_activity(activity, expand, expandReferenceNames, db)
 
-@app.get("/calendarEvents", response_model=List[CalendarEvent])
+@app.get("/calendarEvents", response_model=List[schemas.CalendarEvent])
 def get_calendar_events(
     db: Session = Depends(get_db),
     # Nödvändiga parametrar
@@ -955,8 +1151,10 @@ def get_calendar_events(
     sortkey: Optional[CalendarEventSortkeyEnum] = Query(None, description="Anger hur resultatet ska sorteras."),
     limit: Optional[int] = Query(None, ge=1),
     pageToken: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """Returnerar kalenderhändelser utifrån en aktivitet eller student."""
+    selection = select_fields(fields, CalendarEvent, schemas.CalendarEvent, expand or expandReferenceNames)
 
     # Validera att pageToken inte kombineras med andra filter
     if pageToken and any([
@@ -977,13 +1175,58 @@ def get_calendar_events(
     query = apply_sorting(query, CalendarEvent, sortkey)
     query = apply_pagination(query, limit, pageToken)
 
-    if expand:
-        if CalendarEventExpandEnum.activity in expand:
-            query = query.options(joinedload(CalendarEvent.activity))
-        if CalendarEventExpandEnum.attendance in expand:
-            query = query.options(joinedload(CalendarEvent.attendance).joinedload(Attendance.person))
+    expand_activity = bool(expand) and CalendarEventExpandEnum.activity in expand
+    expand_attendance = bool(expand) and CalendarEventExpandEnum.attendance in expand
+    if expand_activity:
+        query = query.options(joinedload(CalendarEvent.activity))
+    if expand_attendance:
+        query = query.options(joinedload(CalendarEvent.attendance).joinedload(Attendance.person))
+    if selection:
+        # Sorteringskolumnerna läses alltid, eftersom genererade förekomster sorteras in i Python
+        query = selection.apply(query, "start_time", "created", "modified")
+
+    calendar_events = query.all()
+
+    # Förekomster från återkommande regler genereras endast för det efterfrågade fönstret,
+    # med samma meta-filter och expand som de lagrade händelserna
+    recurring_events = expand_recurring_events(
+        db, startTime_onOrAfter, startTime_onOrBefore, endTime_onOrAfter, endTime_onOrBefore, activity, student, teacher, organisation, group,
+        meta_created_before, meta_created_after, meta_modified_before, meta_modified_after, expand_activity, expand_attendance,
+    )
+    if recurring_events:
+        calendar_events = merge_occurrences(calendar_events, recurring_events, sortkey, limit)
+
+    if selection:
+        return selection.response(calendar_events)
+    return calendar_events
 
-    return query.all()
+# --- iCalendar feeds below ---
+def calendar_feed(kind: str, id: str, request: Request, db: Session) -> Response:
+    subject = load_subject(db, kind, id)
+    if not subject:
+        raise HTTPException(status_code=404, detail=f"{kind.capitalize()} not found")
+
+    feed = Feed.prepare(db, subject)
+    headers = {"ETag": feed.etag, "Cache-Control": "private, max-age=300"}
+    # Komprimerade svar får en svag ETag; If-None-Match jämförs svagt
+    if feed.etag in [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(feed.stream(), media_type="text/calendar; charset=utf-8", headers=headers)
+
+@app.get("/persons/{id}/calendar.ics", response_class=StreamingResponse)
+def get_person_calendar_feed(id: str, request: Request, db: Session = Depends(get_db)):
+    """Personens schema som iCalendar-flöde, både som elev och som lärare."""
+    return calendar_feed("person", id, request, db)
+
+@app.get("/groups/{id}/calendar.ics", response_class=StreamingResponse)
+def get_group_calendar_feed(id: str, request: Request, db: Session = Depends(get_db)):
+    """Gruppens schema som iCalendar-flöde."""
+    return calendar_feed("group", id, request, db)
+
+@app.get("/rooms/{id}/calendar.ics", response_class=StreamingResponse)
+def get_room_calendar_feed(id: str, request: Request, db: Session = Depends(get_db)):
+    """Salens schema som iCalendar-flöde; händelserna matchas på platsens namn."""
+    return calendar_feed("room", id, request, db)
 
 @app.get("/calendarEvents/{id}", response_model=CalendarEventExpanded)
 def get_calendar_event_by_id(
@@ -1024,9 +1267,13 @@ def lookup_calendar_events(
     lookup_data: CalendarEventsLookupRequest,
     db: Session = Depends(get_db),
     expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returnera `displayName` för alla refererade objekt."),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """Hämta kalenderhändelser baserat på en lista av ID:n."""
-    query = db.query(CalendarEvent).options(joinedload(CalendarEvent.activity), joinedload(CalendarEvent.attendance).joinedload(Attendance.person))
+    selection = select_fields(fields, CalendarEvent, CalendarEventExpanded, expandReferenceNames)
+    query = db.query(CalendarEvent)
+    query = selection.apply(query) if selection else query.options(
+        joinedload(CalendarEvent.activity), joinedload(CalendarEvent.attendance).joinedload(Attendance.person))
     
     # Skapa en lista med or-villkor för att söka på alla ID:n i alla listor
     filters = []
@@ -1035,10 +1282,8 @@ def lookup_calendar_events(
     if lookup_data.activityIds:
         filters.append(CalendarEvent.activity_id.in_(lookup_data.activityIds))
     if lookup_data.personIds:
-        # Detta är en mock-implementation, i en riktig databas skulle detta kräva en subquery eller joinedload
-        # av attendance-tabellen för att hitta kalenderhändelser baserat på personens ID.
-        # Exempel: query = query.join(Attendance).filter(Attendance.person_id.in_(lookup_data.personIds))
-        pass
+        # Elever och lärare slås upp via deltagarindexet
+        filters.append(participating(lookup_data.personIds))
 
     if not filters:
         raise HTTPException(
@@ -1050,6 +1295,8 @@ def lookup_calendar_events(
 
     if not calendar_events:
         raise HTTPException(status_code=404, detail="Posterna hittades inte.")
+    if selection:
+        return selection.response(calendar_events)
 
     # Mock-logik för expandReferenceNames
     if expandReferenceNames:
@@ -1063,6 +1310,39 @@ def lookup_calendar_events(
 
     return calendar_events
 
+@app.post("/recurrenceRules", response_model=RecurrenceRuleSchema, summary="Skapa en återkommande regel för en aktivitet eller ett närvaroschema.")
+def create_recurrence_rule(rule: RecurrenceRuleCreate, db: Session = Depends(get_db)):
+    """Förekomsterna lagras inte utan genereras när kalenderhändelser hämtas."""
+    if not rule.activity_id and not rule.attendance_schedule_id:
+        raise HTTPException(status_code=400, detail="Minst en av 'activity_id' eller 'attendance_schedule_id' måste anges.")
+    if rule.duration_minutes <= 0:
+        raise HTTPException(status_code=400, detail="duration_minutes måste vara större än 0.")
+    try:
+        until = last_occurrence(rule.rrule, rule.dtstart)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    db_rule = RecurrenceRule(
+        **rule.dict(exclude={"exdates"}),
+        id=str(uuid.uuid4()),
+        until=until,
+        exdates=",".join(d.isoformat() for d in rule.exdates) if rule.exdates else None,
+    )
+    db.add(db_rule)
+    db.commit()
+    db.refresh(db_rule)
+    return db_rule
+
+@app.delete("/recurrenceRules/{rule_id}")
+def delete_recurrence_rule(rule_id: str, db: Session = Depends(get_db)):
+    db_rule = db.query(RecurrenceRule).filter(RecurrenceRule.id == rule_id).first()
+    if not db_rule:
+        raise HTTPException(status_code=404, detail="Recurrence rule not found")
+
+    db.delete(db_rule)
+    db.commit()
+    return {"message": "Recurrence rule deleted successfully"}
+
 @app.get("/attendance", response_model=List[AttendanceWithRelations])
 def get_attendance_records(
     db: Session = Depends(get_db),
@@ -1072,16 +1352,22 @@ def get_attendance_records(
     metaModifiedAfter: Optional[datetime] = Query(None, alias="metaModifiedAfter"),
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
     """Hämtar en lista över närvaroposter med relaterade person, aktivitet och närvarohändelse."""
-    query = db.query(Attendance).options(
+    selection = select_fields(fields, Attendance, AttendanceWithRelations)
+    query = db.query(Attendance)
+    query = apply_meta_filters(query, Attendance, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
+    query = apply_sorting(query, Attendance, sortkey)
+    # Med fields läses bara närvaroposternas egna kolumner, utan relationerna
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
+    query = query.options(
         joinedload(Attendance.person),
         joinedload(Attendance.activity),
         joinedload(Attendance.attendance_event)
     )
-    query = apply_meta_filters(query, Attendance, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
-    query = apply_sorting(query, Attendance, sortkey)
     return query.offset(offset).limit(limit).all()
 
 @app.get("/attendance/{attendance_id}", response_model=AttendanceWithRelations)
@@ -1097,8 +1383,15 @@ def get_attendance_record(attendance_id: str, db: Session = Depends(get_db)):
     return attendance_record
 
 @app.post("/attendance/lookup", response_model=List[AttendanceWithRelations])
-def lookup_attendance(lookup_data: LookupRequest, db: Session = Depends(get_db)):
+def lookup_attendance(
+    lookup_data: LookupRequest,
+    db: Session = Depends(get_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+):
     """Hämta en lista med närvaroposter baserat på en lista med ID:n."""
+    selection = select_fields(fields, Attendance, AttendanceWithRelations)
+    if selection:
+        return selection.response(selection.apply(db.query(Attendance).filter(Attendance.id.in_(lookup_data.ids))).all())
     attendance_records = db.query(Attendance).options(
         joinedload(Attendance.person),
         joinedload(Attendance.activity),
@@ -1106,6 +1399,27 @@ def lookup_attendance(lookup_data: LookupRequest, db: Session = Depends(get_db))
     ).filter(Attendance.id.in_(lookup_data.ids)).all()
     return attendance_records
 
+@app.post("/attendance/bulk", response_model=AttendanceRegistrationResult, status_code=201)
+async def register_attendance(payload: List[AttendanceRegistration], db: Session = Depends(get_db)):
+    """
+    Registrerar närvaro för en eller flera hela klasser. Registreringarna valideras samlat och
+    skrivs i omgångar av skrivkön; svaret skickas först när de är sparade. En befintlig
+    registrering för samma person och lektionstillfälle skrivs över.
+    """
+    rows = await run_in_threadpool(validate_attendance_registrations, payload, db)
+    try:
+        future = attendance_writer.submit(rows)
+    except WriterBusy:
+        raise HTTPException(status_code=503, detail="Attendance queue is full, try again later", headers={"Retry-After": "1"})
+    except RuntimeError:
+        raise HTTPException(status_code=503, detail="Attendance writer is not running")
+
+    try:
+        registered = await asyncio.wrap_future(future)
+    except Exception:
+        raise HTTPException(status_code=500, detail="Attendance could not be saved")
+    return AttendanceRegistrationResult(registered=registered)
+
 @app.get("/attendanceEvents", response_model=List[AttendanceEventBase])
 def get_attendance_events(
     db: Session = Depends(get_db),
@@ -1115,20 +1429,32 @@ def get_attendance_events(
     metaModifiedAfter: Optional[datetime] = Query(None, alias="metaModifiedAfter"),
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
+    selection = select_fields(fields, AttendanceEvent, AttendanceEventBase)
     query = db.query(AttendanceEvent)
     query = apply_meta_filters(query, AttendanceEvent, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, AttendanceEvent, sortkey)
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     return query.offset(offset).limit(limit).all()
 
 @app.post("/attendanceEvents/lookup", response_model=List[AttendanceEventBase])
-def lookup_attendance_events(lookup_data: LookupRequest, db: Session = Depends(get_db)):
+def lookup_attendance_events(
+    lookup_data: LookupRequest,
+    db: Session = Depends(get_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+):
     """Hämta en lista med närvarohändelser baserat på en lista med ID:n."""
-    attendance_events = db.query(AttendanceEvent).filter(AttendanceEvent.id.in_(lookup_data.ids)).all()
+    selection = select_fields(fields, AttendanceEvent, AttendanceEventBase)
+    query = db.query(AttendanceEvent).filter(AttendanceEvent.id.in_(lookup_data.ids))
+    if selection:
+        return selection.response(selection.apply(query).all())
+    attendance_events = query.all()
     return attendance_events
 
-@app.get("/attendanceSchedules", response_model=List[AttendanceSchedule])
+@app.get("/attendanceSchedules", response_model=List[schemas.AttendanceSchedule])
 def get_attendance_schedules(
     db: Session = Depends(get_db),
     metaCreatedBefore: Optional[datetime] = Query(None, alias="metaCreatedBefore"),
@@ -1144,7 +1470,17 @@ def get_attendance_schedules(
     query = apply_sorting(query, AttendanceSchedule, sortkey)
     return query.offset(offset).limit(limit).all()
 
-@app.post("/attendanceSchedules/lookup", response_model=List[AttendanceSchedule])
+@app.get("/attendanceSchedules/{id}/occurrences", response_model=List[OccurrenceSchema])
+def get_attendance_schedule_occurrences(
+    id: str,
+    db: Session = Depends(get_db),
+    startTime_onOrAfter: datetime = Query(..., alias="startTime.onOrAfter"),
+    startTime_onOrBefore: datetime = Query(..., alias="startTime.onOrBefore"),
+):
+    """Hämta ett närvaroschemas förekomster inom ett tidsfönster, genererade från dess regler."""
+    return schedule_occurrences(db, id, startTime_onOrAfter, startTime_onOrBefore)
+
+@app.post("/attendanceSchedules/lookup", response_model=List[schemas.AttendanceSchedule])
 def lookup_attendance_schedules(lookup_data: LookupRequest, db: Session = Depends(get_db)):
     """Hämta en lista med närvaroscheman baserat på en lista med ID:n."""
     attendance_schedules = db.query(AttendanceSchedule).filter(AttendanceSchedule.id.in_(lookup_data.ids)).all()
@@ -1199,6 +1535,37 @@ def get_aggregated_attendance(
     query = apply_sorting(query, AggregatedAttendance, sortkey)
     return query.offset(offset).limit(limit).all()
 
+@app.get("/aggregatedAttendance/rollups", response_model=List[AttendanceRollupSchema])
+def get_attendance_rollups(
+    db: Session = Depends(get_db),
+    scopeType: str = Query(..., description='"person", "activity", "group" eller "period".'),
+    scopeId: Optional[List[str]] = Query(None),
+    period: Optional[str] = Query(None, description='"ÅÅÅÅ-MM" för en månad; utelämnas för hela tiden.'),
+    limit: int = 100,
+    offset: int = 0
+):
+    """Hämtar förberäknade närvarosummor per person, aktivitet, grupp eller månad."""
+    if scopeType not in ("person", "activity", "group", "period"):
+        raise HTTPException(status_code=400, detail="Invalid scopeType")
+
+    query = db.query(AttendanceRollup).filter(AttendanceRollup.scope_type == scopeType)
+    if scopeId:
+        query = query.filter(AttendanceRollup.scope_id.in_(scopeId))
+    if scopeType == "period":
+        if period:
+            query = query.filter(AttendanceRollup.period == period)
+    else:
+        query = query.filter(AttendanceRollup.period == (period or ALL_TIME))
+    rollups = query.order_by(AttendanceRollup.scope_id, AttendanceRollup.period).offset(offset).limit(limit).all()
+    return [
+        AttendanceRollupSchema(
+            scope_type=r.scope_type, scope_id=r.scope_id, period=r.period,
+            present_count=r.present_count, total_count=r.total_count,
+            attendance_percentage=attendance_percentage(r.present_count, r.total_count),
+        )
+        for r in rollups
+    ]
+
 @app.get("/aggregatedAttendance/{aggregated_attendance_id}", response_model=AggregatedAttendanceWithPerson)
 def get_aggregated_attendance_record(aggregated_attendance_id: str, db: Session = Depends(get_db)):
     """Hämta en specifik aggregerad närvaropost med relaterad person."""
@@ -1213,7 +1580,7 @@ def lookup_aggregated_attendance(lookup_data: LookupRequest, db: Session = Depen
     aggregated_attendance_records = db.query(AggregatedAttendance).options(joinedload(AggregatedAttendance.person)).filter(AggregatedAttendance.id.in_(lookup_data.ids)).all()
     return aggregated_attendance_records
 
-@app.get("/resources", response_model=List[Resource])
+@app.get("/resources", response_model=List[schemas.Resource])
 def get_resources(
     db: Session = Depends(get_db),
     metaCreatedBefore: Optional[datetime] = Query(None, alias="metaCreatedBefore"),
@@ -1222,20 +1589,32 @@ def get_resources(
     metaModifiedAfter: Optional[datetime] = Query(None, alias="metaModifiedAfter"),
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
+    selection = select_fields(fields, Resource, schemas.Resource)
     query = db.query(Resource)
     query = apply_meta_filters(query, Resource, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, Resource, sortkey)
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     return query.offset(offset).limit(limit).all()
 
-@app.post("/resources/lookup", response_model=List[Resource])
-def lookup_resources(lookup_data: LookupRequest, db: Session = Depends(get_db)):
+@app.post("/resources/lookup", response_model=List[schemas.Resource])
+def lookup_resources(
+    lookup_data: LookupRequest,
+    db: Session = Depends(get_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+):
     """Hämta en lista med resurser baserat på en lista med ID:n."""
-    resources = db.query(Resource).filter(Resource.id.in_(lookup_data.ids)).all()
+    selection = select_fields(fields, Resource, schemas.Resource)
+    query = db.query(Resource).filter(Resource.id.in_(lookup_data.ids))
+    if selection:
+        return selection.response(selection.apply(query).all())
+    resources = query.all()
     return resources
 
-@app.get("/rooms", response_model=List[Room])
+@app.get("/rooms", response_model=List[schemas.Room])
 def get_rooms(
     db: Session = Depends(get_db),
     metaCreatedBefore: Optional[datetime] = Query(None, alias="metaCreatedBefore"),
@@ -1244,26 +1623,62 @@ def get_rooms(
     metaModifiedAfter: Optional[datetime] = Query(None, alias="metaModifiedAfter"),
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
+    selection = select_fields(fields, Room, schemas.Room)
     query = db.query(Room)
     query = apply_meta_filters(query, Room, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, Room, sortkey)
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     return query.offset(offset).limit(limit).all()
 
-@app.post("/rooms/lookup", response_model=List[Room])
-def lookup_rooms(lookup_data: LookupRequest, db: Session = Depends(get_db)):
+@app.post("/rooms/lookup", response_model=List[schemas.Room])
+def lookup_rooms(
+    lookup_data: LookupRequest,
+    db: Session = Depends(get_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+):
     """Hämta en lista med rum baserat på en lista med ID:n."""
-    rooms = db.query(Room).filter(Room.id.in_(lookup_data.ids)).all()
+    selection = select_fields(fields, Room, schemas.Room)
+    query = db.query(Room).filter(Room.id.in_(lookup_data.ids))
+    if selection:
+        return selection.response(selection.apply(query).all())
+    rooms = query.all()
     return rooms
 
 @app.get("/subscriptions", response_model=List[SubscriptionBase])
 def get_subscriptions(db: Session = Depends(get_db)):
     return db.query(Subscription).all()
 
+@app.get("/subscriptions/deliveries")
+def get_subscription_delivery_metrics():
+    """Räknare för webhook-leveranserna sedan uppstart."""
+    return dispatcher.metrics.snapshot()
+
+@app.get("/subscriptions/deadLetters", response_model=List[WebhookDeadLetterSchema])
+def get_subscription_dead_letters(db: Session = Depends(get_db), limit: int = 100, offset: int = 0):
+    """Leveranser som gav upp efter alla försök, senaste först."""
+    return db.query(WebhookDeadLetter).order_by(WebhookDeadLetter.created.desc()).offset(offset).limit(limit).all()
+
+@app.post("/subscriptions/deadLetters/{dead_letter_id}/redeliver")
+def redeliver_subscription_dead_letter(dead_letter_id: str, db: Session = Depends(get_db)):
+    """Köar om en misslyckad leverans och tar bort den ur dead letters."""
+    dead_letter = db.query(WebhookDeadLetter).filter(WebhookDeadLetter.id == dead_letter_id).first()
+    if not dead_letter:
+        raise HTTPException(status_code=404, detail="Dead letter not found")
+
+    # Ändringarna sparas i webhook_outbox i samma transaktion som dead lettern tas bort
+    deliveries = dispatcher.redeliver(db, dead_letter)
+    db.delete(dead_letter)
+    db.commit()
+    dispatcher.enqueue(deliveries)
+    return {"message": "Dead letter queued for redelivery"}
+
 @app.post("/subscriptions", response_model=SubscriptionCreate)
 def create_subscription(subscription: SubscriptionCreate, db: Session = Depends(get_db)):
-    db_subscription = Subscription(**subscription.model_dump(), id=str(uuid.uuid4()))
+    db_subscription = Subscription(**subscription.dict(), id=str(uuid.uuid4()))
     db.add(db_subscription)
     db.commit()
     db.refresh(db_subscription)
@@ -1275,7 +1690,7 @@ def update_subscription(subscription_id: str, subscription_update: SubscriptionU
     if not db_subscription:
         raise HTTPException(status_code=404, detail="Subscription not found")
 
-    update_data = subscription_update.model_dump(exclude_unset=True)
+    update_data = subscription_update.dict(exclude_unset=True)
     for key, value in update_data.items():
         setattr(db_subscription, key, value)
 
@@ -1293,29 +1708,52 @@ def delete_subscription(subscription_id: str, db: Session = Depends(get_db)):
     db.commit()
     return {"message": "Subscription deleted successfully"}
 
-@app.get("/deletedEntities", response_model=List[DeletedEntity])
+@app.get("/deletedEntities", response_model=List[schemas.DeletedEntity])
 def get_deleted_entities(
+    response: Response,
     db: Session = Depends(get_db),
     metaCreatedBefore: Optional[datetime] = Query(None, alias="metaCreatedBefore"),
     metaCreatedAfter: Optional[datetime] = Query(None, alias="metaCreatedAfter"),
+    metaCreatedAfterDot: Optional[datetime] = Query(None, alias="meta.created.after", description="Samma som metaCreatedAfter."),
     metaModifiedBefore: Optional[datetime] = Query(None, alias="metaModifiedBefore"),
     metaModifiedAfter: Optional[datetime] = Query(None, alias="metaModifiedAfter"),
+    entities: Optional[List[str]] = Query(None, description="Begränsa till resurstyper, t.ex. Person och Group."),
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = 100,
-    offset: int = 0
+    offset: int = 0,
+    pageToken: Optional[str] = Query(None, alias="pageToken", description="Ett opakt värde som servern givit som svar på en tidigare ställd fråga. Kan inte kombineras med andra filter men väl med 'limit'."),
 ):
+    """
+    Borttagna entiteter. Utan sortkey, offset och övriga meta-filter pagineras listan med nyckel
+    på (meta.created, id); nästa sidas pageToken returneras i huvudet X-Page-Token.
+    """
+    created_after = metaCreatedAfter or metaCreatedAfterDot
+    if pageToken and any([created_after, metaCreatedBefore, metaModifiedBefore, metaModifiedAfter, entities, sortkey, offset]):
+        raise HTTPException(status_code=400, detail="Filter kan inte kombineras med pageToken.")
+
+    if not any([metaCreatedBefore, metaModifiedBefore, metaModifiedAfter, sortkey, offset]):
+        try:
+            rows, next_token = tombstone_page(db, created_after, entities, limit, pageToken)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if next_token:
+            response.headers["X-Page-Token"] = next_token
+        return rows
+
     query = db.query(DeletedEntity)
-    query = apply_meta_filters(query, DeletedEntity, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
+    query = apply_meta_filters(query, DeletedEntity, metaCreatedBefore, created_after, metaModifiedBefore, metaModifiedAfter)
+    if entities:
+        query = query.filter(DeletedEntity.resource_type.in_(entities))
     query = apply_sorting(query, DeletedEntity, sortkey)
     return query.offset(offset).limit(limit).all()
 
-@app.post("/deletedEntities/lookup", response_model=List[DeletedEntity])
+@app.post("/deletedEntities/lookup", response_model=List[schemas.DeletedEntity])
 def lookup_deleted_entities(lookup_data: LookupRequest, db: Session = Depends(get_db)):
     """Hämta en lista med borttagna entiteter baserat på en lista med ID:n."""
     deleted_entities = db.query(DeletedEntity).filter(DeletedEntity.id.in_(lookup_data.ids)).all()
     return deleted_entities
 
-@app.get("/log", response_model=List[Log])
+@app.get("/log", response_model=List[schemas.Log])
 def get_logs(
     db: Session = Depends(get_db),
     metaCreatedBefore: Optional[datetime] = Query(None, alias="metaCreatedBefore"),
@@ -1325,29 +1763,326 @@ def get_logs(
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = 100,
     offset: int = 0,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
 ):
+    selection = select_fields(fields, Log, schemas.Log)
     query = db.query(Log)
     query = apply_meta_filters(query, Log, metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter)
     query = apply_sorting(query, Log, sortkey)
+    if selection:
+        return selection.response(selection.apply(query).offset(offset).limit(limit).all())
     return query.offset(offset).limit(limit).all()
 
-@app.post("/log/lookup", response_model=List[Log])
-def lookup_logs(lookup_data: LookupRequest, db: Session = Depends(get_db)):
+@app.post("/log/lookup", response_model=List[schemas.Log])
+def lookup_logs(
+    lookup_data: LookupRequest,
+    db: Session = Depends(get_db),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)
+):
     """Hämta en lista med loggar baserat på en lista med ID:n."""
-    logs = db.query(Log).filter(Log.id.in_(lookup_data.ids)).all()
+    selection = select_fields(fields, Log, schemas.Log)
+    query = db.query(Log).filter(Log.id.in_(lookup_data.ids))
+    if selection:
+        return selection.response(selection.apply(query).all())
+    logs = query.all()
     return logs
 
-@app.get("/statistics")
+@app.get("/statistics", response_model=List[StatisticsSchema])
 def get_statistics(
     db: Session = Depends(get_db),
     metaCreatedBefore: Optional[datetime] = Query(None, alias="metaCreatedBefore"),
     metaCreatedAfter: Optional[datetime] = Query(None, alias="metaCreatedAfter"),
     metaModifiedBefore: Optional[datetime] = Query(None, alias="metaModifiedBefore"),
     metaModifiedAfter: Optional[datetime] = Query(None, alias="metaModifiedAfter"),
+    organisation: Optional[str] = Query(None, description="Begränsa till en organisationsenhet."),
+    schoolType: Optional[str] = Query(None, description="Begränsa till en skolform."),
+    includeDescendants: bool = Query(True, description="Räkna med underliggande organisationsenheter."),
     expandReferenceNames: Optional[bool] = Query(None, alias="expandReferenceNames", description="Returns expanded reference names in the response."),
     sortkey: Optional[str] = Query(None, description='Sort order, e.g. "ModifiedDesc", "CreatedAsc".'),
     limit: int = 100,
     offset: int = 0,
     pageToken: Optional[str] = Query(None, description="An opaque value that the server has returned to a previous query.")
 ):
-    return {"message": "This is a placeholder for statistics with meta-params."}
+    """
+    Hämtar antal aktiva personer, inskrivningar, placeringar, tjänstgöringar, grupper och aktiviteter
+    per organisationsenhet och skolform. Utan metafilter besvaras frågan från förberäknade summor.
+    """
+    rows = statistics_rows(
+        db, organisation, schoolType, includeDescendants,
+        (metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter),
+    )[offset:offset + limit]
+    if expandReferenceNames:
+        for row in rows:
+            unit = organisation_cache.get(db, row["organisation_id"])
+            row["organisation_name"] = unit.name if unit else None
+    return rows
+
+# --- Reports endpoints below ---
+@app.get("/reports/attendance/students", response_model=List[StudentAttendanceReport])
+def get_student_attendance_report(
+    db: Session = Depends(get_db),
+    startTime_onOrAfter: Optional[datetime] = Query(None, alias="startTime.onOrAfter"),
+    startTime_onOrBefore: Optional[datetime] = Query(None, alias="startTime.onOrBefore"),
+    chronicThreshold: float = Query(CHRONIC_ABSENCE_THRESHOLD, ge=0, le=1, description="Andel frånvaro som räknas som kronisk."),
+    minLessons: int = Query(CHRONIC_ABSENCE_MIN_LESSONS, ge=0),
+    chronicOnly: bool = False,
+    limit: int = 100,
+    offset: int = 0
+):
+    """Frånvarograd, frånvaro i följd och kronisk frånvaro per elev, högst frånvaro först."""
+    snapshot = get_snapshot(db.connection(), startTime_onOrAfter, startTime_onOrBefore)
+    report = student_report(snapshot, chronicThreshold, minLessons)
+    if chronicOnly:
+        report = [row for row in report if row["chronic_absence"]]
+    return report[offset:offset + limit]
+
+@app.get("/reports/attendance/groups", response_model=List[GroupAttendanceReport])
+def get_group_attendance_report(
+    db: Session = Depends(get_db),
+    startTime_onOrAfter: Optional[datetime] = Query(None, alias="startTime.onOrAfter"),
+    startTime_onOrBefore: Optional[datetime] = Query(None, alias="startTime.onOrBefore"),
+    limit: int = 100,
+    offset: int = 0
+):
+    """Frånvarograd per grupp, totalt och per veckodag."""
+    snapshot = get_snapshot(db.connection(), startTime_onOrAfter, startTime_onOrBefore)
+    return group_report(snapshot)[offset:offset + limit]
+
+@app.get("/reports/attendance/slots", response_model=List[SlotAttendanceReport])
+def get_slot_attendance_report(
+    db: Session = Depends(get_db),
+    startTime_onOrAfter: Optional[datetime] = Query(None, alias="startTime.onOrAfter"),
+    startTime_onOrBefore: Optional[datetime] = Query(None, alias="startTime.onOrBefore"),
+):
+    """Frånvarograd per veckodag och lektionens starttid."""
+    snapshot = get_snapshot(db.connection(), startTime_onOrAfter, startTime_onOrBefore)
+    return slot_report(snapshot)
+
+# --- Import endpoints below ---
+IMPORT_CONTENT_TYPES = {"application/json": JSON, "application/x-ndjson": JSON_LINES, "application/jsonl": JSON_LINES, "text/csv": CSV}
+
+@app.post("/import/{entity}", response_model=ImportJobSchema, status_code=202)
+async def start_import(
+    entity: str,
+    request: Request,
+    db: Session = Depends(get_db),
+    format: Optional[str] = Query(None, description="json, jsonl eller csv. Annars avgörs formatet av Content-Type."),
+):
+    """
+    Importerar en typ från request-kroppen i bakgrunden. Kroppen sparas till en temporär fil
+    medan den tas emot; förloppet följs med GET /import/jobs/{id}. Typer som refererar till
+    varandra ska importeras i ordningen organisations, persons, duties, groups, groupMemberships,
+    activities, activityGroups, activityTeachers, calendarEvents. Fält som saknas i en post
+    lämnas orörda på en befintlig rad.
+    """
+    if entity not in ENTITIES:
+        raise HTTPException(status_code=404, detail=f"Okänd typ. Välj en av: {', '.join(ENTITIES)}")
+    format = format or IMPORT_CONTENT_TYPES.get(request.headers.get("content-type", "").split(";")[0].strip())
+    if format not in (JSON, JSON_LINES, CSV):
+        raise HTTPException(status_code=415, detail="Ange format=json, jsonl eller csv.")
+
+    upload = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    async for chunk in request.stream():
+        await run_in_threadpool(upload.write, chunk)
+    upload.seek(0)
+    try:
+        job = import_jobs.submit(db.get_bind(), entity, upload, format)
+    except ImportFormatError as e:
+        upload.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    return job.snapshot()
+
+@app.get("/import/jobs/{id}", response_model=ImportJobSchema)
+def get_import_job(id: str):
+    job = import_jobs.get(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Importjobbet hittades inte")
+    return job.snapshot()
+
+# --- Change stream endpoints below ---
+async def connect_change_client(entities: Optional[List[str]], organisation: Optional[List[str]], last_event_id: Optional[str]):
+    """Ansluter en klient och hämtar det den missat sedan last_event_id. HTTPException vid fel."""
+    try:
+        client = change_broadcaster.connect(entities, organisation)
+    except TooManyClients:
+        raise HTTPException(status_code=503, detail="För många anslutna klienter.", headers={"Retry-After": "30"})
+    try:
+        replayed = await run_in_threadpool(change_broadcaster.replay, client, int(last_event_id)) if last_event_id else []
+    except ValueError:
+        change_broadcaster.disconnect(client)
+        raise HTTPException(status_code=400, detail="Last-Event-ID måste vara ett heltal.")
+    except Exception:
+        change_broadcaster.disconnect(client)
+        raise
+    return client, replayed
+
+@app.get("/changes/stream", response_class=StreamingResponse)
+async def stream_changes(
+    request: Request,
+    entities: Optional[List[str]] = Query(None, description="Begränsa till resurstyper, t.ex. CalendarEvent och Duty."),
+    organisation: Optional[List[str]] = Query(None, description="Begränsa till resurser som hör till organisationerna."),
+    lastEventId: Optional[str] = Query(None, description="Fortsätt efter denna händelse; samma som huvudet Last-Event-ID."),
+):
+    """
+    Ändringar som server-sent events. Händelsens id är ändringsloggens seq, så en klient som
+    återansluter med Last-Event-ID får det den missat. Händelsen 'evicted' skickas till en klient
+    som inte hinner läsa och 'reset' när för mycket har missats; klienten ska då synka om.
+    """
+    client, replayed = await connect_change_client(entities, organisation, request.headers.get("Last-Event-ID") or lastEventId)
+    return StreamingResponse(
+        change_broadcaster.sse(client, replayed), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.websocket("/changes/ws")
+async def websocket_changes(
+    websocket: WebSocket,
+    entities: Optional[List[str]] = Query(None),
+    organisation: Optional[List[str]] = Query(None),
+    lastEventId: Optional[str] = Query(None),
+):
+    """Samma ändringar som /changes/stream, som JSON-meddelanden över WebSocket."""
+    try:
+        client, replayed = await connect_change_client(entities, organisation, lastEventId)
+    except HTTPException:
+        await websocket.close(code=1013)
+        return
+    await websocket.accept()
+    events = change_broadcaster.events(client, replayed)
+    try:
+        async for item in events:
+            if item == HEARTBEAT:
+                await websocket.send_json({"event": HEARTBEAT})
+            elif item in (EVICTED, RESET):
+                await websocket.send_json({"event": item})
+                await websocket.close()
+            else:
+                await websocket.send_json(dict(change_payload(item), event=item.operation))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await events.aclose()
+
+@app.get("/changes/stream/stats")
+def get_change_stream_stats():
+    return {"clients": change_broadcaster.clients, "delivered": change_broadcaster.delivered, "evictions": change_broadcaster.evictions}
+
+# --- Hälsokontroller ---
+@app.get("/health/live", include_in_schema=False)
+def get_liveness():
+    return {"status": "ok"}
+
+@app.get("/health/ready", include_in_schema=False)
+def get_readiness():
+    """Svarar 200 först när uppvärmningen i lifespan är klar."""
+    if not getattr(app.state, "ready", False):
+        raise HTTPException(status_code=503, detail="Uppvärmning pågår.")
+    return {"status": "ready", "startup": app.state.startup_profile, "warmup": app.state.warmup_profile}
+
+# --- Metrics endpoints below ---
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Metriker i Prometheus textformat. Asynkron eftersom trådpoolens statistik bara kan läsas från händelseloopen."""
+    return Response(render_metrics(threadpool_stats()), media_type=METRICS_CONTENT_TYPE)
+
+# --- Admin endpoints below ---
+@app.get("/admin/slowQueries", response_model=List[SlowQuerySchema], dependencies=[Depends(require_admin)])
+def get_slow_queries(
+    sortkey: str = Query("TotalDesc", enum=list(SLOW_QUERY_SORTKEYS), description="Sorteringsordning."),
+    limit: int = Query(20, ge=1, le=1000)
+):
+    """De SQL-satsformer som tagit längst tid sedan start, med rutter, parametrar och plan för den långsammaste körningen."""
+    if sortkey not in SLOW_QUERY_SORTKEYS:
+        raise HTTPException(status_code=400, detail=f"Okänd sortkey: {sortkey}.")
+    return slow_queries.top(limit, sortkey)
+
+@app.delete("/admin/slowQueries", status_code=204, dependencies=[Depends(require_admin)])
+def reset_slow_queries():
+    """Nollställer sammanställningen, t.ex. efter en åtgärd som ska utvärderas."""
+    slow_queries.reset()
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def get_profiles():
+    """Sammanfattningar av de senaste profilerade anropen, nyast först."""
+    return profiles.list()
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str, format: str = Query("folded", enum=["folded", "json"])):
+    """
+    En profil som kollapsade stackar för flamegraph.pl eller speedscope, eller med format=json
+    som sammanfattning. Första ramen i varje stack är kategorin: sql, orm, pydantic, json eller app.
+    """
+    profile = profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profilen finns inte.")
+    if format == "json":
+        return profile.summary()
+    return Response(profile.folded(), media_type="text/plain")
+
+@app.get("/admin/memory", dependencies=[Depends(require_admin)])
+def get_memory_status():
+    """Om tracemalloc är igång, spårat minne och sparade ögonblicksbilder."""
+    return memory.status()
+
+@app.post("/admin/memory/start", dependencies=[Depends(require_admin)])
+def start_memory_tracing(frames: int = Query(1, ge=1, le=100, description="Antal ramar som sparas per allokering.")):
+    """
+    Startar tracemalloc. Varje allokering blir flera gånger dyrare så länge den är igång,
+    och fler ramar kostar mer. Ruttstatistiken samlas in medan den är igång.
+    """
+    memory.start(frames)
+    return memory.status()
+
+@app.post("/admin/memory/stop", dependencies=[Depends(require_admin)])
+def stop_memory_tracing():
+    """Stoppar tracemalloc. Sparade ögonblicksbilder och ruttstatistik finns kvar."""
+    memory.stop()
+    return memory.status()
+
+@app.post("/admin/memory/snapshots", status_code=201, dependencies=[Depends(require_admin)])
+def take_memory_snapshot(label: Optional[str] = Query(None, max_length=200)):
+    """Tar en ögonblicksbild av alla spårade allokeringar."""
+    if not memory.active:
+        raise HTTPException(status_code=409, detail="tracemalloc är inte igång.")
+    return memory.take_snapshot(label)
+
+@app.get("/admin/memory/snapshots/{snapshot_id}", dependencies=[Depends(require_admin)])
+def get_memory_snapshot(
+    snapshot_id: str,
+    group_by: str = Query("lineno", enum=list(MEMORY_GROUP_BY)),
+    limit: int = Query(20, ge=1, le=1000)
+):
+    """De allokeringsplatser som håller mest minne i ögonblicksbilden."""
+    snapshot = memory.get(snapshot_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Ögonblicksbilden finns inte.")
+    return memory.top(snapshot, group_by, limit)
+
+@app.get("/admin/memory/snapshots/{snapshot_id}/diff", dependencies=[Depends(require_admin)])
+def diff_memory_snapshots(
+    snapshot_id: str,
+    against: Optional[str] = Query(None, description="Senare ögonblicksbild; utan den jämförs med minnet just nu."),
+    group_by: str = Query("lineno", enum=list(MEMORY_GROUP_BY)),
+    limit: int = Query(20, ge=1, le=1000)
+):
+    """Platserna vars minne har förändrats mest sedan ögonblicksbilden, störst förändring först."""
+    base = memory.get(snapshot_id)
+    current = memory.get(against) if against else None
+    if base is None or (against and current is None):
+        raise HTTPException(status_code=404, detail="Ögonblicksbilden finns inte.")
+    if current is None and not memory.active:
+        raise HTTPException(status_code=409, detail="tracemalloc är inte igång.")
+    return memory.diff(base, current, group_by, limit)
+
+@app.get("/admin/memory/routes", dependencies=[Depends(require_admin)])
+def get_memory_by_route(limit: int = Query(10, ge=1, le=100, description="Allokeringsplatser per rutt.")):
+    """
+    Minne per rutt för anrop som mätts medan tracemalloc varit igång: topp under anropet,
+    vad som fanns kvar efteråt och de platser som allokerat mest. Högst genomsnittlig topp först.
+    """
+    return memory.routes(limit)
+
+@app.delete("/admin/memory/routes", status_code=204, dependencies=[Depends(require_admin)])
+def reset_memory_by_route():
+    """Nollställer ruttstatistiken."""
+    memory.reset_routes()
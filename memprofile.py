@@ -0,0 +1,262 @@
+# memprofile.py
+import asyncio
+import linecache
+import os
+import sysconfig
+import threading
+import tracemalloc
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from metrics import UNMATCHED
+
+# Antal sparade ögonblicksbilder; den äldsta får lämna plats
+MEMORY_SNAPSHOT_STORE_SIZE = int(os.environ.get("MEMORY_SNAPSHOT_STORE_SIZE", "10"))
+# Var N:te anrop mäts medan tracemalloc är igång
+MEMORY_SAMPLE_EVERY = int(os.environ.get("MEMORY_SAMPLE_EVERY", "1"))
+# Allokeringsplatser som sparas per mätt anrop
+MEMORY_TOP_SITES = int(os.environ.get("MEMORY_TOP_SITES", "10"))
+
+GROUP_BY = ("lineno", "filename", "traceback")
+
+_STDLIB = sysconfig.get_paths()["stdlib"] + os.sep
+
+# Allokeringar som tracemalloc och importmaskineriet gör själva är bara brus
+_NOISE = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, linecache.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+    tracemalloc.Filter(False, __file__),
+)
+
+
+def _short(filename: str) -> str:
+    """Sökvägen från site-packages, standardbiblioteket eller arbetskatalogen, så att platserna går att läsa."""
+    _, found, tail = filename.rpartition("site-packages" + os.sep)
+    if found:
+        return tail
+    if filename.startswith(_STDLIB):
+        return filename[len(_STDLIB):]
+    cwd = os.getcwd() + os.sep
+    return filename[len(cwd):] if filename.startswith(cwd) else filename
+
+def _site(frame) -> str:
+    return f"{_short(frame.filename)}:{frame.lineno}"
+
+def _stat(stat, group_by: str = "lineno") -> dict:
+    entry = {"size_kb": stat.size / 1024, "count": stat.count}
+    if group_by == "traceback":
+        entry["traceback"] = [_site(frame) for frame in stat.traceback]
+    elif group_by == "filename":
+        entry["site"] = _short(stat.traceback[0].filename)
+    else:
+        entry["site"] = _site(stat.traceback[0])
+    if hasattr(stat, "size_diff"):
+        entry["size_diff_kb"] = stat.size_diff / 1024
+        entry["count_diff"] = stat.count_diff
+    return entry
+
+
+class _Snapshot:
+    def __init__(self, snapshot: tracemalloc.Snapshot, label: Optional[str]):
+        self.id = uuid.uuid4().hex[:12]
+        self.label = label
+        self.taken = datetime.utcnow()
+        self.snapshot = snapshot.filter_traces(_NOISE)
+        self.size_kb = sum(trace.size for trace in self.snapshot.traces) / 1024
+
+    def summary(self) -> dict:
+        return {"id": self.id, "label": self.label, "taken": self.taken, "size_kb": self.size_kb,
+                "frames": self.snapshot.traceback_limit}
+
+
+class RouteMemory:
+    """Mätta anrop för en rutt: topp under anropet, vad som fanns kvar efteråt och var det allokerades."""
+
+    def __init__(self, route: str):
+        self.route = route
+        self.count = 0
+        self.peak_total_kb = 0.0
+        self.peak_max_kb = 0.0
+        self.net_total_kb = 0.0
+        self.sites: Counter = Counter()
+        self.site_counts: Counter = Counter()
+
+    def as_dict(self, limit: int) -> dict:
+        return {
+            "route": self.route, "count": self.count,
+            "peak_mean_kb": self.peak_total_kb / self.count if self.count else 0.0, "peak_max_kb": self.peak_max_kb,
+            "net_mean_kb": self.net_total_kb / self.count if self.count else 0.0,
+            "sites": [{"site": site, "size_kb": size / 1024, "count": self.site_counts[site]}
+                      for site, size in self.sites.most_common(limit)],
+        }
+
+
+class _Sample:
+    __slots__ = ("before", "traced", "done")
+
+    def __init__(self, before: tracemalloc.Snapshot, traced: int):
+        self.before = before
+        self.traced = traced
+        self.done = False
+
+
+class MemoryTracker:
+    """
+    tracemalloc på begäran. Den startas och stoppas från admin-ytan eftersom den gör varje
+    allokering flera gånger dyrare. Medan den är igång mäts anrop ett i taget: en ögonblicksbild
+    före och en när sista delen av svaret skickas, så att även svarsbufferten kommer med.
+    Toppen under anropet är processens topp och påverkas av anrop som körs samtidigt.
+    """
+
+    def __init__(self, store_size: int = MEMORY_SNAPSHOT_STORE_SIZE, sample_every: int = MEMORY_SAMPLE_EVERY,
+                 top_sites: int = MEMORY_TOP_SITES):
+        self.store_size = store_size
+        self.sample_every = sample_every
+        self.top_sites = top_sites
+        self.started: Optional[datetime] = None
+        self._snapshots: "OrderedDict[str, _Snapshot]" = OrderedDict()
+        self._routes: Dict[str, RouteMemory] = {}
+        self._seen = 0
+        self._sampling = threading.Lock()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        tracemalloc.start(frames)
+        self.started = datetime.utcnow()
+
+    def stop(self):
+        # Sparade ögonblicksbilder och ruttstatistik finns kvar efter stopp
+        tracemalloc.stop()
+        self.started = None
+
+    def status(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            snapshots = [snapshot.summary() for snapshot in reversed(self._snapshots.values())]
+        return {
+            "tracing": self.active, "started": self.started, "frames": tracemalloc.get_traceback_limit() if self.active else None,
+            "traced_kb": current / 1024, "peak_kb": peak / 1024,
+            "overhead_kb": tracemalloc.get_tracemalloc_memory() / 1024, "snapshots": snapshots,
+        }
+
+    # --- Ögonblicksbilder ---
+    def take_snapshot(self, label: Optional[str] = None) -> dict:
+        snapshot = _Snapshot(tracemalloc.take_snapshot(), label)
+        with self._lock:
+            self._snapshots[snapshot.id] = snapshot
+            while len(self._snapshots) > self.store_size:
+                self._snapshots.popitem(last=False)
+        return snapshot.summary()
+
+    def get(self, id: str) -> Optional[_Snapshot]:
+        with self._lock:
+            return self._snapshots.get(id)
+
+    def top(self, snapshot: _Snapshot, group_by: str = "lineno", limit: int = 20) -> List[dict]:
+        return [_stat(stat, group_by) for stat in snapshot.snapshot.statistics(group_by)[:limit]]
+
+    def diff(self, base: _Snapshot, current: Optional[_Snapshot] = None, group_by: str = "lineno", limit: int = 20) -> List[dict]:
+        """Största förändringarna sedan base, mot current eller mot en ny ögonblicksbild som inte sparas."""
+        current = current.snapshot if current is not None else tracemalloc.take_snapshot().filter_traces(_NOISE)
+        return [_stat(stat, group_by) for stat in current.compare_to(base.snapshot, group_by)[:limit]]
+
+    # --- Mätning per anrop ---
+    def due(self) -> bool:
+        """Om nästa anrop ska mätas; billig nog att anropa från händelseloopen."""
+        self._seen += 1
+        return self._seen % self.sample_every == 0 and not self._sampling.locked()
+
+    def begin_request(self) -> Optional[_Sample]:
+        if not self._sampling.acquire(blocking=False):
+            return None
+        try:
+            before = tracemalloc.take_snapshot().filter_traces(_NOISE)
+            tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+        except Exception:
+            self._sampling.release()
+            raise
+        return _Sample(before, traced)
+
+    def end_request(self, sample: _Sample, route: Optional[str]):
+        if sample.done:
+            return
+        sample.done = True
+        try:
+            if not tracemalloc.is_tracing():
+                return
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot().filter_traces(_NOISE)
+            stats = [stat for stat in after.compare_to(sample.before, "lineno") if stat.size_diff > 0][:self.top_sites]
+            with self._lock:
+                entry = self._routes.get(route or UNMATCHED)
+                if entry is None:
+                    entry = self._routes[route or UNMATCHED] = RouteMemory(route or UNMATCHED)
+                entry.count += 1
+                peak_kb = max(peak - sample.traced, 0) / 1024
+                entry.peak_total_kb += peak_kb
+                entry.peak_max_kb = max(entry.peak_max_kb, peak_kb)
+                entry.net_total_kb += (current - sample.traced) / 1024
+                for stat in stats:
+                    site = _site(stat.traceback[0])
+                    entry.sites[site] += stat.size_diff
+                    entry.site_counts[site] += stat.count_diff
+        finally:
+            self._sampling.release()
+
+    def routes(self, limit: int = 10) -> List[dict]:
+        """Rutterna med högst genomsnittlig topp först."""
+        with self._lock:
+            entries = sorted(self._routes.values(), key=lambda e: e.peak_total_kb / e.count, reverse=True)
+            return [entry.as_dict(limit) for entry in entries]
+
+    def reset_routes(self):
+        with self._lock:
+            self._routes.clear()
+            self._seen = 0
+
+
+memory = MemoryTracker()
+
+
+class MemoryMiddleware:
+    """Mäter minnet per anrop medan tracemalloc är igång; annars en kontroll per anrop."""
+
+    def __init__(self, app, tracker: MemoryTracker = memory):
+        self.app = app
+        self.tracker = tracker
+
+    async def __call__(self, scope, receive, send):
+        # Admin-ytan mäts inte; ögonblicksbilderna skulle annars mäta sig själva
+        if scope["type"] != "http" or not self.tracker.active or scope["path"].startswith("/admin/") or not self.tracker.due():
+            await self.app(scope, receive, send)
+            return
+        sample = await asyncio.to_thread(self.tracker.begin_request)
+        if sample is None:
+            await self.app(scope, receive, send)
+            return
+
+        def route():
+            return getattr(scope.get("route"), "path", None)
+
+        async def send_measured(message):
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                await asyncio.to_thread(self.tracker.end_request, sample, route())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            if not sample.done:
+                await asyncio.to_thread(self.tracker.end_request, sample, route())
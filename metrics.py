@@ -0,0 +1,273 @@
+# metrics.py
+import hashlib
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+import database
+from cache import REFERENCE_CACHES
+from compression import compressed_responses
+from ical import week_cache
+from recurrence import expansion_cache_info
+from sqlstats import STATEMENT_OBSERVERS, statement_shape
+
+METRICS_LATENCY_BUCKETS = tuple(float(b) for b in os.environ.get(
+    "METRICS_LATENCY_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10").split(","))
+METRICS_QUERY_BUCKETS = tuple(float(b) for b in os.environ.get(
+    "METRICS_QUERY_BUCKETS", "0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1").split(","))
+# Högsta antal satsformer med egen serie; resten räknas som "other"
+METRICS_MAX_STATEMENTS = int(os.environ.get("METRICS_MAX_STATEMENTS", "500"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+UNMATCHED = "<unmatched>"
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class _Shards:
+    """
+    Värden som skrivs utan lås: varje tråd skriver i sin egen lista och läsningen summerar
+    listorna. Bara första skrivningen från en ny tråd tar låset.
+    """
+
+    __slots__ = ("size", "_local", "_all", "_lock")
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._all: List[list] = []
+        self._lock = threading.Lock()
+
+    def mine(self) -> list:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = [0] * self.size
+            with self._lock:
+                self._all.append(values)
+            self._local.values = values
+            return values
+
+    def total(self) -> list:
+        with self._lock:
+            shards = list(self._all)
+        return [sum(column) for column in zip(*shards)] if shards else [0] * self.size
+
+
+class _Family:
+    """En metrik med etiketter; varje etikettkombination får sina egna shards."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), size: int = 1):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._size = size
+        self._children: Dict[tuple, _Shards] = {}
+        REGISTRY.append(self)
+
+    def _child(self, labels: tuple) -> _Shards:
+        child = self._children.get(labels)
+        if child is None:
+            child = self._children.setdefault(labels, _Shards(self._size))
+        return child
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, child in list(self._children.items()):
+            yield self.name, dict(zip(self.labels, labels)), child.total()[0]
+
+
+class Counter(_Family):
+    type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self._child(labels).mine()[0] += amount
+
+
+class Gauge(_Family):
+    type = "gauge"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self._child(labels).mine()[0] += amount
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self._child(labels).mine()[0] -= amount
+
+
+class Histogram(_Family):
+    """Förindelade hinkar: en observation är en binärsökning och två additioner."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # En plats per hink, en för +Inf och sist summan
+        super().__init__(name, help, labels, len(self.buckets) + 2)
+
+    def observe(self, value: float, labels: tuple = ()):
+        values = self._child(labels).mine()
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, child in list(self._children.items()):
+            values = child.total()
+            labels = dict(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": "+Inf" if bound == float("inf") else repr(bound)}, cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, values[-1]
+
+
+REGISTRY: List[_Family] = []
+# Metriker som räknas fram vid varje hämtning
+COLLECTORS: List[Callable[[], Iterable[Sample]]] = []
+# Typ och hjälptext för metrikerna från COLLECTORS och threadpool_stats
+DESCRIPTIONS = {
+    "ss12000_db_statement_info": ("gauge", "SQL-text för varje satsform i ss12000_db_query_duration_seconds."),
+    "ss12000_db_pool_size": ("gauge", "Anslutningspoolens storlek."),
+    "ss12000_db_pool_checked_out": ("gauge", "Utlånade anslutningar."),
+    "ss12000_db_pool_checked_in": ("gauge", "Lediga anslutningar i poolen."),
+    "ss12000_db_pool_overflow": ("gauge", "Anslutningar utöver poolens storlek."),
+    "ss12000_cache_hits_total": ("counter", "Träffar per cache."),
+    "ss12000_cache_misses_total": ("counter", "Missar per cache."),
+    "ss12000_cache_hit_ratio": ("gauge", "Andel träffar per cache sedan start."),
+    "ss12000_threadpool_size": ("gauge", "Trådar för synkrona endpoints."),
+    "ss12000_threadpool_busy": ("gauge", "Upptagna trådar."),
+    "ss12000_threadpool_waiting": ("gauge", "Anrop som väntar på en ledig tråd."),
+}
+
+http_requests = Counter("ss12000_http_requests_total", "Besvarade anrop per rutt och status.", ("method", "route", "status"))
+http_duration = Histogram("ss12000_http_request_duration_seconds", "Svarstid per rutt, till sista byte.", ("method", "route"))
+http_in_flight = Gauge("ss12000_http_requests_in_flight", "Anrop som pågår just nu.", ("method",))
+query_duration = Histogram("ss12000_db_query_duration_seconds", "SQL-satsernas körtid per satsform.", ("statement",), METRICS_QUERY_BUCKETS)
+
+
+# --- SQL-satser ---
+_statement_keys: Dict[str, str] = {}
+_statement_shapes: Dict[str, str] = {}
+
+def _statement_key(statement: str) -> str:
+    key = _statement_keys.get(statement)
+    if key is None:
+        shape = statement_shape(statement)
+        key = hashlib.sha1(shape.encode()).hexdigest()[:12]
+        if key not in _statement_shapes:
+            if len(_statement_shapes) >= METRICS_MAX_STATEMENTS:
+                return "other"
+            _statement_shapes[key] = shape
+        # SQLAlchemy cachar kompilerade satser, så samma text kommer tillbaka; tak mot okontrollerad tillväxt
+        if len(_statement_keys) < METRICS_MAX_STATEMENTS * 10:
+            _statement_keys[statement] = key
+    return key
+
+def _observe_statement(statement: str, parameters, seconds: float, executemany: bool):
+    query_duration.observe(seconds, (_statement_key(statement),))
+
+STATEMENT_OBSERVERS.append(_observe_statement)
+
+def _statement_info() -> Iterable[Sample]:
+    for key, shape in list(_statement_shapes.items()):
+        yield "ss12000_db_statement_info", {"statement": key, "sql": shape[:300]}, 1
+
+
+# --- Pool, cachar och trådpool ---
+def _pool_stats() -> Iterable[Sample]:
+    pool = getattr(database.engine, "pool", None)
+    # SQLite i minnet och NullPool saknar räknarna
+    for name, method in (("size", "size"), ("checked_out", "checkedout"), ("checked_in", "checkedin"), ("overflow", "overflow")):
+        if hasattr(pool, method):
+            yield f"ss12000_db_pool_{name}", {}, getattr(pool, method)()
+
+def _cache_stats() -> Iterable[Sample]:
+    counts = {name: (cache.hits, cache.misses) for name, cache in REFERENCE_CACHES.items()}
+    counts["icalWeeks"] = (week_cache.hits, week_cache.misses)
+    counts["compressedResponses"] = (compressed_responses.hits, compressed_responses.misses)
+    info = expansion_cache_info()
+    counts["recurrenceWeeks"] = (info.hits, info.misses)
+    for name, (hits, misses) in counts.items():
+        yield "ss12000_cache_hits_total", {"cache": name}, hits
+        yield "ss12000_cache_misses_total", {"cache": name}, misses
+        yield "ss12000_cache_hit_ratio", {"cache": name}, hits / (hits + misses) if hits + misses else 0.0
+
+def threadpool_stats() -> List[Sample]:
+    """Trådpoolen för synkrona endpoints. Måste anropas från händelseloopen."""
+    from anyio import to_thread
+
+    limiter = to_thread.current_default_thread_limiter()
+    return [
+        ("ss12000_threadpool_size", {}, limiter.total_tokens),
+        ("ss12000_threadpool_busy", {}, limiter.borrowed_tokens),
+        ("ss12000_threadpool_waiting", {}, limiter.statistics().tasks_waiting),
+    ]
+
+COLLECTORS.extend([_statement_info, _pool_stats, _cache_stats])
+
+
+# --- Exponering ---
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _line(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        name += "{" + ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items()) + "}"
+    return f"{name} {value}"
+
+def render_metrics(extra: Iterable[Sample] = ()) -> str:
+    """Alla metriker i Prometheus textformat."""
+    lines = []
+    for family in REGISTRY:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.type}")
+        lines.extend(_line(*sample) for sample in family.samples())
+
+    # Samples med samma namn grupperas under en rubrik, som formatet kräver
+    grouped: Dict[str, List[str]] = {}
+    for collect in COLLECTORS:
+        for sample in collect():
+            grouped.setdefault(sample[0], []).append(_line(*sample))
+    for sample in extra:
+        grouped.setdefault(sample[0], []).append(_line(*sample))
+    for name, samples in grouped.items():
+        type, help = DESCRIPTIONS.get(name, ("untyped", ""))
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI-middleware som mäter svarstid, status och pågående anrop per rutt."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc((method,))
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_in_flight.dec((method,))
+            # Omatchade sökvägar samlas i en serie så att antalet serier inte växer med okända URL:er
+            route = getattr(scope.get("route"), "path", UNMATCHED)
+            http_requests.inc((method, route, str(status)))
+            http_duration.observe(time.perf_counter() - started, (method, route))
@@ -0,0 +1,374 @@
+# org_statistics.py
+import argparse
+import logging
+import threading
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, delete, event, func, inspect, insert, or_, select, union
+from sqlalchemy.orm import Session
+
+from database import (
+    SessionLocal, Activity, Duty, Enrolment, Group, Organisation, Person, Placement, StatisticsRollup,
+)
+from helpers import apply_meta_filters
+
+logger = logging.getLogger("ss12000.statistics")
+
+METRICS = ("persons", "enrolments", "placements", "duties", "groups", "activities")
+UNSPECIFIED_SCHOOL_TYPE = ""
+
+# Entiteter som räknas och kolumnen som knyter dem till en organisationsenhet
+COUNTED = {
+    "enrolments": (Enrolment, Enrolment.enroled_at_id),
+    "placements": (Placement, Placement.organisation_id),
+    "duties": (Duty, Duty.organisation_id),
+    "activities": (Activity, Activity.organisation_id),
+    "groups": (Group, Group.organisation_id),
+}
+
+# (organisation_id, school_type, metric) -> antal
+Counts = Dict[Tuple[str, str, str], int]
+
+_rebuild_lock = threading.Lock()
+
+
+def _active(model, today: date):
+    """Aktiv idag: startat (eller saknar start) och inte avslutat."""
+    return and_(
+        or_(model.start_date.is_(None), model.start_date <= today),
+        or_(model.end_date.is_(None), model.end_date >= today),
+    )
+
+def _school_types(value: Optional[str]) -> List[str]:
+    return [t.strip() for t in (value or "").split(",") if t.strip()]
+
+def _unit_school_type(school_types: Optional[str]) -> str:
+    """En enhet med exakt en skolform tillskriver den allt; annars går skolformen inte att avgöra."""
+    types = _school_types(school_types)
+    return types[0] if len(types) == 1 else UNSPECIFIED_SCHOOL_TYPE
+
+def _load_hierarchy(conn) -> dict:
+    """Läser organisationsträdet direkt från databasen så att ändringar i samma flush syns."""
+    return {row.id: row for row in conn.execute(select(Organisation.id, Organisation.parent_id, Organisation.school_types))}
+
+def _ancestors(organisation_id: str, hierarchy) -> List[str]:
+    """Enheten själv och alla dess överordnade enheter, nedifrån och upp."""
+    chain = []
+    current = organisation_id
+    while current is not None and current not in chain:
+        chain.append(current)
+        current = hierarchy[current].parent_id if current in hierarchy else None
+    return chain
+
+def own_counts(db: Session, today: date, organisation_ids: Optional[Iterable[str]] = None, meta=(None, None, None, None)) -> Counts:
+    """
+    Räknar aktiva poster per enhet med en grupperad fråga per entitet. meta är
+    (metaCreatedBefore, metaCreatedAfter, metaModifiedBefore, metaModifiedAfter) och
+    filtrerar på de räknade posterna (för personer på personen).
+    """
+    conn = db.connection()
+    hierarchy = _load_hierarchy(conn)
+    counts: Counts = defaultdict(int)
+
+    def restrict(query, column):
+        if organisation_ids is not None:
+            query = query.where(column.in_(organisation_ids))
+        return query.where(column.is_not(None))
+
+    for metric, (model, column) in COUNTED.items():
+        if metric == "groups":
+            query = select(column, model.school_types, func.count()).where(_active(model, today)).group_by(column, model.school_types)
+        else:
+            query = select(column, func.count()).where(_active(model, today)).group_by(column)
+        query = apply_meta_filters(restrict(query, column), model, *meta)
+
+        for row in conn.execute(query):
+            organisation_id = row[0]
+            unit = hierarchy.get(organisation_id)
+            if metric == "groups":
+                # Grupper har egen skolform; en grupp med flera skolformer räknas under var och en
+                for school_type in _school_types(row[1]) or [_unit_school_type(unit.school_types if unit else None)]:
+                    counts[(organisation_id, school_type, metric)] += row[2]
+            else:
+                counts[(organisation_id, _unit_school_type(unit.school_types if unit else None), metric)] += row[1]
+
+    # Aktiva personer: unika personer med aktiv inskrivning, placering eller tjänstgöring på enheten
+    persons = _active_persons(today, organisation_ids, meta)
+    for organisation_id, count in conn.execute(
+        select(persons.c.organisation_id, func.count()).group_by(persons.c.organisation_id)
+    ):
+        unit = hierarchy.get(organisation_id)
+        counts[(organisation_id, _unit_school_type(unit.school_types if unit else None), "persons")] += count
+
+    return dict(counts)
+
+def _active_persons(today: date, organisation_ids: Optional[Iterable[str]] = None, meta=(None, None, None, None)):
+    """Unika par (organisation_id, person_id) med aktiv inskrivning, placering eller tjänstgöring."""
+    sources = []
+    for model, column in (COUNTED["enrolments"], COUNTED["placements"], COUNTED["duties"]):
+        query = select(column.label("organisation_id"), model.person_id.label("person_id")).where(
+            _active(model, today), model.person_id.is_not(None), column.is_not(None),
+        )
+        if organisation_ids is not None:
+            query = query.where(column.in_(organisation_ids))
+        if any(meta):
+            query = apply_meta_filters(query.join(Person, Person.id == model.person_id), Person, *meta)
+        sources.append(query)
+    return union(*sources).subquery()
+
+def _subtree(organisation_id: str, children: Dict[str, List[str]]) -> List[str]:
+    """Enheten själv och alla dess underliggande enheter."""
+    units, pending = [], [organisation_id]
+    while pending:
+        current = pending.pop()
+        if current not in units:
+            units.append(current)
+            pending.extend(children.get(current, ()))
+    return units
+
+def person_totals(db: Session, today: date, hierarchy, organisation_ids: Optional[Set[str]] = None,
+                  meta=(None, None, None, None)) -> Counts:
+    """
+    Unika aktiva personer i varje enhets delträd per skolform; en person som är aktiv på flera
+    underliggande enheter räknas en gång. Utan organisation_ids läses alla par (enhet, person) en
+    gång. Med organisation_ids räknas de enheterna med en fråga per enhet och skolform.
+    """
+    conn = db.connection()
+
+    def school_type(organisation_id: str) -> str:
+        unit = hierarchy.get(organisation_id)
+        return _unit_school_type(unit.school_types if unit else None)
+
+    if organisation_ids is None:
+        persons = _active_persons(today, meta=meta)
+        members: Dict[Tuple[str, str, str], Set[str]] = defaultdict(set)
+        for organisation_id, person_id in conn.execute(select(persons.c.organisation_id, persons.c.person_id)):
+            for ancestor in _ancestors(organisation_id, hierarchy):
+                members[(ancestor, school_type(organisation_id), "persons")].add(person_id)
+        return {key: len(person_ids) for key, person_ids in members.items()}
+
+    children: Dict[str, List[str]] = defaultdict(list)
+    for unit in hierarchy.values():
+        if unit.parent_id is not None:
+            children[unit.parent_id].append(unit.id)
+    totals: Counts = {}
+    for ancestor in organisation_ids:
+        by_school_type: Dict[str, List[str]] = defaultdict(list)
+        for unit in _subtree(ancestor, children):
+            by_school_type[school_type(unit)].append(unit)
+        for unit_school_type, units in by_school_type.items():
+            persons = _active_persons(today, units, meta)
+            count = conn.execute(select(func.count()).select_from(
+                select(persons.c.person_id).distinct().subquery())).scalar()
+            if count:
+                totals[(ancestor, unit_school_type, "persons")] = count
+    return totals
+
+def roll_up(own: Counts, hierarchy, organisation_ids: Optional[Set[str]] = None) -> Counts:
+    """
+    Summerar egna antal uppåt i organisationsträdet. Med organisation_ids beräknas bara
+    totalerna för de enheterna. Personer går inte att summera, se person_totals.
+    """
+    totals: Counts = defaultdict(int)
+    for (organisation_id, school_type, metric), count in own.items():
+        if metric == "persons":
+            continue
+        for ancestor in _ancestors(organisation_id, hierarchy):
+            if organisation_ids is None or ancestor in organisation_ids:
+                totals[(ancestor, school_type, metric)] += count
+    return dict(totals)
+
+def _write(conn, own: Counts, totals: Counts, hierarchy, organisation_ids: Optional[Set[str]], today: date) -> int:
+    table = StatisticsRollup.__table__
+    clear = delete(table)
+    if organisation_ids is not None:
+        clear = clear.where(table.c.organisation_id.in_(organisation_ids))
+    conn.execute(clear)
+
+    # Varje enhet får rader även utan aktiva poster, så att en tom enhet skiljs från en som inte beräknats
+    totals = dict(totals)
+    for organisation_id in (hierarchy if organisation_ids is None else organisation_ids):
+        if organisation_id in hierarchy:
+            for metric in METRICS:
+                totals.setdefault((organisation_id, _unit_school_type(hierarchy[organisation_id].school_types), metric), 0)
+
+    now = datetime.utcnow()
+    rows = [
+        {"organisation_id": key[0], "school_type": key[1], "metric": key[2],
+         "own_count": own.get(key, 0), "total_count": total, "computed_on": today, "modified": now}
+        for key, total in totals.items()
+    ]
+    if rows:
+        conn.execute(insert(table), rows)
+    return len(rows)
+
+def refresh_statistics(db: Session, organisation_ids: Optional[Iterable[str]] = None) -> int:
+    """
+    Räknar om statistiken i sessionens transaktion. Utan organisation_ids byggs allt om; annars
+    räknas de angivna enheterna om och totalerna för dem och deras överordnade enheter uppdateras.
+    """
+    today = date.today()
+    conn = db.connection()
+    if organisation_ids is None:
+        own = own_counts(db, today)
+        hierarchy = _load_hierarchy(conn)
+        totals = roll_up(own, hierarchy)
+        totals.update(person_totals(db, today, hierarchy))
+        return _write(conn, own, totals, hierarchy, None, today)
+
+    dirty = set(organisation_ids)
+    if not dirty:
+        return 0
+    hierarchy = _load_hierarchy(conn)
+    affected = {ancestor for organisation_id in dirty for ancestor in _ancestors(organisation_id, hierarchy)}
+
+    # Egna antal för övriga enheter i de berörda delträden läses från tabellen
+    table = StatisticsRollup.__table__
+    own = {
+        (row.organisation_id, row.school_type, row.metric): row.own_count
+        for row in conn.execute(select(table.c.organisation_id, table.c.school_type, table.c.metric, table.c.own_count).where(
+            table.c.own_count > 0, table.c.organisation_id.not_in(dirty),
+        ))
+    }
+    own.update(own_counts(db, today, dirty))
+    totals = roll_up(own, hierarchy, affected)
+    totals.update(person_totals(db, today, hierarchy, affected))
+    return _write(conn, own, totals, hierarchy, affected, today)
+
+def _computed_on(db: Session) -> Optional[date]:
+    return db.query(func.min(StatisticsRollup.computed_on)).scalar()
+
+def _rebuild_if_stale() -> bool:
+    """
+    Körs under _rebuild_lock i en egen session. Datumet läses om, eftersom en annan tråd eller
+    process kan ha byggt om medan vi väntade på låset.
+    """
+    db = SessionLocal()
+    try:
+        computed_on = _computed_on(db)
+        if computed_on is not None and computed_on >= date.today():
+            return False
+        refresh_statistics(db)
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+def _rebuild_in_background():
+    if not _rebuild_lock.acquire(blocking=False):
+        return  # En ombyggnad pågår redan
+
+    def run():
+        try:
+            _rebuild_if_stale()
+        except Exception:
+            logger.exception("Ombyggnaden av statistiken misslyckades")
+        finally:
+            _rebuild_lock.release()
+
+    try:
+        threading.Thread(target=run, name="statistics-rebuild", daemon=True).start()
+    except Exception:
+        _rebuild_lock.release()
+        raise
+
+def ensure_current(wait: bool = False) -> bool:
+    """
+    Bygger om statistiken om den saknas eller beräknades en tidigare dag. Returnerar True om den
+    byggdes om i anropet. Finns gårdagens summor svarar anropet med dem och dagens ombyggnad
+    körs i bakgrunden, om inte wait anges; saknas statistiken helt byggs den direkt.
+
+    Kontroll och ombyggnad görs i egna sessioner. Anropa innan den egna sessionen har läst
+    något, så att dess transaktion ser de nya summorna.
+    """
+    db = SessionLocal()
+    try:
+        computed_on = _computed_on(db)
+    finally:
+        db.close()
+    if computed_on is not None and computed_on >= date.today():
+        return False
+    if computed_on is not None and not wait:
+        _rebuild_in_background()
+        return False
+    with _rebuild_lock:
+        return _rebuild_if_stale()
+
+def _dirty_organisations(session: Session) -> Set[str]:
+    """Samlar ihop de enheter vars antal eller delträd kan ha ändrats i den aktuella flushen."""
+    dirty: Set[str] = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Organisation):
+            dirty.add(obj.id)
+            dirty.update(inspect(obj).attrs.parent_id.history.deleted or [])
+            continue
+        for model, column in COUNTED.values():
+            if isinstance(obj, model):
+                dirty.add(getattr(obj, column.key))
+                dirty.update(inspect(obj).attrs[column.key].history.deleted or [])
+    dirty.discard(None)
+    return dirty
+
+@event.listens_for(SessionLocal, "after_flush")
+def _maintain_statistics(session, flush_context):
+    dirty = _dirty_organisations(session)
+    if dirty and session.connection().execute(select(func.count()).select_from(StatisticsRollup.__table__)).scalar():
+        refresh_statistics(session, dirty)
+
+def statistics_rows(db: Session, organisation: Optional[str] = None, school_type: Optional[str] = None,
+                    include_descendants: bool = True, meta=(None, None, None, None)) -> List[dict]:
+    """
+    Returnerar en rad per enhet och skolform med ett antal per mått. Utan metafilter läses de
+    förberäknade summorna; med metafilter räknas de direkt med samma grupperade frågor.
+    """
+    if any(meta):
+        today = date.today()
+        own = own_counts(db, today, meta=meta)
+        if include_descendants:
+            hierarchy = _load_hierarchy(db.connection())
+            counts = roll_up(own, hierarchy)
+            counts.update(person_totals(db, today, hierarchy, meta=meta))
+        else:
+            counts = own
+    else:
+        ensure_current()
+        column = StatisticsRollup.total_count if include_descendants else StatisticsRollup.own_count
+        query = db.query(StatisticsRollup.organisation_id, StatisticsRollup.school_type, StatisticsRollup.metric, column)
+        if organisation:
+            query = query.filter(StatisticsRollup.organisation_id == organisation)
+        if school_type is not None:
+            query = query.filter(StatisticsRollup.school_type == school_type)
+        counts = {(row[0], row[1], row[2]): row[3] for row in query}
+
+    rows = {}
+    for (organisation_id, row_school_type, metric), count in counts.items():
+        if organisation and organisation_id != organisation:
+            continue
+        if school_type is not None and row_school_type != school_type:
+            continue
+        row = rows.setdefault((organisation_id, row_school_type), dict(
+            {"organisation_id": organisation_id, "school_type": row_school_type or None}, **{m: 0 for m in METRICS}
+        ))
+        row[metric] = count
+    return [rows[key] for key in sorted(rows)]
+
+
+if __name__ == "__main__":
+    from database import init_engine
+
+    parser = argparse.ArgumentParser(description="Underhåll av förberäknad statistik.")
+    parser.add_argument("--rebuild", action="store_true", help="Räkna om all statistik.")
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.error("Ange --rebuild")
+    init_engine()
+    db = SessionLocal()
+    try:
+        count = refresh_statistics(db)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Räknade om {count} rader")
@@ -0,0 +1,209 @@
+# participation.py
+import argparse
+from collections import defaultdict
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, delete, event, exists, func, insert, inspect, literal, select, union_all
+from sqlalchemy.orm import Session
+
+from database import (
+    SessionLocal, Activity, ActivityParticipant, CalendarEvent, Duty, GroupMembership, Person,
+    activity_group_association, activity_teacher_association,
+)
+
+STUDENT = "student"
+TEACHER = "teacher"
+
+# Öppna giltighetstider lagras med datum som ryms i alla databasers DATE
+VALID_FROM_MIN = date(1000, 1, 1)
+VALID_TO_MAX = date(9999, 12, 31)
+
+Period = Tuple[date, date]
+
+
+def _participant_rows(activity_column, person_id, start_date, end_date, role: str, activity_ids: Optional[List[str]]):
+    # Perioder med samma startdatum slås ihop till den längsta, eftersom startdatumet ingår i primärnyckeln
+    valid_from = func.coalesce(start_date, literal(VALID_FROM_MIN))
+    query = select(
+        activity_column,
+        person_id,
+        literal(role),
+        valid_from,
+        func.max(func.coalesce(end_date, literal(VALID_TO_MAX))),
+    ).where(person_id.is_not(None)).group_by(activity_column, person_id, valid_from)
+    if activity_ids is not None:
+        query = query.where(activity_column.in_(activity_ids))
+    return query
+
+def _student_rows(activity_ids: Optional[List[str]]):
+    """aktivitet -> grupp -> gruppmedlemskap -> person"""
+    return _participant_rows(
+        activity_group_association.c.activity_id, GroupMembership.person_id,
+        GroupMembership.start_date, GroupMembership.end_date, STUDENT, activity_ids,
+    ).join_from(
+        activity_group_association, GroupMembership, GroupMembership.group_id == activity_group_association.c.group_id
+    )
+
+def _teacher_rows(activity_ids: Optional[List[str]]):
+    """aktivitet -> activity_teacher -> tjänstgöring -> person"""
+    return _participant_rows(
+        activity_teacher_association.c.activity_id, Duty.person_id,
+        Duty.start_date, Duty.end_date, TEACHER, activity_ids,
+    ).join_from(
+        activity_teacher_association, Duty, Duty.id == activity_teacher_association.c.teacher_duty_id
+    )
+
+def rebuild_participation(conn, activity_ids: Optional[Iterable[str]] = None) -> int:
+    """
+    Bygger om deltagarindexet för de angivna aktiviteterna, eller för alla om activity_ids är None.
+    conn kan vara en Connection eller en Session; anropet sker i anroparens transaktion.
+    Returnerar antalet rader i indexet för aktiviteterna.
+    """
+    if activity_ids is not None:
+        activity_ids = list(activity_ids)
+        if not activity_ids:
+            return 0
+
+    table = ActivityParticipant.__table__
+    columns = [table.c.activity_id, table.c.person_id, table.c.role, table.c.valid_from, table.c.valid_to]
+
+    clear = delete(table)
+    if activity_ids is not None:
+        clear = clear.where(table.c.activity_id.in_(activity_ids))
+    conn.execute(clear)
+    students = conn.execute(insert(table).from_select(columns, _student_rows(activity_ids)))
+    teachers = conn.execute(insert(table).from_select(columns, _teacher_rows(activity_ids)))
+    return students.rowcount + teachers.rowcount
+
+def ensure_participation(bind) -> int:
+    """Bygger indexet om det är tomt men aktiviteter har grupper eller lärare, t.ex. efter att database.sql lästs in."""
+    with bind.begin() as conn:
+        if conn.execute(select(func.count()).select_from(ActivityParticipant.__table__)).scalar():
+            return 0
+        linked = union_all(select(activity_group_association.c.activity_id), select(activity_teacher_association.c.activity_id))
+        if not conn.execute(select(func.count()).select_from(linked.subquery())).scalar():
+            return 0
+        return rebuild_participation(conn)
+
+def _affected_activity_ids(session: Session) -> Set[str]:
+    """Samlar ihop de aktiviteter vars deltagare kan ha ändrats i den aktuella flushen."""
+    activity_ids: Set[str] = set()
+    group_ids: Set[str] = set()
+    duty_ids: Set[str] = set()
+
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Activity):
+            activity_ids.add(obj.id)
+        elif isinstance(obj, GroupMembership):
+            # Ta även med gruppen som medlemskapet eventuellt flyttats från
+            group_ids.add(obj.group_id)
+            group_ids.update(inspect(obj).attrs.group_id.history.deleted or [])
+        elif isinstance(obj, Duty):
+            duty_ids.add(obj.id)
+
+    conn = session.connection()
+    if group_ids:
+        activity_ids.update(conn.execute(
+            select(activity_group_association.c.activity_id).where(activity_group_association.c.group_id.in_(group_ids))
+        ).scalars())
+    if duty_ids:
+        activity_ids.update(conn.execute(
+            select(activity_teacher_association.c.activity_id).where(activity_teacher_association.c.teacher_duty_id.in_(duty_ids))
+        ).scalars())
+    return activity_ids
+
+@event.listens_for(SessionLocal, "before_flush")
+def _clear_deleted_participants(session, flush_context, instances):
+    # Rader i indexet måste bort innan aktiviteten eller personen själv tas bort (främmande nycklar)
+    table = ActivityParticipant.__table__
+    activity_ids = [obj.id for obj in session.deleted if isinstance(obj, Activity)]
+    person_ids = [obj.id for obj in session.deleted if isinstance(obj, Person)]
+    if activity_ids:
+        session.connection().execute(delete(table).where(table.c.activity_id.in_(activity_ids)))
+    if person_ids:
+        session.connection().execute(delete(table).where(table.c.person_id.in_(person_ids)))
+
+@event.listens_for(SessionLocal, "after_flush")
+def _maintain_participation(session, flush_context):
+    activity_ids = _affected_activity_ids(session)
+    if activity_ids:
+        rebuild_participation(session.connection(), activity_ids)
+
+def participating(person_ids: Iterable[str], role: Optional[str] = None, activity_column=None, time_column=None):
+    """
+    EXISTS-villkor för att någon av personerna deltar i aktiviteten i activity_column, som standard
+    kalenderhändelsens. Med time_column, som standard händelsens starttid, måste deltagandet även
+    gälla den dagen. Villkoret ger aldrig dubbletter, även om en person har flera perioder.
+    """
+    if activity_column is None:
+        activity_column = CalendarEvent.activity_id
+        time_column = CalendarEvent.start_time if time_column is None else time_column
+    participant = ActivityParticipant.__table__.alias(f"{role or 'any'}_participant")
+    conditions = [participant.c.activity_id == activity_column, participant.c.person_id.in_([str(id) for id in person_ids])]
+    if role:
+        conditions.append(participant.c.role == role)
+    if time_column is not None:
+        day = func.date(time_column)
+        conditions += [participant.c.valid_from <= day, participant.c.valid_to >= day]
+    return exists().where(and_(*conditions))
+
+def participation_periods(db: Session, person_id: str, role: Optional[str], activity_ids: Iterable[str]) -> Dict[str, List[Period]]:
+    """
+    Personens giltighetsperioder per aktivitet, för tidpunkter som räknas fram utanför databasen.
+    Utan role ingår perioderna både som elev och som lärare.
+    """
+    table = ActivityParticipant.__table__
+    periods = defaultdict(list)
+    activity_ids = list(set(activity_ids))
+    if activity_ids:
+        query = select(table.c.activity_id, table.c.valid_from, table.c.valid_to).where(
+            table.c.person_id == str(person_id), table.c.activity_id.in_(activity_ids))
+        if role:
+            query = query.where(table.c.role == role)
+        for activity_id, valid_from, valid_to in db.execute(query):
+            periods[activity_id].append((valid_from, valid_to))
+    return periods
+
+def valid_on(periods: List[Period], day: date) -> bool:
+    return any(valid_from <= day <= valid_to for valid_from, valid_to in periods)
+
+def apply_participation_filters(query, student=None, teacher=None, organisation=None, group=None, activity_column=None, time_column=None):
+    """
+    Applicerar student-, lärar-, organisations- och gruppfilter på en fråga mot CalendarEvent
+    (eller annan entitet med aktivitetsreferens via activity_column) med indexerade EXISTS-villkor
+    mot deltagarindexet. För CalendarEvent måste eleven eller läraren delta på händelsens dag; för
+    andra entiteter bara om time_column anges.
+    """
+    if student:
+        query = query.filter(participating([student], STUDENT, activity_column, time_column))
+    if teacher:
+        query = query.filter(participating([teacher], TEACHER, activity_column, time_column))
+
+    if activity_column is None:
+        activity_column = CalendarEvent.activity_id
+
+    if organisation:
+        query = query.join(Activity, Activity.id == activity_column).filter(Activity.organisation_id == str(organisation))
+
+    if group:
+        query = query.join(activity_group_association, and_(
+            activity_group_association.c.activity_id == activity_column,
+            activity_group_association.c.group_id == str(group),
+        ))
+
+    return query
+
+
+if __name__ == "__main__":
+    from database import init_engine
+
+    parser = argparse.ArgumentParser(description="Underhåll av deltagarindexet activity_participants.")
+    parser.add_argument("--rebuild", action="store_true", help="Bygg om indexet från grupper, gruppmedlemskap och lärare.")
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.error("Ange --rebuild")
+    with init_engine().begin() as conn:
+        count = rebuild_participation(conn)
+    print(f"Byggde om {count} deltagarrader")
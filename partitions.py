@@ -0,0 +1,163 @@
+# partitions.py
+import argparse
+import os
+import threading
+import time
+from datetime import date, datetime
+from typing import List, Optional
+
+from sqlalchemy import text
+
+CALENDAR_EVENTS_TABLE = "calendarEvents"
+MAX_PARTITION = "pmax"
+# Hur ofta kartan får läsas om när ett fönster når en månad som saknas i den
+PARTITION_REFRESH_SECONDS = float(os.environ.get("PARTITION_REFRESH_SECONDS", "60"))
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+def next_month(value: date) -> date:
+    return date(value.year + 1, 1, 1) if value.month == 12 else date(value.year, value.month + 1, 1)
+
+def partition_name(month: date) -> str:
+    """Månadspartitionerna heter pÅÅÅÅMM och innehåller händelser som startar den månaden."""
+    return f"p{month.year:04d}{month.month:02d}"
+
+def months_between(start, end) -> List[date]:
+    months = []
+    month = month_start(start)
+    while month <= month_start(end):
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+class PartitionMap:
+    """
+    Håller reda på vilka månadspartitioner som finns för calendarEvents i MySQL.
+    Används för att rikta frågor mot exakt de partitioner som ett tidsfönster berör.
+    Partitionerna kan delas upp från en annan process (ensure_partitions), så en månad som
+    saknas i kartan leder till en ny läsning av den i stället för en gissning.
+    """
+
+    def __init__(self, table: str = CALENDAR_EVENTS_TABLE, refresh_seconds: float = PARTITION_REFRESH_SECONDS):
+        self.table = table
+        self.refresh_seconds = refresh_seconds
+        self.partitions = set()
+        self._bind = None
+        self._refreshed = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.partitions)
+
+    def refresh(self, bind) -> int:
+        if bind.dialect.name != "mysql":
+            return 0
+        with bind.connect() as conn:
+            names = conn.execute(text(
+                "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL"
+            ), {"table": self.table}).scalars().all()
+        with self._lock:
+            self.partitions = set(names)
+            self._bind = bind
+            self._refreshed = time.monotonic()
+        return len(names)
+
+    def _refresh_if_stale(self) -> bool:
+        with self._lock:
+            bind = self._bind
+            if bind is None or time.monotonic() - self._refreshed < self.refresh_seconds:
+                return False
+            # Bara en tråd läser om kartan; övriga fortsätter utan ledtråd tills den är klar
+            self._refreshed = time.monotonic()
+        self.refresh(bind)
+        return True
+
+    def _select(self, months: List[date]) -> Optional[List[str]]:
+        partitions = self.partitions
+        named = sorted(p for p in partitions if p != MAX_PARTITION)
+        if not named:
+            return None
+        selected = []
+        for month in months:
+            name = partition_name(month)
+            if name < named[0]:
+                # Den första partitionen har ingen nedre gräns och innehåller även äldre månader
+                name = named[0]
+            elif name not in partitions:
+                # Månaden kan ha fått en egen partition sedan kartan lästes; pmax vore en gissning
+                return None
+            if name not in selected:
+                selected.append(name)
+        return selected
+
+    def partitions_for_window(self, start: datetime, end: datetime) -> Optional[List[str]]:
+        """
+        Returnerar partitionerna som täcker [start, end], eller None om fönstret inte kan
+        begränsas: okänd partitionering, eller en månad som inte har en egen partition.
+        Då läses kartan om (högst var refresh_seconds) och frågan körs utan ledtråd.
+        """
+        if not self.enabled or start is None or end is None or end < start:
+            return None
+        months = months_between(start, end)
+        selected = self._select(months)
+        if selected is None and self._refresh_if_stale():
+            selected = self._select(months)
+        return selected
+
+
+calendar_event_partitions = PartitionMap()
+
+def prune_partitions(query, model, start: datetime, end: datetime):
+    """Lägger till en MySQL PARTITION-ledtråd så att endast berörda månader läses."""
+    names = calendar_event_partitions.partitions_for_window(start, end)
+    if not names:
+        return query
+    return query.with_hint(model, f"PARTITION ({', '.join(names)})", "mysql")
+
+def ensure_partitions(bind, through: date) -> List[str]:
+    """
+    Skapar månadspartitioner till och med månaden för through genom att dela upp pmax.
+    Idempotent: befintliga partitioner lämnas orörda.
+    """
+    calendar_event_partitions.refresh(bind)
+    existing = calendar_event_partitions.partitions
+    if MAX_PARTITION not in existing:
+        raise RuntimeError(f"Tabellen {CALENDAR_EVENTS_TABLE} är inte partitionerad med en {MAX_PARTITION}-partition.")
+
+    named = sorted(p for p in existing if p != MAX_PARTITION)
+    month = next_month(date(int(named[-1][1:5]), int(named[-1][5:7]), 1)) if named else month_start(date.today())
+    created = []
+    definitions = []
+    while month <= month_start(through):
+        name = partition_name(month)
+        definitions.append(f"PARTITION {name} VALUES LESS THAN (TO_DAYS('{next_month(month).isoformat()}'))")
+        created.append(name)
+        month = next_month(month)
+
+    if definitions:
+        definitions.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+        with bind.begin() as conn:
+            conn.execute(text(
+                f"ALTER TABLE {CALENDAR_EVENTS_TABLE} REORGANIZE PARTITION {MAX_PARTITION} INTO ({', '.join(definitions)})"
+            ))
+        calendar_event_partitions.refresh(bind)
+    return created
+
+
+if __name__ == "__main__":
+    from database import init_engine
+
+    parser = argparse.ArgumentParser(description="Underhåll av månadspartitioner för calendarEvents.")
+    parser.add_argument("--months-ahead", type=int, default=6, help="Antal månader framåt som ska ha egna partitioner.")
+    args = parser.parse_args()
+
+    target = date.today()
+    for _ in range(args.months_ahead):
+        target = next_month(target)
+    created = ensure_partitions(init_engine(), target)
+    print(f"Skapade {len(created)} partitioner: {', '.join(created) or '-'}")
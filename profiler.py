@@ -0,0 +1,231 @@
+# profiler.py
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import List, Optional
+from urllib.parse import parse_qs
+
+from helpers import admin_token_valid
+
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "2"))
+PROFILE_STORE_SIZE = int(os.environ.get("PROFILE_STORE_SIZE", "50"))
+# Samplingen avbryts efter så här lång tid även om anropet pågår, t.ex. för strömmade svar
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "30"))
+# Katalog där profilerna även sparas som .folded-filer
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+# Kategorier efter modul, i den ordning de prövas från stackens topp. SQL före ORM eftersom
+# ORM:en anropar motorn; en sampling i motorn under en ORM-fråga är databastid.
+CATEGORIES = (
+    ("sql", ("sqlalchemy/engine/", "sqlalchemy/pool/", "mysql/connector/", "pymysql/", "sqlite3/")),
+    ("orm", ("sqlalchemy/orm/",)),
+    ("pydantic", ("pydantic/", "pydantic_core/", "fastapi/_compat")),
+    ("json", ("json/", "fastapi/encoders.py", "starlette/responses.py", "fastapi/responses.py")),
+)
+APP = "app"
+
+_active: contextvars.ContextVar[Optional["Profile"]] = contextvars.ContextVar("profile", default=None)
+
+
+class Profile:
+    """Samplingar för ett anrop, som kollapsade stackar (formatet som flamegraph.pl och speedscope läser)."""
+
+    def __init__(self, method: str, path: str, interval_ms: float):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.route: Optional[str] = None
+        self.status: Optional[int] = None
+        self.interval_ms = interval_ms
+        self.started = datetime.utcnow()
+        self.duration_ms = 0.0
+        self.stacks: Counter = Counter()
+        self.categories: Counter = Counter()
+
+    @property
+    def samples(self) -> int:
+        return sum(self.stacks.values())
+
+    def folded(self) -> str:
+        """En rad per unik stack: kategori;yttersta;...;innersta antal."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id, "method": self.method, "path": self.path, "route": self.route, "status": self.status,
+            "started": self.started, "duration_ms": self.duration_ms, "samples": self.samples,
+            "interval_ms": self.interval_ms,
+            "categories_ms": {name: count * self.interval_ms for name, count in self.categories.most_common()},
+        }
+
+
+def _request_context(frame) -> Optional[contextvars.Context]:
+    """Kontexten som en tråd kör i: anyios arbetstrådar och asyncio-loopens handles bär den i en lokal variabel."""
+    code = frame.f_code
+    if code.co_name == "_run":
+        handle = frame.f_locals.get("self")
+        if isinstance(handle, asyncio.Handle):
+            return handle._context
+    # asyncio.Runner.run har också en lokal context, men den gäller hela loopen och inte anropet
+    elif code.co_name == "run" and "anyio" in code.co_filename:
+        context = frame.f_locals.get("context")
+        if isinstance(context, contextvars.Context):
+            return context
+    return None
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+def _category(filenames: List[str]) -> str:
+    for filename in filenames:
+        for name, markers in CATEGORIES:
+            if any(marker in filename for marker in markers):
+                return name
+    return APP
+
+
+class _Sampler(threading.Thread):
+    """
+    Tar ögonblicksbilder av alla trådars stackar och behåller de som kör i profilens kontext.
+    Det gäller både händelseloopen och trådpoolen, så även synkrona endpoints kommer med.
+    """
+
+    def __init__(self, profile: Profile):
+        super().__init__(name=f"profiler-{profile.id[:8]}", daemon=True)
+        self.profile = profile
+        self.done = threading.Event()
+
+    def run(self):
+        interval = self.profile.interval_ms / 1000
+        deadline = time.monotonic() + PROFILE_MAX_SECONDS
+        while not self.done.wait(interval) and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != self.ident:
+                    self._sample(frame)
+
+    def _sample(self, leaf):
+        frames = []
+        frame, child = leaf, None
+        while frame is not None:
+            context = _request_context(frame)
+            if context is not None:
+                # En ledig arbetstråd kan fortfarande ha kontexten kvar; den räknas bara om den kör något
+                if child is None or context.get(_active) is not self.profile or child.f_code.co_filename.endswith("queue.py"):
+                    return
+                break
+            frames.append(frame)
+            frame, child = frame.f_back, frame
+        if frame is None:
+            return
+        filenames = [f.f_code.co_filename.replace("\\", "/") for f in frames]
+        category = _category(filenames)
+        self.profile.categories[category] += 1
+        self.profile.stacks[";".join([category] + [_frame_name(f) for f in reversed(frames)])] += 1
+
+
+class ProfileStore:
+    """De senaste profilerna i minnet, och som filer i PROFILE_DIR om den är satt."""
+
+    def __init__(self, size: int = PROFILE_STORE_SIZE, directory: Optional[str] = PROFILE_DIR):
+        self.size = size
+        self.directory = directory
+        self._profiles: "OrderedDict[str, Profile]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, profile: Profile):
+        with self._lock:
+            self._profiles[profile.id] = profile
+            while len(self._profiles) > self.size:
+                self._profiles.popitem(last=False)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, f"{profile.started:%Y%m%dT%H%M%S}-{profile.id}")
+            with open(base + ".folded", "w") as f:
+                f.write(profile.folded())
+            with open(base + ".json", "w") as f:
+                json.dump(profile.summary(), f, default=str)
+
+    def get(self, id: str) -> Optional[Profile]:
+        with self._lock:
+            return self._profiles.get(id)
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            return [profile.summary() for profile in reversed(self._profiles.values())]
+
+
+profiles = ProfileStore()
+
+
+def _profiling_requested(scope) -> Optional[bool]:
+    """None om ingen profilering begärts, annars om anroparen har rätt att begära den."""
+    requested = False
+    token = None
+    for name, value in scope["headers"]:
+        if name == b"x-profile":
+            requested = value == b"1"
+        elif name == b"x-admin-token":
+            token = value.decode("latin-1")
+    if not requested and b"profile=" in scope["query_string"]:
+        requested = parse_qs(scope["query_string"].decode("latin-1")).get("profile") == ["1"]
+    if not requested:
+        return None
+    return admin_token_valid(token)
+
+
+class ProfilerMiddleware:
+    """
+    Profilerar enskilda anrop på begäran: X-Profile: 1 eller ?profile=1 tillsammans med
+    X-Admin-Token. Svaret får X-Profile-Id och profilen hämtas från /admin/profiles/{id}.
+    Utan flaggan görs bara kontrollen av huvudena; ingen sampling sker och inga trådar startas.
+    """
+
+    def __init__(self, app, interval_ms: float = PROFILE_INTERVAL_MS, store: ProfileStore = profiles):
+        self.app = app
+        self.interval_ms = interval_ms
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        allowed = _profiling_requested(scope)
+        if allowed is None:
+            await self.app(scope, receive, send)
+            return
+        if not allowed:
+            body = json.dumps({"detail": "Profilering kräver en giltig X-Admin-Token."}).encode()
+            await send({"type": "http.response.start", "status": 403, "headers": [
+                (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        profile = Profile(scope["method"], scope["path"], self.interval_ms)
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]}
+            await send(message)
+
+        token = _active.set(profile)
+        sampler = _Sampler(profile)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            sampler.done.set()
+            _active.reset(token)
+            profile.duration_ms = (time.perf_counter() - started) * 1000
+            profile.route = getattr(scope.get("route"), "path", None)
+            await asyncio.to_thread(sampler.join)
+            self.store.add(profile)
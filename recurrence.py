@@ -0,0 +1,293 @@
+# recurrence.py
+import math
+import uuid
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from database import Attendance, CalendarEvent, RecurrenceRule
+from participation import STUDENT, TEACHER, apply_participation_filters, participating, participation_periods, valid_on
+
+WEEKDAYS = {"MO": 0, "TU": 1, "WE": 2, "TH": 3, "FR": 4, "SA": 5, "SU": 6}
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY")
+
+# Förekomsternas ID:n är deterministiska så att klienter kan referera till dem mellan anrop
+OCCURRENCE_NAMESPACE = uuid.UUID("6f6d2a4e-9d1b-4c1e-9a53-1d2f0c7a5b10")
+
+
+def _parse_datetime(value: str) -> datetime:
+    value = value.rstrip("Z")
+    for fmt in ("%Y%m%dT%H%M%S", "%Y%m%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"Ogiltig tidpunkt i regeln: {value}")
+
+def parse_rrule(rule: str) -> dict:
+    """
+    Tolkar en RRULE-liknande regel. Stöder FREQ (DAILY, WEEKLY, MONTHLY), INTERVAL,
+    BYDAY (endast WEEKLY), COUNT och UNTIL.
+    """
+    try:
+        parts = dict(part.split("=", 1) for part in rule.strip().upper().split(";") if part)
+    except ValueError:
+        raise ValueError(f"Ogiltig regel: {rule}")
+
+    unknown = set(parts) - {"FREQ", "INTERVAL", "BYDAY", "COUNT", "UNTIL"}
+    if unknown:
+        raise ValueError(f"Regeln innehåller delar som inte stöds: {', '.join(sorted(unknown))}")
+
+    freq = parts.get("FREQ")
+    if freq not in FREQUENCIES:
+        raise ValueError(f"FREQ måste vara en av {', '.join(FREQUENCIES)}")
+
+    interval = int(parts.get("INTERVAL", "1"))
+    if interval < 1:
+        raise ValueError("INTERVAL måste vara minst 1")
+
+    count = int(parts["COUNT"]) if "COUNT" in parts else None
+    until = _parse_datetime(parts["UNTIL"]) if "UNTIL" in parts else None
+    if count is not None and until is not None:
+        raise ValueError("COUNT och UNTIL kan inte kombineras")
+
+    byday = None
+    if "BYDAY" in parts:
+        if freq != "WEEKLY":
+            raise ValueError("BYDAY stöds endast tillsammans med FREQ=WEEKLY")
+        try:
+            byday = tuple(sorted({WEEKDAYS[day] for day in parts["BYDAY"].split(",")}))
+        except KeyError as e:
+            raise ValueError(f"Okänd veckodag i BYDAY: {e.args[0]}")
+
+    return {"freq": freq, "interval": interval, "count": count, "until": until, "byday": byday}
+
+def parse_exdates(exdates: Optional[str]) -> FrozenSet[datetime]:
+    if not exdates:
+        return frozenset()
+    return frozenset(datetime.fromisoformat(d.strip()) for d in exdates.split(",") if d.strip())
+
+def _iter_starts(parsed: dict, dtstart: datetime, window_start: datetime) -> Iterator[Tuple[int, datetime]]:
+    """
+    Genererar (ordningsnummer, starttid) i stigande ordning. Hoppar direkt fram till fönstret
+    när det går, men ordningsnumret räknas alltid från dtstart så att COUNT blir rätt.
+    """
+    interval = parsed["interval"]
+
+    if parsed["freq"] == "DAILY":
+        step = timedelta(days=interval)
+        k = max(0, math.ceil((window_start - dtstart) / step))
+        while True:
+            yield k, dtstart + k * step
+            k += 1
+
+    elif parsed["freq"] == "WEEKLY":
+        days = parsed["byday"] or (dtstart.weekday(),)
+        week0 = dtstart - timedelta(days=dtstart.weekday())
+        first_week = [week0 + timedelta(days=d) for d in days if week0 + timedelta(days=d) >= dtstart]
+        j = max(0, (window_start - week0).days // (7 * interval))
+        while True:
+            if j == 0:
+                for ordinal, start in enumerate(first_week):
+                    yield ordinal, start
+            else:
+                week = week0 + timedelta(weeks=j * interval)
+                base = len(first_week) + (j - 1) * len(days)
+                for position, d in enumerate(days):
+                    yield base + position, week + timedelta(days=d)
+            j += 1
+
+    else:  # MONTHLY
+        # Månader som saknar dagen (t.ex. den 31:a) hoppas över och räknas inte, enligt RFC 5545
+        ordinal = 0
+        k = 0
+        while True:
+            month_index = dtstart.month - 1 + k * interval
+            year, month = dtstart.year + month_index // 12, month_index % 12 + 1
+            try:
+                start = dtstart.replace(year=year, month=month)
+            except ValueError:
+                k += 1
+                continue
+            yield ordinal, start
+            ordinal += 1
+            k += 1
+
+def occurrences(rrule: str, dtstart: datetime, duration_minutes: int, exdates: FrozenSet[datetime],
+                window_start: datetime, window_end: datetime) -> List[Tuple[datetime, datetime]]:
+    """Returnerar (start, slut) för alla förekomster som startar inom [window_start, window_end]."""
+    parsed = parse_rrule(rrule)
+    duration = timedelta(minutes=duration_minutes)
+    result = []
+    for ordinal, start in _iter_starts(parsed, dtstart, window_start):
+        if parsed["count"] is not None and ordinal >= parsed["count"]:
+            break
+        if parsed["until"] is not None and start > parsed["until"]:
+            break
+        if start > window_end:
+            break
+        if start < window_start or start in exdates:
+            continue
+        result.append((start, start + duration))
+    return result
+
+def last_occurrence(rrule: str, dtstart: datetime) -> Optional[datetime]:
+    """Härleder sista möjliga starttid ur regeln; None om regeln saknar slut."""
+    parsed = parse_rrule(rrule)
+    if parsed["until"] is not None:
+        return parsed["until"]
+    if parsed["count"] is None:
+        return None
+    last = None
+    for ordinal, start in _iter_starts(parsed, dtstart, dtstart):
+        if ordinal >= parsed["count"]:
+            break
+        last = start
+    return last
+
+@lru_cache(maxsize=8192)
+def _expand_week(rrule: str, dtstart: datetime, duration_minutes: int, exdates: FrozenSet[datetime], week_start: datetime):
+    """Expanderar en regel för en hel vecka. Cachas på regelns innehåll, så ändrade regler får nya nycklar."""
+    return tuple(occurrences(rrule, dtstart, duration_minutes, exdates, week_start, week_start + timedelta(weeks=1) - timedelta(microseconds=1)))
+
+def expansion_cache_info():
+    """Träffar och missar i veckocachen ovan."""
+    return _expand_week.cache_info()
+
+def expand_rule(rule: RecurrenceRule, window_start: datetime, window_end: datetime) -> List[Tuple[datetime, datetime]]:
+    """Expanderar en regel veckovis via cachen och klipper resultatet till fönstret."""
+    exdates = parse_exdates(rule.exdates)
+    week = datetime.combine((window_start - timedelta(days=window_start.weekday())).date(), datetime.min.time())
+    result = []
+    while week <= window_end:
+        for start, end in _expand_week(rule.rrule, rule.dtstart, rule.duration_minutes, exdates, week):
+            if window_start <= start <= window_end:
+                result.append((start, end))
+        week += timedelta(weeks=1)
+    return result
+
+def occurrence_id(rule_id: str, start: datetime) -> str:
+    return str(uuid.uuid5(OCCURRENCE_NAMESPACE, f"{rule_id}/{start.isoformat()}"))
+
+def occurrence_activities(db: Session, activity_ids: Iterable[str], since: datetime, until: datetime) -> Dict[str, str]:
+    """
+    Aktiviteten för varje genererad förekomst som startar inom [since, until], nycklad på
+    förekomstens id. Bara fönstret expanderas, så kostnaden beror inte på terminens längd.
+    """
+    activity_ids = list(set(activity_ids))
+    if not activity_ids:
+        return {}
+    result = {}
+    rules = db.query(RecurrenceRule).filter(
+        RecurrenceRule.activity_id.in_(activity_ids),
+        RecurrenceRule.dtstart <= until,
+        or_(RecurrenceRule.until.is_(None), RecurrenceRule.until >= since),
+    )
+    for rule in rules:
+        for start, _ in expand_rule(rule, since, until):
+            result[occurrence_id(rule.id, start)] = rule.activity_id
+    return result
+
+def expand_recurring_events(db: Session, startTime_onOrAfter: datetime, startTime_onOrBefore: datetime,
+                            endTime_onOrAfter: Optional[datetime] = None, endTime_onOrBefore: Optional[datetime] = None,
+                            activity=None, student=None, teacher=None, organisation=None, group=None,
+                            meta_created_before: Optional[datetime] = None, meta_created_after: Optional[datetime] = None,
+                            meta_modified_before: Optional[datetime] = None, meta_modified_after: Optional[datetime] = None,
+                            expand_activity: bool = False, expand_attendance: bool = False,
+                            participant=None, location: Optional[str] = None) -> List[CalendarEvent]:
+    """
+    Genererar kalenderhändelser från aktiviteternas återkommande regler inom tidsfönstret.
+    Händelserna är transienta CalendarEvent-objekt som aldrig läggs till i sessionen.
+    Förekomsterna ärver regelns created/modified, så meta-filtren tillämpas på reglerna.
+    participant matchar personen både som elev och som lärare; location matchar regelns plats.
+    """
+    query = db.query(RecurrenceRule).options(joinedload(RecurrenceRule.activity)).filter(
+        RecurrenceRule.activity_id.is_not(None),
+        RecurrenceRule.dtstart <= startTime_onOrBefore,
+        or_(RecurrenceRule.until.is_(None), RecurrenceRule.until >= startTime_onOrAfter),
+    )
+    if activity:
+        query = query.filter(RecurrenceRule.activity_id == str(activity))
+    query = apply_participation_filters(query, student, teacher, organisation, group, activity_column=RecurrenceRule.activity_id)
+    if participant:
+        query = query.filter(participating([participant], activity_column=RecurrenceRule.activity_id))
+    if location is not None:
+        query = query.filter(RecurrenceRule.location == location)
+    if meta_created_before:
+        query = query.filter(RecurrenceRule.created < meta_created_before)
+    if meta_created_after:
+        query = query.filter(RecurrenceRule.created > meta_created_after)
+    if meta_modified_before:
+        query = query.filter(RecurrenceRule.modified < meta_modified_before)
+    if meta_modified_after:
+        query = query.filter(RecurrenceRule.modified > meta_modified_after)
+
+    rules = query.all()
+    # Förekomsternas dagar finns inte i databasen, så deltagarens giltighetstid prövas här
+    periods = [
+        participation_periods(db, person_id, role, (rule.activity_id for rule in rules))
+        for person_id, role in ((student, STUDENT), (teacher, TEACHER), (participant, None)) if person_id
+    ]
+
+    events = []
+    for rule in rules:
+        name = rule.name or (rule.activity.display_name if rule.activity else None)
+        for start, end in expand_rule(rule, startTime_onOrAfter, startTime_onOrBefore):
+            if endTime_onOrAfter and end < endTime_onOrAfter:
+                continue
+            if endTime_onOrBefore and end > endTime_onOrBefore:
+                continue
+            if not all(valid_on(by_activity[rule.activity_id], start.date()) for by_activity in periods):
+                continue
+            events.append(CalendarEvent(
+                id=occurrence_id(rule.id, start),
+                name=name,
+                start_time=start,
+                end_time=end,
+                location=rule.location,
+                activity_id=rule.activity_id,
+                created=rule.created,
+                modified=rule.modified,
+            ))
+            if expand_activity:
+                # Utan händelser, så att förekomsten inte hamnar i aktivitetens samling och sessionen
+                set_committed_value(events[-1], "activity", rule.activity)
+    if expand_attendance:
+        load_occurrence_attendance(db, events)
+    return events
+
+def load_occurrence_attendance(db: Session, events: List[CalendarEvent]):
+    """Fyller i attendance på genererade förekomster, med personen inläst som för lagrade händelser."""
+    by_event = {event.id: [] for event in events}
+    ids = list(by_event)
+    for i in range(0, len(ids), 1000):
+        records = db.query(Attendance).options(joinedload(Attendance.person)).filter(Attendance.calendar_event_id.in_(ids[i:i + 1000]))
+        for record in records:
+            by_event[record.calendar_event_id].append(record)
+    for event in events:
+        set_committed_value(event, "attendance", by_event[event.id])
+
+def merge_occurrences(events: list, generated: list, sortkey=None, limit: Optional[int] = None) -> list:
+    """Slår ihop lagrade och genererade händelser enligt sortkey och klipper till limit."""
+    sortkey = getattr(sortkey, "value", sortkey) or "StartTimeAsc"
+    attribute = {"Modified": "modified", "Created": "created"}.get(sortkey.replace("Asc", "").replace("Desc", ""), "start_time")
+    merged = sorted(events + generated, key=lambda e: (getattr(e, attribute) or datetime.min, e.id), reverse=sortkey.endswith("Desc"))
+    return merged[:limit] if limit else merged
+
+def schedule_occurrences(db: Session, attendance_schedule_id: str, window_start: datetime, window_end: datetime) -> List[dict]:
+    """Returnerar förekomsterna för ett närvaroschema inom fönstret."""
+    rules = db.query(RecurrenceRule).filter(
+        RecurrenceRule.attendance_schedule_id == attendance_schedule_id,
+        RecurrenceRule.dtstart <= window_end,
+        or_(RecurrenceRule.until.is_(None), RecurrenceRule.until >= window_start),
+    ).all()
+    result = [
+        {"id": occurrence_id(rule.id, start), "rule_id": rule.id, "name": rule.name, "location": rule.location, "start_time": start, "end_time": end}
+        for rule in rules
+        for start, end in expand_rule(rule, window_start, window_end)
+    ]
+    return sorted(result, key=lambda o: o["start_time"])
@@ -1,8 +1,9 @@
 # schemas.py
 from datetime import date, datetime
 from enum import Enum
-from typing import List, Optional, Union
-from pydantic import BaseModel, ConfigDict
+from typing import Any, Dict, List, Optional, Union
+from urllib.parse import urlsplit
+from pydantic import BaseModel, ConfigDict, validator
 
 
 # Helper class for Pydantic
@@ -367,13 +368,13 @@ class SchoolUnitOfferingSchema(BaseModel):
     modified: datetime
 
     class Config:
-        from_attributes = True
+        orm_mode = True
 
 class SchoolUnitOfferingExpanded(SchoolUnitOfferingSchema):
     offered_at: Optional[OrganisationBase] = None
     
     class Config:
-        from_attributes = True
+        orm_mode = True
 
 class SchoolUnitOfferingsArray(BaseModel):
     __root__: List["SchoolUnitOfferingSchema"]
@@ -399,11 +400,61 @@ class CalendarEventBase(BaseModel):
 
 class CalendarEvent(CalendarEventBase):
     class Config:
-        from_attributes = True
+        orm_mode = True
+
+class CalendarEventImport(CalendarEventBase):
+    """En händelse i en importfil; till skillnad från svaren krävs namnet."""
+    name: str
+
+class ActivityGroupImport(BaseModel):
+    """En koppling mellan en aktivitet och en grupp i en importfil."""
+    activity_id: str
+    group_id: str
+
+class ActivityTeacherImport(BaseModel):
+    """En koppling mellan en aktivitet och en lärares tjänstgöring i en importfil."""
+    activity_id: str
+    teacher_duty_id: str
 
 class CalendarEvents(BaseModel):
     __root__: List[CalendarEvent]
 
+class RecurrenceRuleCreate(BaseModel):
+    """En återkommande regel kopplad till en aktivitet eller ett närvaroschema."""
+    activity_id: Optional[str] = None
+    attendance_schedule_id: Optional[str] = None
+    name: Optional[str] = None
+    location: Optional[str] = None
+    rrule: str
+    dtstart: datetime
+    duration_minutes: int
+    exdates: Optional[List[datetime]] = None
+
+class RecurrenceRuleSchema(BaseModel):
+    id: str
+    activity_id: Optional[str] = None
+    attendance_schedule_id: Optional[str] = None
+    name: Optional[str] = None
+    location: Optional[str] = None
+    rrule: str
+    dtstart: datetime
+    until: Optional[datetime] = None
+    duration_minutes: int
+    exdates: Optional[str] = None
+    created: datetime
+    modified: datetime
+
+    class Config:
+        orm_mode = True
+
+class OccurrenceSchema(BaseModel):
+    id: str
+    rule_id: str
+    name: Optional[str] = None
+    location: Optional[str] = None
+    start_time: datetime
+    end_time: datetime
+
 class AttendanceEventBase(BaseModel):
     id: str
     name: str
@@ -415,6 +466,19 @@ class AttendanceBase(BaseModel):
     attendance_event_id: str
     timestamp: datetime
 
+class AttendanceRegistrationEntry(BaseModel):
+    person_id: str
+    attendance_event_id: str
+
+class AttendanceRegistration(BaseModel):
+    """Närvaro för en hel klass vid ett lektionstillfälle."""
+    activity_id: str
+    calendar_event_id: str
+    registrations: List[AttendanceRegistrationEntry]
+
+class AttendanceRegistrationResult(BaseModel):
+    registered: int
+
 class AttendanceSchedule(BaseModel):
     id: str
     name: str
@@ -429,6 +493,49 @@ class AggregatedAttendanceBase(BaseModel):
     person_id: str
     attendance_percentage: float
 
+class AttendanceRollupSchema(BaseModel):
+    scope_type: str
+    scope_id: str
+    period: str
+    present_count: int
+    total_count: int
+    attendance_percentage: Optional[float] = None
+
+class StatisticsSchema(BaseModel):
+    organisation_id: str
+    organisation_name: Optional[str] = None
+    school_type: Optional[str] = None
+    persons: int = 0
+    enrolments: int = 0
+    placements: int = 0
+    duties: int = 0
+    groups: int = 0
+    activities: int = 0
+
+class StudentAttendanceReport(BaseModel):
+    person_id: str
+    lessons: int
+    absences: int
+    absence_rate: float
+    longest_absence_streak: int
+    current_absence_streak: int
+    chronic_absence: bool
+
+class GroupAttendanceReport(BaseModel):
+    group_id: str
+    members: int
+    lessons: int
+    absences: int
+    absence_rate: float
+    by_weekday: Dict[str, float] = {}
+
+class SlotAttendanceReport(BaseModel):
+    weekday: str
+    start: str
+    lessons: int
+    absences: int
+    absence_rate: float
+
 class Resource(BaseModel):
     id: str
     name: str
@@ -442,12 +549,61 @@ class SubscriptionBase(BaseModel):
     resource_type: str
     resource_id: str
     user_id: str
+    target: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+
+class ImportProgressSchema(BaseModel):
+    entity: str
+    read: int
+    invalid: int
+    inserted: int
+    updated: int
+    failed: int
+    seconds: float
+    rows_per_second: float
+    errors: List[Dict[str, Union[int, str]]] = []
+
+class ImportJobSchema(BaseModel):
+    id: str
+    entity: str
+    status: str
+    progress: ImportProgressSchema
+    error: Optional[str] = None
+
+class SlowQuerySchema(BaseModel):
+    id: str
+    sql: str
+    count: int
+    total_ms: float
+    mean_ms: float
+    max_ms: float
+    last_seen: Optional[datetime] = None
+    routes: Dict[str, int] = {}
+    parameters: Optional[Union[Dict[str, str], List[str], str]] = None
+    plan: Optional[List[Dict[str, Any]]] = None
+    explain_error: Optional[str] = None
+
+class WebhookDeadLetterSchema(BaseModel):
+    id: str
+    target: str
+    payload: str
+    attempts: int
+    last_error: Optional[str] = None
+    created: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
 
 class DeletedEntity(BaseModel):
     id: str
     resource_type: str
     deleted_at: datetime
 
+    class Config:
+        orm_mode = True
+
 class Log(BaseModel):
     id: str
     log_message: str
@@ -487,7 +643,7 @@ class ActivitySchema(BaseModel):
     modified: Optional[datetime] = None
 
     class Config:
-        from_attributes = True
+        orm_mode = True
 
 class ActivityExpanded(ActivitySchema):
     groups: Optional[List[GroupBase]] = None
@@ -553,15 +709,32 @@ class GroupReference(BaseModel):
     displayName: Optional[str] = None
 
 # --- Schemas for Request/Response Bodies ---
+def webhook_target(value: Optional[str]) -> Optional[str]:
+    """Servern skickar POST till target, så bara http- och https-URL:er tillåts."""
+    if value is not None:
+        parts = urlsplit(value)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("target måste vara en http- eller https-URL")
+    return value
+
 class SubscriptionCreate(BaseModel):
     resource_type: str
-    resource_id: str
+    resource_id: str # "*" för alla resurser av typen
     user_id: str
+    target: Optional[str] = None
+
+    _target = validator("target", allow_reuse=True)(webhook_target)
+
+    class Config:
+        orm_mode = True
 
 class SubscriptionUpdate(BaseModel):
     resource_type: Optional[str] = None
     resource_id: Optional[str] = None
     user_id: Optional[str] = None
+    target: Optional[str] = None
+
+    _target = validator("target", allow_reuse=True)(webhook_target)
 
 # --- Expanded Schemas ---
 
@@ -659,14 +832,14 @@ class StudyPlanSchema(StudyPlanBase):
     modified: datetime
 
     class Config:
-        from_attributes = True
+        orm_mode = True
 
 class StudyPlanReference(BaseModel):
     id: str
     title: Optional[str] = None
     
     class Config:
-        from_attributes = True
+        orm_mode = True
 
 class StudyPlans(BaseModel):
     __root__: List[StudyPlanSchema]
@@ -675,7 +848,7 @@ class StudyPlanExpanded(StudyPlanSchema):
     student: Optional[PersonSchema] = None
     
     class Config:
-        from_attributes = True
+        orm_mode = True
 
 class StudyPlansExpandedArray(BaseModel):
     __root__: List["StudyPlanExpanded"]
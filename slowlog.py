@@ -0,0 +1,184 @@
+# slowlog.py
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert
+
+from database import Log
+from sqlstats import STATEMENT_OBSERVERS, current_route, statement_shape
+
+logger = logging.getLogger("ss12000.slowlog")
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "200"))
+# Antal satsformer som hålls i minnet; den med minst total tid får lämna plats
+SLOW_QUERY_STORE_SIZE = int(os.environ.get("SLOW_QUERY_STORE_SIZE", "200"))
+SLOW_QUERY_QUEUE_SIZE = int(os.environ.get("SLOW_QUERY_QUEUE_SIZE", "1000"))
+SLOW_QUERY_EXPLAIN = os.environ.get("SLOW_QUERY_EXPLAIN", "1") == "1"
+# Skriv även varje långsam sats till tabellen log
+SLOW_QUERY_LOG_TABLE = os.environ.get("SLOW_QUERY_LOG_TABLE", "0") == "1"
+
+SORTKEYS = {"TotalDesc": "total_ms", "MaxDesc": "max_ms", "CountDesc": "count"}
+
+
+def _parameters(parameters) -> object:
+    """Parametrarna som JSON-vänliga strängar, kortade så att stora IN-listor inte fyller minnet."""
+    if isinstance(parameters, dict):
+        return {key: repr(value)[:100] for key, value in list(parameters.items())[:50]}
+    if isinstance(parameters, (list, tuple)):
+        return [repr(value)[:100] for value in parameters[:50]]
+    return repr(parameters)[:200]
+
+
+class SlowQuery:
+    """Sammanställning för en satsform. Parametrar och plan gäller den långsammaste körningen."""
+
+    def __init__(self, key: str, sql: str):
+        self.key = key
+        self.sql = sql
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_seen: Optional[datetime] = None
+        self.routes: Counter = Counter()
+        self.parameters = None
+        self.plan: Optional[List[dict]] = None
+        self.explain_error: Optional[str] = None
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.key, "sql": self.sql, "count": self.count, "total_ms": self.total_ms,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0, "max_ms": self.max_ms,
+            "last_seen": self.last_seen, "routes": dict(self.routes.most_common(10)),
+            "parameters": self.parameters, "plan": self.plan, "explain_error": self.explain_error,
+        }
+
+
+class SlowQueryRecorder:
+    """
+    Fångar satser som tar längre tid än threshold_ms. Lyssnaren lägger bara satsen i en
+    begränsad kö; en egen tråd kör EXPLAIN på en separat anslutning och sammanställer per
+    satsform, så att det långsamma anropet inte blir ännu långsammare. Är kön full tappas
+    satsen och räknas i dropped.
+    """
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS, size: int = SLOW_QUERY_STORE_SIZE,
+                 explain: bool = SLOW_QUERY_EXPLAIN, log_table: bool = SLOW_QUERY_LOG_TABLE,
+                 queue_size: int = SLOW_QUERY_QUEUE_SIZE):
+        self.threshold_ms = threshold_ms
+        self.size = size
+        self.explain = explain
+        self.log_table = log_table
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._entries: Dict[str, SlowQuery] = {}
+        self._lock = threading.Lock()
+        self._bind = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def observe(self, statement: str, parameters, seconds: float, executemany: bool):
+        # Körs efter varje sats, så den snabba vägen är en jämförelse
+        elapsed_ms = seconds * 1000
+        if elapsed_ms < self.threshold_ms or self._thread is None:
+            return
+        # Recorderns egna EXPLAIN-satser ska inte fångas igen
+        if statement.lstrip()[:7].upper() == "EXPLAIN":
+            return
+        try:
+            self._queue.put_nowait((statement, None if executemany else parameters, elapsed_ms, current_route(), datetime.utcnow()))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self, bind):
+        if self._thread is not None:
+            return
+        self._bind = bind
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="slowlog", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                item = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.record(*item)
+            except Exception:
+                logger.exception("Kunde inte registrera långsam SQL-sats")
+
+    def _explain(self, statement: str, parameters) -> List[dict]:
+        prefix = "EXPLAIN QUERY PLAN " if self._bind.dialect.name == "sqlite" else "EXPLAIN "
+        with self._bind.connect() as conn:
+            rows = conn.exec_driver_sql(prefix + statement, parameters if parameters is not None else ()).mappings().all()
+        return [{key: value if isinstance(value, (int, float)) or value is None else str(value) for key, value in row.items()} for row in rows]
+
+    def record(self, statement: str, parameters, elapsed_ms: float, route: Optional[str], seen: datetime):
+        shape = statement_shape(statement)
+        key = hashlib.sha1(shape.encode()).hexdigest()[:12]
+        with self._lock:
+            entry = self._entries.get(key)
+            slowest = entry is None or elapsed_ms > entry.max_ms
+
+        # Planen hämtas bara för nya former och nya toppnoteringar, utanför låset
+        plan, error = None, None
+        if slowest and self.explain and parameters is not None and shape.split(" ", 1)[0].upper() in ("SELECT", "WITH"):
+            try:
+                plan = self._explain(statement, parameters)
+            except Exception as e:
+                error = str(e)[:500]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.size:
+                    del self._entries[min(self._entries.values(), key=lambda e: e.total_ms).key]
+                entry = self._entries[key] = SlowQuery(key, shape)
+            entry.count += 1
+            entry.total_ms += elapsed_ms
+            entry.last_seen = seen
+            entry.routes[route or "-"] += 1
+            if elapsed_ms > entry.max_ms:
+                entry.max_ms = elapsed_ms
+                entry.parameters = _parameters(parameters)
+                entry.plan, entry.explain_error = plan, error
+
+        logger.warning("Långsam SQL-sats (%.0f ms) i %s: %s", elapsed_ms, route or "bakgrunden", shape[:300])
+        if self.log_table:
+            message = json.dumps({"type": "slowQuery", "ms": round(elapsed_ms, 1), "route": route, "sql": shape,
+                                  "parameters": _parameters(parameters), "plan": plan}, ensure_ascii=False, default=str)
+            with self._bind.begin() as conn:
+                conn.execute(insert(Log.__table__), {"id": str(uuid.uuid4()), "log_message": message, "timestamp": seen,
+                                                     "created": seen, "modified": seen})
+
+    def top(self, limit: int = 20, sortkey: str = "TotalDesc") -> List[dict]:
+        """De värsta satsformerna, som standard efter total tid."""
+        attribute = SORTKEYS[sortkey]
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda e: getattr(e, attribute), reverse=True)[:limit]
+            return [entry.as_dict() for entry in entries]
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+        self.dropped = 0
+
+
+slow_queries = SlowQueryRecorder()
+STATEMENT_OBSERVERS.append(slow_queries.observe)
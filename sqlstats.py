@@ -0,0 +1,169 @@
+# sqlstats.py
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("ss12000.sqlstats")
+
+# Så många identiska satser i samma anrop räknas som ett N+1-mönster
+SQL_REPEAT_THRESHOLD = int(os.environ.get("SQL_REPEAT_THRESHOLD", "10"))
+# Utvecklingsläge: anrop som kör fler satser än budgeten besvaras med 500. Tomt värde stänger av.
+SQL_QUERY_BUDGET = int(os.environ["SQL_QUERY_BUDGET"]) if os.environ.get("SQL_QUERY_BUDGET") else None
+# Budget per rutt, t.ex. "/persons=20,/studyplans/{id}=10". Gäller före SQL_QUERY_BUDGET.
+SQL_QUERY_BUDGETS = os.environ.get("SQL_QUERY_BUDGETS", "")
+
+# Platshållare i alla dialekters format: ?, %s, %(namn)s och :namn
+_PLACEHOLDER = r"(?:\?|%s|%\(\w+\)s|:\w+)"
+_PLACEHOLDER_LIST = re.compile(rf"\(\s*{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})*\s*\)")
+_VALUES_LIST = re.compile(r"(\(\?\))(?:\s*,\s*\(\?\))+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """Satsens form: IN-listor och flerradiga VALUES slås ihop så att bara antalet värden skiljer inte räknas."""
+    shape = _WHITESPACE.sub(" ", statement).strip()
+    shape = _PLACEHOLDER_LIST.sub("(?)", shape)
+    return _VALUES_LIST.sub(r"\1", shape)
+
+
+class RequestStats:
+    """SQL-satser och databastid för ett anrop."""
+
+    __slots__ = ("scope", "statements", "db_seconds", "shapes")
+
+    def __init__(self, scope: Optional[dict] = None):
+        self.scope = scope
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.shapes: Counter = Counter()
+
+    def record(self, statement: str, seconds: float):
+        self.statements += 1
+        self.db_seconds += seconds
+        self.shapes[statement] += 1
+
+    def repeated(self, threshold: int = SQL_REPEAT_THRESHOLD) -> List[Tuple[str, int]]:
+        """Satsformer som körts minst threshold gånger, vanligast först."""
+        counts: Counter = Counter()
+        for statement, count in self.shapes.items():
+            counts[statement_shape(statement)] += count
+        return [(shape, count) for shape, count in counts.most_common() if count >= threshold]
+
+    def server_timing(self, total_seconds: float, repeated: List[Tuple[str, int]] = ()) -> str:
+        timings = [
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.statements} SQL"',
+            f"app;dur={max(total_seconds - self.db_seconds, 0) * 1000:.1f}",
+        ]
+        if repeated:
+            timings.append(f'nplus1;desc="{repeated[0][1]}x"')
+        return ", ".join(timings)
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("sqlstats", default=None)
+
+def current_stats() -> Optional[RequestStats]:
+    """Statistiken för anropet som körs just nu, eller None utanför ett anrop."""
+    return _current.get()
+
+def current_route() -> Optional[str]:
+    """Ruttens mall för anropet som körs just nu, t.ex. "/persons/{id}"."""
+    stats = _current.get()
+    if stats is None or stats.scope is None:
+        return None
+    return getattr(stats.scope.get("route"), "path", stats.scope.get("path"))
+
+
+# Anropas med (statement, parameters, seconds, executemany) efter varje sats, även utanför
+# anrop. Satserna tidsmäts bara här, så metrics och slowlog delar på samma mätning.
+STATEMENT_OBSERVERS: List[Callable[[str, object, float, bool], None]] = []
+
+# Lyssnarna registreras på Engine-klassen så att de gäller motorn som skapas i lifespan
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._sqlstats_started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_sqlstats_started", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    stats = _current.get()
+    if stats is not None:
+        stats.record(statement, seconds)
+    for observer in STATEMENT_OBSERVERS:
+        observer(statement, parameters, seconds, executemany)
+
+
+def parse_budgets(budgets: str) -> Dict[str, int]:
+    parsed = {}
+    for entry in filter(None, (part.strip() for part in budgets.split(","))):
+        route, _, limit = entry.rpartition("=")
+        parsed[route.strip()] = int(limit)
+    return parsed
+
+
+class SQLStatsMiddleware:
+    """
+    ASGI-middleware som samlar SQL-statistik per anrop och skickar den i Server-Timing.
+    Upprepade satser loggas som möjliga N+1-mönster. Med en budget besvaras anrop som kört
+    fler satser än ruttens gräns med 500, så att regressioner syns redan under utveckling.
+
+    Statistiken läses när svarshuvudena skickas; satser som körs medan ett strömmat svar
+    skrivs kommer därför inte med.
+    """
+
+    def __init__(self, app, budget: Optional[int] = SQL_QUERY_BUDGET,
+                 budgets: Optional[Dict[str, int]] = None, repeat_threshold: int = SQL_REPEAT_THRESHOLD):
+        self.app = app
+        self.budget = budget
+        self.budgets = parse_budgets(SQL_QUERY_BUDGETS) if budgets is None else budgets
+        self.repeat_threshold = repeat_threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = _current.set(stats)
+        started = time.perf_counter()
+        replaced = False
+
+        async def send_with_stats(message):
+            nonlocal replaced
+            if replaced:
+                return
+            if message["type"] == "http.response.start":
+                # Rutten är satt i scope först efter routingen
+                route = current_route()
+                repeated = stats.repeated(self.repeat_threshold)
+                for shape, count in repeated:
+                    logger.warning("Möjlig N+1 i %s %s: %d likadana satser: %s", scope["method"], route, count, shape[:300])
+                timing = (b"server-timing", stats.server_timing(time.perf_counter() - started, repeated).encode())
+
+                budget = self.budgets.get(route, self.budget)
+                if budget is not None and stats.statements > budget:
+                    replaced = True
+                    body = json.dumps({"detail": f"{route} körde {stats.statements} SQL-satser, budgeten är {budget}."}).encode()
+                    await send({"type": "http.response.start", "status": 500, "headers": [
+                        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), timing,
+                    ]})
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                message = {**message, "headers": [*message.get("headers", []), timing]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _current.reset(token)
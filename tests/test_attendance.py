@@ -0,0 +1,69 @@
+# tests/test_attendance.py
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import main
+from recurrence import occurrence_id
+
+# Regeln har en förekomst varje dag klockan åtta, från ett år bakåt
+DTSTART = datetime.combine(datetime.utcnow().date() - timedelta(days=365), datetime.min.time()) + timedelta(hours=8)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """En aktivitet med en daglig regel, en elev och en närvarohändelse."""
+    database_url = f"sqlite:///{tmp_path / 'attendance.db'}"
+    monkeypatch.setattr(database, "DATABASE_URL", database_url)
+    engine = database.init_engine(database_url)
+    database.create_schema(engine)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(database.Organisation.__table__.insert(), [{"id": "org-1", "name": "Skolan", "created": now, "modified": now}])
+        conn.execute(database.Activity.__table__.insert(), [
+            {"id": "activity-1", "display_name": "Matematik", "organisation_id": "org-1", "syllabus_id": "s", "created": now, "modified": now},
+        ])
+        conn.execute(database.Person.__table__.insert(), [
+            {"id": "person-1", "display_name": "Anna", "securityMarking": "Ingen", "created": now, "modified": now},
+        ])
+        conn.execute(database.AttendanceEvent.__table__.insert(), [{"id": "present", "name": "Närvarande", "created": now, "modified": now}])
+        conn.execute(database.RecurrenceRule.__table__.insert(), [
+            {"id": "rule-1", "activity_id": "activity-1", "rrule": "FREQ=DAILY", "dtstart": DTSTART, "duration_minutes": 60,
+             "created": now, "modified": now},
+        ])
+    database.dispose_engine()
+    with TestClient(main.app) as client:
+        yield client
+
+
+def _registration(calendar_event_id, person_id="person-1"):
+    return {"activity_id": "activity-1", "calendar_event_id": calendar_event_id,
+            "registrations": [{"person_id": person_id, "attendance_event_id": "present"}]}
+
+
+def test_registers_attendance_for_a_recent_generated_occurrence(client):
+    yesterday = DTSTART + timedelta(days=364)
+    response = client.post("/attendance/bulk", json=[_registration(occurrence_id("rule-1", yesterday))])
+    assert response.status_code == 201
+    assert response.json() == {"registered": 1}
+    with database.SessionLocal() as db:
+        assert db.execute(select(database.Attendance.calendar_event_id)).scalars().all() == [occurrence_id("rule-1", yesterday)]
+
+
+def test_all_errors_are_returned_together_as_422(client):
+    response = client.post("/attendance/bulk", json=[
+        _registration("no-such-lesson"),
+        # Förekomsten finns men ligger utanför fönstret som expanderas
+        _registration(occurrence_id("rule-1", DTSTART)),
+        _registration(occurrence_id("rule-1", DTSTART + timedelta(days=364)), person_id="no-such-person"),
+    ])
+    assert response.status_code == 422
+    locations = sorted(error["loc"] for error in response.json()["detail"])
+    assert locations == [[0, "calendar_event_id"], [1, "calendar_event_id"], [2, "registrations", 0, "person_id"]]
@@ -0,0 +1,56 @@
+# tests/test_benchmark.py
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import main
+
+
+def _scenario(p50, errors=0, status=None):
+    return {
+        "status": status or {"200": 10}, "errors": errors, "throughput_rps": 100.0, "sql_statements": 2.0,
+        "latency_ms": {"p50": p50, "p95": p50 * 2} if not errors else None,
+    }
+
+
+def test_failing_scenarios_are_regressions_without_latency_comparison():
+    baseline = {"scenarios": {"a": _scenario(1.0), "b": _scenario(None, errors=10, status={"500": 10}),
+                              "c": _scenario(1.0)}}
+    current = {"scenarios": {"a": _scenario(10.0), "b": _scenario(None, errors=10, status={"500": 10}),
+                             "c": _scenario(None, errors=10, status={"404": 10})}}
+
+    regressions = benchmark.compare_results(baseline, current)
+
+    assert regressions == ["a: p50 1.0 -> 10.0 ms", "a: p95 2.0 -> 20.0 ms",
+                           "b: svarar med status 500", "c: svarar med status 404"]
+
+
+def test_measure_excludes_error_responses_from_latency(monkeypatch):
+    statuses = iter([200, 500, 200, 500, 200, 200])
+
+    async def request(app, method, path, query, body):
+        return next(statuses, 200), 10, 1
+    monkeypatch.setattr(benchmark, "asgi_request", request)
+
+    result = asyncio.run(benchmark.measure(None, benchmark.Scenario("x", "GET", "/x", [], None), 4, 0, 1))
+
+    assert result["status"] == {"200": 2, "500": 2}
+    assert result["errors"] == 2
+    assert result["latency_ms"] is not None
+
+
+def test_admin_routes_are_skipped_without_token(monkeypatch):
+    monkeypatch.setattr(benchmark, "ADMIN_TOKEN", None)
+    window = datetime(2025, 8, 18)
+    fixtures = {"tables": {}, "school": None, "student": None, "teacher": None, "group": None, "activity": None,
+                "window_start": window, "window_end": window + timedelta(days=7)}
+    scenarios, skipped = benchmark.build_scenarios(main.app, fixtures)
+
+    assert not [s for s in scenarios if s.path.startswith("/admin/")]
+    assert skipped["GET /admin/slowQueries"] == "kräver ADMIN_TOKEN"
+    # Stora sidor följer rutternas egen gräns för limit
+    assert ("limit", "100") in next(s.query for s in scenarios if s.name == "GET /studyplans [stor sida]")
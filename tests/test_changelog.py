@@ -0,0 +1,126 @@
+# tests/test_changelog.py
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert, select, update
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from changelog import ChangeLogReader, ChangeTailer
+from database import ChangeLog, ChangeLogCursor
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = database.init_engine(f"sqlite:///{tmp_path / 'changelog.db'}")
+    database.create_schema(engine)
+    yield engine
+    database.dispose_engine()
+
+
+def _write(engine, *seqs):
+    """Skriver ändringar med givna seq, som om transaktionerna committats i den ordningen."""
+    with engine.begin() as conn:
+        conn.execute(insert(ChangeLog.__table__), [
+            {"seq": seq, "resource_type": "Person", "resource_id": f"p-{seq}", "operation": "update", "created": datetime.utcnow()}
+            for seq in seqs
+        ])
+
+def _poll(reader):
+    db = database.SessionLocal()
+    try:
+        return [change.seq for change in reader.poll(db)]
+    finally:
+        db.close()
+
+def _stored(engine, consumer):
+    with engine.connect() as conn:
+        return conn.execute(select(ChangeLogCursor.__table__.c.seq).where(ChangeLogCursor.__table__.c.consumer == consumer)).scalar()
+
+
+def test_reader_reads_past_gaps_and_delivers_late_commits(engine):
+    _write(engine, 1, 2, 5)
+    reader = ChangeLogReader(start=0, gap_timeout=60)
+
+    # Ingen väntan vid luckan 3-4
+    assert _poll(reader) == [1, 2, 5]
+    _write(engine, 4)
+    assert _poll(reader) == [4]
+    _write(engine, 3, 6)
+    assert _poll(reader) == [3, 6]
+    assert reader.position == 6
+    assert _poll(reader) == []
+
+
+def test_gap_is_read_once_more_after_timeout_then_dropped(engine, caplog):
+    _write(engine, 1, 3)
+    reader = ChangeLogReader(start=0, gap_timeout=0)
+
+    assert _poll(reader) == [1, 3]
+    assert reader.position == 1
+    with caplog.at_level(logging.WARNING, logger="ss12000.changelog"):
+        assert _poll(reader) == []
+    assert "Hoppar över seq 2-2" in caplog.text
+    assert reader.position == 3
+    # En rad som committas efter att luckan släppts levereras inte
+    _write(engine, 2)
+    assert _poll(reader) == []
+
+
+def test_saved_cursor_stops_before_open_gap(engine):
+    _write(engine, 1, 2, 4)
+    tailer = ChangeTailer("test", lambda changes: None, lease_seconds=30)
+    tailer.reader.cursor, tailer.reader.gap_timeout = 0, 60
+
+    assert tailer.poll_once() == 3
+    assert _stored(engine, "test") == 2
+    _write(engine, 3)
+    assert tailer.poll_once() == 1
+    assert _stored(engine, "test") == 4
+
+
+def test_failed_handler_keeps_gaps_for_the_next_poll(engine):
+    _write(engine, 1, 3)
+    failures, seen = [], []
+
+    def handler(changes):
+        if failures:
+            raise failures.pop()
+        seen.extend(change.seq for change in changes)
+    tailer = ChangeTailer(None, handler)
+    tailer.reader.cursor, tailer.reader.gap_timeout = 0, 60
+
+    assert tailer.poll_once() == 2
+    _write(engine, 2)
+    failures.append(RuntimeError("nere"))
+    with pytest.raises(RuntimeError):
+        tailer.poll_once()
+    assert tailer.poll_once() == 1
+    assert seen == [1, 3, 2]
+
+
+def test_lease_lets_one_process_read_and_hands_over_on_expiry(engine):
+    _write(engine, 1, 2)
+    first = ChangeTailer("test", lambda changes: None, lease_seconds=30)
+    second = ChangeTailer("test", lambda changes: None, lease_seconds=30)
+    first.reader.cursor = 0
+
+    assert first.poll_once() == 2 and first.leader
+    _write(engine, 3)
+    assert second.poll_once() == 0 and not second.leader
+
+    # Hyran går ut; den andra processen tar över från den sparade markören
+    with engine.begin() as conn:
+        conn.execute(update(ChangeLogCursor.__table__).values(lease_until=datetime.utcnow() - timedelta(seconds=1)))
+    assert second.poll_once() == 1 and second.leader
+    assert first.poll_once() == 0 and not first.leader
+
+    # När den andra lämnar ifrån sig läsningen tar den första över direkt
+    second._release_lease()
+    _write(engine, 4)
+    assert first.poll_once() == 1 and first.leader
+    assert _stored(engine, "test") == 4
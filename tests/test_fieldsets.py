@@ -0,0 +1,146 @@
+# tests/test_fieldsets.py
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """En SQLite-databas med två personer; lifespan skapar motorn mot den."""
+    database_url = f"sqlite:///{tmp_path / 'fields.db'}"
+    monkeypatch.setattr(database, "DATABASE_URL", database_url)
+    engine = database.init_engine(database_url)
+    database.create_schema(engine)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(database.Person.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "display_name": "Anna Andersson", "given_name": "Anna", "family_name": "Andersson",
+             "email": "anna@example.com", "civic_no": "200501011234", "securityMarking": "Ingen", "created": now, "modified": now},
+            {"id": str(uuid.uuid4()), "display_name": "Bo Berg", "given_name": "Bo", "family_name": "Berg",
+             "email": "bo@example.com", "civic_no": "200502021234", "securityMarking": "Ingen", "created": now, "modified": now},
+        ])
+    database.dispose_engine()
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_persons_fields_returns_only_requested_keys(client):
+    response = client.get("/persons", params={"fields": "id,givenName,email"})
+    assert response.status_code == 200
+    rows = response.json()
+    assert len(rows) == 2
+    assert all(set(row) == {"id", "given_name", "email"} for row in rows)
+    assert {row["email"] for row in rows} == {"anna@example.com", "bo@example.com"}
+
+
+def test_persons_lookup_fields(client):
+    response = client.post("/persons/lookup", params={"fields": "displayName"},
+                           json={"ids": ["200501011234"]})
+    assert response.status_code == 200
+    assert response.json() == [{"display_name": "Anna Andersson"}]
+
+
+def test_persons_fields_rejects_unknown_field(client):
+    response = client.get("/persons", params={"fields": "id,shoeSize"})
+    assert response.status_code == 400
+    assert "shoeSize" in response.json()["detail"]
+
+
+def test_persons_fields_cannot_be_combined_with_expand(client):
+    response = client.get("/persons", params={"fields": "id", "expand": "duties"})
+    assert response.status_code == 400
+
+
+@pytest.fixture
+def school(tmp_path, monkeypatch):
+    """En skola med en aktivitet, en lektion, en närvaropost, en studieplan och ett skolenhetserbjudande."""
+    database_url = f"sqlite:///{tmp_path / 'school.db'}"
+    monkeypatch.setattr(database, "DATABASE_URL", database_url)
+    engine = database.init_engine(database_url)
+    database.create_schema(engine)
+    now = datetime.utcnow()
+    meta = {"created": now, "modified": now}
+    with engine.begin() as conn:
+        conn.execute(database.Organisation.__table__.insert(), [{"id": "org-1", "name": "Skolan", **meta}])
+        conn.execute(database.Person.__table__.insert(), [{"id": "anna", "display_name": "Anna", "securityMarking": "Ingen", **meta}])
+        conn.execute(database.Activity.__table__.insert(), [
+            {"id": "math", "display_name": "Matematik", "organisation_id": "org-1", "syllabus_id": "s", **meta}])
+        conn.execute(database.CalendarEvent.__table__.insert(), [
+            {"id": "lesson-1", "name": "Matematik", "start_time": now, "end_time": now + timedelta(hours=1),
+             "location": "Sal 1", "activity_id": "math", **meta}])
+        conn.execute(database.AttendanceEvent.__table__.insert(), [{"id": "present", "name": "Närvarande", **meta}])
+        conn.execute(database.Attendance.__table__.insert(), [
+            {"id": "att-1", "person_id": "anna", "activity_id": "math", "attendance_event_id": "present",
+             "calendar_event_id": "lesson-1", **meta}])
+        conn.execute(database.StudyPlan.__table__.insert(), [{"id": "plan-1", "title": "Studieplan", "student_id": "anna", **meta}])
+        conn.execute(database.SchoolUnitOffering.__table__.insert(), [
+            {"id": "offer-1", "name": "Naturvetenskap", "code": "NA", "offered_at_id": "org-1", **meta}])
+    database.dispose_engine()
+    with TestClient(main.app) as client:
+        yield client
+
+
+WINDOW = {"startTime.onOrAfter": (datetime.utcnow() - timedelta(days=1)).isoformat(),
+          "startTime.onOrBefore": (datetime.utcnow() + timedelta(days=1)).isoformat()}
+
+
+@pytest.mark.parametrize("path, params, expected", [
+    ("/activities", {"fields": "id,displayName"}, [{"id": "math", "display_name": "Matematik"}]),
+    ("/calendarEvents", dict(WINDOW, fields="id,location"), [{"id": "lesson-1", "location": "Sal 1"}]),
+    ("/attendance", {"fields": "personId,attendanceEventId"}, [{"person_id": "anna", "attendance_event_id": "present"}]),
+    ("/studyplans", {"fields": "title,studentId"}, [{"title": "Studieplan", "student_id": "anna"}]),
+    ("/schoolunitofferings", {"fields": "code"}, [{"code": "NA"}]),
+])
+def test_list_fields(school, path, params, expected):
+    response = school.get(path, params=params)
+    assert response.status_code == 200, response.text
+    assert response.json() == expected
+
+
+@pytest.mark.parametrize("path, body, fields, expected", [
+    ("/activities/lookup", {"ids": ["math"]}, "displayName", [{"display_name": "Matematik"}]),
+    ("/calendarEvents/lookup", {"calendarEventIds": ["lesson-1"]}, "id,name", [{"id": "lesson-1", "name": "Matematik"}]),
+    ("/attendance/lookup", {"ids": ["att-1"]}, "id,activityId", [{"id": "att-1", "activity_id": "math"}]),
+    ("/schoolunitofferings/lookup", {"ids": ["offer-1"]}, "name", [{"name": "Naturvetenskap"}]),
+])
+def test_lookup_fields(school, path, body, fields, expected):
+    response = school.post(path, params={"fields": fields}, json=body)
+    assert response.status_code == 200, response.text
+    assert response.json() == expected
+
+
+def test_calendar_events_fields_include_generated_occurrences(school):
+    rule = {"activity_id": "math", "rrule": "FREQ=DAILY;COUNT=1", "dtstart": datetime.utcnow().isoformat(), "duration_minutes": 45}
+    assert school.post("/recurrenceRules", json=rule).status_code == 200
+
+    response = school.get("/calendarEvents", params=dict(WINDOW, fields="startTime,activityId"))
+    assert response.status_code == 200, response.text
+    rows = response.json()
+    assert len(rows) == 2
+    assert all(set(row) == {"startTime", "activity_id"} for row in rows)
+
+
+@pytest.mark.parametrize("path, params", [
+    ("/activities", {"fields": "id", "expand": "groups"}),
+    ("/calendarEvents", dict(WINDOW, fields="id", expand="activity")),
+    ("/studyplans", {"fields": "id", "expandReferenceNames": "true"}),
+    ("/attendance", {"fields": "person"}),
+])
+def test_fields_rejected(school, path, params):
+    assert school.get(path, params=params).status_code == 400
+
+
+@pytest.mark.parametrize("path", ["/activities", "/studyplans", "/schoolunitofferings"])
+def test_lists_without_fields(school, path):
+    response = school.get(path)
+    assert response.status_code == 200, response.text
+    assert len(response.json()) == 1
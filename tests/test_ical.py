@@ -0,0 +1,85 @@
+# tests/test_ical.py
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import ical
+import main
+from participation import rebuild_participation
+
+DTSTART = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(hours=8)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Anna är elev i Matematik (Sal 1) och lärare i Svenska (Sal 2); båda har en daglig regel."""
+    database_url = f"sqlite:///{tmp_path / 'ical.db'}"
+    monkeypatch.setattr(database, "DATABASE_URL", database_url)
+    engine = database.init_engine(database_url)
+    database.create_schema(engine)
+    now = datetime.utcnow()
+    meta = {"created": now, "modified": now}
+    with engine.begin() as conn:
+        conn.execute(database.Organisation.__table__.insert(), [{"id": "org-1", "name": "Skolan", **meta}])
+        conn.execute(database.Person.__table__.insert(), [{"id": "anna", "display_name": "Anna", "securityMarking": "Ingen", **meta}])
+        conn.execute(database.Group.__table__.insert(), [{"id": "7a", "display_name": "7A", "group_type": "ClassGroup", **meta}])
+        conn.execute(database.GroupMembership.__table__.insert(), [{"id": "m-1", "person_id": "anna", "group_id": "7a", **meta}])
+        conn.execute(database.Duty.__table__.insert(), [{"id": "d-1", "person_id": "anna", "organisation_id": "org-1", "duty_role": "Lärare", **meta}])
+        conn.execute(database.Room.__table__.insert(), [{"id": "room-1", "name": "Sal 1", **meta}])
+        conn.execute(database.Activity.__table__.insert(), [
+            {"id": "math", "display_name": "Matematik", "organisation_id": "org-1", "syllabus_id": "s", **meta},
+            {"id": "swedish", "display_name": "Svenska", "organisation_id": "org-1", "syllabus_id": "s", **meta},
+        ])
+        conn.execute(database.activity_group_association.insert(), [{"activity_id": "math", "group_id": "7a"}])
+        conn.execute(database.activity_teacher_association.insert(), [{"activity_id": "swedish", "teacher_duty_id": "d-1"}])
+        conn.execute(database.RecurrenceRule.__table__.insert(), [
+            {"id": "rule-math", "activity_id": "math", "location": "Sal 1", "rrule": "FREQ=DAILY;COUNT=3", "dtstart": DTSTART,
+             "duration_minutes": 60, **meta},
+            {"id": "rule-swedish", "activity_id": "swedish", "location": "Sal 2", "rrule": "FREQ=DAILY;COUNT=2",
+             "dtstart": DTSTART + timedelta(hours=2), "duration_minutes": 60, **meta},
+        ])
+        rebuild_participation(conn)
+    database.dispose_engine()
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def expansions(monkeypatch):
+    calls = []
+    expand = ical.expand_recurring_events
+
+    def counting(*args, **kwargs):
+        calls.append(kwargs)
+        return expand(*args, **kwargs)
+    monkeypatch.setattr(ical, "expand_recurring_events", counting)
+    return calls
+
+
+def _events(response):
+    return [line for line in response.text.splitlines() if line.startswith(("SUMMARY:", "LOCATION:"))]
+
+
+def test_person_feed_expands_student_and_teacher_rules_in_one_query(client, expansions):
+    response = client.get("/persons/anna/calendar.ics")
+    assert response.status_code == 200
+    summaries = [line for line in _events(response) if line.startswith("SUMMARY:")]
+    assert sorted(summaries) == ["SUMMARY:Matematik"] * 3 + ["SUMMARY:Svenska"] * 2
+    assert expansions == [{"participant": "anna"}]
+
+
+def test_room_feed_only_expands_rules_in_the_room(client, expansions):
+    response = client.get("/rooms/room-1/calendar.ics")
+    assert response.status_code == 200
+    assert _events(response) == ["SUMMARY:Matematik", "LOCATION:Sal 1"] * 3
+    assert expansions == [{"location": "Sal 1"}]
+
+    # En omvalidering med samma ETag ger 304
+    response = client.get("/rooms/room-1/calendar.ics", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
@@ -0,0 +1,81 @@
+# tests/test_importer.py
+import csv
+import json
+import os
+import sys
+
+import pytest
+from sqlalchemy import func, select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from importer import ENTITIES, import_files
+
+# En post per typ; referenserna pekar på posterna före
+RECORDS = {
+    "organisations": {"id": "org-1", "name": "Skolan", "type": "Skola", "school_types": ["Grundskola", "Gymnasium"]},
+    "persons": {"id": "person-1", "display_name": "Anna Andersson", "given_name": "Anna", "securityMarking": "Ingen"},
+    "duties": {"id": "duty-1", "person_id": "person-1", "organisation_id": "org-1", "duty_role": "Lärare"},
+    "groups": {"id": "group-1", "display_name": "7A", "group_type": "ClassGroup", "organisation_id": "org-1"},
+    "groupMemberships": {"id": "membership-1", "person_id": "person-1", "group_id": "group-1"},
+    "activities": {"id": "activity-1", "display_name": "Matematik 7A", "organisation_id": "org-1", "syllabus_id": "syllabus-1"},
+    "activityGroups": {"activity_id": "activity-1", "group_id": "group-1"},
+    "activityTeachers": {"activity_id": "activity-1", "teacher_duty_id": "duty-1"},
+    "calendarEvents": {"id": "event-1", "name": "Lektion", "startTime": "2025-09-01T08:00:00",
+                       "endTime": "2025-09-01T09:00:00", "activity_id": "activity-1"},
+}
+
+
+def _write_json(path, record):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([record], f)
+
+def _write_csv(path, record):
+    row = {key: ",".join(value) if isinstance(value, list) else value for key, value in record.items()}
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(row))
+        writer.writeheader()
+        writer.writerow(row)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = database.init_engine(f"sqlite:///{tmp_path / 'import.db'}")
+    database.create_schema(engine)
+    yield engine
+    database.dispose_engine()
+
+
+@pytest.mark.parametrize("extension, write", [(".json", _write_json), (".csv", _write_csv)])
+def test_import_files_writes_every_entity(engine, tmp_path, extension, write):
+    files = {}
+    for entity, record in RECORDS.items():
+        files[entity] = str(tmp_path / f"{entity}{extension}")
+        write(files[entity], record)
+
+    results = import_files(engine, files, workers=1)
+
+    assert [(p.entity, p.inserted, p.invalid, p.failed) for p in results] == [(entity, 1, 0, 0) for entity in ENTITIES]
+    with engine.connect() as conn:
+        for spec in ENTITIES.values():
+            assert conn.execute(select(func.count()).select_from(spec.table)).scalar() == 1, spec.name
+        school_types = conn.execute(select(database.Organisation.school_types)).scalar()
+        assert school_types == "Grundskola,Gymnasium"
+        # Deltagarindexet byggs om efter importen; personen är både elev och lärare
+        participants = conn.execute(select(database.ActivityParticipant.person_id, database.ActivityParticipant.role)).all()
+        assert sorted(role for person_id, role in participants if person_id == "person-1") == ["student", "teacher"]
+
+
+def test_import_updates_only_supplied_columns(engine, tmp_path):
+    path = tmp_path / "persons.jsonl"
+    path.write_text(json.dumps(RECORDS["persons"]) + "\n", encoding="utf-8")
+    import_files(engine, {"persons": str(path)}, workers=1)
+
+    path.write_text(json.dumps({"id": "person-1", "display_name": "Anna Berg", "securityMarking": "Ingen"}) + "\n", encoding="utf-8")
+    [progress] = import_files(engine, {"persons": str(path)}, workers=1)
+
+    assert (progress.inserted, progress.updated) == (0, 1)
+    with engine.connect() as conn:
+        person = conn.execute(select(database.Person.display_name, database.Person.given_name)).one()
+    assert tuple(person) == ("Anna Berg", "Anna")
@@ -0,0 +1,63 @@
+# tests/test_participation.py
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from database import ActivityParticipant
+from participation import ensure_participation
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    """Som efter att database.sql lästs in: aktiviteten har en grupp och en lärare men indexet är tomt."""
+    database_url = f"sqlite:///{tmp_path / 'participation.db'}"
+    engine = database.init_engine(database_url)
+    database.create_schema(engine)
+    now = datetime.utcnow()
+    meta = {"created": now, "modified": now}
+    with engine.begin() as conn:
+        conn.execute(database.Organisation.__table__.insert(), [{"id": "org-1", "name": "Skolan", **meta}])
+        conn.execute(database.Person.__table__.insert(), [
+            {"id": "anna", "display_name": "Anna", "securityMarking": "Ingen", **meta},
+            {"id": "bo", "display_name": "Bo", "securityMarking": "Ingen", **meta},
+        ])
+        conn.execute(database.Group.__table__.insert(), [{"id": "7a", "display_name": "7A", "group_type": "ClassGroup", **meta}])
+        conn.execute(database.GroupMembership.__table__.insert(), [{"id": "m-1", "person_id": "anna", "group_id": "7a", **meta}])
+        conn.execute(database.Duty.__table__.insert(), [{"id": "d-1", "person_id": "bo", "organisation_id": "org-1", "duty_role": "Lärare", **meta}])
+        conn.execute(database.Activity.__table__.insert(), [{"id": "math", "display_name": "Matematik", "organisation_id": "org-1", "syllabus_id": "s", **meta}])
+        conn.execute(database.activity_group_association.insert(), [{"activity_id": "math", "group_id": "7a"}])
+        conn.execute(database.activity_teacher_association.insert(), [{"activity_id": "math", "teacher_duty_id": "d-1"}])
+    yield database_url
+    database.dispose_engine()
+
+
+def _participants(engine):
+    with engine.connect() as conn:
+        return sorted(conn.execute(select(ActivityParticipant.person_id, ActivityParticipant.role)).all())
+
+
+def test_ensure_participation_builds_an_empty_index_once(database_url):
+    engine = database.engine
+
+    assert ensure_participation(engine) == 2
+    assert _participants(engine) == [("anna", "student"), ("bo", "teacher")]
+    assert ensure_participation(engine) == 0
+
+
+def test_rebuild_from_the_command_line(database_url):
+    result = subprocess.run([sys.executable, "participation.py", "--rebuild"], cwd=ROOT, capture_output=True, text=True,
+                            env=dict(os.environ, DATABASE_URL=database_url), timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "Byggde om 2 deltagarrader"
+    with database.engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(ActivityParticipant.__table__)).scalar() == 2
@@ -0,0 +1,57 @@
+# tests/test_recurrence.py
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """En SQLite-databas med en aktivitet som reglerna kan kopplas till."""
+    database_url = f"sqlite:///{tmp_path / 'recurrence.db'}"
+    monkeypatch.setattr(database, "DATABASE_URL", database_url)
+    engine = database.init_engine(database_url)
+    database.create_schema(engine)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(database.Organisation.__table__.insert(), [{"id": "org-1", "name": "Skolan", "created": now, "modified": now}])
+        conn.execute(database.Activity.__table__.insert(), [
+            {"id": "activity-1", "display_name": "Matematik", "organisation_id": "org-1", "syllabus_id": "syllabus-1",
+             "created": now, "modified": now},
+        ])
+    database.dispose_engine()
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_create_recurrence_rule_and_expand_occurrences(client):
+    response = client.post("/recurrenceRules", json={
+        "activity_id": "activity-1", "name": "Matematik", "location": "Sal 1", "rrule": "FREQ=WEEKLY;COUNT=3",
+        "dtstart": "2025-09-01T08:00:00", "duration_minutes": 60, "exdates": ["2025-09-08T08:00:00"],
+    })
+    assert response.status_code == 200
+    rule = response.json()
+    assert rule["activity_id"] == "activity-1"
+    assert rule["until"] == "2025-09-15T08:00:00"
+    assert rule["exdates"] == "2025-09-08T08:00:00"
+
+    response = client.get("/calendarEvents", params={"startTime.onOrAfter": "2025-09-01T00:00:00",
+                                                     "startTime.onOrBefore": "2025-09-30T00:00:00"})
+    assert response.status_code == 200
+    assert sorted(event["startTime"] for event in response.json()) == ["2025-09-01T08:00:00", "2025-09-15T08:00:00"]
+
+
+@pytest.mark.parametrize("body", [
+    {"rrule": "FREQ=WEEKLY;COUNT=3", "dtstart": "2025-09-01T08:00:00", "duration_minutes": 60},
+    {"activity_id": "activity-1", "rrule": "FREQ=WEEKLY;COUNT=3", "dtstart": "2025-09-01T08:00:00", "duration_minutes": 0},
+    {"activity_id": "activity-1", "rrule": "FREQ=SOMETIMES", "dtstart": "2025-09-01T08:00:00", "duration_minutes": 60},
+])
+def test_create_recurrence_rule_rejects_invalid_rules(client, body):
+    assert client.post("/recurrenceRules", json=body).status_code == 400
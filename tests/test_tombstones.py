@@ -0,0 +1,72 @@
+# tests/test_tombstones.py
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """En SQLite-databas med tre personer som testerna kan ta bort."""
+    database_url = f"sqlite:///{tmp_path / 'tombstones.db'}"
+    monkeypatch.setattr(database, "DATABASE_URL", database_url)
+    engine = database.init_engine(database_url)
+    database.create_schema(engine)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(database.Person.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "display_name": f"Person {n}", "securityMarking": "Ingen", "created": now, "modified": now}
+            for n in range(3)
+        ])
+    database.dispose_engine()
+    with TestClient(main.app) as client:
+        yield client
+
+
+def _delete_persons():
+    """Tar bort personerna en i taget genom sessionen, som skriver tombstones."""
+    db = database.SessionLocal()
+    try:
+        ids = []
+        for person in db.query(database.Person).order_by(database.Person.id).all():
+            db.delete(person)
+            db.commit()
+            ids.append(person.id)
+        return ids
+    finally:
+        db.close()
+
+
+def test_deleted_entities_pages_with_created_after_and_page_token(client):
+    started = datetime.utcnow() - timedelta(seconds=1)
+    ids = _delete_persons()
+
+    first = client.get("/deletedEntities", params={"meta.created.after": started.isoformat(), "limit": 2})
+    assert first.status_code == 200
+    assert [row["resource_type"] for row in first.json()] == ["Person", "Person"]
+    token = first.headers["X-Page-Token"]
+
+    second = client.get("/deletedEntities", params={"pageToken": token, "limit": 2})
+    assert second.status_code == 200
+    assert "X-Page-Token" not in second.headers
+    assert sorted(row["id"] for row in first.json() + second.json()) == sorted(ids)
+
+
+def test_deleted_entities_sortkey_and_lookup(client):
+    ids = _delete_persons()
+
+    response = client.get("/deletedEntities", params={"sortkey": "CreatedDesc"})
+    assert response.status_code == 200
+    assert sorted(row["id"] for row in response.json()) == sorted(ids)
+
+    response = client.post("/deletedEntities/lookup", json={"ids": ids[:1]})
+    assert response.status_code == 200
+    assert [row["id"] for row in response.json()] == ids[:1]
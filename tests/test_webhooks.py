@@ -0,0 +1,108 @@
+# tests/test_webhooks.py
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import main
+from webhooks import dispatcher
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """En tom SQLite-databas; leveranserna hamnar i delivered i stället för att skickas."""
+    database_url = f"sqlite:///{tmp_path / 'webhooks.db'}"
+    monkeypatch.setattr(database, "DATABASE_URL", database_url)
+    database.create_schema(database.init_engine(database_url))
+    database.dispose_engine()
+    delivered = []
+    monkeypatch.setattr(dispatcher, "transport", lambda url, body, headers: delivered.append((url, json.loads(body))) or 204)
+    with TestClient(main.app) as client:
+        client.delivered = delivered
+        yield client
+
+
+def _wait_for(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return predicate()
+
+
+@pytest.mark.parametrize("target", ["file:///etc/passwd", "ftp://example.com/", "gopher://example.com", "http://"])
+def test_subscription_target_must_be_http(client, target):
+    response = client.post("/subscriptions", json={"resource_type": "Person", "resource_id": "*", "user_id": "u", "target": target})
+    assert response.status_code == 422
+
+
+def test_subscription_with_http_target_can_be_created_and_updated(client):
+    response = client.post("/subscriptions", json={"resource_type": "Person", "resource_id": "*", "user_id": "u",
+                                                   "target": "https://example.com/hook"})
+    assert response.status_code == 200
+    [subscription] = client.get("/subscriptions").json()
+    assert subscription["target"] == "https://example.com/hook"
+
+    response = client.patch(f"/subscriptions/{subscription['id']}", json={"target": "file:///etc/passwd"})
+    assert response.status_code == 422
+
+
+def test_dead_letter_is_listed_and_redelivered_through_the_outbox(client):
+    dead_letter_id = str(uuid.uuid4())
+    change = {"resource_type": "Person", "id": "person-1", "operation": "updated", "subscription_id": "s"}
+    db = database.SessionLocal()
+    try:
+        db.add(database.WebhookDeadLetter(id=dead_letter_id, target="http://example.com/hook", attempts=6,
+                                          payload=json.dumps({"changes": [change]}), last_error="HTTP 500",
+                                          created=datetime.utcnow()))
+        db.commit()
+    finally:
+        db.close()
+
+    response = client.get("/subscriptions/deadLetters")
+    assert response.status_code == 200
+    assert [row["id"] for row in response.json()] == [dead_letter_id]
+
+    response = client.post(f"/subscriptions/deadLetters/{dead_letter_id}/redeliver")
+    assert response.status_code == 200
+    assert client.get("/subscriptions/deadLetters").json() == []
+    assert _wait_for(lambda: client.delivered)
+    assert client.delivered == [("http://example.com/hook", {"changes": [change]})]
+
+    def outbox_empty():
+        db = database.SessionLocal()
+        try:
+            return db.query(database.WebhookOutbox).count() == 0
+        finally:
+            db.close()
+    # Raden i webhook_outbox tas bort när leveransen lyckats
+    assert _wait_for(outbox_empty)
+
+
+def test_redelivery_survives_a_crash_before_enqueue(client, monkeypatch):
+    dead_letter_id = str(uuid.uuid4())
+    change = {"resource_type": "Group", "id": "group-1", "operation": "deleted", "subscription_id": "s"}
+    db = database.SessionLocal()
+    try:
+        db.add(database.WebhookDeadLetter(id=dead_letter_id, target="http://example.com/hook", attempts=6,
+                                          payload=json.dumps({"changes": [change]}), created=datetime.utcnow()))
+        db.commit()
+    finally:
+        db.close()
+
+    # Processen dör efter commit men innan leveransen köats i minnet
+    with monkeypatch.context() as m:
+        m.setattr(dispatcher, "enqueue", lambda deliveries: 0)
+        assert client.post(f"/subscriptions/deadLetters/{dead_letter_id}/redeliver").status_code == 200
+    assert client.delivered == []
+
+    assert dispatcher.recover() == 1
+    assert _wait_for(lambda: client.delivered)
+    assert client.delivered == [("http://example.com/hook", {"changes": [change]})]
@@ -0,0 +1,133 @@
+# tombstones.py
+import argparse
+import base64
+import json
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import and_, delete, event, inspect, or_, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, DeletedEntity, resource_type_of, upsert_rows
+
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get("TOMBSTONE_RETENTION_DAYS", "180"))
+TOMBSTONE_COMPACT_BATCH = int(os.environ.get("TOMBSTONE_COMPACT_BATCH", "5000"))
+
+
+def _entity_id(obj) -> Optional[str]:
+    key = inspect(obj).mapper.primary_key_from_instance(obj)
+    if len(key) != 1 or key[0] is None:
+        return None
+    return str(key[0])
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _write_tombstones(session, flush_context):
+    """
+    Skriver en tombstone i deletedEntities för varje borttagen resurs, i samma transaktion som
+    borttagningen. Återskapas ett ID tas dess tombstone bort. Massborttagningar med
+    query.delete() eller Core-satser passerar inte sessionen och måste skriva egna tombstones.
+    """
+    now = datetime.utcnow()
+    rows = {}
+    for obj in session.deleted:
+        resource_type = resource_type_of(obj, include_internal=True)
+        id = _entity_id(obj) if resource_type else None
+        if id:
+            rows[id] = {"id": id, "resource_type": resource_type, "deleted_at": now, "created": now, "modified": now}
+
+    recreated = set()
+    for obj in session.new:
+        if resource_type_of(obj, include_internal=True):
+            id = _entity_id(obj)
+            if id and id not in rows:
+                recreated.add(id)
+
+    conn = session.connection()
+    if rows:
+        # Ett ID som tas bort igen får ny tid, så att klienter som paginerar på meta.created ser det
+        upsert_rows(conn, DeletedEntity.__table__, list(rows.values()), ("id",),
+                    update=("resource_type", "deleted_at", "created", "modified"))
+    if recreated:
+        conn.execute(delete(DeletedEntity.__table__).where(DeletedEntity.__table__.c.id.in_(recreated)))
+
+
+def encode_page_token(created: datetime, id: str, resource_types: Optional[List[str]]) -> str:
+    payload = {"c": created.isoformat(), "i": id, "t": resource_types or []}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_page_token(token: str) -> Tuple[datetime, str, List[str]]:
+    """Avkodar en pageToken; ValueError om den inte kommer från encode_page_token."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return datetime.fromisoformat(payload["c"]), str(payload["i"]), list(payload["t"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Ogiltig pageToken") from e
+
+
+def tombstone_page(db: Session, created_after: Optional[datetime] = None, resource_types: Optional[List[str]] = None,
+                   limit: int = 100, page_token: Optional[str] = None) -> Tuple[List[DeletedEntity], Optional[str]]:
+    """
+    Nyckelbaserad paginering över tombstones i ordningen (created, id), så att varje sida är en
+    indexsökning oavsett hur långt in i listan klienten har kommit. Returnerar sidan och en
+    pageToken för nästa sida, eller None när listan är slut.
+    """
+    query = db.query(DeletedEntity)
+    if page_token:
+        last_created, last_id, resource_types = decode_page_token(page_token)
+        query = query.filter(or_(
+            DeletedEntity.created > last_created,
+            and_(DeletedEntity.created == last_created, DeletedEntity.id > last_id),
+        ))
+    elif created_after:
+        query = query.filter(DeletedEntity.created > created_after)
+    if resource_types:
+        query = query.filter(DeletedEntity.resource_type.in_(resource_types))
+
+    rows = query.order_by(DeletedEntity.created, DeletedEntity.id).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_page_token(rows[-1].created, rows[-1].id, resource_types)
+
+
+def compact_tombstones(bind, older_than_days: int = TOMBSTONE_RETENTION_DAYS, batch_size: int = TOMBSTONE_COMPACT_BATCH) -> int:
+    """
+    Tar bort tombstones äldre än older_than_days, i omgångar per resurstyp längs indexet
+    (resource_type, deleted_at) så att ingen omgång låser hela tabellen. Klienter som inte har
+    synkat sedan dess måste göra en full synkning.
+    """
+    table = DeletedEntity.__table__
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    removed = 0
+    with bind.connect() as conn:
+        resource_types = [row[0] for row in conn.execute(select(table.c.resource_type).distinct())]
+    for resource_type in resource_types:
+        while True:
+            with bind.begin() as conn:
+                ids = [row[0] for row in conn.execute(
+                    select(table.c.id)
+                    .where(table.c.resource_type == resource_type, table.c.deleted_at < cutoff)
+                    .limit(batch_size)
+                )]
+                if ids:
+                    conn.execute(delete(table).where(table.c.id.in_(ids)))
+            removed += len(ids)
+            if len(ids) < batch_size:
+                break
+    return removed
+
+
+if __name__ == "__main__":
+    from database import init_engine
+
+    parser = argparse.ArgumentParser(description="Underhåll av tombstones i deletedEntities.")
+    parser.add_argument("--compact", action="store_true", help="Ta bort gamla tombstones.")
+    parser.add_argument("--days", type=int, default=TOMBSTONE_RETENTION_DAYS, help="Behåll tombstones så här många dagar.")
+    args = parser.parse_args()
+
+    if not args.compact:
+        parser.error("Ange --compact")
+    count = compact_tombstones(init_engine(), args.days)
+    print(f"Tog bort {count} tombstones äldre än {args.days} dagar")
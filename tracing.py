@@ -0,0 +1,366 @@
+# tracing.py
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+from fastapi.routing import APIRoute
+
+import database
+from sqlstats import STATEMENT_OBSERVERS, statement_shape
+
+logger = logging.getLogger("ss12000.tracing")
+
+# console, file eller otlp; tomt värde stänger av spårningen helt
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "")
+TRACING_FILE = os.environ.get("TRACING_FILE", "traces.jsonl")
+# Andel nya spår som sparas; inkommande traceparent bestämmer själv
+TRACING_SAMPLE_RATIO = float(os.environ.get("TRACING_SAMPLE_RATIO", "1"))
+TRACING_QUEUE_SIZE = int(os.environ.get("TRACING_QUEUE_SIZE", "10000"))
+TRACING_BATCH_SIZE = int(os.environ.get("TRACING_BATCH_SIZE", "512"))
+# Samma variabler som OpenTelemetrys SDK läser
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "ss12000-server")
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT") or \
+    os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318").rstrip("/") + "/v1/traces"
+
+# Span-typer och statuskoder enligt OTLP
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns",
+                 "attributes", "error", "root", "handler_end_ns")
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, kind: int = INTERNAL,
+                 trace_id: Optional[str] = None, parent_id: Optional[str] = None, start_ns: Optional[int] = None):
+        self.trace_id = parent.trace_id if parent is not None else trace_id or f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent is not None else parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.end_ns = 0
+        self.attributes: Dict[str, object] = {}
+        self.error: Optional[str] = None
+        # Anropets serverspan, där hanteraren noterar när den är klar
+        self.root = parent.root if parent is not None else self
+        self.handler_end_ns = 0
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def end(self, end_ns: Optional[int] = None):
+        self.end_ns = time.time_ns() if end_ns is None else end_ns
+        tracer.export(self)
+
+    def otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id, "spanId": self.span_id, "name": self.name, "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns), "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return span
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+def current_span() -> Optional[Span]:
+    """Spannet som körs just nu, eller None om anropet inte spåras."""
+    return _current.get()
+
+
+def parse_traceparent(header: Optional[str]):
+    """(trace_id, parent_id, sampled) ur en W3C traceparent, eller None om den saknas eller är ogiltig."""
+    match = _TRACEPARENT.match(header.strip().lower()) if header else None
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == "ff" or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+# --- Spans i koden ---
+def _record_error(span: Span, error: BaseException):
+    # HTTPException med 4xx är ett svar till klienten, inte ett fel i servern
+    if getattr(error, "status_code", 500) >= 500:
+        span.error = repr(error)[:500]
+
+def traced(function: Optional[Callable] = None, *, name: Optional[str] = None):
+    """
+    Dekorator som lägger funktionen i ett eget span när anropet spåras. Utan pågående
+    spår anropas funktionen direkt, så kostnaden är en uppslagning i en ContextVar.
+    """
+    if function is None:
+        return functools.partial(traced, name=name)
+    span_name = name or function.__name__
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            parent = _current.get()
+            if parent is None:
+                return await function(*args, **kwargs)
+            span = Span(span_name, parent)
+            token = _current.set(span)
+            try:
+                return await function(*args, **kwargs)
+            except BaseException as e:
+                _record_error(span, e)
+                raise
+            finally:
+                _current.reset(token)
+                span.end()
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        parent = _current.get()
+        if parent is None:
+            return function(*args, **kwargs)
+        span = Span(span_name, parent)
+        token = _current.set(span)
+        try:
+            return function(*args, **kwargs)
+        except BaseException as e:
+            _record_error(span, e)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+    return wrapper
+
+
+def _handler(endpoint: Callable) -> Callable:
+    """Som traced, men noterar även när hanteraren är klar så att serialiseringen kan mätas för sig."""
+    traced_endpoint = traced(endpoint, name=f"handler {endpoint.__name__}")
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await traced_endpoint(*args, **kwargs)
+            finally:
+                _mark_handler_end()
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        try:
+            return traced_endpoint(*args, **kwargs)
+        finally:
+            _mark_handler_end()
+    return wrapper
+
+def _mark_handler_end():
+    span = _current.get()
+    if span is not None:
+        span.root.handler_end_ns = time.time_ns()
+
+
+class TracedRoute(APIRoute):
+    """Rutt vars hanterare körs i ett span. Sätts som app.router.route_class innan rutterna deklareras."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _handler(endpoint), **kwargs)
+
+
+def _observe_statement(statement: str, parameters, seconds: float, executemany: bool):
+    parent = _current.get()
+    if parent is None:
+        return
+    # Satsen är redan klar när lyssnaren anropas, så spannet får sin start i efterhand
+    end_ns = time.time_ns()
+    shape = statement_shape(statement)
+    operation = shape.split(" ", 1)[0].upper()
+    span = Span(operation, parent, CLIENT, start_ns=end_ns - int(seconds * 1_000_000_000))
+    engine = database.engine
+    span.attributes["db.system"] = engine.dialect.name if engine is not None else "unknown"
+    span.attributes["db.operation"] = operation
+    span.attributes["db.statement"] = shape[:2000]
+    span.end(end_ns)
+
+
+# --- Export ---
+def _resource_spans(spans: List[Span]) -> dict:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": OTEL_SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "ss12000.tracing"}, "spans": [span.otlp() for span in spans]}],
+    }]}
+
+def console_exporter(spans: List[Span]):
+    for span in spans:
+        sys.stderr.write(f"{span.trace_id} {span.span_id} {span.parent_id or '-':16} "
+                         f"{(span.end_ns - span.start_ns) / 1_000_000:9.2f} ms {span.name}"
+                         f"{' ERROR ' + span.error if span.error else ''}\n")
+
+def file_exporter(spans: List[Span], path: str = TRACING_FILE):
+    """En rad OTLP/JSON per omgång, formatet som collectorns otlpjsonfile-mottagare läser."""
+    with open(path, "a") as f:
+        f.write(json.dumps(_resource_spans(spans), ensure_ascii=False) + "\n")
+
+def otlp_exporter(spans: List[Span], url: str = OTEL_EXPORTER_OTLP_ENDPOINT):
+    """OTLP/HTTP med JSON-kodning direkt till en collector."""
+    body = json.dumps(_resource_spans(spans)).encode()
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=10):
+            pass
+    except urllib.error.URLError as e:
+        logger.warning("Kunde inte skicka %d spans till %s: %s", len(spans), url, e)
+
+EXPORTERS = {"console": console_exporter, "file": file_exporter, "otlp": otlp_exporter}
+
+
+class Tracer:
+    """
+    Samlar avslutade spans och exporterar dem i omgångar från en egen tråd, så att
+    anropen aldrig väntar på filen eller collectorn. Är kön full tappas spannet och räknas i dropped.
+    """
+
+    def __init__(self, exporter: Optional[str] = TRACING_EXPORTER, sample_ratio: float = TRACING_SAMPLE_RATIO,
+                 queue_size: int = TRACING_QUEUE_SIZE, batch_size: int = TRACING_BATCH_SIZE):
+        self.exporter = EXPORTERS[exporter] if exporter else None
+        self.sample_ratio = sample_ratio
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def sampled(self) -> bool:
+        return random.random() < self.sample_ratio
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if self._thread is not None or not self.enabled:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="tracing", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        # Töm kön även efter stop så att de sista anropens spans kommer med
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.exporter(batch)
+            except Exception:
+                logger.exception("Kunde inte exportera %d spans", len(batch))
+
+
+tracer = Tracer()
+if tracer.enabled:
+    STATEMENT_OBSERVERS.append(_observe_statement)
+
+
+class TracingMiddleware:
+    """
+    ASGI-middleware som skapar ett serverspan per anrop och fortsätter spåret från en inkommande
+    W3C traceparent. Svaret får traceresponse med spårets id. Tiden från att hanteraren är klar
+    till att svarshuvudena skickas (validering mot response_model och JSON) blir ett eget span.
+    """
+
+    def __init__(self, app, tracer: Tracer = tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                traceparent = parse_traceparent(value.decode("latin-1"))
+                break
+        if traceparent is not None:
+            trace_id, parent_id, sampled = traceparent
+        else:
+            trace_id, parent_id, sampled = None, None, self.tracer.sampled()
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+
+        span = Span(scope["method"], kind=SERVER, trace_id=trace_id, parent_id=parent_id)
+        span.attributes["http.request.method"] = scope["method"]
+        span.attributes["url.path"] = scope["path"]
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                span.attributes["http.response.status_code"] = status
+                if status >= 500:
+                    span.error = f"HTTP {status}"
+                if span.handler_end_ns:
+                    serialize = Span("serialize", span, start_ns=span.handler_end_ns)
+                    serialize.end()
+                message = {**message, "headers": [*message.get("headers", []), (b"traceresponse", span.traceparent().encode())]}
+            await send(message)
+
+        token = _current.set(span)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as e:
+            _record_error(span, e)
+            raise
+        finally:
+            _current.reset(token)
+            route = getattr(scope.get("route"), "path", None)
+            if route is not None:
+                span.name = f"{scope['method']} {route}"
+                span.attributes["http.route"] = route
+            span.end()
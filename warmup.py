@@ -0,0 +1,91 @@
+# warmup.py
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from database import SessionLocal, Organisation, Person, Activity, CalendarEvent, Duty, Group
+from helpers import apply_meta_filters, apply_time_filters
+from cache import REFERENCE_CACHES
+from partitions import calendar_event_partitions
+from aggregation import ensure_rollups
+from participation import ensure_participation
+from org_statistics import ensure_current
+
+logger = logging.getLogger("ss12000.warmup")
+
+WARMUP_CONNECTIONS = int(os.environ.get("WARMUP_CONNECTIONS", "5"))
+
+# Vanliga filterformer. Frågorna körs med LIMIT 0 så att SQLAlchemy kompilerar och
+# cachar satserna utan att några rader behöver hämtas.
+def _common_query_shapes(db):
+    now = datetime.utcnow()
+    return {
+        "organisations": db.query(Organisation).offset(0),
+        "organisations_modified": apply_meta_filters(db.query(Organisation), Organisation, None, None, None, now),
+        "persons": db.query(Person).order_by(Person.display_name.asc()).offset(0),
+        "persons_modified": apply_meta_filters(db.query(Person), Person, None, None, None, now).order_by(Person.display_name.asc()),
+        "duties": db.query(Duty).filter(Duty.organisation_id == "").offset(0),
+        "groups": db.query(Group).filter(Group.organisation_id.in_([""])).offset(0),
+        "activities": db.query(Activity).offset(0),
+        "calendarEvents": apply_time_filters(db.query(CalendarEvent), CalendarEvent, now, now + timedelta(days=7), None, None),
+    }
+
+def open_connections(engine, count: int = WARMUP_CONNECTIONS) -> int:
+    """Öppnar count anslutningar samtidigt så att poolen är fylld innan trafiken kommer."""
+    connections = []
+    try:
+        for _ in range(count):
+            conn = engine.connect()
+            conn.exec_driver_sql("SELECT 1")
+            connections.append(conn)
+    finally:
+        for conn in connections:
+            conn.close()
+    return len(connections)
+
+def prime_statement_cache() -> int:
+    db = SessionLocal()
+    try:
+        shapes = _common_query_shapes(db)
+        for name, query in shapes.items():
+            query.limit(0).all()
+        return len(shapes)
+    finally:
+        db.close()
+
+def preload_reference_caches() -> dict:
+    db = SessionLocal()
+    try:
+        return {name: cache.load(db) for name, cache in REFERENCE_CACHES.items()}
+    finally:
+        db.close()
+
+def current_statistics() -> bool:
+    return ensure_current(wait=True)
+
+def run_warmup(app, engine) -> dict:
+    """
+    Kör uppvärmningens steg i tur och ordning och returnerar tidsåtgången per steg.
+    Ett misslyckat steg loggas men stoppar inte resten av uppvärmningen.
+    """
+    steps = {
+        "connections": lambda: open_connections(engine),
+        "partitions": lambda: calendar_event_partitions.refresh(engine),
+        "statements": prime_statement_cache,
+        "openapi": lambda: len(app.openapi()["paths"]),
+        "reference_caches": preload_reference_caches,
+        "attendance_rollups": lambda: ensure_rollups(engine),
+        "participation": lambda: ensure_participation(engine),
+        "statistics": current_statistics,
+    }
+    profile = {}
+    for name, step in steps.items():
+        started = time.perf_counter()
+        try:
+            result = step()
+            profile[name] = {"ms": (time.perf_counter() - started) * 1000, "result": result}
+        except Exception:
+            logger.exception("Uppvärmningssteget '%s' misslyckades", name)
+            profile[name] = {"ms": (time.perf_counter() - started) * 1000, "error": True}
+    return profile
@@ -0,0 +1,420 @@
+# webhooks.py
+import argparse
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from changelog import DELETE, INSERT, UPDATE, Change, ChangeTailer
+from database import INTERNAL_MODELS, SessionLocal, Subscription, WebhookDeadLetter, WebhookOutbox
+
+logger = logging.getLogger("ss12000.webhooks")
+
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+WEBHOOK_TARGET_CONCURRENCY = int(os.environ.get("WEBHOOK_TARGET_CONCURRENCY", "2"))
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", "100"))
+WEBHOOK_BATCH_DELAY_MS = float(os.environ.get("WEBHOOK_BATCH_DELAY_MS", "200"))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_BACKOFF_SECONDS = float(os.environ.get("WEBHOOK_BACKOFF_SECONDS", "1"))
+WEBHOOK_MAX_BACKOFF_SECONDS = float(os.environ.get("WEBHOOK_MAX_BACKOFF_SECONDS", "300"))
+WEBHOOK_TIMEOUT_SECONDS = float(os.environ.get("WEBHOOK_TIMEOUT_SECONDS", "10"))
+
+# resource_id som matchar alla resurser av typen
+ALL_RESOURCES = ("", "*")
+
+# Transport: (url, kropp, headers) -> HTTP-status. Kan bytas ut, t.ex. mot en lokal testserver.
+Transport = Callable[[str, bytes, Dict[str, str]], int]
+
+# (mottagare, id i webhook_outbox, ändringen som den levereras)
+Delivery = Tuple[str, str, dict]
+
+
+def urllib_transport(url: str, body: bytes, headers: Dict[str, str]) -> int:
+    # urlopen läser även file:// och ftp://; prenumerationer sparade före valideringen stoppas här
+    if urlsplit(url).scheme not in ("http", "https"):
+        raise ValueError(f"Otillåtet schema i {url}")
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=WEBHOOK_TIMEOUT_SECONDS) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+class Batch:
+    def __init__(self, target: str, items: List[dict], attempts: int = 0, outbox_ids: List[str] = ()):
+        self.target = target
+        self.items = items
+        self.attempts = attempts
+        self.outbox_ids = list(outbox_ids)
+        self.last_error: Optional[str] = None
+
+    def payload(self) -> dict:
+        return {"changes": self.items}
+
+
+class _Target:
+    """Köer och pågående leveranser för en mottagar-URL."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.pending = deque() # (id i webhook_outbox, ändring)
+        self.first_pending_at: Optional[float] = None
+        self.retries = [] # heap av (förfallotid, löpnummer, Batch)
+        self.in_flight = 0
+
+
+class WebhookMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"changes_published": 0, "changes_matched": 0, "batches_sent": 0, "deliveries_succeeded": 0,
+                         "deliveries_failed": 0, "retries_scheduled": 0, "dead_lettered": 0}
+        self.delivery_seconds_total = 0.0
+
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.delivery_seconds_total += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            sent = self.counters["batches_sent"]
+            return dict(self.counters, delivery_seconds_total=self.delivery_seconds_total,
+                        delivery_seconds_avg=self.delivery_seconds_total / sent if sent else None)
+
+
+class WebhookDispatcher:
+    """
+    Levererar ändringar till prenumeranter. Ändringar matchas mot prenumerationerna på resource_type
+    (och resource_id om den inte är "*"), samlas per mottagar-URL och skickas i omgångar av en pool
+    med arbetstrådar. Varje mottagare har högst target_concurrency pågående leveranser. Misslyckade
+    omgångar försöks igen med exponentiell backoff och hamnar i webhook_dead_letters efter max_attempts.
+
+    Matchade leveranser sparas först i webhook_outbox (stage) och köas i minnet efter commit
+    (enqueue). De tas bort ur webhook_outbox när de levererats eller blivit dead letters, så
+    leveranser som inte hann skickas före en krasch köas igen av recover().
+    """
+
+    def __init__(self, transport: Transport = urllib_transport, workers: int = WEBHOOK_WORKERS,
+                 target_concurrency: int = WEBHOOK_TARGET_CONCURRENCY, batch_size: int = WEBHOOK_BATCH_SIZE,
+                 batch_delay_ms: float = WEBHOOK_BATCH_DELAY_MS, max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+                 backoff_seconds: float = WEBHOOK_BACKOFF_SECONDS, max_backoff_seconds: float = WEBHOOK_MAX_BACKOFF_SECONDS):
+        self.transport = transport
+        self.workers = workers
+        self.target_concurrency = target_concurrency
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay_ms / 1000
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.metrics = WebhookMetrics()
+        self._targets: Dict[str, _Target] = {}
+        self._subscriptions: Optional[List[tuple]] = None
+        self._queued: Set[str] = set() # id:n i webhook_outbox som finns i minnet
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._scheduler: Optional[threading.Thread] = None
+        self._stopping = False
+
+    # --- Prenumerationer ---
+    def invalidate_subscriptions(self):
+        self._subscriptions = None
+
+    def _load_subscriptions(self) -> List[tuple]:
+        subscriptions = self._subscriptions
+        if subscriptions is None:
+            db = SessionLocal()
+            try:
+                subscriptions = [
+                    (s.id, s.resource_type, s.resource_id, s.target)
+                    for s in db.query(Subscription.id, Subscription.resource_type, Subscription.resource_id, Subscription.target)
+                    .filter(Subscription.target.is_not(None))
+                ]
+            finally:
+                db.close()
+            self._subscriptions = subscriptions
+        return subscriptions
+
+    def match(self, change: dict) -> List[tuple]:
+        """(subscription_id, target) för prenumerationerna som ändringen ska levereras till."""
+        return [
+            (subscription_id, target)
+            for subscription_id, resource_type, resource_id, target in self._load_subscriptions()
+            if resource_type == change["resource_type"] and (resource_id in ALL_RESOURCES or resource_id == change["id"])
+        ]
+
+    # --- Publicering ---
+    def stage(self, db: Session, changes: List[dict]) -> List[Delivery]:
+        """Matchar ändringarna och sparar leveranserna i webhook_outbox i db:s transaktion."""
+        if not changes:
+            return []
+        self.metrics.add("changes_published", len(changes))
+        deliveries = [(target, str(uuid.uuid4()), dict(change, subscription_id=subscription_id))
+                      for change in changes for subscription_id, target in self.match(change)]
+        if deliveries:
+            self._save(db, deliveries)
+            self.metrics.add("changes_matched", len(deliveries))
+        return deliveries
+
+    def _save(self, db: Session, deliveries: List[Delivery]):
+        now = datetime.utcnow()
+        db.execute(WebhookOutbox.__table__.insert(), [
+            {"id": id, "target": target, "item": json.dumps(item, default=str), "created": now}
+            for target, id, item in deliveries
+        ])
+
+    def enqueue(self, deliveries: List[Delivery]) -> int:
+        """Köar sparade leveranser i minnet. Leveranser som redan finns i kön hoppas över."""
+        now = time.monotonic()
+        queued = 0
+        with self._condition:
+            for target, id, item in deliveries:
+                if id in self._queued:
+                    continue
+                self._queued.add(id)
+                state = self._targets.get(target)
+                if state is None:
+                    state = self._targets[target] = _Target(target)
+                if not state.pending:
+                    state.first_pending_at = now
+                state.pending.append((id, item))
+                queued += 1
+            self._condition.notify_all()
+        return queued
+
+    def recover(self) -> int:
+        """Köar leveranser som finns kvar i webhook_outbox, t.ex. efter en krasch eller när en annan process slutat läsa."""
+        self.invalidate_subscriptions()
+        db = SessionLocal()
+        try:
+            rows = db.query(WebhookOutbox.id, WebhookOutbox.target, WebhookOutbox.item).order_by(WebhookOutbox.created).all()
+        finally:
+            db.close()
+        queued = self.enqueue([(row.target, row.id, json.loads(row.item)) for row in rows])
+        if queued:
+            logger.info("Köade %d leveranser från webhook_outbox", queued)
+        return queued
+
+    def _forget(self, db: Session, batch: Batch):
+        # Körs i anroparens transaktion; id:n släpps ur minnet först efter commit
+        if batch.outbox_ids:
+            table = WebhookOutbox.__table__
+            db.execute(delete(table).where(table.c.id.in_(batch.outbox_ids)))
+
+    def _forgotten(self, batch: Batch):
+        with self._condition:
+            self._queued.difference_update(batch.outbox_ids)
+
+    # --- Schemaläggning ---
+    def start(self):
+        with self._condition:
+            if self._scheduler is not None:
+                return
+            self._stopping = False
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="webhook")
+            self._scheduler = threading.Thread(target=self._run, name="webhook-scheduler", daemon=True)
+            self._scheduler.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        with self._condition:
+            if self._scheduler is None:
+                return
+            self._stopping = True
+            self._condition.notify_all()
+            scheduler = self._scheduler
+        scheduler.join(timeout)
+        self._executor.shutdown(wait=True)
+        with self._condition:
+            self._scheduler = None
+            self._executor = None
+
+    def _next_batch(self, state: _Target, now: float) -> Optional[Batch]:
+        if state.retries and state.retries[0][0] <= now:
+            return heapq.heappop(state.retries)[2]
+        if state.pending and (len(state.pending) >= self.batch_size or now - state.first_pending_at >= self.batch_delay or self._stopping):
+            entries = [state.pending.popleft() for _ in range(min(self.batch_size, len(state.pending)))]
+            state.first_pending_at = now if state.pending else None
+            return Batch(state.url, [item for _, item in entries], outbox_ids=[id for id, _ in entries])
+        return None
+
+    def _next_due(self, state: _Target) -> Optional[float]:
+        due = []
+        if state.retries:
+            due.append(state.retries[0][0])
+        if state.pending:
+            due.append(state.first_pending_at + self.batch_delay)
+        return min(due) if due else None
+
+    def _run(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wake = now + 1.0
+                for state in list(self._targets.values()):
+                    while state.in_flight < self.target_concurrency:
+                        batch = self._next_batch(state, now)
+                        if batch is None:
+                            break
+                        state.in_flight += 1
+                        self._executor.submit(self._deliver, state, batch)
+                    due = self._next_due(state)
+                    if due is not None and state.in_flight < self.target_concurrency:
+                        wake = min(wake, due)
+                    if not state.pending and not state.retries and not state.in_flight:
+                        del self._targets[state.url]
+                if self._stopping and not any(s.pending for s in self._targets.values()):
+                    # Omgångar som väntar på nytt försök sparas som dead letters i stället för att gå förlorade
+                    for state in self._targets.values():
+                        for _, _, batch in state.retries:
+                            self._dead_letter(batch)
+                        state.retries = []
+                    return
+                self._condition.wait(max(0.0, wake - time.monotonic()))
+
+    # --- Leverans ---
+    def _deliver(self, state: _Target, batch: Batch):
+        body = json.dumps(batch.payload(), default=str).encode("utf-8")
+        headers = {"Content-Type": "application/json", "X-SS12000-Delivery": str(uuid.uuid4()),
+                   "X-SS12000-Attempt": str(batch.attempts + 1)}
+        started = time.perf_counter()
+        try:
+            status = self.transport(batch.target, body, headers)
+            error = None if 200 <= status < 300 else f"HTTP {status}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        self.metrics.observe(time.perf_counter() - started)
+        self.metrics.add("batches_sent")
+
+        if error is None:
+            self.metrics.add("deliveries_succeeded")
+            self._delivered(batch)
+        else:
+            self.metrics.add("deliveries_failed")
+            batch.attempts += 1
+            batch.last_error = error
+            if batch.attempts >= self.max_attempts or self._stopping:
+                self._dead_letter(batch)
+            else:
+                delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (batch.attempts - 1)) * random.uniform(0.5, 1.0)
+                with self._condition:
+                    self._sequence += 1
+                    heapq.heappush(state.retries, (time.monotonic() + delay, self._sequence, batch))
+                self.metrics.add("retries_scheduled")
+                logger.info("Leverans till %s misslyckades (%s), nytt försök om %.1f s", batch.target, error, delay)
+
+        with self._condition:
+            state.in_flight -= 1
+            self._targets.setdefault(state.url, state)
+            self._condition.notify_all()
+
+    def _delivered(self, batch: Batch):
+        if not batch.outbox_ids:
+            return
+        db = SessionLocal()
+        try:
+            self._forget(db, batch)
+            db.commit()
+        except Exception:
+            # Raderna finns kvar och levereras igen av recover(), vilket mottagaren måste tåla ändå
+            logger.exception("Kunde inte ta bort levererade ändringar till %s ur webhook_outbox", batch.target)
+        else:
+            self._forgotten(batch)
+        finally:
+            db.close()
+
+    def _dead_letter(self, batch: Batch):
+        self.metrics.add("dead_lettered")
+        logger.warning("Leverans till %s gav upp efter %d försök: %s", batch.target, batch.attempts, batch.last_error)
+        db = SessionLocal()
+        try:
+            db.add(WebhookDeadLetter(
+                id=str(uuid.uuid4()), target=batch.target, payload=json.dumps(batch.payload(), default=str),
+                attempts=batch.attempts, last_error=batch.last_error,
+            ))
+            self._forget(db, batch)
+            db.commit()
+        except Exception:
+            logger.exception("Kunde inte spara dead letter för %s", batch.target)
+        else:
+            self._forgotten(batch)
+        finally:
+            db.close()
+
+    def redeliver(self, db: Session, dead_letter: WebhookDeadLetter) -> List[Delivery]:
+        """
+        Sparar en dead letters ändringar i webhook_outbox i db:s transaktion, som anroparen
+        committar tillsammans med att dead lettern tas bort. Köas med enqueue efter commit.
+        """
+        deliveries = [(dead_letter.target, str(uuid.uuid4()), item) for item in json.loads(dead_letter.payload)["changes"]]
+        if deliveries:
+            self._save(db, deliveries)
+        return deliveries
+
+
+dispatcher = WebhookDispatcher()
+
+
+# Ändringsloggens operationer heter som i notiserna
+OPERATIONS = {INSERT: "created", UPDATE: "updated", DELETE: "deleted"}
+
+def _stage_changes(changes: List[Change], db: Session):
+    if any(change.resource_type == "Subscription" for change in changes):
+        dispatcher.invalidate_subscriptions()
+    deliveries = dispatcher.stage(db, [
+        {"resource_type": change.resource_type, "id": change.resource_id,
+         "operation": OPERATIONS[change.operation], "timestamp": change.created.isoformat()}
+        for change in changes if change.resource_type not in INTERNAL_MODELS
+    ])
+    # Köas i minnet först när leveranserna och markören är committade
+    return lambda: dispatcher.enqueue(deliveries)
+
+# Följer ändringsloggen med en sparad markör, så ändringar som committas medan servern är nere
+# levereras efter omstart. Med flera arbetsprocesser läser bara den som hyr markören, så varje
+# ändring levereras en gång. Startas efter dispatcher.
+change_tailer = ChangeTailer("webhooks", _stage_changes, with_session=True, on_lease=dispatcher.recover)
+
+
+def run_stand_in(port: int, fail_rate: float = 0.0):
+    """Enkel lokal mottagare för test: loggar varje omgång och svarar 500 med sannolikheten fail_rate."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+            status = 500 if random.random() < fail_rate else 204
+            changes = json.loads(body or b"{}").get("changes", [])
+            print(f"{datetime.now().isoformat()} {self.path} försök {self.headers.get('X-SS12000-Attempt')}: {len(changes)} ändringar -> {status}", flush=True)
+            self.send_response(status)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lokal mottagare för att testa webhook-leveranser.")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Andel omgångar som besvaras med 500.")
+    args = parser.parse_args()
+    print(f"Tar emot leveranser på http://127.0.0.1:{args.port}/")
+    run_stand_in(args.port, args.fail_rate)
@@ -0,0 +1,222 @@
+# writebehind.py
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Attendance, upsert_rows
+from aggregation import apply_attendance_deltas
+from changelog import INSERT, UPDATE, activity_organisations, append_changes
+
+logger = logging.getLogger("ss12000.writebehind")
+
+ATTENDANCE_BATCH_ROWS = int(os.environ.get("ATTENDANCE_BATCH_ROWS", "500"))
+ATTENDANCE_BATCH_DELAY_MS = float(os.environ.get("ATTENDANCE_BATCH_DELAY_MS", "5"))
+ATTENDANCE_MAX_PENDING_ROWS = int(os.environ.get("ATTENDANCE_MAX_PENDING_ROWS", "20000"))
+
+REGISTRATION_KEY = ("calendar_event_id", "person_id")
+INSERTED_COLUMNS = ["id", "person_id", "activity_id", "calendar_event_id", "attendance_event_id", "created", "modified"]
+UPDATED_COLUMNS = ["activity_id", "attendance_event_id", "modified"]
+
+
+class WriterBusy(Exception):
+    """Kön är full; klienten bör försöka igen senare."""
+
+
+def write_attendance(db: Session, rows: List[dict]) -> int:
+    """
+    Skriver närvaroregistreringar med flerradiga UPSERT-satser på (calendar_event_id, person_id)
+    och uppdaterar närvarosummorna och ändringsloggen i samma transaktion. Vid dubbletter gäller
+    den sista raden.
+
+    Nya rader läggs först in med INSERT som ignorerar befintliga nycklar, och därefter läses och
+    låses alla registreringarna med SELECT ... FOR UPDATE. En rad med vårt id lades alltså in av
+    oss; övriga fanns redan och skrivs över. Summorna räknas på det som faktiskt skrevs, så två
+    samtidiga registreringar av samma person räknas inte dubbelt.
+    """
+    latest = {tuple(row[k] for k in REGISTRATION_KEY): row for row in rows}
+    if not latest:
+        return 0
+
+    table = Attendance.__table__
+    conn = db.connection()
+    now = datetime.utcnow()
+    ids = {key: str(uuid.uuid4()) for key in latest}
+    upsert_rows(conn, table, [
+        {"id": ids[key], "person_id": row["person_id"], "activity_id": row["activity_id"],
+         "calendar_event_id": row["calendar_event_id"], "attendance_event_id": row["attendance_event_id"],
+         "created": now, "modified": now}
+        for key, row in latest.items()
+    ], REGISTRATION_KEY)
+
+    current = {}
+    for row in db.execute(
+        select(table.c.id, table.c.calendar_event_id, table.c.person_id, table.c.activity_id,
+               table.c.attendance_event_id, table.c.created)
+        .where(table.c.calendar_event_id.in_({key[0] for key in latest}), table.c.person_id.in_({key[1] for key in latest}))
+        .order_by(table.c.calendar_event_id, table.c.person_id)
+        .with_for_update()
+    ):
+        current[(row.calendar_event_id, row.person_id)] = row
+
+    updates = []
+    deltas = []
+    logged = []
+    for key, row in latest.items():
+        old = current[key]
+        if old.id == ids[key]:
+            deltas.append((1, row["person_id"], row["activity_id"], row["attendance_event_id"], row["calendar_event_id"], now))
+            logged.append((old.id, INSERT, row["activity_id"]))
+            continue
+        if (old.activity_id, old.attendance_event_id) == (row["activity_id"], row["attendance_event_id"]):
+            continue
+        deltas.append((-1, old.person_id, old.activity_id, old.attendance_event_id, old.calendar_event_id, old.created))
+        deltas.append((1, row["person_id"], row["activity_id"], row["attendance_event_id"], row["calendar_event_id"], old.created))
+        logged.append((old.id, UPDATE, row["activity_id"]))
+        updates.append({
+            "id": old.id,
+            "person_id": row["person_id"],
+            "activity_id": row["activity_id"],
+            "calendar_event_id": row["calendar_event_id"],
+            "attendance_event_id": row["attendance_event_id"],
+            "created": old.created,
+            "modified": now,
+        })
+
+    upsert_rows(conn, table, updates, REGISTRATION_KEY, update=tuple(UPDATED_COLUMNS))
+    apply_attendance_deltas(db, deltas)
+    # Core-satserna passerar inte sessionen, så ändringarna loggas här
+    organisations = activity_organisations(conn, (activity_id for _, _, activity_id in logged))
+    append_changes(conn, [
+        ("Attendance", id, operation, UPDATED_COLUMNS if operation == UPDATE else INSERTED_COLUMNS, organisations.get(activity_id))
+        for id, operation, activity_id in logged
+    ])
+    return len(logged)
+
+
+class AttendanceWriter:
+    """
+    Samlar närvaroregistreringar i en kö i processen och skriver dem i omgångar om högst
+    max_batch_rows rader, eller efter max_delay_ms millisekunder. submit() returnerar en Future
+    som blir klar först när raderna är committade, så ett svar till klienten betyder att
+    registreringen är sparad. När kön är full kastas WriterBusy i stället för att vänta.
+    """
+
+    def __init__(self, max_batch_rows: int = ATTENDANCE_BATCH_ROWS, max_delay_ms: float = ATTENDANCE_BATCH_DELAY_MS,
+                 max_pending_rows: int = ATTENDANCE_MAX_PENDING_ROWS):
+        self.max_batch_rows = max_batch_rows
+        self.max_delay = max_delay_ms / 1000
+        self.max_pending_rows = max_pending_rows
+        self.batches = 0
+        self.rows_written = 0
+        self.failures = 0
+        self._pending = deque()
+        self._pending_rows = 0
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    @property
+    def pending_rows(self) -> int:
+        return self._pending_rows
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="attendance-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stoppar skrivtråden efter att kön har tömts."""
+        with self._condition:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._condition.notify_all()
+            thread = self._thread
+        thread.join(timeout)
+        with self._condition:
+            self._thread = None
+
+    def submit(self, rows: List[dict]) -> Future:
+        future = Future()
+        if not rows:
+            future.set_result(0)
+            return future
+        with self._condition:
+            if self._thread is None or self._stopping:
+                raise RuntimeError("Skrivkön är inte startad")
+            if self._pending_rows + len(rows) > self.max_pending_rows:
+                raise WriterBusy()
+            self._pending.append((rows, future))
+            self._pending_rows += len(rows)
+            self._condition.notify_all()
+        return future
+
+    def _take_batch(self):
+        with self._condition:
+            while not self._pending and not self._stopping:
+                self._condition.wait()
+            if not self._pending:
+                return None
+
+            # Vänta in fler rader tills omgången är full eller fördröjningen har gått ut
+            deadline = time.monotonic() + self.max_delay
+            while self._pending_rows < self.max_batch_rows and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch = []
+            batch_rows = 0
+            while self._pending and (not batch or batch_rows + len(self._pending[0][0]) <= self.max_batch_rows):
+                rows, future = self._pending.popleft()
+                batch.append((rows, future))
+                batch_rows += len(rows)
+            self._pending_rows -= batch_rows
+            return batch
+
+    def _write(self, batch) -> None:
+        db = SessionLocal()
+        try:
+            written = write_attendance(db, [row for rows, _ in batch for row in rows])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if len(batch) > 1:
+                # Skriv förfrågningarna var för sig så att bara den felaktiga misslyckas
+                for item in batch:
+                    self._write([item])
+                return
+            self.failures += 1
+            logger.exception("Kunde inte skriva %d närvaroregistreringar", len(batch[0][0]))
+            batch[0][1].set_exception(e)
+            return
+        finally:
+            db.close()
+
+        self.batches += 1
+        self.rows_written += written
+        for rows, future in batch:
+            future.set_result(len(rows))
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._write(batch)
+
+
+attendance_writer = AttendanceWriter()